@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# test_crypto_executor.py
+# Copyright (C) 2017 LEAP Encryption Acess Project
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Throughput of the crypto executors for a growing number of workers.
+
+Each round runs a batch of decryptions through the same functions used by
+leap.bitmask.keymanager.openpgp, in a pool of threads or in a pool of
+processes, so the results show how the crypto work scales across cores.
+"""
+
+import multiprocessing
+import pytest
+
+from multiprocessing.pool import ThreadPool
+
+from leap.bitmask.keymanager.executor import _init_worker
+from leap.bitmask.keymanager.executor import WorkerKeyring
+from leap.bitmask.keymanager.openpgp import _decrypt
+
+from common import CIPHERTEXT
+
+
+BATCH_SIZE = 16
+
+
+def _dec(keyring):
+    result = _decrypt(keyring, CIPHERTEXT, always_trust=True)
+    assert result.ok
+    return len(result.data)
+
+
+def create_test(mode, workers):
+
+    @pytest.mark.benchmark(group='executor %s' % mode)
+    def test(benchmark, openpgp_keys):
+        keyring = WorkerKeyring(openpgp_keys[2])  # this is PRIVATE_KEY
+        if mode == 'process':
+            pool = multiprocessing.Pool(workers, initializer=_init_worker)
+        else:
+            pool = ThreadPool(workers)
+        # warm the keyrings up, so only the crypto work is measured
+        pool.map(_dec, [keyring] * workers)
+        try:
+            benchmark(pool.map, _dec, [keyring] * BATCH_SIZE)
+        finally:
+            pool.close()
+            pool.join()
+
+    return test
+
+
+test_thread_1_worker = create_test('thread', 1)
+test_thread_2_workers = create_test('thread', 2)
+test_thread_4_workers = create_test('thread', 4)
+
+test_process_1_worker = create_test('process', 1)
+test_process_2_workers = create_test('process', 2)
+test_process_4_workers = create_test('process', 4)
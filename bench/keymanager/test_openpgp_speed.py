@@ -25,6 +25,7 @@ import pytest
 from functools import partial
 
 from gnupg import GPG
+from leap.bitmask.keymanager.wrapper import GPGKeyringPool
 from leap.bitmask.keymanager.wrapper import TempGPGWrapper
 
 from common import CIPHERTEXT
@@ -182,12 +183,31 @@ def gpg_enc(res):
     assert len(ciphertext.data)
 
 
+def pool_init(tmpdir, benchmark, openpgp_keys, monkeypatch, _):
+    pubkey = openpgp_keys[0]
+    privkey = openpgp_keys[2]
+    pool = GPGKeyringPool(basedir=str(tmpdir))
+    # warm the pool up, so only keyring reuse is measured
+    with pool.keyring([pubkey, privkey]):
+        pass
+    return pool, pubkey, privkey
+
+
+def pool_exec(fun, res):
+    pool, pubkey, privkey = res
+    with pool.keyring([pubkey, privkey]) as gpg:
+        fun((gpg, pubkey, privkey))
+
+
 test_gpg_init_enc = create_test(
     partial(gpg_init_exec, gpg_enc),
     group=GROUP_INIT_AND_CRYPTO)
 test_wrapper_init_enc = create_test(
     partial(wrapper_init_exec, gpg_enc),
     group=GROUP_INIT_AND_CRYPTO)
+test_pool_init_enc = create_test(
+    partial(pool_exec, gpg_enc), init=pool_init,
+    group=GROUP_INIT_AND_CRYPTO)
 
 
 #
@@ -207,6 +227,9 @@ test_gpg_init_dec = create_test(
 test_wrapper_init_dec = create_test(
     partial(wrapper_init_exec, gpg_dec),
     group=GROUP_INIT_AND_CRYPTO)
+test_pool_init_dec = create_test(
+    partial(pool_exec, gpg_dec), init=pool_init,
+    group=GROUP_INIT_AND_CRYPTO)
 
 
 #
@@ -229,6 +252,9 @@ test_gpg_init_sign = create_test(
 test_wrapper_init_sign = create_test(
     partial(wrapper_init_exec, gpg_sign),
     group=GROUP_INIT_AND_CRYPTO)
+test_pool_init_sign = create_test(
+    partial(pool_exec, gpg_sign), init=pool_init,
+    group=GROUP_INIT_AND_CRYPTO)
 
 
 #
@@ -247,6 +273,9 @@ test_gpg_init_verify = create_test(
 test_wrapper_init_verify = create_test(
     partial(wrapper_init_exec, gpg_verify),
     group=GROUP_INIT_AND_CRYPTO)
+test_pool_init_verify = create_test(
+    partial(pool_exec, gpg_verify), init=pool_init,
+    group=GROUP_INIT_AND_CRYPTO)
 
 
 #
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# test_walk_speed.py
+# Copyright (C) 2018 LEAP Encryption Acess Project
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarking for splitting incoming messages into documents.
+
+Each round walks the whole corpus of sample messages used by the mail tests,
+either in a single pass or with the separate walks (and the re-serialization
+to compute the size) that the soledad adaptor used before.
+"""
+
+import glob
+import os.path
+import pytest
+
+from email.parser import Parser
+
+from leap.bitmask.mail import walk
+
+
+_here = os.path.dirname(__file__)
+CORPUS_DIR = os.path.join(_here, '..', '..', 'tests', 'integration', 'mail')
+
+_parser = Parser()
+
+
+@pytest.fixture
+def corpus():
+    messages = []
+    for filename in sorted(glob.glob(os.path.join(CORPUS_DIR, '*.message'))):
+        with open(filename) as f:
+            messages.append(f.read())
+    assert messages
+    return messages
+
+
+def _split_in_several_passes(raw):
+    msg = _parser.parsestr(raw)
+    size = len(msg.as_string())
+    tree = walk.get_tree(msg)
+    cdocs = list(walk.get_raw_docs(msg))
+    body_phash = walk.get_body_phash(msg)
+    return size, tree, cdocs, body_phash
+
+
+def _split_in_one_pass(raw):
+    msg = _parser.parsestr(raw)
+    tree, cdocs, body_phash = walk.walk_message(msg)
+    return len(raw), tree, cdocs, body_phash
+
+
+def _split_corpus(split, corpus):
+    return [split(raw) for raw in corpus]
+
+
+@pytest.mark.benchmark(group='walk')
+def test_walk_several_passes(benchmark, corpus):
+    benchmark(_split_corpus, _split_in_several_passes, corpus)
+
+
+@pytest.mark.benchmark(group='walk')
+def test_walk_one_pass(benchmark, corpus):
+    benchmark(_split_corpus, _split_in_one_pass, corpus)
@@ -24,25 +24,77 @@ import os
 import urllib
 
 from leap.common.files import get_mtime
+from leap.common.http import DEFAULT_HTTP_TIMEOUT, _HTTPConnectionPool
 
 from twisted.logger import Logger
 from twisted.internet import defer, protocol, reactor
 from twisted.internet.ssl import Certificate
 from twisted.python.filepath import FilePath
-from twisted.web.client import Agent, CookieAgent
+from twisted.web.client import Agent, CookieAgent, ResponseDone
 from twisted.web.client import BrowserLikePolicyForHTTPS
+from twisted.web.http import PotentialDataLoss
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
 from zope.interface import implements
 
+from leap.bitmask.system import IS_WIN
 
-log = Logger()
 
+log = Logger()
 
-def cookieAgentFactory(verify_path, connectTimeout=30):
+# limits for the persistent connections to a provider
+MAX_PERSISTENT_PER_HOST = 5
+IDLE_TIMEOUT = 120  # seconds
+
+_pools = {}
+
+
+def getConnectionPool(ca_cert_path, timeout=DEFAULT_HTTP_TIMEOUT):
+    """
+    Get the persistent connection pool shared by all the clients that talk to
+    a provider: the bonafide sessions, the provider configuration downloads
+    and the nicknym client.
+
+    All the connections to a provider are verified against its CA
+    certificate, so the path to that certificate identifies the provider.
+
+    :param ca_cert_path: the path to the CA certificate of the provider.
+    :type ca_cert_path: str
+    :param timeout: the timeout for the requests, in seconds. Only used
+                    when the pool is created.
+    :type timeout: float
+    :rtype: twisted.web.client.HTTPConnectionPool
+    """
+    pool = _pools.get(ca_cert_path)
+    if pool is None:
+        if not _pools:
+            reactor.addSystemEventTrigger(
+                'before', 'shutdown', closeConnectionPools)
+        pool = _HTTPConnectionPool(
+            reactor, persistent=True, timeout=timeout,
+            maxPersistentPerHost=MAX_PERSISTENT_PER_HOST)
+        pool.cachedConnectionTimeout = IDLE_TIMEOUT
+        _pools[ca_cert_path] = pool
+    return pool
+
+
+def closeConnectionPools():
+    """
+    Close the cached connections of all the provider pools.
+
+    :rtype: Deferred
+    """
+    pools = _pools.values()
+    _pools.clear()
+    return defer.gatherResults(
+        [pool.closeCachedConnections() for pool in pools])
+
+
+def cookieAgentFactory(verify_path, connectTimeout=30, pool=None):
     customPolicy = BrowserLikePolicyForHTTPS(
         Certificate.loadPEM(FilePath(verify_path).getContent()))
-    agent = Agent(reactor, customPolicy, connectTimeout=connectTimeout)
+    agent = Agent(reactor, customPolicy, connectTimeout=connectTimeout,
+                  pool=pool)
     cookiejar = cookielib.CookieJar()
     return CookieAgent(agent, cookiejar)
 
@@ -85,28 +137,17 @@ def httpRequest(agent, url, values=None, headers=None,
 
     def handle_response(response):
         log.debug("RESPONSE %s %s %s" % (method, response.code, url))
-        if response.code == 204:
-            d = defer.succeed('')
-        elif response.code == 401:
+        if response.code == 401:
             raise Forbidden()
         if saveto and mtime and response.code == 304:
             log.debug('304 (Not modified): %s' % url)
             raise Unchanged()
+
+        d = defer.Deferred()
+        if saveto:
+            response.deliverBody(_FileReceiver(d, saveto))
         else:
-            class SimpleReceiver(protocol.Protocol):
-                def __init__(s, d):
-                    s.buf = ''
-                    s.d = d
-
-                def dataReceived(s, data):
-                    s.buf += data
-
-                def connectionLost(s, reason):
-                    # TODO: test if reason is twisted.web.client.ResponseDone,
-                    # if not, do an errback
-                    s.d.callback(s.buf)
-            d = defer.Deferred()
-            response.deliverBody(SimpleReceiver(d))
+            response.deliverBody(_BodyReceiver(d))
         return d
 
     def passthru(failure):
@@ -116,19 +157,72 @@ def httpRequest(agent, url, values=None, headers=None,
                       StringProducer(data) if data else None)
     d.addCallback(handle_response)
     if saveto:
-        d.addCallback(lambda body: _write_to_file(body, saveto))
         d.addErrback(passthru)
     return d
 
 
-def _write_to_file(content, path):
-    folder = os.path.split(path)[0]
-    if not os.path.isdir(folder):
-        os.makedirs(folder)
-    with open(path, 'w') as f:
-        f.write(content)
-    # touch it to update its utime
-    os.utime(path, None)
+def _body_is_complete(reason):
+    # bodies without a content-length end with a PotentialDataLoss
+    return reason.check(ResponseDone, PotentialDataLoss) is not None
+
+
+class _BodyReceiver(protocol.Protocol):
+    """
+    Collect the body of a response as a list of chunks, that are joined once
+    the whole body has been received.
+    """
+
+    def __init__(self, finished):
+        self._finished = finished
+        self._chunks = []
+
+    def dataReceived(self, data):
+        self._chunks.append(data)
+
+    def connectionLost(self, reason):
+        if _body_is_complete(reason):
+            self._finished.callback(''.join(self._chunks))
+        else:
+            self._finished.errback(reason)
+
+
+class _FileReceiver(protocol.Protocol):
+    """
+    Stream the body of a response to a file.
+
+    The body is written to a temporary file next to the destination, which
+    replaces it only once the whole body has been received.
+    """
+
+    def __init__(self, finished, path):
+        self._finished = finished
+        self._path = path
+        self._tmp_path = path + '.part'
+        folder = os.path.split(path)[0]
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self._file = open(self._tmp_path, 'wb')
+
+    def dataReceived(self, data):
+        self._file.write(data)
+
+    def connectionLost(self, reason):
+        self._file.close()
+        if not _body_is_complete(reason):
+            os.remove(self._tmp_path)
+            self._finished.errback(reason)
+            return
+        try:
+            if IS_WIN and os.path.isfile(self._path):
+                # rename does not replace existing files on windows
+                os.remove(self._path)
+            os.rename(self._tmp_path, self._path)
+            # touch it to update its utime
+            os.utime(self._path, None)
+        except OSError:
+            self._finished.errback()
+        else:
+            self._finished.callback(None)
 
 
 class StringProducer(object):
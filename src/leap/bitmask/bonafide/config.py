@@ -36,7 +36,7 @@ from twisted.internet import defer
 from twisted.logger import Logger
 from twisted.web.client import downloadPage
 
-from leap.bitmask.bonafide._http import httpRequest
+from leap.bitmask.bonafide._http import httpRequest, getConnectionPool
 from leap.bitmask.bonafide.errors import NotConfiguredError, NetworkError
 from leap.bitmask.bonafide.provider import Discovery
 from leap.bitmask.bonafide.session import Session
@@ -204,7 +204,7 @@ class Provider(object):
         is_configured = self.is_configured()
         if not cert_path and is_configured:
             cert_path = self._get_ca_cert_path()
-        self._http = HTTPClient(cert_path)
+        self._http = _get_http_client(cert_path)
 
         self._load_provider_json()
 
@@ -370,7 +370,7 @@ class Provider(object):
         return d
 
     def _reload_http_client(self, ret):
-        self._http = HTTPClient(self._get_ca_cert_path())
+        self._http = _get_http_client(self._get_ca_cert_path())
         return ret
 
     def validate_ca_cert(self, ignored):
@@ -549,6 +549,14 @@ class Provider(object):
         return services_dict
 
 
+def _get_http_client(cert_path):
+    # without a provider certificate, the system CAs are used and there is
+    # no provider pool to share yet
+    if not cert_path:
+        return HTTPClient(cert_path)
+    return HTTPClient(cert_path, pool=getConnectionPool(cert_path))
+
+
 class Record(object):
     def __init__(self, **kw):
         self.__dict__.update(kw)
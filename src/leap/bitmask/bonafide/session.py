@@ -24,6 +24,7 @@ from twisted.logger import Logger
 from leap.bitmask.bonafide import _srp
 from leap.bitmask.bonafide import provider
 from leap.bitmask.bonafide._http import httpRequest, cookieAgentFactory
+from leap.bitmask.bonafide._http import getConnectionPool
 
 
 OK = 'ok'
@@ -67,7 +68,9 @@ class Session(object):
         self._initialize_session()
 
     def _initialize_session(self):
-        self._agent = cookieAgentFactory(self._provider_cert)
+        self._agent = cookieAgentFactory(
+            self._provider_cert,
+            pool=getConnectionPool(self._provider_cert))
         username = self.username or ''
         password = self.password or ''
         self._srp_auth = _srp.SRPAuthMechanism(username, password)
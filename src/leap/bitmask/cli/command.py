@@ -93,6 +93,8 @@ def print_status(status, depth=0):
             k = '↑↑↑         '
         elif k == 'down':
             k = '↓↓↓         '
+        if isinstance(v, dict):
+            v = ', '.join('%s: %s' % item for item in sorted(v.items()))
         print(Fore.RESET + k.ljust(12) + Fore.CYAN + str(v) + Fore.RESET)
 
 
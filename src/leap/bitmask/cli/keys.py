@@ -54,6 +54,10 @@ SUBCOMMANDS:
                             help='Select the userid of the keyring')
         parser.add_argument('--private', action='store_true',
                             help='Use private keys (by default uses public)')
+        parser.add_argument('--offset', type=int, default=0,
+                            help='Skip this number of keys')
+        parser.add_argument('--limit', type=int,
+                            help='List at most this number of keys')
         subargs = parser.parse_args(raw_args)
 
         userid = subargs.userid
@@ -65,6 +69,10 @@ SUBCOMMANDS:
             self.data += ['private']
         else:
             self.data += ['public']
+        if subargs.offset or subargs.limit is not None:
+            self.data += [str(subargs.offset)]
+        if subargs.limit is not None:
+            self.data += [str(subargs.limit)]
 
         return self._send(self._print_key_list)
 
@@ -20,6 +20,8 @@ Bitmask Command Line interface: mail
 import argparse
 import sys
 
+from colorama import Fore
+
 from leap.bitmask.cli import command
 
 
@@ -37,6 +39,8 @@ SUBCOMMANDS:
    get_token            Returns token for the mail service
    msg_status           Get message status
    msg_add              Add a msg file to a mailbox
+   search               Search the contents of the messages
+   search_index         Enable, disable or rebuild the search index
 
 '''.format(name=command.appname)
 
@@ -125,6 +129,50 @@ SUBCOMMANDS:
 
         return self._send(command.default_printer)
 
+    def search(self, raw_args):
+        parser = argparse.ArgumentParser(
+            description='Bitmask email search',
+            prog='%s %s %s' % tuple(sys.argv[:3]))
+        parser.add_argument('-u', '--userid', default='',
+                            help='Select the userid of the mail')
+        parser.add_argument('-m', '--mailbox', default='',
+                            help='Search only in this mailbox')
+        parser.add_argument('text', nargs='+',
+                            help='the text to search for')
+        subargs = parser.parse_args(raw_args)
+
+        if subargs.userid:
+            userid = subargs.userid
+        else:
+            userid = self.cfg.get('bonafide', 'active', default=None)
+
+        self.data += ['search', userid, subargs.mailbox,
+                      ' '.join(subargs.text)]
+
+        return self._send(self._print_search_results)
+
+    def search_index(self, raw_args):
+        parser = argparse.ArgumentParser(
+            description='Bitmask email search index',
+            prog='%s %s %s' % tuple(sys.argv[:3]))
+        parser.add_argument('-u', '--userid', default='',
+                            help='Select the userid of the mail')
+        parser.add_argument('action', nargs='?', default='status',
+                            choices=['status', 'enable', 'disable',
+                                     'rebuild'],
+                            help='what to do with the local full-text index '
+                                 'of the message contents')
+        subargs = parser.parse_args(raw_args)
+
+        if subargs.userid:
+            userid = subargs.userid
+        else:
+            userid = self.cfg.get('bonafide', 'active', default=None)
+
+        self.data += ['search_index', userid, subargs.action]
+
+        return self._send(command.default_printer)
+
     def mixnet_status(self, raw_args):
         parser = argparse.ArgumentParser(
             description='Bitmask mixnet status',
@@ -143,3 +191,10 @@ SUBCOMMANDS:
         self.data += ['mixnet_status', userid, subargs.address[0]]
 
         return self._send(command.default_printer)
+
+    def _print_search_results(self, results):
+        for msg in results:
+            print(Fore.GREEN + msg['mailbox'] + ' ' + str(msg['uid']) +
+                  Fore.RESET + ' ' + msg['date'])
+            print('    ' + msg['from'])
+            print('    ' + msg['subject'])
@@ -328,6 +328,31 @@ class MailCmd(SubCommand):
         d = mail.do_msg_add(userid, msg, mailbox)
         return d
 
+    @register_method('list')
+    def do_SEARCH(self, mail, *parts, **kw):
+        try:
+            userid = parts[2]
+            mailbox = parts[3]
+            text = parts[4]
+        except IndexError:
+            raise DispatchError(
+                'wrong number of arguments: expected 3')
+        d = mail.do_search(userid, text, mailbox)
+        return d
+
+    @register_method('dict')
+    def do_SEARCH_INDEX(self, mail, *parts, **kw):
+        try:
+            userid = parts[2]
+            action = parts[3]
+        except IndexError:
+            raise DispatchError(
+                'wrong number of arguments: expected 2')
+        if action not in ('status', 'enable', 'disable', 'rebuild'):
+            raise DispatchError('unknown search index action: %s' % action)
+        d = mail.do_search_index(userid, action)
+        return d
+
 
 class WebUICmd(SubCommand):
 
@@ -360,10 +385,17 @@ class KeysCmd(SubCommand):
         uid = parts[2]
 
         private = False
-        if parts[-1] == 'private':
+        if len(parts) > 3 and parts[3] == 'private':
             private = True
 
-        return service.do_list_keys(uid, private)
+        offset = 0
+        limit = None
+        if len(parts) > 4:
+            offset = int(parts[4])
+        if len(parts) > 5:
+            limit = int(parts[5])
+
+        return service.do_list_keys(uid, private, offset, limit)
 
     @register_method('dict')
     def do_EXPORT(self, service, *parts, **kw):
@@ -78,6 +78,10 @@ class BackendCommands(object):
 
 class mail_services(object):
 
+    @staticmethod
+    def start_crypto_executor():
+        pass
+
     class SoledadService(HookableService):
         pass
 
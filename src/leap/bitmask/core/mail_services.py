@@ -26,24 +26,29 @@ import re
 import shutil
 import tempfile
 from collections import defaultdict
+from itertools import islice
 from collections import namedtuple
 
 from twisted.application import service
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.logger import Logger
 
 from leap.common.events import catalog, emit_async
 from leap.common.files import check_and_fix_urw_only
 
 from leap.bitmask.bonafide import config
+from leap.bitmask.bonafide._http import getConnectionPool
 from leap.bitmask.hooks import HookableService
 from leap.bitmask.util import get_gpg_bin_path, merge_status
 
 try:
     from leap.bitmask.keymanager import KeyManager
     from leap.bitmask.keymanager.errors import KeyNotFound
+    from leap.bitmask.keymanager.executor import get_crypto_executor
     from leap.bitmask.keymanager.validation import ValidationLevels
+    from leap.bitmask.keymanager.wrapper import GPGKeyringPool
     from leap.bitmask.mail import errors
+    from leap.bitmask.mail.adaptors.soledad import get_lock_stats
     from leap.bitmask.mail.constants import INBOX_NAME
     from leap.bitmask.mail.mail import Account
     from leap.bitmask.mail.imap import service as imap_service
@@ -332,15 +337,29 @@ class KeymanagerContainer(Container):
 
         km_args = (userid, nickserver_uri, soledad)
 
+        gpgbinary = get_gpg_bin_path()
+        keyring_pool = GPGKeyringPool(gpgbinary=gpgbinary)
+        reactor.addSystemEventTrigger(
+            'before', 'shutdown', keyring_pool.clear)
+
         km_kwargs = {
             "token": token, "uid": uuid,
             "api_uri": api_uri, "api_version": "1",
             "ca_cert_path": cert_path,
-            "gpgbinary": get_gpg_bin_path()
+            "gpgbinary": gpgbinary,
+            "keyring_pool": keyring_pool,
+            "crypto_executor": self._get_crypto_executor(),
+            "http_pool": getConnectionPool(cert_path),
+            "basedir": self._basedir
         }
         keymanager = KeyManager(*km_args, **km_kwargs)
         return keymanager
 
+    def _get_crypto_executor(self):
+        # a single executor is shared by all the keymanager instances, so
+        # the number of concurrent gpg operations is bounded globally.
+        return start_crypto_executor()
+
     def _get_api_uri(self, provider):
         api_uri = config.Provider.get(provider).api_uri
         return api_uri
@@ -350,6 +369,31 @@ class KeymanagerContainer(Container):
             provider=provider)
 
 
+_crypto_executor = None
+
+
+def start_crypto_executor():
+    """
+    Start the crypto executor shared by all the keymanager instances, if it
+    is not running yet.
+
+    The process executor forks its workers when it is created, which is
+    only safe while there are no other threads, so the backend calls this
+    before the reactor starts.
+
+    :rtype: ThreadCryptoExecutor or ProcessCryptoExecutor
+    """
+    global _crypto_executor
+    if _crypto_executor is None:
+        _crypto_executor = get_crypto_executor()
+        KeymanagerContainer.log.debug(
+            'Using a %s crypto executor with %d workers' % (
+                _crypto_executor.mode, _crypto_executor.size))
+        reactor.addSystemEventTrigger(
+            'before', 'shutdown', _crypto_executor.stop)
+    return _crypto_executor
+
+
 class KeymanagerService(HookableService):
 
     log = Logger()
@@ -408,14 +452,17 @@ class KeymanagerService(HookableService):
 
     # commands
 
-    def do_list_keys(self, userid, private=False):
+    def do_list_keys(self, userid, private=False, offset=0, limit=None):
         km = self._container.get_instance(userid)
         if km is None:
             return defer.fail(ValueError("User " + userid + " has no active "
                                          "keymanager"))
 
-        d = km.get_all_keys(private=private)
-        d.addCallback(lambda keys: [dict(key) for key in keys])
+        # only the keys in the requested page are built
+        stop = offset + limit if limit is not None else None
+        d = km.iter_all_keys(private=private)
+        d.addCallback(
+            lambda keys: [dict(key) for key in islice(keys, offset, stop)])
         return d
 
     def do_export(self, userid, address, private=False, fetch_remote=False):
@@ -482,13 +529,15 @@ class StandardMailService(service.MultiService, HookableService):
 
     # TODO factor out Mail Service to inside mail package.
 
-    def __init__(self, basedir, mixnet_enabled=False):
+    def __init__(self, basedir, mixnet_enabled=False, encrypt_once=False):
         self._basedir = basedir
         self._soledad_sessions = {}
         self._keymanager_sessions = {}
         self._outgoing_sessions = {}
+        self._smtp_senders = {}
         self._service_tokens = {}
         self._mixnet_enabled = mixnet_enabled
+        self._encrypt_once = encrypt_once
         super(StandardMailService, self).__init__()
         self.initializeChildrenServices()
 
@@ -506,6 +555,8 @@ class StandardMailService(service.MultiService, HookableService):
 
     def stopService(self):
         self.log.info('Stopping Mail service')
+        for sender in self._smtp_senders.values():
+            sender.close()
         super(StandardMailService, self).stopService()
 
     def startInstance(self, userid, soledad, keymanager):
@@ -531,7 +582,8 @@ class StandardMailService(service.MultiService, HookableService):
         return d
 
     def _create_outgoing_service(self, bouncer, userid, keymanager, soledad):
-        outgoing = OutgoingMail(userid, keymanager, bouncer)
+        outgoing = OutgoingMail(userid, keymanager, bouncer,
+                                encrypt_once=self._encrypt_once)
 
         username, provider = userid.split('@')
         key = _get_smtp_client_cert_path(self._basedir, provider, username)
@@ -544,6 +596,10 @@ class StandardMailService(service.MultiService, HookableService):
         smtp_sender = SMTPSender(userid, key, hostname, port)
         outgoing.add_sender(smtp_sender)
 
+        old_sender = self._smtp_senders.get(userid)
+        if old_sender:
+            old_sender.close()
+        self._smtp_senders[userid] = smtp_sender
         self._outgoing_sessions[userid] = outgoing
 
     # hooks
@@ -611,6 +667,9 @@ class StandardMailService(service.MultiService, HookableService):
                     'looking for incoming mail service '
                     'for logout: %s' % username)
                 incoming.stopService()
+            sender = self._smtp_senders.get(username)
+            if sender:
+                sender.close()
 
     # commands
 
@@ -621,8 +680,12 @@ class StandardMailService(service.MultiService, HookableService):
         keymanager = self.parent.getServiceNamed('keymanager')
         incoming = self.getServiceNamed('incoming_mail')
         incoming_status = yield incoming.status(userid)
+        smtp_status = smtp.status()
+        sender = self._smtp_senders.get(userid)
+        if sender:
+            smtp_status['relay'] = sender.get_stats()
         childrenStatus = {
-            'smtp': smtp.status(),
+            'smtp': smtp_status,
             'imap': imap.status(),
             'keymanager': keymanager.status(userid),
             'incoming': incoming_status
@@ -681,6 +744,44 @@ class StandardMailService(service.MultiService, HookableService):
         d.addCallback(lambda _: {'added': True})
         return d
 
+    @defer.inlineCallbacks
+    def do_search(self, userid, text, mailbox=None):
+        account = self._get_account(userid)
+        names = yield account.list_all_mailbox_names()
+        if mailbox:
+            if mailbox not in names:
+                raise ValueError('No such mailbox: %s' % mailbox)
+            names = [mailbox]
+
+        results = []
+        for name in names:
+            collection = yield account.get_collection_by_mailbox(name)
+            uids = yield collection.search(('text', text))
+            msgs = yield collection.get_messages_by_uids(uids)
+            for msg in msgs:
+                if msg is None:
+                    continue
+                headers = msg.get_headers()
+                results.append({
+                    'mailbox': name,
+                    'uid': msg.get_uid(),
+                    'from': headers.get('from', ''),
+                    'subject': headers.get('subject', ''),
+                    'date': headers.get('date', '')})
+        defer.returnValue(results)
+
+    @defer.inlineCallbacks
+    def do_search_index(self, userid, action):
+        account = self._get_account(userid)
+        if action == 'enable':
+            yield account.enable_fulltext()
+        elif action == 'rebuild':
+            yield account.enable_fulltext(rebuild=True)
+        elif action == 'disable':
+            yield account.disable_fulltext()
+        enabled = yield account.is_fulltext_enabled()
+        defer.returnValue({'fulltext': enabled})
+
     # access to containers
 
     def get_soledad_session(self, userid):
@@ -754,7 +855,8 @@ class IMAPService(service.Service):
     def status(self):
         return {
             'status': 'on' if self.running else 'off',
-            'error': None
+            'error': None,
+            'locks': get_lock_stats()
         }
 
 
@@ -106,6 +106,8 @@ class BitmaskBackend(configurable.ConfigurableService):
         on_start(self.init_sessions)
 
         if HAS_MAIL and self._enabled('mail'):
+            # crypto worker processes must be forked before any thread runs
+            mail_services.start_crypto_executor()
             on_start(self._init_mail_services)
 
         if HAS_VPN and self._enabled('vpn'):
@@ -210,8 +212,11 @@ class BitmaskBackend(configurable.ConfigurableService):
 
     def _init_mail(self):
         service = mail_services.StandardMailService
+        encrypt_once = self.get_config(
+            'mail', 'encrypt_once', False, boolean=True)
         self._maybe_init_service('mail', service, self.basedir,
-                                 self._enabled('mixnet'))
+                                 self._enabled('mixnet'),
+                                 encrypt_once=encrypt_once)
 
     def _init_vpn(self):
         if HAS_VPN:
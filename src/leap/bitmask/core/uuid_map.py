@@ -16,9 +16,21 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 UUID Map: a persistent mapping between user-ids and uuids.
+
+The map is stored in a text file. Its first line holds the format version and
+a random salt. Each of the following lines holds a record, encrypted with the
+password of its user, preceded by a lookup tag: a keyed hash of the userid,
+that allows to find the record of a user without trying to decrypt all the
+others. Records from files written in the old format, which have no tag, are
+tagged as soon as they are decrypted.
+
+New records are appended to the file, and the records that they supersede are
+only dropped when the whole file is rewritten.
 """
 
 import base64
+import hashlib
+import hmac
 import os
 import re
 import scrypt
@@ -35,6 +47,11 @@ if IS_WIN:
 
 MAP_PATH = os.path.join(get_path_prefix(), 'leap', 'uuids')
 
+MAP_VERSION = 2
+_HEADER_PREFIX = '#uuids:'
+# the tag of the records from old files, until they are decrypted
+_NO_TAG = '-'
+
 
 class UserMap(object):
 
@@ -44,11 +61,20 @@ class UserMap(object):
 
     # TODO Add padding to the encrypted string
 
-    def __init__(self):
+    def __init__(self, path=None):
+        self._path = path or MAP_PATH
         self._d = {}
-        self._lines = set([])
-        if os.path.isfile(MAP_PATH):
+        self._salt = None
+        # lookup tag -> latest encrypted record
+        self._records = {}
+        # records without a lookup tag, from old files
+        self._untagged = []
+        # number of superseded records still in the file
+        self._superseded = 0
+        if os.path.isfile(self._path):
             self.load()
+        if self._salt is None:
+            self._salt = os.urandom(16)
 
     def add(self, userid, uuid, passwd):
         """
@@ -56,45 +82,112 @@ class UserMap(object):
         password.
         """
         self._add_to_cache(userid, uuid)
-        self._lines.add(_encode_uuid_map(userid, uuid, passwd))
-        self.dump()
+        tag = self._get_tag(userid)
+        if tag in self._records:
+            self._superseded += 1
+        self._records[tag] = _encode_uuid_map(userid, uuid, passwd)
+
+        if self._superseded > len(self._records) or \
+                not os.path.isfile(self._path):
+            self.dump()
+        else:
+            self._append(tag, self._records[tag])
 
     def _add_to_cache(self, userid, uuid):
         self._d[userid] = uuid
 
+    def _get_tag(self, userid):
+        digest = hmac.new(self._salt, userid, hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:16])
+
     def load(self):
         """
         Load a mapping from a default file.
+
+        Files in the old format are rewritten in the current one.
         """
-        with open(MAP_PATH, 'r') as infile:
-            lines = infile.readlines()
-            self._lines = set(lines)
+        with open(self._path, 'r') as infile:
+            lines = [line.strip() for line in infile.readlines()]
+        lines = [line for line in lines if line]
+
+        header = _parse_header(lines[0]) if lines else None
+        if header is None:
+            self._untagged = lines
+            self.dump()
+            return
+
+        self._salt = header
+        for line in lines[1:]:
+            tag, _, record = line.partition(' ')
+            if tag == _NO_TAG:
+                self._untagged.append(record)
+            elif record:
+                if tag in self._records:
+                    self._superseded += 1
+                self._records[tag] = record
 
     def dump(self):
         """
         Dump the mapping to a default file.
+
+        The file is replaced atomically, so that it is never left half
+        written.
         """
-        with open(MAP_PATH, 'w') as out:
-            out.write('\n'.join(self._lines))
+        if self._salt is None:
+            self._salt = os.urandom(16)
+        lines = ['%s%d:%s' % (_HEADER_PREFIX, MAP_VERSION,
+                              base64.urlsafe_b64encode(self._salt))]
+        lines += ['%s %s' % (tag, record)
+                  for tag, record in sorted(self._records.items())]
+        lines += ['%s %s' % (_NO_TAG, record) for record in self._untagged]
+
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as out:
+            out.write('\n'.join(lines) + '\n')
+            out.flush()
+            os.fsync(out.fileno())
+        if IS_WIN and os.path.isfile(self._path):
+            # rename does not replace existing files on windows
+            os.remove(self._path)
+        os.rename(tmp_path, self._path)
+        self._superseded = 0
+
+    def _append(self, tag, record):
+        with open(self._path, 'a') as out:
+            out.write('%s %s\n' % (tag, record))
+            out.flush()
+            os.fsync(out.fileno())
 
     def lookup_uuid(self, userid, passwd=None):
         """
         Lookup the uuid for a given userid.
 
         If no password is given, try to lookup on cache.
-        Else, try to decrypt all the records that we know about with the
-        passed password.
+        Else, decrypt the record of the userid with the passed password. Only
+        the records from old files, that have no lookup tag yet, have to be
+        tried one by one.
         """
         if not passwd:
             return self._d.get(userid)
 
-        for line in self._lines:
-            guess = _decode_uuid_line(line, passwd)
-            if guess:
-                record_userid, uuid = guess
-                if record_userid == userid:
-                    self._add_to_cache(userid, uuid)
-                    return uuid
+        tag = self._get_tag(userid)
+        record = self._records.get(tag)
+        if record is not None:
+            uuid = _get_uuid_from_record(record, userid, passwd)
+            if uuid:
+                self._add_to_cache(userid, uuid)
+                return uuid
+
+        for record in self._untagged:
+            uuid = _get_uuid_from_record(record, userid, passwd)
+            if uuid:
+                self._add_to_cache(userid, uuid)
+                # tag the record, so it's found directly next time. A tagged
+                # record that did not decrypt with this password is stale.
+                self._untagged.remove(record)
+                self._records[tag] = record
+                self.dump()
+                return uuid
 
     def lookup_userid(self, uuid):
         """
@@ -104,6 +197,33 @@ class UserMap(object):
         return rev_d.get(uuid)
 
 
+def _parse_header(line):
+    """
+    Get the salt from the header line of a map file.
+
+    :return: the salt, or None if the line is not a header of the current
+             version.
+    :rtype: str
+    """
+    if not line.startswith(_HEADER_PREFIX):
+        return None
+    version, _, salt = line[len(_HEADER_PREFIX):].partition(':')
+    if version != str(MAP_VERSION):
+        return None
+    try:
+        return base64.urlsafe_b64decode(salt)
+    except TypeError:
+        return None
+
+
+def _get_uuid_from_record(record, userid, passwd):
+    guess = _decode_uuid_line(record, passwd)
+    if guess:
+        record_userid, uuid = guess
+        if record_userid == userid:
+            return uuid
+
+
 def _encode_uuid_map(userid, uuid, passwd):
     data = 'userid:%s:uuid:%s' % (userid, uuid)
 
@@ -124,7 +244,10 @@ def _encode_uuid_map(userid, uuid, passwd):
 
 
 def _decode_uuid_line(line, passwd):
-    decoded = base64.urlsafe_b64decode(line)
+    try:
+        decoded = base64.urlsafe_b64decode(line)
+    except TypeError:
+        return None
     if IS_WIN:
         key = scrypt.hash(passwd, socket.gethostname())
         key = base64.urlsafe_b64encode(key[:32])
@@ -18,25 +18,38 @@
 Key Manager is a Nicknym agent for LEAP client.
 """
 import fileinput
+import os
 import tempfile
 
 from urlparse import urlparse
 
 from twisted.logger import Logger
 from twisted.internet import defer, task, reactor
+from twisted.python.failure import Failure
 
 from leap.common import ca_bundle
 from leap.common.http import HTTPClient
 from leap.common.events import emit_async, catalog
 
+from leap.bitmask.config import DEFAULT_BASEDIR
 from leap.bitmask.keymanager import errors as keymanager_errors
+from leap.bitmask.keymanager.cache import KeyCache
 from leap.bitmask.keymanager.errors import KeyNotFound
+from leap.bitmask.keymanager.keys import parse_address
 from leap.bitmask.keymanager.nicknym import Nicknym
+from leap.bitmask.keymanager.packets import get_key_ids
+from leap.bitmask.keymanager.packets import get_recipient_key_ids
+from leap.bitmask.keymanager.packets import WILDCARD_KEY_ID
 from leap.bitmask.keymanager.refresher import RandomRefreshPublicKey
 from leap.bitmask.keymanager.validation import ValidationLevels, can_upgrade
 from leap.bitmask.keymanager.openpgp import OpenPGPScheme
 
 
+# the refresh schedule is kept in a file under the basedir, unless a path,
+# or None to keep it in memory only, is given
+_DEFAULT_SCHEDULE_PATH = object()
+
+
 class KeyManager(object):
     #
     # server's key storage constants
@@ -46,7 +59,9 @@ class KeyManager(object):
 
     def __init__(self, address, nickserver_uri, soledad, token=None,
                  ca_cert_path=None, api_uri=None, api_version=None, uid=None,
-                 gpgbinary=None, combined_ca_bundle=None):
+                 gpgbinary=None, combined_ca_bundle=None, keyring_pool=None,
+                 crypto_executor=None, http_pool=None,
+                 basedir=DEFAULT_BASEDIR):
         """
         Initialize a Key Manager for user's C{address} with provider's
         nickserver reachable in C{nickserver_uri}.
@@ -69,8 +84,22 @@ class KeyManager(object):
         :type uid: str
         :param gpgbinary: Name for GnuPG binary executable.
         :type gpgbinary: C{str}
+        :param keyring_pool: A pool of warm GPG keyrings to reuse between
+                             crypto operations.
+        :type keyring_pool: leap.bitmask.keymanager.wrapper.GPGKeyringPool
+        :param crypto_executor: The executor where the blocking gpg
+                                operations are run.
+        :type crypto_executor: ThreadCryptoExecutor or
+                               ProcessCryptoExecutor
+        :param http_pool: The persistent connection pool to the provider,
+                          shared with the nickserver client.
+        :type http_pool: twisted.web.client.HTTPConnectionPool
+        :param basedir: The folder where the local state of the Key Manager
+                        is kept.
+        :type basedir: str
         """
         self._address = address
+        self._basedir = os.path.expanduser(basedir)
         self._nickserver_uri = nickserver_uri
         self._soledad = soledad
         self._token = token
@@ -87,8 +116,16 @@ class KeyManager(object):
 
         self._async_client = HTTPClient(self._combined_ca_bundle)
         self._nicknym = Nicknym(self._nickserver_uri,
-                                self._ca_cert_path, self._token)
+                                self._ca_cert_path, self._token,
+                                http_pool=http_pool)
         self.refresher = None
+        self._keyring_pool = keyring_pool
+        self._crypto_executor = crypto_executor
+        self._key_cache = KeyCache()
+        # the pending writes of the usage flags of keys
+        self._used_flag_writes = {}
+        # (key cache generation, inactive private keys by key id)
+        self._inactive_key_index = None
         self._init_gpg(soledad, gpgbinary)
 
     #
@@ -96,15 +133,51 @@ class KeyManager(object):
     #
 
     def _init_gpg(self, soledad, gpgbinary):
-        self._openpgp = OpenPGPScheme(soledad, gpgbinary=gpgbinary)
+        self._openpgp = OpenPGPScheme(soledad, gpgbinary=gpgbinary,
+                                      keyring_pool=self._keyring_pool,
+                                      crypto_executor=self._crypto_executor,
+                                      key_cache=self._key_cache)
 
-    def start_refresher(self):
-        self.refresher = RandomRefreshPublicKey(self._openpgp, self)
+    def start_refresher(self, schedule_path=_DEFAULT_SCHEDULE_PATH,
+                        **kwargs):
+        """
+        Start refreshing the stored public keys from the nickserver.
+
+        :param schedule_path: The file where the time of the last refresh of
+                              each key is kept across runs. By default, a
+                              file for this address under the basedir. If
+                              None, it is only kept in memory.
+        :type schedule_path: str
+        :param kwargs: The batch_size and max_requests_per_hour of the
+                       L{RandomRefreshPublicKey}.
+        """
+        if schedule_path is _DEFAULT_SCHEDULE_PATH:
+            schedule_path = os.path.join(
+                self._basedir, 'keymanager',
+                '%s.refresh_schedule.json' % self._address)
+        self.refresher = RandomRefreshPublicKey(
+            self._openpgp, self, schedule_path=schedule_path, **kwargs)
         self.refresher.start()
 
     def stop_refresher(self):
         self.refresher.stop()
 
+    def clear_key_cache(self):
+        """
+        Drop all the keys cached in memory, so they are read again from the
+        local storage. To be called when the storage may have been modified
+        elsewhere, for example after a sync.
+        """
+        self._key_cache.clear()
+
+    def get_key_cache_stats(self):
+        """
+        Return the usage counters of the in-memory key cache.
+
+        :rtype: dict
+        """
+        return self._key_cache.stats()
+
     def _create_combined_bundle_file(self):
         leap_ca_bundle = ca_bundle.where()
 
@@ -225,13 +298,36 @@ class KeyManager(object):
             sorted(inactive_keys, key=lambda _key: _key.expiry_date)
         defer.returnValue(inactive_keys)
 
+    @defer.inlineCallbacks
+    def _get_inactive_key_index(self):
+        """
+        Return the inactive private keys indexed by the ids of their primary
+        keys and subkeys. The index is kept until the stored keys are
+        modified.
+
+        :return: A Deferred which fires with a dict of key ids to keys.
+        :rtype: Deferred
+        """
+        generation = self._key_cache.generation
+        if (self._inactive_key_index is not None and
+                self._inactive_key_index[0] == generation):
+            defer.returnValue(self._inactive_key_index[1])
+
+        index = {}
+        # sorted by expiry date, so the newest key wins on duplicated ids
+        for key in (yield self._get_inactive_private_keys()):
+            for key_id in get_key_ids(key.key_data):
+                index[key_id] = key
+        self._inactive_key_index = (generation, index)
+        defer.returnValue(index)
+
     def get_key(self, address, private=False, fetch_remote=True):
         """
         Return a key bound to address.
 
-        First, search for the key in local storage. When it is available
-        locally but is expired or when it is not available locally,
-        then a fetch from nickserver is tried.
+        First, search for the key in the in-memory cache and then in local
+        storage. When it is available locally but is expired or when it is
+        not available locally, then a fetch from nickserver is tried.
 
         :param address: The address bound to the key.
         :type address: str
@@ -253,6 +349,19 @@ class KeyManager(object):
         """
         self.log.debug('Getting key for %s' % (address,))
         emit_async(catalog.KEYMANAGER_LOOKING_FOR_KEY, address)
+        cache_address = parse_address(address)
+
+        def get_local_key():
+            key = self._key_cache.get(cache_address, private)
+            if key is not None:
+                return defer.succeed(key)
+            d = self._openpgp.get_key(address, private=private)
+            d.addCallback(cache_key, self._key_cache.generation)
+            return d
+
+        def cache_key(key, generation):
+            self._key_cache.put(cache_address, key, generation)
+            return key
 
         @defer.inlineCallbacks
         def maybe_extend_expiration(key):
@@ -288,13 +397,12 @@ class KeyManager(object):
             self.log.debug('Fetching remotely key for %s.' % address)
             emit_async(catalog.KEYMANAGER_LOOKING_FOR_KEY, address)
             d = self._fetch_keys_from_server_and_store_local(address)
-            d.addCallback(
-                lambda _: self._openpgp.get_key(address, private=False))
+            d.addCallback(lambda _: get_local_key())
             d.addCallback(key_found)
             return d
 
         # return key if it exists in local database
-        d = self._openpgp.get_key(address, private=private)
+        d = get_local_key()
         if private:
             d.addCallback(maybe_extend_expiration)
         d.addCallbacks(ensure_valid, key_not_found)
@@ -319,7 +427,7 @@ class KeyManager(object):
         :rtype: Deferred
         """
         key_data = yield self._nicknym.fetch_key_with_fingerprint(fingerprint)
-        key, _ = self._openpgp.parse_key(key_data, address)
+        key, _ = yield self._openpgp.parse_key(key_data, address)
         key.validation = ValidationLevels.Fingerprint
 
         if key.fingerprint != fingerprint:
@@ -349,6 +457,20 @@ class KeyManager(object):
         """
         return self._openpgp.get_all_keys(private)
 
+    def iter_all_keys(self, private=False):
+        """
+        Return an iterator over all keys stored in local database, that builds
+        each key only when it is reached.
+
+        :param private: Include private keys
+        :type private: bool
+
+        :return: A Deferred which fires with an iterator of all keys in local
+                 db.
+        :rtype: Deferred
+        """
+        return self._openpgp.iter_all_keys(private)
+
     def gen_key(self):
         """
         Generate a key bound to the user's address.
@@ -453,25 +575,64 @@ class KeyManager(object):
                  failed encrypting for some reason.
         :rtype: Deferred
 
+        :raise UnsupportedKeyTypeError: if invalid key type
+        """
+        return self.encrypt_to_addresses(
+            data, [address], passphrase=passphrase, sign=sign,
+            cipher_algo=cipher_algo, fetch_remote=fetch_remote)
+
+    def encrypt_to_addresses(self, data, addresses, passphrase=None,
+                             sign=None, cipher_algo='AES256',
+                             fetch_remote=True):
+        """
+        Encrypt data once with the public keys bound to all the addresses,
+        and sign with the private key bound to sign address.
+
+        The encrypted data can be decrypted with any of the keys, and it
+        discloses the ids of all of them.
+
+        :param data: The data to be encrypted.
+        :type data: str
+        :param addresses: The addresses to encrypt it for.
+        :type addresses: list of str
+        :param passphrase: The passphrase for the secret key used for the
+                           signature.
+        :type passphrase: str
+        :param sign: The address to be used for signature.
+        :type sign: str
+        :param cipher_algo: The cipher algorithm to use.
+        :type cipher_algo: str
+        :param fetch_remote: If a key is not found in local storage try to
+                             fetch from nickserver
+        :type fetch_remote: bool
+
+        :return: A Deferred which fires with the encrypted data as str, or
+                 which fails with KeyNotFound if the key for any of the
+                 addresses was found neither locally or in keyserver, or
+                 fails with KeyVersionError if the key format is not
+                 supported or fails with EncryptError if failed encrypting
+                 for some reason.
+        :rtype: Deferred
+
         :raise UnsupportedKeyTypeError: if invalid key type
         """
         @defer.inlineCallbacks
         def encrypt(keys):
-            pubkey, signkey = keys
+            pubkeys, signkey = keys[:-1], keys[-1]
             encrypted = yield self._openpgp.encrypt(
-                data, pubkey, passphrase, sign=signkey,
+                data, pubkeys, passphrase, sign=signkey,
                 cipher_algo=cipher_algo)
-            if not pubkey.encr_used:
-                pubkey.encr_used = True
-                yield self._openpgp.put_key(pubkey)
+            for pubkey in pubkeys:
+                yield self._put_used_flag(pubkey, 'encr_used')
             defer.returnValue(encrypted)
 
-        dpub = self.get_key(address, private=False,
-                            fetch_remote=fetch_remote)
+        dpubs = [self.get_key(address, private=False,
+                              fetch_remote=fetch_remote)
+                 for address in addresses]
         dpriv = defer.succeed(None)
         if sign is not None:
             dpriv = self.get_key(sign, private=True)
-        d = defer.gatherResults([dpub, dpriv], consumeErrors=True)
+        d = defer.gatherResults(dpubs + [dpriv], consumeErrors=True)
         d.addCallbacks(encrypt, self._extract_first_error)
         return d
 
@@ -479,9 +640,10 @@ class KeyManager(object):
                 fetch_remote=True):
         """
         Decrypt data using private key from address and verify with public key
-        bound to verify address. If the decryption using the active private
-        key fails, then decryption with inactive keys, if any, is recursively
-        tried.
+        bound to verify address. The private key, active or inactive, is
+        chosen by the key ids the data was encrypted to. If they can not be
+        told, decryption with the active key and then with the inactive keys
+        is tried.
 
         :param data: The data to be decrypted.
         :type data: str
@@ -501,7 +663,8 @@ class KeyManager(object):
             * (decripted str, KeyNotFound) if signing key not found
             * (decripted str, InvalidSignature) if signature is invalid
             * KeyNotFound failure if private key not found
-            * DecryptError failure if decription failed
+            * DecryptError failure if decription failed or there is no
+              private key for the recipients of the data
         :rtype: Deferred
 
         :raise UnsupportedKeyTypeError: if invalid key type
@@ -516,10 +679,7 @@ class KeyManager(object):
                 signature = keymanager_errors.KeyNotFound(verify)
             elif signed:
                 signature = pubkey
-                if not pubkey.sign_used:
-                    pubkey.sign_used = True
-                    yield self._openpgp.put_key(pubkey)
-                    defer.returnValue((decrypted, signature))
+                yield self._put_used_flag(pubkey, 'sign_used')
             else:
                 signature = keymanager_errors.InvalidSignature(
                     'Failed to verify signature with key %s' %
@@ -543,7 +703,7 @@ class KeyManager(object):
             defer.returnValue(result)
 
         @defer.inlineCallbacks
-        def decrypt(keys):
+        def decrypt_with_all_keys(keys):
             try:
                 result = yield _decrypt(keys)
             except keymanager_errors.DecryptError as e:
@@ -553,6 +713,35 @@ class KeyManager(object):
                                                           verify_key, e)
             defer.returnValue(result)
 
+        @defer.inlineCallbacks
+        def decrypt(keys):
+            verify_key, active_key = keys
+            key_ids = get_recipient_key_ids(data)
+            if not key_ids:
+                # unparseable, or without public-key encrypted session keys:
+                # gpg will tell which key is the right one
+                result = yield decrypt_with_all_keys(keys)
+                defer.returnValue(result)
+
+            key_ids = set(key_ids)
+            if get_key_ids(active_key.key_data) & key_ids:
+                result = yield _decrypt(keys)
+                defer.returnValue(result)
+
+            index = yield self._get_inactive_key_index()
+            matching = [index[key_id] for key_id in key_ids
+                        if key_id in index]
+            if matching:
+                result = yield _decrypt([verify_key, matching[0]])
+            elif WILDCARD_KEY_ID in key_ids:
+                # the message hides its recipients
+                result = yield decrypt_with_all_keys(keys)
+            else:
+                raise keymanager_errors.DecryptError(
+                    'No private key for any of the recipients: %s'
+                    % (', '.join(sorted(key_ids)),))
+            defer.returnValue(result)
+
         dpriv = self.get_key(address, private=True)
         dpub = defer.succeed(None)
         if verify is not None:
@@ -567,6 +756,43 @@ class KeyManager(object):
     def _extract_first_error(self, failure):
         return failure.value.subFailure
 
+    def _put_used_flag(self, key, flag):
+        """
+        Set the usage C{flag} of C{key} and store it, unless it was already
+        set. Concurrent writes of the same flag of a key are coalesced into
+        a single one.
+
+        :param key: The key that has been used.
+        :type key: EncryptionKey
+        :param flag: The name of the flag, 'encr_used' or 'sign_used'.
+        :type flag: str
+
+        :return: A Deferred which fires when the flag is stored.
+        :rtype: Deferred
+        """
+        if getattr(key, flag):
+            return defer.succeed(None)
+        setattr(key, flag, True)
+
+        write_id = (key.fingerprint, key.private, flag)
+        waiting = self._used_flag_writes.get(write_id)
+        d = defer.Deferred()
+        if waiting is not None:
+            waiting.append(d)
+            return d
+
+        def notify_waiting(result):
+            del self._used_flag_writes[write_id]
+            for waiter in waiting:
+                if isinstance(result, Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(None)
+
+        waiting = self._used_flag_writes[write_id] = [d]
+        self._openpgp.put_key(key).addBoth(notify_waiting)
+        return d
+
     def sign(self, data, address, digest_algo='SHA512', clearsign=False,
              detach=True, binary=False):
         """
@@ -629,15 +855,16 @@ class KeyManager(object):
         :raise UnsupportedKeyTypeError: if invalid key type
         """
         def verify(pubkey):
-            signed = self._openpgp.verify(
+            d = self._openpgp.verify(
                 data, pubkey, detached_sig=detached_sig)
+            d.addCallback(check_signature, pubkey)
+            return d
+
+        def check_signature(signed, pubkey):
             if signed:
-                if not pubkey.sign_used:
-                    pubkey.sign_used = True
-                    d = self._openpgp.put_key(pubkey)
-                    d.addCallback(lambda _: pubkey)
-                    return d
-                return pubkey
+                d = self._put_used_flag(pubkey, 'sign_used')
+                d.addCallback(lambda _: pubkey)
+                return d
             else:
                 raise keymanager_errors.InvalidSignature(
                     'Failed to verify signature with key %s' %
@@ -720,7 +947,7 @@ class KeyManager(object):
 
         :raise UnsupportedKeyTypeError: if invalid key type
         """
-        pubkey, privkey = self._openpgp.parse_key(key, address)
+        pubkey, privkey = yield self._openpgp.parse_key(key, address)
 
         if pubkey is None:
             raise keymanager_errors.KeyNotFound(key)
@@ -772,7 +999,7 @@ class KeyManager(object):
         key_content = yield self._get_with_combined_ca_bundle(uri)
 
         # XXX parse binary keys
-        pubkey, _ = self._openpgp.parse_key(key_content, address)
+        pubkey, _ = yield self._openpgp.parse_key(key_content, address)
         if pubkey is None:
             raise keymanager_errors.KeyNotFound(uri)
 
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# cache.py
+# Copyright (C) 2018 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+In-memory cache of the keys bound to addresses
+"""
+from collections import OrderedDict
+
+from leap.common.check import leap_assert
+
+
+DEFAULT_CACHE_SIZE = 256
+DEFAULT_CACHE_TTL = 5 * 60  # five minutes
+
+
+class KeyCache(object):
+    """
+    A bounded cache of the keys bound to addresses, indexed by address and
+    privateness.
+
+    Entries expire C{ttl} seconds after being stored, and the least recently
+    used entry is dropped when the cache grows over its size. Every write to
+    the key storage has to L{invalidate} the keys it touches.
+
+    Each invalidation starts a new generation of the cache. Lookups that were
+    started in a previous generation could have read keys that are no longer
+    stored, so they are not cached (see L{put}).
+    """
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL,
+                 reactor=None):
+        """
+        :param size: Maximum number of keys in the cache.
+        :type size: int
+        :param ttl: Seconds a key is kept in the cache.
+        :type ttl: int
+        :param reactor: The reactor used to tell the time.
+        :type reactor: IReactorTime
+        """
+        leap_assert(size > 0, 'Key cache size must be positive.')
+        if reactor is None:
+            from twisted.internet import reactor
+        self._size = size
+        self._ttl = ttl
+        self._reactor = reactor
+        self._keys = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, address, private=False):
+        """
+        Return the cached key bound to C{address}.
+
+        :param address: The address bound to the key.
+        :type address: str
+        :param private: Look for a private key instead of a public one?
+        :type private: bool
+
+        :return: The key, or None if it is not cached.
+        :rtype: EncryptionKey
+        """
+        entry = self._keys.pop((address, private), None)
+        if entry is None or entry[0] <= self._reactor.seconds():
+            self.misses += 1
+            return None
+        self.hits += 1
+        # reinsert as the most recently used one
+        self._keys[(address, private)] = entry
+        return entry[1]
+
+    def put(self, address, key, generation):
+        """
+        Cache C{key} as the one bound to C{address}, unless the cache has been
+        invalidated since the key was looked up.
+
+        :param address: The address bound to the key.
+        :type address: str
+        :param key: The key.
+        :type key: EncryptionKey
+        :param generation: The cache L{generation} when the key lookup was
+                           started.
+        :type generation: int
+        """
+        if generation != self.generation:
+            return
+        cache_id = (address, key.private)
+        self._keys.pop(cache_id, None)
+        self._keys[cache_id] = (self._reactor.seconds() + self._ttl, key)
+        while len(self._keys) > self._size:
+            self._keys.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key=None, address=None):
+        """
+        Drop the cached keys with the fingerprint of C{key}, or bound to its
+        address or to C{address}.
+
+        :param key: The key that was modified.
+        :type key: EncryptionKey
+        :param address: The address whose key was modified.
+        :type address: str
+        """
+        self.generation += 1
+        addresses = set([address])
+        if key is not None:
+            addresses.add(key.address)
+        for cache_id, (_, cached) in self._keys.items():
+            if (cache_id[0] in addresses or
+                    (key is not None and
+                     cached.fingerprint == key.fingerprint)):
+                del self._keys[cache_id]
+
+    def clear(self):
+        """
+        Drop all the cached keys.
+        """
+        self.generation += 1
+        self._keys.clear()
+
+    def stats(self):
+        """
+        Return the cache usage counters.
+
+        :rtype: dict
+        """
+        return {'size': len(self._keys), 'max_size': self._size,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+# executor.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Executors for the blocking OpenPGP operations.
+
+Running gnupg means spawning the gpg binary and parsing its output in
+python, which holds the GIL most of the time. When that happens in the
+reactor threadpool it also competes with the sqlcipher work of soledad, so
+crypto operations are sent to a dedicated executor instead:
+
+    * L{ThreadCryptoExecutor} runs them in a threadpool of its own.
+    * L{ProcessCryptoExecutor} runs them in a pool of worker processes, so
+      they can use all the available cores.
+
+The mode and the number of workers are chosen with the
+C{BITMASK_CRYPTO_EXECUTOR} ('thread' or 'process') and
+C{BITMASK_CRYPTO_WORKERS} environment variables. The thread mode is used
+whenever the process pool can not be created. Jobs sent to worker processes
+fail after C{BITMASK_CRYPTO_TIMEOUT} seconds without an answer.
+"""
+import cPickle as pickle
+import multiprocessing
+import os
+import signal
+import sys
+
+from collections import namedtuple
+from multiprocessing import cpu_count
+from multiprocessing.util import Finalize
+
+from twisted.internet import defer, reactor, threads
+from twisted.logger import Logger
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+from leap.common.check import leap_assert
+from leap.bitmask.keymanager import errors
+from leap.bitmask.keymanager.wrapper import GPGKeyringPool
+from leap.bitmask.keymanager.wrapper import TempGPGWrapper
+
+
+THREAD_MODE = 'thread'
+PROCESS_MODE = 'process'
+
+CRYPTO_EXECUTOR = os.environ.get('BITMASK_CRYPTO_EXECUTOR', THREAD_MODE)
+CRYPTO_WORKERS = int(os.environ.get('BITMASK_CRYPTO_WORKERS', cpu_count()))
+CRYPTO_TIMEOUT = int(os.environ.get('BITMASK_CRYPTO_TIMEOUT', 600))
+
+log = Logger()
+
+
+# The keys are sent to the worker processes stripped down to what is needed
+# to build a keyring, which is also what identifies it in a keyring pool.
+KeyMaterial = namedtuple('KeyMaterial', ['fingerprint', 'private', 'key_data'])
+
+
+class _CryptoExecutor(object):
+    """
+    Base class for the crypto executors, keeping track of the jobs that are
+    queued or running.
+    """
+
+    mode = None
+
+    def __init__(self, size):
+        leap_assert(size > 0, 'Number of crypto workers must be positive.')
+        self.size = size
+        self.pending = 0
+        self.max_pending = 0
+        self.completed = 0
+        self.failed = 0
+
+    def run(self, func, *args, **kwargs):
+        """
+        Run C{func} in the executor.
+
+        :param func: The function to be run. In process mode it has to be
+                     a module level function, and its arguments and return
+                     value must be picklable.
+        :type func: callable
+
+        :return: A Deferred which fires with the result of C{func}.
+        :rtype: Deferred
+        """
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        d = self._submit(func, args, kwargs)
+        d.addBoth(self._job_done)
+        return d
+
+    def keyring(self, keys, gpgbinary=None, keyring_pool=None):
+        """
+        Return a context manager for a keyring holding C{keys}, that can be
+        handed to a function run in this executor.
+
+        :param keys: OpenPGP key, or list of.
+        :type keys: OpenPGPKey or list of OpenPGPKeys
+        :param gpgbinary: Name for GnuPG binary executable.
+        :type gpgbinary: C{str}
+        :param keyring_pool: A pool of warm keyrings, if any.
+        :type keyring_pool: GPGKeyringPool
+        """
+        raise NotImplementedError()
+
+    def stats(self):
+        """
+        Return the executor usage counters.
+
+        :rtype: dict
+        """
+        return {'mode': self.mode, 'workers': self.size,
+                'pending': self.pending, 'max_pending': self.max_pending,
+                'completed': self.completed, 'failed': self.failed}
+
+    def stop(self):
+        """
+        Stop the executor.
+
+        :rtype: Deferred
+        """
+        raise NotImplementedError()
+
+    def _submit(self, func, args, kwargs):
+        raise NotImplementedError()
+
+    def _job_done(self, result):
+        self.pending -= 1
+        if isinstance(result, Failure):
+            self.failed += 1
+        else:
+            self.completed += 1
+        return result
+
+
+class ThreadCryptoExecutor(_CryptoExecutor):
+    """
+    Run crypto operations in a dedicated threadpool, separated from the
+    reactor one.
+    """
+
+    mode = THREAD_MODE
+
+    def __init__(self, size=CRYPTO_WORKERS):
+        """
+        :param size: Number of threads.
+        :type size: int
+        """
+        _CryptoExecutor.__init__(self, size)
+        self._threadpool = ThreadPool(
+            minthreads=0, maxthreads=size, name='crypto')
+        self._threadpool.start()
+
+    def keyring(self, keys, gpgbinary=None, keyring_pool=None):
+        if keyring_pool is not None:
+            return keyring_pool.keyring(keys)
+        return TempGPGWrapper(keys, gpgbinary)
+
+    def stop(self):
+        self._threadpool.stop()
+        return defer.succeed(None)
+
+    def _submit(self, func, args, kwargs):
+        return threads.deferToThreadPool(
+            reactor, self._threadpool, func, *args, **kwargs)
+
+
+class ProcessCryptoExecutor(_CryptoExecutor):
+    """
+    Run crypto operations in a pool of worker processes.
+
+    Each worker keeps its own pool of warm keyrings, so keys are given to
+    the functions run here through L{WorkerKeyring} context managers.
+    """
+
+    mode = PROCESS_MODE
+
+    def __init__(self, size=CRYPTO_WORKERS, timeout=CRYPTO_TIMEOUT):
+        """
+        The worker processes are forked right away, so this should be
+        created before the reactor starts any thread.
+
+        :param size: Number of worker processes.
+        :type size: int
+        :param timeout: Seconds after which a job that got no answer from
+                        the workers fails.
+        :type timeout: int
+        """
+        _CryptoExecutor.__init__(self, size)
+        self._timeout = timeout
+        self._lost = 0
+        self._pool = multiprocessing.Pool(
+            processes=size, initializer=_init_worker)
+
+    def keyring(self, keys, gpgbinary=None, keyring_pool=None):
+        return WorkerKeyring(keys, gpgbinary)
+
+    def stop(self):
+        if self._lost:
+            # the pool waits forever for the answer of the lost jobs
+            self._pool.terminate()
+        else:
+            self._pool.close()
+        return threads.deferToThread(self._pool.join)
+
+    def _submit(self, func, args, kwargs):
+        # the pool only reports successful jobs back: a job that can not be
+        # sent to a worker, or whose worker dies, is never answered. So the
+        # job is checked to be picklable here and times out otherwise.
+        try:
+            pickle.dumps((func, args, kwargs), pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            return defer.fail(errors.GPGError(
+                'Could not send job to crypto worker: %r' % (e,)))
+
+        d = defer.Deferred()
+
+        def deliver((ok, result)):
+            if d.called:
+                return
+            timeout.cancel()
+            if ok:
+                d.callback(result)
+            else:
+                d.errback(result)
+
+        def expire():
+            self._lost += 1
+            d.errback(errors.GPGError(
+                'Crypto worker did not answer in %d seconds' % self._timeout))
+
+        timeout = reactor.callLater(self._timeout, expire)
+        self._pool.apply_async(
+            _call_in_worker, (func, args, kwargs),
+            callback=lambda res: reactor.callFromThread(deliver, res))
+        return d
+
+
+class WorkerKeyring(object):
+    """
+    A picklable context manager that borrows a keyring holding C{keys} from
+    the pool of the worker process where it is used.
+    """
+
+    def __init__(self, keys=None, gpgbinary=None):
+        """
+        :param keys: OpenPGP key, or list of.
+        :type keys: OpenPGPKey or list of OpenPGPKeys
+        :param gpgbinary: Name for GnuPG binary executable.
+        :type gpgbinary: C{str}
+        """
+        if not keys:
+            keys = list()
+        if not isinstance(keys, list):
+            keys = [keys]
+        self._keys = [KeyMaterial(key.fingerprint, key.private, key.key_data)
+                      for key in keys if key]
+        self._gpgbinary = gpgbinary
+        self._wrapper = None
+
+    def __enter__(self):
+        pool = _get_worker_keyring_pool(self._gpgbinary)
+        self._wrapper = pool.keyring(self._keys)
+        return self._wrapper.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._wrapper.__exit__(exc_type, exc_value, traceback)
+        self._wrapper = None
+
+    def __getstate__(self):
+        return (self._keys, self._gpgbinary)
+
+    def __setstate__(self, state):
+        self._keys, self._gpgbinary = state
+        self._wrapper = None
+
+
+def get_crypto_executor(mode=CRYPTO_EXECUTOR, size=CRYPTO_WORKERS):
+    """
+    Create a crypto executor, falling back to the thread mode if a process
+    pool is requested but can not be used.
+
+    :param mode: Either 'thread' or 'process'.
+    :type mode: str
+    :param size: Number of workers.
+    :type size: int
+
+    :rtype: ThreadCryptoExecutor or ProcessCryptoExecutor
+    """
+    if mode == PROCESS_MODE:
+        if getattr(sys, 'frozen', False):
+            log.warn('Process crypto executor is not available in bundles, '
+                     'falling back to threads.')
+        else:
+            try:
+                return ProcessCryptoExecutor(size)
+            except (OSError, ImportError) as e:
+                log.warn('Could not start crypto worker processes (%r), '
+                         'falling back to threads.' % (e,))
+    elif mode != THREAD_MODE:
+        log.warn('Unknown crypto executor mode %r, using threads.' % (mode,))
+    return ThreadCryptoExecutor(size)
+
+
+#
+# Worker process side
+#
+
+_worker_keyring_pools = {}
+
+
+def _init_worker():
+    # workers are forked from the reactor process, so they inherit its
+    # signal handlers, including the wakeup fd that would wake up the
+    # parent reactor on every SIGCHLD of the gpg subprocesses.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    try:
+        signal.set_wakeup_fd(-1)
+    except ValueError:
+        pass
+    _worker_keyring_pools.clear()
+    Finalize(None, _clear_worker_keyring_pools, exitpriority=10)
+
+
+def _get_worker_keyring_pool(gpgbinary):
+    pool = _worker_keyring_pools.get(gpgbinary)
+    if pool is None:
+        pool = GPGKeyringPool(gpgbinary=gpgbinary)
+        _worker_keyring_pools[gpgbinary] = pool
+    return pool
+
+
+def _clear_worker_keyring_pools():
+    for pool in _worker_keyring_pools.values():
+        pool.clear()
+    _worker_keyring_pools.clear()
+
+
+def _call_in_worker(func, args, kwargs):
+    """
+    Run C{func} in a worker process and return whether it succeeded along
+    with its result or the exception it raised, making sure that both can
+    be sent back to the parent process.
+    """
+    try:
+        result = (True, func(*args, **kwargs))
+    except Exception as e:
+        result = (False, e)
+    try:
+        pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        result = (False, errors.GPGError(
+            'Crypto worker returned an unpicklable result: %r' % (e,)))
+    return result
@@ -41,9 +41,9 @@ class Nicknym(object):
     OPENPGP_KEY = 'openpgp'
     PUBKEY_KEY = "user[public_key]"
 
-    def __init__(self, nickserver_uri, ca_cert_path, token):
+    def __init__(self, nickserver_uri, ca_cert_path, token, http_pool=None):
         self._nickserver_uri = nickserver_uri
-        self._async_client_pinned = HTTPClient(ca_cert_path)
+        self._async_client_pinned = HTTPClient(ca_cert_path, pool=http_pool)
         self.token = token
 
     @defer.inlineCallbacks
@@ -24,6 +24,7 @@ import re
 import tempfile
 import io
 
+from collections import namedtuple, OrderedDict
 from datetime import datetime
 from multiprocessing import cpu_count
 from twisted.internet import defer
@@ -105,7 +106,8 @@ class OpenPGPScheme(object):
     KEY_TYPE = OpenPGPKey.__name__
     ACTIVE_TYPE = KEY_TYPE + KEYMANAGER_ACTIVE_TYPE
 
-    def __init__(self, soledad, gpgbinary=None):
+    def __init__(self, soledad, gpgbinary=None, keyring_pool=None,
+                 crypto_executor=None, key_cache=None):
         """
         Initialize the OpenPGP wrapper.
 
@@ -113,12 +115,29 @@ class OpenPGPScheme(object):
         :type soledad: leap.soledad.Soledad
         :param gpgbinary: Name for GnuPG binary executable.
         :type gpgbinary: C{str}
+        :param keyring_pool: A pool of warm keyrings to be used for
+                             encryption, decryption, signing and
+                             verification. If None, a temporary keyring is
+                             built for each operation.
+        :type keyring_pool: GPGKeyringPool
+        :param crypto_executor: The executor where the blocking gpg
+                                operations are run. If None, they are run
+                                in the reactor threadpool.
+        :type crypto_executor: ThreadCryptoExecutor or
+                               ProcessCryptoExecutor
+        :param key_cache: A cache of keys to be invalidated whenever the
+                          stored keys are modified.
+        :type key_cache: leap.bitmask.keymanager.cache.KeyCache
         """
         self._soledad = soledad
         self._gpgbinary = gpgbinary
+        self._keyring_pool = keyring_pool
+        self._crypto_executor = crypto_executor
+        self._key_cache = key_cache
         self.deferred_init = init_indexes(soledad)
         self.deferred_init.addCallback(self._migrate_documents_schema)
-        self._wait_indexes("get_key", "put_key", "get_all_keys")
+        self._wait_indexes("get_key", "put_key", "get_all_keys",
+                           "iter_all_keys")
 
     def _migrate_documents_schema(self, _):
         migrator = KeyDocumentsMigrator(self._soledad)
@@ -158,6 +177,55 @@ class OpenPGPScheme(object):
 
         self.deferred_init.addCallback(restore)
 
+    def _keyring(self, keys=None):
+        """
+        Return a context manager for a keyring holding C{keys}, that must not
+        be modified while in use.
+
+        :param keys: OpenPGP key, or list of.
+        :type keys: OpenPGPKey or list of OpenPGPKeys
+
+        :rtype: TempGPGWrapper or PooledGPGWrapper
+        """
+        if self._keyring_pool is not None:
+            return self._keyring_pool.keyring(keys)
+        return TempGPGWrapper(keys, self._gpgbinary)
+
+    def _job_keyring(self, keys):
+        """
+        Return a context manager for a keyring holding C{keys}, to be handed
+        to a function run with L{_run}.
+
+        :param keys: OpenPGP key, or list of.
+        :type keys: OpenPGPKey or list of OpenPGPKeys
+        """
+        if self._crypto_executor is not None:
+            return self._crypto_executor.keyring(
+                keys, self._gpgbinary, self._keyring_pool)
+        return self._keyring(keys)
+
+    def _invalidate_cache(self, result, key=None, address=None):
+        """
+        Drop the keys modified in the storage from the key cache, if any.
+
+        :return: C{result}, so it can be used as a callback.
+        """
+        if self._key_cache is not None:
+            self._key_cache.invalidate(key=key, address=address)
+        return result
+
+    def _run(self, func, *args, **kwargs):
+        """
+        Run the blocking C{func} in the crypto executor, or in the reactor
+        threadpool if there is none.
+
+        :return: A Deferred which fires with the result of C{func}.
+        :rtype: Deferred
+        """
+        if self._crypto_executor is not None:
+            return self._crypto_executor.run(func, *args, **kwargs)
+        return from_thread(func, *args, **kwargs)
+
     #
     # Keys management
     #
@@ -270,39 +338,85 @@ class OpenPGPScheme(object):
         :return: A Deferred which fires with a list of all keys in local db.
         :rtype: Deferred
         """
-        HAS_ACTIVE = "has_active"
+        keys = yield self.iter_all_keys(private)
+        defer.returnValue(list(keys))
 
-        active_docs = yield self._soledad.get_from_index(
-            TAGS_PRIVATE_INDEX,
-            KEYMANAGER_ACTIVE_TAG,
-            '1' if private else '0')
-        key_docs = yield self._soledad.get_from_index(
-            TAGS_PRIVATE_INDEX,
-            KEYMANAGER_KEY_TAG,
-            '1' if private else '0')
+    def iter_all_keys(self, private=False):
+        """
+        Return an iterator over all keys stored in local database, that
+        builds each key only when it is reached.
 
-        keys = []
-        fp = lambda doc: doc.content[KEY_FINGERPRINT_KEY]
-        for active in active_docs:
-            fp_keys = filter(lambda k: fp(k) == fp(active), key_docs)
+        :param private: Include private keys
+        :type private: bool
 
-            if len(fp_keys) == 0:
-                yield self._soledad.delete_doc(active)
-                continue
-            elif len(fp_keys) == 1:
-                key = fp_keys[0]
-            else:
-                key = yield self._repair_key_docs(fp_keys)
-            key.content[HAS_ACTIVE] = True
-            keys.append(build_key_from_dict(key.content, active.content,
-                                            gpgbinary=self._gpgbinary))
+        :return: A Deferred which fires with an iterator of all keys in local
+                 db, the active ones first.
+        :rtype: Deferred
+        """
+        def build_keys(docs):
+            for keydoc, activedoc in docs:
+                active_content = activedoc.content if activedoc else None
+                yield build_key_from_dict(keydoc.content, active_content,
+                                          gpgbinary=self._gpgbinary)
+
+        d = self._get_all_key_docs(private)
+        d.addCallback(build_keys)
+        return d
+
+    @defer.inlineCallbacks
+    def _get_all_key_docs(self, private=False):
+        """
+        Return the documents of all keys stored in local database, joined
+        with their active documents by fingerprint.
 
-        unactive_keys = filter(lambda k: HAS_ACTIVE not in k.content, key_docs)
-        keys += map(lambda k: build_key_from_dict(k.content,
-                                                  gpgbinary=self._gpgbinary),
-                    unactive_keys)
-        defer.returnValue(keys)
+        Duplicated key documents are repaired and active documents without a
+        key are deleted, all at once.
 
+        :param private: Include private keys
+        :type private: bool
+
+        :return: A Deferred which fires with a list of (keydoc, activedoc)
+                 tuples, where activedoc is None for inactive keys.
+        :rtype: Deferred
+        """
+        private = '1' if private else '0'
+        active_docs, key_docs = yield defer.gatherResults([
+            self._soledad.get_from_index(
+                TAGS_PRIVATE_INDEX, KEYMANAGER_ACTIVE_TAG, private),
+            self._soledad.get_from_index(
+                TAGS_PRIVATE_INDEX, KEYMANAGER_KEY_TAG, private)],
+            consumeErrors=True).addErrback(lambda f: f.value.subFailure)
+
+        docs_by_fp = OrderedDict()
+        for doc in key_docs:
+            docs_by_fp.setdefault(
+                doc.content[KEY_FINGERPRINT_KEY], []).append(doc)
+
+        duplicated = [fp for fp, docs in docs_by_fp.items() if len(docs) > 1]
+        deferreds = [self._repair_key_docs(docs_by_fp[fp])
+                     for fp in duplicated]
+        active_by_fp = OrderedDict()
+        for active in active_docs:
+            fp = active.content[KEY_FINGERPRINT_KEY]
+            if fp in docs_by_fp:
+                active_by_fp.setdefault(fp, []).append(active)
+            else:
+                deferreds.append(self._soledad.delete_doc(active))
+        results = yield defer.gatherResults(
+            deferreds, consumeErrors=True).addErrback(
+                lambda f: f.value.subFailure)
+        for fp, keydoc in zip(duplicated, results):
+            docs_by_fp[fp] = [keydoc]
+
+        docs = []
+        for fp, actives in active_by_fp.items():
+            keydoc = docs_by_fp[fp][0]
+            docs.extend((keydoc, active) for active in actives)
+        docs.extend((keydocs[0], None) for fp, keydocs in docs_by_fp.items()
+                    if fp not in active_by_fp)
+        defer.returnValue(docs)
+
+    @defer.inlineCallbacks
     def parse_key(self, key_data, address=None):
         """
         Parses a key (or key pair) data and returns
@@ -313,21 +427,22 @@ class OpenPGPScheme(object):
         :param address: Active address for the key.
         :type address: str
 
-        :returns: the public key and private key (if applies) for that data.
-        :rtype: (public, private) -> tuple(OpenPGPKey, OpenPGPKey)
+        :returns: A Deferred which fires with the public key and private key
+                  (if applies) for that data.
+        :rtype: Deferred -> tuple(OpenPGPKey, OpenPGPKey)
                 the tuple may have one or both components None
         """
         leap_assert_type(key_data, (str, unicode))
         # TODO: add more checks for correct key data.
         leap_assert(key_data is not None, 'Data does not represent a key.')
 
-        priv_info, privkey = process_key(
-            key_data, self._gpgbinary, secret=True)
-        pub_info, pubkey = process_key(
-            key_data, self._gpgbinary, secret=False)
+        (priv_info, privkey), (pub_info, pubkey) = yield defer.gatherResults(
+            [self._run(process_key, key_data, self._gpgbinary, secret=True),
+             self._run(process_key, key_data, self._gpgbinary, secret=False)],
+            consumeErrors=True).addErrback(lambda f: f.value.subFailure)
 
         if not pubkey:
-            return (None, None)
+            defer.returnValue((None, None))
 
         openpgp_privkey = None
         if privkey:
@@ -340,7 +455,7 @@ class OpenPGPScheme(object):
         # build public key
         openpgp_pubkey = self._build_key_from_gpg(pub_info, pubkey, address)
 
-        return (openpgp_pubkey, openpgp_privkey)
+        defer.returnValue((openpgp_pubkey, openpgp_privkey))
 
     def put_raw_key(self, key_data, address):
         """
@@ -356,21 +471,19 @@ class OpenPGPScheme(object):
         """
         leap_assert_type(key_data, (str, unicode))
 
-        openpgp_privkey = None
-        try:
-            openpgp_pubkey, openpgp_privkey = self.parse_key(
-                key_data, address)
-        except (errors.KeyAddressMismatch, errors.KeyFingerprintMismatch) as e:
-            return defer.fail(e)
+        def put_keys((openpgp_pubkey, openpgp_privkey)):
+            d = defer.succeed(None)
+            if openpgp_pubkey is not None:
+                d.addCallback(put_key, openpgp_pubkey)
+            if openpgp_privkey is not None:
+                d.addCallback(put_key, openpgp_privkey)
+            return d
 
         def put_key(_, key):
             return self.put_key(key)
 
-        d = defer.succeed(None)
-        if openpgp_pubkey is not None:
-            d.addCallback(put_key, openpgp_pubkey)
-        if openpgp_privkey is not None:
-            d.addCallback(put_key, openpgp_privkey)
+        d = self.parse_key(key_data, address)
+        d.addCallback(put_keys)
         return d
 
     def put_key(self, key):
@@ -425,6 +538,7 @@ class OpenPGPScheme(object):
         d = self._get_key_doc_from_fingerprint(key.fingerprint, key.private)
         d.addCallback(get_active_doc)
         d.addCallback(merge_and_put)
+        d.addBoth(self._invalidate_cache, key=key)
         return d
 
     def _get_key_doc(self, address, private=False):
@@ -535,6 +649,7 @@ class OpenPGPScheme(object):
         d.addCallback(delete_docs)
         d.addCallback(get_key_docs)
         d.addCallback(delete_key)
+        d.addBoth(self._invalidate_cache, key=key)
         return d
 
     @defer.inlineCallbacks
@@ -543,8 +658,12 @@ class OpenPGPScheme(object):
         Mark a active doc as deleted.
         :param address: The unique address for the active content.
         """
-        active_doc = yield self._get_active_doc_from_address(address, False)
-        yield self._soledad.delete_doc(active_doc)
+        try:
+            active_doc = yield self._get_active_doc_from_address(
+                address, False)
+            yield self._soledad.delete_doc(active_doc)
+        finally:
+            self._invalidate_cache(None, address=address)
 
     #
     # Data encryption, decryption, signing and verifying
@@ -574,10 +693,13 @@ class OpenPGPScheme(object):
         """
         Encrypt C{data} using public @{pubkey} and sign with C{sign} key.
 
+        When C{pubkey} is a list of keys, the data is encrypted only once,
+        and can be decrypted with any of them.
+
         :param data: The data to be encrypted.
         :type data: str
-        :param pubkey: The key used to encrypt.
-        :type pubkey: OpenPGPKey
+        :param pubkey: The key, or list of keys, used to encrypt.
+        :type pubkey: OpenPGPKey or list of OpenPGPKeys
         :param sign: The key used for signing.
         :type sign: OpenPGPKey
         :param cipher_algo: The cipher algorithm to use.
@@ -588,36 +710,38 @@ class OpenPGPScheme(object):
 
         :raise EncryptError: Raised if failed encrypting for some reason.
         """
-        leap_assert_type(pubkey, OpenPGPKey)
-        leap_assert(pubkey.private is False, 'Key is not public.')
-        keys = [pubkey]
+        pubkeys = pubkey if isinstance(pubkey, list) else [pubkey]
+        leap_assert(pubkeys, 'No key to encrypt to.')
+        for key in pubkeys:
+            leap_assert_type(key, OpenPGPKey)
+            leap_assert(key.private is False, 'Key is not public.')
+        keys = list(pubkeys)
         if sign is not None:
             leap_assert_type(sign, OpenPGPKey)
             leap_assert(sign.private is True)
             keys.append(sign)
-        with TempGPGWrapper(keys, self._gpgbinary) as gpg:
-            kw = dict(
-                default_key=sign.fingerprint if sign else None,
-                passphrase=passphrase, symmetric=False,
-                cipher_algo=cipher_algo)
-            if not GNUPG_NG:
-                kw.pop('cipher_algo')
-                kw.pop('default_key')
-                kw.update(passphrase='')
-                kw.update(always_trust=True)
-            result = yield from_thread(
-                gpg.encrypt,
-                data, pubkey.fingerprint, **kw)
-            # Here we cannot assert for correctness of sig because the sig is
-            # in the ciphertext.
-            # result.ok    - (bool) indicates if the operation succeeded
-            # result.data  - (bool) contains the result of the operation
-            try:
-                self._assert_gpg_result_ok(result)
-                defer.returnValue(result.data)
-            except errors.GPGError as e:
-                self.log.warn('Failed to encrypt: %s.' % str(e))
-                raise errors.EncryptError()
+        kw = dict(
+            default_key=sign.fingerprint if sign else None,
+            passphrase=passphrase, symmetric=False,
+            cipher_algo=cipher_algo)
+        if not GNUPG_NG:
+            kw.pop('cipher_algo')
+            kw.pop('default_key')
+            kw.update(passphrase='')
+            kw.update(always_trust=True)
+        result = yield self._run(
+            _encrypt, self._job_keyring(keys), data,
+            [key.fingerprint for key in pubkeys], **kw)
+        # Here we cannot assert for correctness of sig because the sig is
+        # in the ciphertext.
+        # result.ok    - (bool) indicates if the operation succeeded
+        # result.data  - (bool) contains the result of the operation
+        try:
+            self._assert_gpg_result_ok(result)
+            defer.returnValue(result.data)
+        except errors.GPGError as e:
+            self.log.warn('Failed to encrypt: %s.' % str(e))
+            raise errors.EncryptError()
 
     @defer.inlineCallbacks
     def expire(self, seckey, expiration_time='1y', passphrase=None):
@@ -688,24 +812,23 @@ class OpenPGPScheme(object):
             leap_assert_type(verify, OpenPGPKey)
             leap_assert(verify.private is False)
             keys.append(verify)
-        with TempGPGWrapper(keys, self._gpgbinary) as gpg:
-            try:
-                result = yield from_thread(gpg.decrypt,
-                                           data, passphrase=passphrase,
-                                           always_trust=True)
-                self._assert_gpg_result_ok(result)
-
-                # verify signature
-                sign_valid = False
-                if (verify is not None and
-                        result.valid is True and
-                        verify.fingerprint == result.pubkey_fingerprint):
-                    sign_valid = True
-
-                defer.returnValue((result.data, sign_valid))
-            except errors.GPGError as e:
-                self.log.warn('Failed to decrypt: %s.' % str(e))
-                raise errors.DecryptError(str(e))
+        try:
+            result = yield self._run(
+                _decrypt, self._job_keyring(keys), data,
+                passphrase=passphrase, always_trust=True)
+            self._assert_gpg_result_ok(result)
+
+            # verify signature
+            sign_valid = False
+            if (verify is not None and
+                    result.valid is True and
+                    verify.fingerprint == result.pubkey_fingerprint):
+                sign_valid = True
+
+            defer.returnValue((result.data, sign_valid))
+        except errors.GPGError as e:
+            self.log.warn('Failed to decrypt: %s.' % str(e))
+            raise errors.DecryptError(str(e))
 
     def is_encrypted(self, data):
         """
@@ -717,10 +840,11 @@ class OpenPGPScheme(object):
         :return: Whether C{data} was encrypted using this wrapper.
         :rtype: bool
         """
-        with TempGPGWrapper(gpgbinary=self._gpgbinary) as gpg:
+        with self._keyring() as gpg:
             gpgutil = GPGUtilities(gpg)
             return gpgutil.is_encrypted_asym(data)
 
+    @defer.inlineCallbacks
     def sign(self, data, privkey, digest_algo='SHA512', clearsign=False,
              detach=True, binary=False):
         """
@@ -740,34 +864,32 @@ class OpenPGPScheme(object):
         :param binary: If True, do not ascii armour the output.
         :type binary: bool
 
-        :return: The ascii-armored signed data.
-        :rtype: str
+        :return: A Deferred which fires with the ascii-armored signed data.
+        :rtype: Deferred
         """
         leap_assert_type(privkey, OpenPGPKey)
         leap_assert(privkey.private is True)
 
         # result.fingerprint - contains the fingerprint of the key used to
         #                      sign.
-        with TempGPGWrapper(privkey, self._gpgbinary) as gpg:
-            kw = dict(default_key=privkey.fingerprint,
-                      digest_algo=digest_algo, clearsign=clearsign,
-                      detach=detach, binary=binary)
-            if not GNUPG_NG:
-                kw.pop('digest_algo')
-                kw.pop('default_key')
-            result = gpg.sign(data, **kw)
-            rfprint = privkey.fingerprint
-            privkey = gpg.list_keys(secret=True).pop()
-            kfprint = privkey['fingerprint']
-            if result.fingerprint is None:
-                raise errors.SignFailed(
-                    'Failed to sign with key %s: %s' %
-                    (privkey['fingerprint'], result.stderr))
-            leap_assert(
-                result.fingerprint == kfprint,
-                'Signature and private key fingerprints mismatch: '
-                '%s != %s' % (rfprint, kfprint))
-        return result.data
+        kw = dict(default_key=privkey.fingerprint,
+                  digest_algo=digest_algo, clearsign=clearsign,
+                  detach=detach, binary=binary)
+        if not GNUPG_NG:
+            kw.pop('digest_algo')
+            kw.pop('default_key')
+        result, kfprint = yield self._run(
+            _sign, self._job_keyring(privkey), data, **kw)
+        rfprint = privkey.fingerprint
+        if result.fingerprint is None:
+            raise errors.SignFailed(
+                'Failed to sign with key %s: %s' %
+                (kfprint, result.stderr))
+        leap_assert(
+            result.fingerprint == kfprint,
+            'Signature and private key fingerprints mismatch: '
+            '%s != %s' % (rfprint, kfprint))
+        defer.returnValue(result.data)
 
     def verify(self, data, pubkey, detached_sig=None):
         """
@@ -782,29 +904,13 @@ class OpenPGPScheme(object):
                              verified against this detached signature.
         :type detached_sig: str
 
-        :return: signature matches
-        :rtype: bool
+        :return: A Deferred which fires with whether the signature matches.
+        :rtype: Deferred
         """
         leap_assert_type(pubkey, OpenPGPKey)
         leap_assert(pubkey.private is False)
-        with TempGPGWrapper(pubkey, self._gpgbinary) as gpg:
-            result = None
-            if detached_sig is None:
-                result = gpg.verify(data)
-            else:
-                # to verify using a detached sig we have to use
-                # gpg.verify_file(), which receives the data as a binary
-                # stream and the name of a file containing the signature.
-                sf, sfname = tempfile.mkstemp()
-                with os.fdopen(sf, 'w') as sfd:
-                    sfd.write(detached_sig)
-                result = gpg.verify_file(io.BytesIO(data), sig_file=sfname)
-                os.unlink(sfname)
-            gpgpubkey = gpg.list_keys().pop()
-            valid = result.valid
-            rfprint = result.fingerprint
-            kfprint = gpgpubkey['fingerprint']
-            return valid and rfprint == kfprint
+        return self._run(_verify, self._job_keyring(pubkey), data,
+                         detached_sig=detached_sig)
 
     def _get_active_doc_from_address(self, address, private):
         d = self._soledad.get_from_index(
@@ -923,6 +1029,64 @@ class OpenPGPScheme(object):
         return d
 
 
+#
+# Blocking gpg operations, run in the crypto executor. They only take and
+# return picklable values so that they can also run in a worker process.
+#
+
+GPGResult = namedtuple(
+    'GPGResult',
+    ['ok', 'data', 'stderr', 'valid', 'fingerprint', 'pubkey_fingerprint'])
+
+
+def _gpg_result(result):
+    return GPGResult(
+        ok=getattr(result, 'ok', None),
+        data=getattr(result, 'data', None),
+        stderr=getattr(result, 'stderr', None),
+        valid=getattr(result, 'valid', None),
+        fingerprint=getattr(result, 'fingerprint', None),
+        pubkey_fingerprint=getattr(result, 'pubkey_fingerprint', None))
+
+
+def _encrypt(keyring, data, fingerprints, **kwargs):
+    with keyring as gpg:
+        return _gpg_result(gpg.encrypt(data, fingerprints, **kwargs))
+
+
+def _decrypt(keyring, data, **kwargs):
+    with keyring as gpg:
+        return _gpg_result(gpg.decrypt(data, **kwargs))
+
+
+def _sign(keyring, data, **kwargs):
+    with keyring as gpg:
+        result = gpg.sign(data, **kwargs)
+        privkey = gpg.list_keys(secret=True).pop()
+        return _gpg_result(result), privkey['fingerprint']
+
+
+def _verify(keyring, data, detached_sig=None):
+    with keyring as gpg:
+        result = None
+        if detached_sig is None:
+            result = gpg.verify(data)
+        else:
+            # to verify using a detached sig we have to use
+            # gpg.verify_file(), which receives the data as a binary
+            # stream and the name of a file containing the signature.
+            sf, sfname = tempfile.mkstemp()
+            with os.fdopen(sf, 'w') as sfd:
+                sfd.write(detached_sig)
+            result = gpg.verify_file(io.BytesIO(data), sig_file=sfname)
+            os.unlink(sfname)
+        gpgpubkey = gpg.list_keys().pop()
+        valid = result.valid
+        rfprint = result.fingerprint
+        kfprint = gpgpubkey['fingerprint']
+        return valid and rfprint == kfprint
+
+
 def process_key(key_data, gpgbinary, secret=False):
     with TempGPGWrapper(gpgbinary=gpgbinary) as gpg:
         try:
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# packets.py
+# Copyright (C) 2018 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Minimal parsing of OpenPGP packets (RFC 4880), to learn which keys a message
+is encrypted to without running gpg.
+"""
+import binascii
+import hashlib
+import struct
+
+
+# packet tags
+PUBKEY_ENC_SESSION_KEY = 1
+SYM_ENC_SESSION_KEY = 3
+SECRET_KEY = 5
+PUBLIC_KEY = 6
+SECRET_SUBKEY = 7
+MARKER = 10
+PUBLIC_SUBKEY = 14
+
+KEY_TAGS = (SECRET_KEY, PUBLIC_KEY, SECRET_SUBKEY, PUBLIC_SUBKEY)
+
+# the key id of an anonymous recipient
+WILDCARD_KEY_ID = '0' * 16
+
+# number of MPIs in the public part of a key, by public key algorithm
+_KEY_MPIS = {
+    1: 2, 2: 2, 3: 2,  # RSA: n, e
+    16: 3, 20: 3,  # Elgamal: p, g, y
+    17: 4,  # DSA: p, q, g, y
+}
+# elliptic curve algorithms: curve oid, point and, for ECDH, kdf parameters
+_ECDH = 18
+_EC_ALGOS = (_ECDH, 19, 22)
+
+
+class PacketError(Exception):
+    """
+    Raised when the data is not a well formed sequence of OpenPGP packets.
+    """
+
+
+def get_recipient_key_ids(data):
+    """
+    Return the ids of the keys an OpenPGP message is encrypted to, as found
+    in its public-key encrypted session key packets.
+
+    Anonymous recipients have the L{WILDCARD_KEY_ID}.
+
+    :param data: The encrypted message, ascii armored or binary.
+    :type data: str
+
+    :return: The key ids as uppercase hex strings, or None if C{data} can
+             not be parsed.
+    :rtype: list of str
+    """
+    try:
+        key_ids = []
+        for tag, body in _iter_packets(_dearmor(data)):
+            if tag in (SYM_ENC_SESSION_KEY, MARKER):
+                continue
+            if tag != PUBKEY_ENC_SESSION_KEY:
+                # the session keys come before the encrypted data
+                break
+            if len(body) < 9 or ord(body[0]) != 3:
+                # unknown version, the key id can not be trusted
+                key_ids.append(WILDCARD_KEY_ID)
+            else:
+                key_ids.append(binascii.hexlify(body[1:9]).upper())
+        return key_ids
+    except (PacketError, TypeError, ValueError, struct.error):
+        return None
+
+
+def get_key_ids(key_data):
+    """
+    Return the ids of the primary key and the subkeys in C{key_data}.
+
+    :param key_data: A public or secret key, ascii armored or binary.
+    :type key_data: str
+
+    :return: The key ids as uppercase hex strings, or an empty set if
+             C{key_data} can not be parsed.
+    :rtype: set of str
+    """
+    key_ids = set()
+    try:
+        for tag, body in _iter_packets(_dearmor(key_data)):
+            if tag not in KEY_TAGS or not body or ord(body[0]) != 4:
+                continue
+            if tag in (SECRET_KEY, SECRET_SUBKEY):
+                body = body[:_public_key_length(body)]
+            digest = hashlib.sha1(
+                '\x99' + struct.pack('>H', len(body)) + body).digest()
+            key_ids.add(binascii.hexlify(digest[-8:]).upper())
+    except (PacketError, TypeError, ValueError, struct.error):
+        pass
+    return key_ids
+
+
+def _dearmor(data):
+    """
+    Return the binary content of ascii armored C{data}, or C{data} itself if
+    it is not armored.
+    """
+    if isinstance(data, unicode):
+        data = data.encode('ascii')
+    start = data.find('-----BEGIN PGP ')
+    if start == -1:
+        return data
+    lines = iter(data[start:].splitlines()[1:])
+    # skip the armor headers
+    for line in lines:
+        if not line.strip():
+            break
+    encoded = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith('=') or line.startswith('-----'):
+            break
+        encoded.append(line)
+    return binascii.a2b_base64(''.join(encoded))
+
+
+def _iter_packets(data):
+    """
+    Iterate over the (tag, body) of the packets in binary C{data}.
+
+    The iteration stops at a packet with a partial body length, which are
+    only used for data packets.
+    """
+    pos = 0
+    end = len(data)
+    while pos < end:
+        ctb = ord(data[pos])
+        pos += 1
+        if not ctb & 0x80:
+            raise PacketError('Not an OpenPGP packet.')
+        if ctb & 0x40:
+            # new packet format
+            tag = ctb & 0x3f
+            first = ord(data[pos])
+            pos += 1
+            if first < 192:
+                length = first
+            elif first < 224:
+                length = ((first - 192) << 8) + ord(data[pos]) + 192
+                pos += 1
+            elif first == 255:
+                length, = struct.unpack('>I', data[pos:pos + 4])
+                pos += 4
+            else:
+                yield tag, None
+                return
+        else:
+            # old packet format
+            tag = (ctb >> 2) & 0x0f
+            length_type = ctb & 0x03
+            if length_type == 3:
+                length = end - pos
+            else:
+                size = 1 << length_type
+                length, = struct.unpack(
+                    ('>B', '>H', '>I')[length_type], data[pos:pos + size])
+                pos += size
+        if pos + length > end:
+            raise PacketError('Truncated OpenPGP packet.')
+        yield tag, data[pos:pos + length]
+        pos += length
+
+
+def _public_key_length(body):
+    """
+    Return the length of the public part of a version 4 key packet body.
+    """
+    # version, creation time and algorithm
+    pos = 6
+    algo = ord(body[5])
+    if algo in _KEY_MPIS:
+        mpis = _KEY_MPIS[algo]
+    elif algo in _EC_ALGOS:
+        pos += 1 + ord(body[pos])  # curve oid
+        mpis = 1
+    else:
+        raise PacketError('Unknown public key algorithm %d.' % algo)
+    for _ in range(mpis):
+        bits, = struct.unpack('>H', body[pos:pos + 2])
+        pos += 2 + (bits + 7) // 8
+    if algo == _ECDH:
+        pos += 1 + ord(body[pos])  # kdf parameters
+    if pos > len(body):
+        raise PacketError('Truncated key packet.')
+    return pos
@@ -17,14 +17,22 @@
 
 
 """
-A service which continuous refreshes the (public) key directories randomly in a
-random time interval.
+A service which continuously refreshes the (public) keys of the key directory
+in small batches, at random time intervals. The keys that have gone longer
+without a refresh, and the ones about to expire, are refreshed first.
 """
 
+import json
+import os
+import platform
+import time
+
+from heapq import nsmallest
+from random import randrange
+
 from twisted.internet.task import LoopingCall
 from twisted.logger import Logger
 from twisted.internet import defer
-from random import choice, randrange
 
 DEBUG_STOP_REFRESH = "Stop to refresh the key directory ..."
 DEBUG_START_REFRESH = "Start to refresh the key directory ..."
@@ -32,22 +40,54 @@ ERROR_UNEQUAL_FINGERPRINTS = "[WARNING] Your provider *might* be cheating " \
                              "on you, and given a wrong key back. " \
                              "Fingerprints do not match: old-> %s, new-> %s "
 
+# keys refreshed at the same time
+BATCH_SIZE = 4
+# key requests sent to the nickserver per hour, at most
+MAX_REQUESTS_PER_HOUR = 60
+
 MIN_RANDOM_INTERVAL_RANGE = 4 * 60  # four minutes
 MAX_RANDOM_INTERVAL_RANGE = 6 * 60  # six minutes
 
+REFRESH_PERIOD = 24 * 60 * 60  # a key is due for refresh once a day
+EXPIRY_MARGIN = 7 * 24 * 60 * 60  # or four times a day, a week before expiry
+RESCAN_PERIOD = 60 * 60  # the stored keys are listed again every hour
+
+IS_WIN = platform.system() == "Windows"
+
 
 class RandomRefreshPublicKey(object):
 
     log = Logger()
 
-    def __init__(self, openpgp, keymanager):
+    def __init__(self, openpgp, keymanager, schedule_path=None,
+                 batch_size=BATCH_SIZE,
+                 max_requests_per_hour=MAX_REQUESTS_PER_HOUR):
         """
         Initialize the RandomRefreshPublicKey.
         :param openpgp: Openpgp object.
         :param keymanager: The key manager.
+        :param schedule_path: The file where the time of the last refresh of
+                              each key is kept. If None, it is only kept in
+                              memory.
+        :type schedule_path: str
+        :param batch_size: The number of keys refreshed at the same time.
+        :type batch_size: int
+        :param max_requests_per_hour: The maximum number of keys refreshed
+                                      per hour.
+        :type max_requests_per_hour: int
         """
         self._openpgp = openpgp
         self._keymanger = keymanager
+        self._schedule_path = schedule_path
+        self._batch_size = batch_size
+        self._max_requests_per_hour = max_requests_per_hour
+        # the stored keys, listed every RESCAN_PERIOD
+        self._keys = None
+        self._scanned_at = None
+        # fingerprint -> unix time of the last refresh
+        self._refreshed = self._load_schedule()
+        self._requests = 0
+        self._failures = 0
         self._loop = LoopingCall(self._refresh_continuous)
         self._loop.interval = self._get_random_interval_to_refresh()
 
@@ -68,15 +108,56 @@ class RandomRefreshPublicKey(object):
         self._loop.stop()
         self.log.debug(DEBUG_STOP_REFRESH)
 
+    def get_stats(self):
+        """
+        Return how up to date the keys are.
+
+        :return: The number of keys, how many of them are not due for
+                 refresh, that fraction as coverage, the seconds since the
+                 stalest key was refreshed, and the number of refresh
+                 requests and failures.
+        :rtype: dict
+        """
+        now = self._now()
+        ages = [now - self._get_refreshed_at(key) for key in self._keys or []]
+        fresh = len([age for age in ages if age < REFRESH_PERIOD])
+        return {'keys': len(ages), 'fresh': fresh,
+                'coverage': float(fresh) / len(ages) if ages else 1.0,
+                'stalest': max(ages) if ages else 0,
+                'requests': self._requests, 'failures': self._failures}
+
     @defer.inlineCallbacks
-    def _get_random_key(self):
+    def _get_keys_to_refresh(self):
         """
-        Get a random key of all the keys in a users key doc.
-        :return: A random key.
+        Get the keys that are due for refresh, the most urgent first, and no
+        more than a batch of them.
+        :return: A list of keys.
         :rtype: A deferred.
         """
-        keys = yield self._openpgp.get_all_keys()
-        defer.returnValue(None if keys is None or keys == [] else choice(keys))
+        now = self._now()
+        if self._keys is None or now - self._scanned_at >= RESCAN_PERIOD:
+            self._keys = yield self._openpgp.get_all_keys()
+            self._scanned_at = now
+        due = [key for key in self._keys if self._get_due_at(key) <= now]
+        defer.returnValue(
+            nsmallest(self._batch_size, due, key=self._get_due_at))
+
+    def _get_refreshed_at(self, key):
+        refreshed_at = self._refreshed.get(key.fingerprint)
+        if refreshed_at is None and key.refreshed_at is not None:
+            refreshed_at = time.mktime(key.refreshed_at.timetuple())
+        return refreshed_at or 0
+
+    def _get_due_at(self, key):
+        """
+        Return the unix time when C{key} is due for refresh.
+        """
+        period = REFRESH_PERIOD
+        if key.expiry_date is not None:
+            expiry = time.mktime(key.expiry_date.timetuple())
+            if expiry - self._now() < EXPIRY_MARGIN:
+                period = REFRESH_PERIOD // 4
+        return self._get_refreshed_at(key) + period
 
     @defer.inlineCallbacks
     def _refresh_continuous(self):
@@ -84,7 +165,29 @@ class RandomRefreshPublicKey(object):
         The LoopingCall to refresh the key doc continuously.
         """
         self._loop.interval = self._get_random_interval_to_refresh()
-        yield self.maybe_refresh_key()
+        keys = yield self._get_keys_to_refresh()
+        if keys:
+            yield defer.gatherResults([self._refresh(key) for key in keys])
+            self._save_schedule()
+
+    def _refresh(self, key):
+        """
+        Refresh C{key}, and schedule its next refresh even if it fails, so
+        that a failing key does not take the place of the others.
+        """
+        def failed(failure):
+            self._failures += 1
+            self.log.warn('Error refreshing key %s: %r'
+                          % (key.fingerprint, failure.value))
+
+        def schedule(_):
+            self._refreshed[key.fingerprint] = self._now()
+
+        self._requests += 1
+        d = self.maybe_refresh_key(key)
+        d.addErrback(failed)
+        d.addCallback(schedule)
+        return d
 
     @defer.inlineCallbacks
     def _maybe_unactivate_key(self, key):
@@ -97,19 +200,15 @@ class RandomRefreshPublicKey(object):
             key.set_unactive()
 
     @defer.inlineCallbacks
-    def maybe_refresh_key(self):
+    def maybe_refresh_key(self, old_key):
         """
         Get key from nicknym and try to refresh.
+        :param old_key: The key to be refreshed.
         """
-        old_key = yield self._get_random_key()
-
-        if old_key is None:
-            defer.returnValue(None)
-
         updated_key_data = yield self._keymanger._nicknym.\
             fetch_key_with_fingerprint(old_key.fingerprint)
-        updated_key, _ = self._openpgp.parse_key(updated_key_data,
-                                                 old_key.address)
+        updated_key, _ = yield self._openpgp.parse_key(updated_key_data,
+                                                       old_key.address)
 
         if updated_key.fingerprint != old_key.fingerprint:
             self.log.error(
@@ -131,10 +230,47 @@ class RandomRefreshPublicKey(object):
 
     def _get_random_interval_to_refresh(self):
         """
-        Return a random quantity, in minutes, to be used as the refresh
-        interval.
+        Return a random quantity, in seconds, to be used as the refresh
+        interval. The random jitter keeps the requests from disclosing a
+        pattern.
 
-        :return: A random integer, in the interval defined by the constants
+        :return: A random integer, no shorter than the interval in which a
+        batch of requests fits in the hourly budget, and half of it longer at
+        most. With the defaults, in the interval defined by the constants
         (MIN_RANDOM_INTERVAL_RANGE, MAX_RANDOM_INTERVAL_RANGE).
         """
-        return randrange(MIN_RANDOM_INTERVAL_RANGE, MAX_RANDOM_INTERVAL_RANGE)
+        interval = max(
+            1, self._batch_size * 60 * 60 // self._max_requests_per_hour)
+        return randrange(interval, interval * 3 // 2 + 1)
+
+    def _now(self):
+        return self._loop.clock.seconds()
+
+    def _load_schedule(self):
+        if self._schedule_path is None:
+            return {}
+        try:
+            with open(self._schedule_path) as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            if os.path.isfile(self._schedule_path):
+                self.log.warn('Error loading the refresh schedule: %r' % (e,))
+            return {}
+
+    def _save_schedule(self):
+        """
+        Save the time of the last refresh of each key. The file is replaced
+        atomically, so that it is never left half written.
+        """
+        if self._schedule_path is None:
+            return
+        folder = os.path.dirname(self._schedule_path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        tmp_path = self._schedule_path + '.tmp'
+        with open(tmp_path, 'w') as out:
+            json.dump(self._refreshed, out)
+        if IS_WIN and os.path.isfile(self._schedule_path):
+            # rename does not replace existing files on windows
+            os.remove(self._schedule_path)
+        os.rename(tmp_path, self._schedule_path)
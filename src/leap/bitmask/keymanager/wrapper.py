@@ -15,12 +15,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
-GPG wrapper for temporary keyrings
+GPG wrappers for temporary and pooled keyrings
 """
+import hashlib
 import os
 import platform
 import shutil
 import tempfile
+import threading
+
+from collections import OrderedDict
 
 from gnupg import GPG
 
@@ -35,6 +39,15 @@ except ImportError:
     GNUPG_NG = False
 
 
+# Memory-backed filesystems where pooled keyrings can live without ever
+# touching the disk. The first writable one is used.
+TMPFS_DIRS = ('/dev/shm', '/run/shm')
+
+DEFAULT_POOL_SIZE = 8
+
+log = Logger()
+
+
 class TempGPGWrapper(object):
     """
     A context manager that wraps a temporary GPG keyring which only contains
@@ -85,48 +98,8 @@ class TempGPGWrapper(object):
         :return: A GPG instance containing the keys given on object creation.
         :rtype: gnupg.GPG
         """
-        privkeys = [key for key in self._keys if key and key.private is True]
-        publkeys = [key for key in self._keys if key and key.private is False]
-        # here we filter out public keys that have a correspondent
-        # private key in the list because the private key_data by
-        # itself is enough to also have the public key in the keyring,
-        # and we want to count the keys afterwards.
-
-        privfps = map(lambda privkey: privkey.fingerprint, privkeys)
-        publkeys = filter(
-            lambda pubkey: pubkey.fingerprint not in privfps, publkeys)
-
-        listkeys = lambda: self._gpg.list_keys()
-        listsecretkeys = lambda: self._gpg.list_keys(secret=True)
-
-        try:
-            self._gpg = GPG(binary=self._gpgbinary,
-                            homedir=tempfile.mkdtemp())
-        except TypeError:
-            # compat-mode with python-gnupg until windows
-            # support is fixed in gnupg-ng
-            self._gpg = GPG(gpgbinary=self._gpgbinary,
-                            gnupghome=tempfile.mkdtemp(),
-                            options=[])
-
-        leap_assert(len(listkeys()) is 0, 'Keyring not empty.')
-
-        # import keys into the keyring:
-        # concatenating ascii-armored keys, which is correctly
-        # understood by GPG.
-
-        self._gpg.import_keys("".join(
-            [x.key_data for x in publkeys + privkeys]))
-
-        # assert the number of keys in the keyring
-        leap_assert(
-            len(listkeys()) == len(publkeys) + len(privkeys),
-            'Wrong number of public keys in keyring: %d, should be %d)' %
-            (len(listkeys()), len(publkeys) + len(privkeys)))
-        leap_assert(
-            len(listsecretkeys()) == len(privkeys),
-            'Wrong number of private keys in keyring: %d, should be %d)' %
-            (len(listsecretkeys()), len(privkeys)))
+        self._gpg = _new_gpg(self._gpgbinary, tempfile.mkdtemp())
+        _import_keys(self._gpg, self._keys)
 
     def _destroy_keyring(self):
         """
@@ -148,16 +121,326 @@ class TempGPGWrapper(object):
             raise
 
         finally:
+            _remove_homedir(self._gpg)
+
+
+class PooledGPGWrapper(object):
+    """
+    A context manager with the same interface as L{TempGPGWrapper}, but which
+    borrows a warm keyring from a L{GPGKeyringPool} instead of building and
+    destroying one for every operation.
+
+    The keyring must not be modified (no imports, deletions or key
+    generation) while it is borrowed, as other operations may be using it
+    concurrently.
+    """
+
+    def __init__(self, pool, keys=None):
+        """
+        :param pool: The pool to borrow the keyring from.
+        :type pool: GPGKeyringPool
+        :param keys: OpenPGP key, or list of.
+        :type keys: OpenPGPKey or list of OpenPGPKeys
+        """
+        self._pool = pool
+        if not keys:
+            keys = list()
+        if not isinstance(keys, list):
+            keys = [keys]
+        self._keys = keys
+        self._keyring = None
+
+    def __enter__(self):
+        """
+        Borrow a GPG keyring containing exactly the keys given on object
+        creation.
+
+        :return: A GPG instance containing the keys given on object creation.
+        :rtype: gnupg.GPG
+        """
+        self._keyring = self._pool.acquire(self._keys)
+        return self._keyring.gpg
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Give the keyring back to the pool.
+        """
+        self._pool.release(self._keyring)
+        self._keyring = None
+
+
+class _PooledKeyring(object):
+    """
+    A warm keyring held by a L{GPGKeyringPool}.
+    """
+
+    def __init__(self, keyring_id, gpg):
+        self.keyring_id = keyring_id
+        self.gpg = gpg
+        self.users = 0
+
+
+class GPGKeyringPool(object):
+    """
+    A bounded pool of warm GPG keyrings, indexed by the set of keys they
+    hold.
+
+    Building a keyring means creating a homedir, probing the gpg binary
+    version and importing the keys, which dominates the cost of a single
+    encryption or decryption. The pool keeps up to C{size} keyrings alive,
+    in a memory-backed directory when one is available, and hands them out
+    again whenever an operation needs the same keys. The least recently
+    used idle keyring is wiped when the pool grows over its size.
+    """
+    log = Logger()
+
+    def __init__(self, size=DEFAULT_POOL_SIZE, gpgbinary=None, basedir=None):
+        """
+        :param size: Maximum number of idle keyrings kept alive.
+        :type size: int
+        :param gpgbinary: Name for GnuPG binary executable.
+        :type gpgbinary: C{str}
+        :param basedir: Directory in which keyring homedirs are created. If
+                        not given, a tmpfs mount is used when available.
+        :type basedir: C{str}
+        """
+        leap_assert(size > 0, 'Keyring pool size must be positive.')
+        self._size = size
+        self._gpgbinary = gpgbinary
+        self._basedir = basedir or _get_tmpfs_dir()
+        self._keyrings = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._keyrings)
+
+    def keyring(self, keys=None):
+        """
+        Return a context manager that borrows a keyring holding C{keys}.
+
+        :param keys: OpenPGP key, or list of.
+        :type keys: OpenPGPKey or list of OpenPGPKeys
+
+        :rtype: PooledGPGWrapper
+        """
+        return PooledGPGWrapper(self, keys)
+
+    def acquire(self, keys):
+        """
+        Borrow a keyring holding exactly C{keys}, building it if needed.
+
+        :param keys: The keys that the keyring must hold.
+        :type keys: list of OpenPGPKeys
+
+        :rtype: _PooledKeyring
+        """
+        keyring_id = _keyring_id(keys)
+        with self._lock:
+            keyring = self._checkout(keyring_id)
+            if keyring is not None:
+                self.hits += 1
+                return keyring
+            self.misses += 1
+
+        # building a keyring spawns gpg several times, so it is done without
+        # holding the lock to not serialize every other operation behind it.
+        gpg = _new_gpg(self._gpgbinary, tempfile.mkdtemp(dir=self._basedir))
+        try:
+            _import_keys(gpg, keys)
+        except Exception:
+            _remove_homedir(gpg, wipe=True)
+            raise
+
+        with self._lock:
+            # another thread may have published the same keyring meanwhile
+            keyring = self._checkout(keyring_id)
+            if keyring is None:
+                keyring = _PooledKeyring(keyring_id, gpg)
+                self._keyrings[keyring_id] = keyring
+                keyring.users += 1
+                self._evict()
+                return keyring
+        _remove_homedir(gpg, wipe=True)
+        return keyring
+
+    def release(self, keyring):
+        """
+        Give back a keyring borrowed with L{acquire}.
+
+        :param keyring: The borrowed keyring.
+        :type keyring: _PooledKeyring
+        """
+        with self._lock:
+            keyring.users -= 1
+            self._evict()
+
+    def clear(self):
+        """
+        Wipe all idle keyrings in the pool.
+        """
+        with self._lock:
+            for keyring_id, keyring in self._keyrings.items():
+                if keyring.users == 0:
+                    del self._keyrings[keyring_id]
+                    _remove_homedir(keyring.gpg, wipe=True)
+
+    def stats(self):
+        """
+        Return the pool usage counters.
+
+        :rtype: dict
+        """
+        return {'size': len(self._keyrings), 'max_size': self._size,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+    def _checkout(self, keyring_id):
+        # must be called with the lock held
+        keyring = self._keyrings.pop(keyring_id, None)
+        if keyring is None:
+            return None
+        # reinsert as the most recently used one
+        self._keyrings[keyring_id] = keyring
+        keyring.users += 1
+        return keyring
+
+    def _evict(self):
+        # keyrings that are in use are never evicted, so the pool may
+        # temporarily hold more than its size while all of them are busy.
+        excess = len(self._keyrings) - self._size
+        if excess <= 0:
+            return
+        for keyring_id, keyring in self._keyrings.items():
+            if excess == 0:
+                break
+            if keyring.users == 0:
+                del self._keyrings[keyring_id]
+                _remove_homedir(keyring.gpg, wipe=True)
+                self.evictions += 1
+                excess -= 1
+
+
+def _keyring_id(keys):
+    """
+    Identify a keyring by the keys it holds. The digest of the key data is
+    part of the identifier so a key renewed with the same fingerprint does
+    not reuse a keyring that holds the old one.
+
+    :rtype: frozenset
+    """
+    return frozenset(
+        (key.fingerprint, key.private, hashlib.sha1(key.key_data).digest())
+        for key in keys if key)
+
+
+def _get_tmpfs_dir():
+    """
+    Return the first writable memory-backed directory, or None if there is
+    none and the default temporary directory has to be used.
+    """
+    if platform.system() == "Windows":
+        return None
+    for path in TMPFS_DIRS:
+        if os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK):
+            return path
+    return None
+
+
+def _new_gpg(gpgbinary, homedir):
+    """
+    Create a GPG instance with its home in C{homedir}.
+    """
+    try:
+        return GPG(binary=gpgbinary, homedir=homedir)
+    except TypeError:
+        # compat-mode with python-gnupg until windows
+        # support is fixed in gnupg-ng
+        return GPG(gpgbinary=gpgbinary, gnupghome=homedir, options=[])
+
+
+def _import_keys(gpg, keys):
+    """
+    Import C{keys} into the empty keyring of C{gpg}.
+
+    :param gpg: The GPG instance.
+    :type gpg: gnupg.GPG
+    :param keys: The keys to import.
+    :type keys: list of OpenPGPKeys
+    """
+    privkeys = [key for key in keys if key and key.private is True]
+    publkeys = [key for key in keys if key and key.private is False]
+    # here we filter out public keys that have a correspondent
+    # private key in the list because the private key_data by
+    # itself is enough to also have the public key in the keyring,
+    # and we want to count the keys afterwards.
+
+    privfps = map(lambda privkey: privkey.fingerprint, privkeys)
+    publkeys = filter(
+        lambda pubkey: pubkey.fingerprint not in privfps, publkeys)
+
+    listkeys = lambda: gpg.list_keys()
+    listsecretkeys = lambda: gpg.list_keys(secret=True)
+
+    leap_assert(len(listkeys()) is 0, 'Keyring not empty.')
+
+    # import keys into the keyring:
+    # concatenating ascii-armored keys, which is correctly
+    # understood by GPG.
+
+    gpg.import_keys("".join(
+        [x.key_data for x in publkeys + privkeys]))
+
+    # assert the number of keys in the keyring
+    leap_assert(
+        len(listkeys()) == len(publkeys) + len(privkeys),
+        'Wrong number of public keys in keyring: %d, should be %d)' %
+        (len(listkeys()), len(publkeys) + len(privkeys)))
+    leap_assert(
+        len(listsecretkeys()) == len(privkeys),
+        'Wrong number of private keys in keyring: %d, should be %d)' %
+        (len(listsecretkeys()), len(privkeys)))
+
+
+def _remove_homedir(gpg, wipe=False):
+    """
+    Remove the home directory of C{gpg}, overwriting its files first if
+    C{wipe} is True.
+    """
+    try:
+        homedir = gpg.homedir
+    except AttributeError:
+        homedir = gpg.gnupghome
+    leap_assert(homedir != os.path.expanduser('~/.gnupg'),
+                "watch out! Tried to remove default gnupg home!")
+    # TODO some windows debug ....
+    homedir = os.path.normpath(homedir).replace("\\", "/")
+    homedir = str(homedir.replace("c:/", "c://"))
+    if platform.system() == "Windows":
+        log.error("BUG! Not erasing folder in Windows")
+        return
+    if wipe:
+        _wipe_files(homedir)
+    shutil.rmtree(homedir)
+
+
+def _wipe_files(path):
+    """
+    Overwrite with zeros every regular file under C{path}.
+    """
+    for root, _, files in os.walk(path):
+        for name in files:
+            filename = os.path.join(root, name)
+            if os.path.islink(filename) or not os.path.isfile(filename):
+                continue
             try:
-                homedir = self._gpg.homedir
-            except AttributeError:
-                homedir = self._gpg.gnupghome
-            leap_assert(homedir != os.path.expanduser('~/.gnupg'),
-                        "watch out! Tried to remove default gnupg home!")
-            # TODO some windows debug ....
-            homedir = os.path.normpath(homedir).replace("\\", "/")
-            homedir = str(homedir.replace("c:/", "c://"))
-            if platform.system() == "Windows":
-                self.log.error("BUG! Not erasing folder in Windows")
-                return
-            shutil.rmtree(homedir)
+                size = os.path.getsize(filename)
+                with open(filename, 'r+b') as f:
+                    f.write('\0' * size)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except (IOError, OSError):
+                # sockets and files removed by gpg-agent in the meantime
+                pass
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# locks.py
+# Copyright (C) 2018 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Deferred locks scoped by key.
+"""
+import time
+
+from twisted.internet import defer
+
+
+class KeyedLocks(object):
+    """
+    A set of DeferredLocks, one for each key, so that the operations on
+    independent keys (a store, a mailbox in a store...) do not wait for each
+    other.
+
+    The locks are created on demand, and dropped as soon as nobody holds or
+    waits for them. The contention is counted, for diagnosis.
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self.acquired = 0
+        self.contended = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.max_queue = 0
+
+    def run(self, keys, f, *args, **kwargs):
+        """
+        Run C{f} while holding the locks for all of C{keys}.
+
+        :param keys: the keys to lock.
+        :type keys: list
+        :param f: the function to run.
+        :type f: callable
+
+        :return: a deferred that will fire with the result of C{f}.
+        :rtype: Deferred
+        """
+        # the locks are always taken in the same order, so that two runs
+        # with common keys do not deadlock
+        keys = sorted(set(keys))
+
+        def execute(_):
+            d = defer.maybeDeferred(f, *args, **kwargs)
+            d.addBoth(release)
+            return d
+
+        def release(result):
+            for key in keys:
+                self._release(key)
+            return result
+
+        d = defer.succeed(None)
+        for key in keys:
+            d.addCallback(lambda _, key=key: self._acquire(key))
+        d.addCallback(execute)
+        return d
+
+    def _acquire(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = defer.DeferredLock()
+        self.acquired += 1
+        if not lock.locked:
+            return lock.acquire()
+
+        self.contended += 1
+        self.max_queue = max(self.max_queue, len(lock.waiting) + 1)
+        d = lock.acquire()
+        d.addCallback(self._count_wait, time.time())
+        return d
+
+    def _count_wait(self, lock, started):
+        waited = time.time() - started
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+        return lock
+
+    def _release(self, key):
+        lock = self._locks[key]
+        lock.release()
+        if not lock.locked:
+            del self._locks[key]
+
+    def get_stats(self):
+        """
+        Get the contention statistics of the locks.
+
+        :return: the number of locks held, and of runs waiting for them, the
+                 number of locks acquired and of those that had to wait,
+                 the total and maximum seconds waited, and the longest
+                 queue for a lock so far.
+        :rtype: dict
+        """
+        return {
+            'held': len(self._locks),
+            'waiting': sum(len(lock.waiting) for lock in self._locks.values()),
+            'acquired': self.acquired,
+            'contended': self.contended,
+            'wait_time': self.wait_time,
+            'max_wait_time': self.max_wait_time,
+            'max_queue': self.max_queue,
+        }
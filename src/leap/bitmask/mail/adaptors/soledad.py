@@ -17,12 +17,14 @@
 Soledadad MailAdaptor module.
 """
 import re
+import time
 
 from collections import defaultdict
 from email import message_from_string
 
 from twisted.internet import defer
 from twisted.logger import Logger
+from twisted.python.failure import Failure
 from zope.interface import implements
 
 from leap.common.check import leap_assert, leap_assert_type
@@ -31,11 +33,14 @@ from leap.bitmask.mail import constants
 from leap.bitmask.mail import walk
 from leap.bitmask.mail.adaptors import soledad_indexes as indexes
 from leap.bitmask.mail.constants import INBOX_NAME
+from leap.bitmask.mail.constants import MessageFlags
 from leap.bitmask.mail.adaptors import models
+from leap.bitmask.mail.adaptors.locks import KeyedLocks
 from leap.bitmask.mail.imap.mailbox import normalize_mailbox
 from leap.bitmask.mail.utils import lowerdict, first
 from leap.bitmask.mail.utils import stringify_parts_map
 from leap.bitmask.mail.interfaces import IMailAdaptor, IMessageWrapper
+from leap.bitmask.mail.mailbox_indexer import MAX_SQL_VARIABLES
 
 from leap.soledad.common import l2db
 from leap.soledad.common.document import SoledadDocument
@@ -61,7 +66,126 @@ def cleanup_deferred_locks():
     Need to use this from within trial to cleanup the reactor before
     each run.
     """
-    SoledadDocumentWrapper._k_locks = defaultdict(defer.DeferredLock)
+    SoledadDocumentWrapper._k_locks = KeyedLocks()
+    SoledadMailAdaptor._mbox_locks = KeyedLocks()
+
+
+def get_lock_stats():
+    """
+    Get the contention statistics of the locks that guard the creation of
+    documents and the changes to mailboxes.
+
+    :rtype: dict
+    """
+    return {
+        'documents': SoledadDocumentWrapper._k_locks.get_stats(),
+        'mailboxes': SoledadMailAdaptor._mbox_locks.get_stats(),
+    }
+
+
+def _get_docs_by_id(store, doc_ids):
+    """
+    Get several documents from the store, as a dict keyed by doc_id.
+
+    store.get_docs gives back a lazy generator, which runs its queries in
+    the reactor thread as it is consumed and breaks on the first document
+    that does not exist. So each document is retrieved with get_doc, in the
+    database threadpool, and the missing ones are left out of the dict.
+
+    :param store: an instance of soledad, or anything that behaves alike
+    :param doc_ids: the doc_ids of the documents.
+    :type doc_ids: iterable of str
+    :rtype: Deferred
+    """
+    doc_ids = set(doc_ids)
+    if not doc_ids:
+        return defer.succeed({})
+    d = defer.gatherResults(
+        [store.get_doc(doc_id) for doc_id in doc_ids], consumeErrors=True)
+    d.addCallback(lambda docs: dict(
+        (doc.doc_id, doc) for doc in docs if doc is not None))
+    return d
+
+
+# A local table, which is never synced, with the flags documents of the
+# messages being created. A creation that is interrupted between the flags
+# and the meta document of a message leaves its row behind, so the orphaned
+# flags document can be told apart from the flags documents synced from
+# other devices whose meta document has not arrived yet.
+_PENDING_FDOCS_TABLE = "leapmail_pending_fdocs"
+
+
+def _create_pending_fdocs_table(store):
+    return store.raw_sqlcipher_operation(
+        "CREATE TABLE if not exists {table} "
+        "(fdoc_id TEXT PRIMARY KEY)".format(table=_PENDING_FDOCS_TABLE))
+
+
+def _add_pending_fdoc(store, fdoc_id):
+    return store.raw_sqlcipher_operation(
+        "INSERT OR REPLACE INTO {table} VALUES (?)".format(
+            table=_PENDING_FDOCS_TABLE), (fdoc_id,))
+
+
+def _remove_pending_fdoc(store, fdoc_id):
+    return store.raw_sqlcipher_operation(
+        "DELETE FROM {table} WHERE fdoc_id=?".format(
+            table=_PENDING_FDOCS_TABLE), (fdoc_id,))
+
+
+# A local table, which is never synced, with the header and content documents
+# left behind by the messages deleted in this device, and when they were
+# queued. The parts are shared by every replica, so they are only swept after
+# a grace period that gives the other devices time to sync the copies of those
+# messages they may have made, which would point to them again.
+_PENDING_PARTS_TABLE = "leapmail_pending_parts"
+
+# the seconds that a queued part is kept before it can be swept
+PARTS_SWEEP_GRACE_PERIOD = 30 * 24 * 60 * 60
+
+
+def _create_pending_parts_table(store):
+    return store.raw_sqlcipher_operation(
+        "CREATE TABLE if not exists {table} "
+        "(doc_id TEXT PRIMARY KEY, queued REAL)".format(
+            table=_PENDING_PARTS_TABLE))
+
+
+def _add_pending_parts(store, doc_ids):
+    # a part freed again waits for the whole grace period again
+    doc_ids = sorted(doc_ids)
+    queued = time.time()
+    step = MAX_SQL_VARIABLES / 2
+    operations = []
+    for i in range(0, len(doc_ids), step):
+        chunk = doc_ids[i:i + step]
+        sql = "INSERT OR REPLACE INTO {table} VALUES {rows}".format(
+            table=_PENDING_PARTS_TABLE,
+            rows=", ".join(["(?, ?)"] * len(chunk)))
+        args = []
+        for doc_id in chunk:
+            args.extend((doc_id, queued))
+        operations.append(store.raw_sqlcipher_operation(sql, tuple(args)))
+    return defer.gatherResults(operations, consumeErrors=True)
+
+
+def _remove_pending_parts(store, doc_ids):
+    operations = []
+    for i in range(0, len(doc_ids), MAX_SQL_VARIABLES):
+        chunk = tuple(doc_ids[i:i + MAX_SQL_VARIABLES])
+        sql = "DELETE FROM {table} WHERE doc_id IN ({params})".format(
+            table=_PENDING_PARTS_TABLE, params=", ".join("?" * len(chunk)))
+        operations.append(store.raw_sqlcipher_operation(sql, chunk))
+    return defer.gatherResults(operations, consumeErrors=True)
+
+
+def _get_part_lock_key(store, doc_id):
+    """
+    Get the key of the DeferredLock that guards the references from the
+    meta documents to a header or content document, which are shared by
+    several messages.
+    """
+    return (store, 'part', doc_id)
 
 
 class SoledadDocumentWrapper(models.DocumentWrapper):
@@ -79,18 +203,20 @@ class SoledadDocumentWrapper(models.DocumentWrapper):
     # TODO we could also use a _dirty flag (in models)
     # TODO add a get_count() method ??? -- that is extended over l2db.
 
-    # We keep a dictionary with DeferredLocks, that will be
-    # unique to every subclass of SoledadDocumentWrapper.
-    _k_locks = defaultdict(defer.DeferredLock)
+    # We keep the DeferredLocks that guard the access to the indexes of
+    # every subclass of SoledadDocumentWrapper, scoped by store, so that
+    # different accounts do not wait for each other.
+    _k_locks = KeyedLocks()
 
     @classmethod
-    def _get_klass_lock(cls):
+    def _get_klass_lock_key(cls, store, *values):
         """
-        Get a DeferredLock that is unique for this subclass name.
+        Get the key of the DeferredLock for this subclass name in C{store},
+        and optionally for an index query.
         Used to lock the access to indexes in the `get_or_create` call
         for a particular DocumentWrapper.
         """
-        return cls._k_locks[cls.__name__]
+        return (store, cls.__name__) + values
 
     def __init__(self, doc_id=None, future_doc_id=None, **kwargs):
         self._doc_id = doc_id
@@ -110,7 +236,7 @@ class SoledadDocumentWrapper(models.DocumentWrapper):
         self._future_doc_id = doc_id
 
     @defer.inlineCallbacks
-    def create(self, store, is_copy=False):
+    def create(self, store, is_copy=False, strict=False):
         """
         Create the documents for this wrapper.
         Since this method will not check for duplication, the
@@ -120,6 +246,10 @@ class SoledadDocumentWrapper(models.DocumentWrapper):
         instead (that's the preferred way of creating documents from
         the wrapper object).
 
+        :param strict: if True, errors other than revision conflicts are
+                       raised instead of logged.
+        :type strict: bool
+
         :return: a deferred that will fire when the underlying
                  Soledad document has been created.
         :rtype: Deferred
@@ -144,11 +274,14 @@ class SoledadDocumentWrapper(models.DocumentWrapper):
                 # thing to do.
                 self._doc_id = self.future_doc_id
                 self._future_doc_id = None
-                yield self.update(store)
+                # the caller may hold the locks that update takes
+                yield self._lock.run(self._update, store)
             else:
                 self.log.warn(
                     'Revision conflict, ignoring: %s' % self.future_doc_id)
         except Exception as exc:
+            if strict:
+                raise
             self.log.warn('Error while creating %s: %r' % (
                 self.future_doc_id, exc))
 
@@ -220,8 +353,9 @@ class SoledadDocumentWrapper(models.DocumentWrapper):
                  matching the index query, either existing or just created.
         :rtype: Deferred
         """
-        return cls._get_klass_lock().run(
-            cls._get_or_create, store, index, value)
+        # only the lookups of the same document need to wait for each other
+        key = cls._get_klass_lock_key(store, index, value)
+        return cls._k_locks.run([key], cls._get_or_create, store, index, value)
 
     @classmethod
     def _get_or_create(cls, store, index, value):
@@ -328,7 +462,8 @@ class SoledadDocumentWrapper(models.DocumentWrapper):
         # [ ] benchmark the cost of querying and returning indexes in a big
         #     database. This might badly need pagination before being put to
         #     serious use.
-        return cls._get_klass_lock().run(cls._get_all, store)
+        key = cls._get_klass_lock_key(store)
+        return cls._k_locks.run([key], cls._get_all, store)
 
     @classmethod
     def _get_all(cls, store):
@@ -393,6 +528,14 @@ class FlagsDocWrapper(SoledadDocumentWrapper):
         """
         return map(str, self.flags)
 
+    def update(self, store):
+        # the same lock as the bulk flag updates of
+        # SoledadMailAdaptor.update_msgs_flags, so that neither overwrites
+        # the flags written by the other
+        key = self._get_klass_lock_key(store, self._doc_id)
+        return self._k_locks.run(
+            [key], SoledadDocumentWrapper.update, self, store)
+
 
 class HeaderDocWrapper(SoledadDocumentWrapper):
 
@@ -451,8 +594,8 @@ class MetaMsgDocWrapper(SoledadDocumentWrapper):
 
 class MessageWrapper(object):
 
-    # This could benefit of a DeferredLock to create/update all the
-    # documents at the same time maybe, and defend against concurrent updates?
+    # This could benefit of a DeferredLock to update all the documents at the
+    # same time maybe, and defend against concurrent updates?
 
     implements(IMessageWrapper)
     log = Logger()
@@ -502,7 +645,6 @@ class MessageWrapper(object):
                 self.log.warn('Empty raw field in cdoc %s' % doc_id)
             cdoc.set_future_doc_id(doc_id)
 
-    @defer.inlineCallbacks
     def create(self, store):
         """
         Create all the parts for this message in the store.
@@ -513,29 +655,71 @@ class MessageWrapper(object):
                  part documents have been written.
         :rtype: defer.Deferred
         """
+        # the shared parts are not swept while the mdoc that points to them
+        # is being written, nor the fdoc taken for an orphaned one
+        keys = [_get_part_lock_key(store, doc_id)
+                for doc_id in self.get_part_doc_ids()]
+        keys.append(FlagsDocWrapper._get_klass_lock_key(
+            store, self.fdoc.future_doc_id))
+        return SoledadDocumentWrapper._k_locks.run(keys, self._create, store)
+
+    @defer.inlineCallbacks
+    def _create(self, store):
         assert self.cdocs, "Need cdocs to create the MessageWrapper docs"
         assert self.mdoc.doc_id is None, "Cannot create: mdoc has a doc_id"
         assert self.fdoc.doc_id is None, "Cannot create: fdoc has a doc_id"
 
         copy = self._is_copy
-
-        mdoc = yield self.mdoc.create(store, is_copy=copy)
-        assert mdoc
-        self.mdoc = mdoc
-        fdoc = yield self.fdoc.create(store, is_copy=copy)
-        self.fdoc = fdoc
+        fdoc_id = self.fdoc.future_doc_id
+
+        # All the part documents are written at once, and the mdoc, which
+        # links them to the mailbox, only when all of them are stored. This
+        # way a failure, or a crash, never leaves a message in the mailbox
+        # with some of its parts missing. The fdoc is pending until then, so
+        # it can be deleted if a crash leaves it without its mdoc.
+        yield _add_pending_fdoc(store, fdoc_id)
+        creating = [self.fdoc.create(store, is_copy=copy, strict=True)]
         if not copy:
             if self.hdoc.doc_id is None:
-                hdoc = yield self.hdoc.create(store)
-                self.hdoc = hdoc
+                creating.append(self.hdoc.create(store, strict=True))
             for cdoc in self.cdocs.values():
                 if cdoc.doc_id is not None:
                     # we could be just linking to an existing
                     # content-doc.
                     continue
-                yield cdoc.create(store)
+                creating.append(cdoc.create(store, strict=True))
+        # wait for all of them, so that nothing is written after a rollback
+        results = yield defer.DeferredList(creating, consumeErrors=True)
+        failures = [result for ok, result in results if not ok]
+        if not failures:
+            try:
+                mdoc = yield self.mdoc.create(store, is_copy=copy, strict=True)
+            except Exception:
+                failures.append(Failure())
+        if failures:
+            # the headers and contents could be shared with other messages,
+            # but the flags belong to this one
+            if self.fdoc.doc_id is not None:
+                yield self.fdoc.delete(store)
+            yield _remove_pending_fdoc(store, fdoc_id)
+            failures[0].raiseException()
+        assert mdoc
+        self.mdoc = mdoc
+        yield _remove_pending_fdoc(store, fdoc_id)
         defer.returnValue(self)
 
+    def get_part_doc_ids(self):
+        """
+        Get the doc_ids of the header and content documents of this message,
+        which can be shared with other messages.
+
+        :rtype: list of str
+        """
+        doc_ids = list(self.mdoc.cdocs)
+        if self.mdoc.hdoc:
+            doc_ids.append(self.mdoc.hdoc)
+        return doc_ids
+
     def update(self, store):
         """
         Update the only mutable parts, which are within the flags document.
@@ -731,6 +915,9 @@ class SoledadIndexMixin(object):
                     d.addCallback(
                         lambda _: _create_index(name, *expression))
                     deferreds.append(d)
+            # and the local tables, that are never synced
+            deferreds.append(_create_pending_fdocs_table(store))
+            deferreds.append(_create_pending_parts_table(store))
             return defer.gatherResults(deferreds, consumeErrors=True)
 
         def store_ready(whatever):
@@ -785,13 +972,31 @@ class SoledadMailAdaptor(SoledadIndexMixin):
     wait_for_indexes = ['get_or_create_mbox', 'update_mbox', 'get_all_mboxes']
 
     mboxwrapper_klass = MailboxWrapper
-    atomic = defer.DeferredLock()
+    # shared by all the adaptors of a store
+    _mbox_locks = KeyedLocks()
 
     log = Logger()
 
     def __init__(self):
         SoledadIndexMixin.__init__(self)
 
+    def atomic(self, store, names, f, *args, **kwargs):
+        """
+        Run C{f} while no other change is being done to the mailboxes with
+        the given names in C{store}.
+
+        :param store: the store that holds the mailboxes.
+        :param names: the names of the mailboxes.
+        :type names: list of str
+        :param f: the function to run.
+        :type f: callable
+
+        :return: a deferred that will fire with the result of C{f}.
+        :rtype: Deferred
+        """
+        keys = [(store, name) for name in names]
+        return self._mbox_locks.run(keys, f, *args, **kwargs)
+
     # Message handling
 
     def get_msg_from_string(self, MessageClass, raw_msg):
@@ -912,6 +1117,84 @@ class SoledadMailAdaptor(SoledadIndexMixin):
         d.addErrback(_err_log_cannot_find_msg)
         return d
 
+    def get_msgs_from_mdoc_ids(self, MessageClass, store, mdoc_ids,
+                               uids=None, get_cdocs=False):
+        """
+        Get instances of a MessageClass for many MetaMsg doc_ids at once.
+
+        All the flags, headers and meta documents are retrieved at once, and
+        then the content documents (if asked for), instead of retrieving the
+        documents of each message one after the other.
+
+        :param MessageClass: any Message class that can be initialized passing
+                             an instance of an IMessageWrapper implementor.
+        :type MessageClass: type
+        :param store: an instance of soledad, or anything that behaves alike
+        :param mdoc_ids: the doc_ids of the MetaMsg documents.
+        :type mdoc_ids: list
+        :param uids: the uids of the messages, in the same order than
+                     mdoc_ids, if known.
+        :type uids: list or None
+        :param get_cdocs: whether to retrieve the content documents too.
+        :type get_cdocs: bool
+
+        :return: a Deferred that will fire with a list of MessageClass
+                 instances, in the same order than mdoc_ids, with None in
+                 place of the messages that could not be found.
+        :rtype: Deferred
+        """
+        mdoc_ids = list(mdoc_ids)
+        if uids is None:
+            uids = [None] * len(mdoc_ids)
+
+        def _get_part_doc_ids(mdoc_id):
+            mbox = re.findall(constants.METAMSGID_MBOX_RE, mdoc_id)[0]
+            chash = re.findall(constants.METAMSGID_CHASH_RE, mdoc_id)[0]
+            return (constants.FDOCID.format(mbox_uuid=mbox, chash=chash),
+                    constants.HDOCID.format(mbox_uuid=mbox, chash=chash))
+
+        part_doc_ids = map(_get_part_doc_ids, mdoc_ids)
+
+        def get_cdocs_for(docs):
+            cdoc_ids = set()
+            for mdoc_id in mdoc_ids:
+                if mdoc_id in docs:
+                    cdoc_ids.update(docs[mdoc_id].content.get('cdocs', []))
+            d = _get_docs_by_id(store, cdoc_ids)
+            d.addCallback(lambda cdocs: (docs, cdocs))
+            return d
+
+        def build_msgs((docs, cdocs)):
+            msgs = []
+            for mdoc_id, (fdoc_id, hdoc_id), uid in zip(
+                    mdoc_ids, part_doc_ids, uids):
+                mdoc = docs.get(mdoc_id)
+                if mdoc is None:
+                    self.log.error('Cannot find msg (uid=%s)' % uid)
+                    msgs.append(None)
+                    continue
+                msg_cdocs = None
+                if cdocs is not None:
+                    msg_cdocs = dict(enumerate(
+                        [cdocs.get(cdoc_id)
+                         for cdoc_id in mdoc.content.get('cdocs', [])], 1))
+                msgs.append(self.get_msg_from_docs(
+                    MessageClass, mdoc, docs.get(fdoc_id), docs.get(hdoc_id),
+                    msg_cdocs, uid=uid))
+            return msgs
+
+        all_doc_ids = list(mdoc_ids)
+        for fdoc_id, hdoc_id in part_doc_ids:
+            all_doc_ids.extend((fdoc_id, hdoc_id))
+
+        d = _get_docs_by_id(store, all_doc_ids)
+        if get_cdocs:
+            d.addCallback(get_cdocs_for)
+        else:
+            d.addCallback(lambda docs: (docs, None))
+        d.addCallback(build_msgs)
+        return d
+
     def _get_msg_from_variable_doc_list(self, doc_list, msg_class, uid=None):
         if len(doc_list) == 3:
             mdoc, fdoc, hdoc = doc_list
@@ -975,11 +1258,78 @@ class SoledadMailAdaptor(SoledadIndexMixin):
         wrapper = msg.get_wrapper()
         return wrapper.update(store)
 
+    def update_msgs_flags(self, store, mdoc_ids, update):
+        """
+        Update the flags of many messages at once.
+
+        The flags documents are all retrieved at once, updated in memory and
+        written back together. Soledad has no transactions spanning several
+        documents, so each of them is still written on its own; the ones
+        whose flags do not change are not written at all.
+
+        :param store: an instance of soledad, or anything that behaves alike
+        :param mdoc_ids: the doc_ids of the MetaMsg documents.
+        :type mdoc_ids: list
+        :param update: a function that gets the current flags of a message
+                       (a list of str) and returns the new ones.
+        :type update: callable
+
+        :return: a Deferred that will fire with a list of (old flags, new
+                 flags) tuples, in the same order than mdoc_ids, with None in
+                 place of the messages whose flags could not be found.
+        :rtype: Deferred
+        """
+        fdoc_ids = ["F" + mdoc_id[1:] for mdoc_id in mdoc_ids]
+        if not fdoc_ids:
+            return defer.succeed([])
+
+        def update_fdocs(fdocs):
+            results = []
+            d = []
+            for fdoc_id in fdoc_ids:
+                doc = fdocs.get(fdoc_id)
+                if doc is None:
+                    results.append(None)
+                    continue
+                old = map(str, doc.content.get('flags', []))
+                new = map(str, update(old))
+                results.append((old, new))
+                if set(new) == set(old):
+                    continue
+                doc.content['flags'] = new
+                doc.content['seen'] = MessageFlags.SEEN_FLAG in new
+                doc.content['deleted'] = MessageFlags.DELETED_FLAG in new
+                d.append(store.put_doc(doc))
+            d = defer.gatherResults(d, consumeErrors=True)
+            d.addCallback(lambda _: results)
+            return d
+
+        def get_and_update():
+            d = _get_docs_by_id(store, fdoc_ids)
+            d.addCallback(update_fdocs)
+            return d
+
+        # the same flags docs are not read and written by two updates at
+        # once, be them bulk or single ones
+        keys = [FlagsDocWrapper._get_klass_lock_key(store, fdoc_id)
+                for fdoc_id in fdoc_ids]
+        return FlagsDocWrapper._k_locks.run(keys, get_and_update)
+
     # batch deletion
 
     def del_all_flagged_messages(self, store, mbox_uuid):
         """
         Delete all messages flagged as deleted.
+
+        The flags and meta documents of all the messages are deleted at
+        once, and their header and content documents are queued to be swept
+        after the next sync.
+
+        :param store: an instance of soledad, or anything that behaves alike
+        :param mbox_uuid: the uuid for this mailbox.
+        :return: a Deferred that will fire with the doc_ids of the deleted
+                 meta documents.
+        :rtype: Deferred
         """
 
         def delete_fdoc_and_mdoc_flagged(fdocs):
@@ -987,23 +1337,42 @@ class SoledadMailAdaptor(SoledadIndexMixin):
             # get meta doc ids from the flag doc ids
             fdoc_ids = [doc.doc_id for doc in fdocs]
             mdoc_ids = map(lambda s: "M" + s[1:], fdoc_ids)
+            if not mdoc_ids:
+                return []
 
             def delete_all_docs(mdocs, fdocs):
-                mdocs = list(mdocs)
+                mdocs = mdocs.values()
                 doc_ids = [m.doc_id for m in mdocs]
+                part_doc_ids = set()
+                for mdoc in mdocs:
+                    part_doc_ids.update(mdoc.content.get('cdocs', []))
+                    part_doc_ids.add(mdoc.content.get('hdoc'))
+                part_doc_ids.discard(None)
+
+                # soledad has no transactions spanning several documents,
+                # but all the deletions are issued together
                 _d = []
                 docs = mdocs + fdocs
                 for doc in docs:
                     _d.append(store.delete_doc(doc))
-                d = defer.gatherResults(_d)
+                d = defer.gatherResults(_d, consumeErrors=True)
+                d.addCallback(queue_parts, part_doc_ids)
                 # return the mdocs ids only
                 d.addCallback(lambda _: doc_ids)
                 return d
 
-            d = store.get_docs(mdoc_ids)
+            d = _get_docs_by_id(store, mdoc_ids)
             d.addCallback(delete_all_docs, fdocs)
             return d
 
+        def queue_parts(_, part_doc_ids):
+            # the messages are gone anyway, a part left behind is only
+            # wasted space
+            d = self.queue_orphaned_parts(store, part_doc_ids)
+            d.addErrback(lambda f: self.log.failure(
+                'Error queueing orphaned parts', failure=f))
+            return d
+
         type_ = FlagsDocWrapper.model.type_
         uuid = mbox_uuid.replace('-', '_')
         deleted_index = indexes.TYPE_MBOX_DEL_IDX
@@ -1012,6 +1381,132 @@ class SoledadMailAdaptor(SoledadIndexMixin):
         d.addCallback(delete_fdoc_and_mdoc_flagged)
         return d
 
+    def queue_orphaned_parts(self, store, doc_ids):
+        """
+        Queue the header and content documents of some messages deleted in
+        this device, to be deleted by a C{sweep_orphaned_parts} after the
+        grace period if no meta document points to them by then.
+
+        :param store: an instance of soledad, or anything that behaves alike
+        :param doc_ids: the doc_ids of the header and content documents of
+                        some deleted messages.
+        :type doc_ids: iterable of str
+        :return: a Deferred that will fire when the documents are queued.
+        :rtype: Deferred
+        """
+        return _add_pending_parts(store, set(doc_ids))
+
+    def sweep_orphaned_parts(self, store):
+        """
+        Delete the header and content documents queued for longer than
+        C{PARTS_SWEEP_GRACE_PERIOD} that no meta document points to anymore.
+
+        The headers are shared by all the copies of a message, and the
+        contents also by the messages with the same parts, so they can only
+        be deleted after the last message that uses them. The references
+        are counted in the local replica, which lacks the copies made in
+        other devices that have not synced them yet. The grace period gives
+        them time to do it, and a deleted part would be deleted in every
+        replica.
+
+        :param store: an instance of soledad, or anything that behaves alike
+        :return: a Deferred that will fire with the number of documents
+                 deleted.
+        :rtype: Deferred
+        """
+        type_ = MetaMsgDocWrapper.model.type_
+        hdoc_preffix = constants.HDOCID.format(chash='')
+
+        def count_references(doc_ids):
+            counts = []
+            for doc_id in doc_ids:
+                if doc_id.startswith(hdoc_preffix):
+                    index = indexes.TYPE_HDOC_IDX
+                else:
+                    index = indexes.TYPE_CDOCS_IDX
+                counts.append(store.get_count_from_index(index, type_, doc_id))
+            # a part freed again meanwhile is queued again, and swept by
+            # the next sweep
+            d = _remove_pending_parts(store, doc_ids)
+            d.addCallback(lambda _: defer.gatherResults(
+                counts, consumeErrors=True))
+            d.addCallback(lambda counts: [
+                doc_id for doc_id, count in zip(doc_ids, counts)
+                if not count])
+            d.addCallback(delete_orphans)
+            return d
+
+        def delete_orphans(orphan_ids):
+            if not orphan_ids:
+                return 0
+            d = _get_docs_by_id(store, orphan_ids)
+            d.addCallback(lambda docs: defer.gatherResults(
+                [store.delete_doc(doc) for doc in docs.values()],
+                consumeErrors=True))
+            d.addCallback(len)
+            return d
+
+        def sweep(rows):
+            doc_ids = sorted(doc_id for doc_id, in rows)
+            if not doc_ids:
+                return 0
+            keys = [_get_part_lock_key(store, doc_id) for doc_id in doc_ids]
+            return SoledadDocumentWrapper._k_locks.run(
+                keys, count_references, doc_ids)
+
+        d = store.raw_sqlcipher_query(
+            "SELECT doc_id FROM {table} WHERE queued <= ?".format(
+                table=_PENDING_PARTS_TABLE),
+            (time.time() - PARTS_SWEEP_GRACE_PERIOD,))
+        d.addCallback(sweep)
+        return d
+
+    def delete_orphaned_fdocs(self, store):
+        """
+        Delete the flags documents left behind by the creation of messages
+        that was interrupted before their meta document was written, which
+        would be counted as unseen or recent messages otherwise.
+
+        Only the creations done in this device are considered, so the flags
+        documents whose meta document is still to be synced are left alone.
+
+        :param store: an instance of soledad, or anything that behaves alike
+        :return: a Deferred that will fire with the uuids of the mailboxes
+                 that had orphaned flags documents.
+        :rtype: Deferred
+        """
+        mbox_uuids = set()
+
+        @defer.inlineCallbacks
+        def delete_if_orphaned(fdoc_id):
+            mdoc = yield store.get_doc("M" + fdoc_id[1:])
+            if mdoc is None:
+                fdoc = yield store.get_doc(fdoc_id)
+                if fdoc is not None:
+                    self.log.info('Deleting orphaned %s' % fdoc_id)
+                    yield store.delete_doc(fdoc)
+                    mbox_uuid = re.findall(
+                        constants.FDOCID_MBOX_RE, fdoc_id)[0]
+                    mbox_uuids.add(mbox_uuid.replace('_', '-'))
+            yield _remove_pending_fdoc(store, fdoc_id)
+
+        def delete_orphans(rows):
+            d = []
+            for fdoc_id, in rows:
+                # wait for the creation of the message, if it is running
+                key = FlagsDocWrapper._get_klass_lock_key(store, fdoc_id)
+                d.append(FlagsDocWrapper._k_locks.run(
+                    [key], delete_if_orphaned, fdoc_id))
+            d = defer.gatherResults(d, consumeErrors=True)
+            d.addCallback(lambda _: sorted(mbox_uuids))
+            return d
+
+        d = store.raw_sqlcipher_query(
+            "SELECT fdoc_id FROM {table}".format(
+                table=_PENDING_FDOCS_TABLE))
+        d.addCallback(delete_orphans)
+        return d
+
     # count messages
 
     def get_count_unseen(self, store, mbox_uuid):
@@ -1124,12 +1619,10 @@ def _split_into_parts(raw):
     # TODO seed propely the content_docs with defaults??
 
     msg, chash, multi = _parse_msg(raw)
-    size = len(msg.as_string())
+    size = len(raw)
 
-    parts_map = walk.get_tree(msg)
-    cdocs_list = list(walk.get_raw_docs(msg))
+    parts_map, cdocs_list, body_phash = walk.walk_message(msg)
     cdocs_phashes = [c['phash'] for c in cdocs_list]
-    body_phash = walk.get_body_phash(msg)
 
     mdoc = _build_meta_doc(chash, cdocs_phashes)
     fdoc = _build_flags_doc(chash, size, multi)
@@ -40,6 +40,8 @@ CONTENT_HASH = "chash"
 PAYLOAD_HASH = "phash"
 MSGID = "msgid"
 UID = "uid"
+HDOC = "hdoc"
+CDOCS = "cdocs"
 
 
 # Index  types
@@ -57,6 +59,8 @@ TYPE_MBOX_C_HASH_IDX = 'by-type-and-mbox-and-contenthash'
 TYPE_C_HASH_IDX = 'by-type-and-contenthash'
 TYPE_C_HASH_PART_IDX = 'by-type-and-contenthash-and-partnumber'
 TYPE_P_HASH_IDX = 'by-type-and-payloadhash'
+TYPE_HDOC_IDX = 'by-type-and-hdoc'
+TYPE_CDOCS_IDX = 'by-type-and-cdocs'
 
 # Soledad index for incoming mail, without decrypting errors.
 # and the backward-compatible index, will be deprecated at 0.7
@@ -95,6 +99,10 @@ MAIL_INDEXES = {
     # attachment payload dedup
     TYPE_P_HASH_IDX: [TYPE, PAYLOAD_HASH],
 
+    # headers and content docs referenced by the meta docs
+    TYPE_HDOC_IDX: [TYPE, HDOC],
+    TYPE_CDOCS_IDX: [TYPE, CDOCS],
+
     # messages
     TYPE_MBOX_SEEN_IDX: [TYPE, MBOX_UUID, 'bool(seen)'],
     TYPE_MBOX_RECENT_IDX: [TYPE, MBOX_UUID, 'bool(recent)'],
@@ -30,6 +30,7 @@ METAMSGID_MBOX_RE = "M\-(\w+)\-[0-9a-fA-F]+"
 FDOCID = "F-{mbox_uuid}-{chash}"
 FDOCID_RE = "F\-{mbox_uuid}\-[0-9a-fA-F]+"
 FDOCID_CHASH_RE = "F\-\w+\-([0-9a-fA-F]+)"
+FDOCID_MBOX_RE = "F\-(\w+)\-[0-9a-fA-F]+"
 
 HDOCID = "H-{chash}"
 HDOCID_RE = "H\-[0-9a-fA-F]+"
@@ -38,10 +38,11 @@ from leap.common.check import leap_assert
 from leap.common.check import leap_assert_type
 from leap.bitmask.mail.constants import INBOX_NAME, MessageFlags
 from leap.bitmask.mail.imap.messages import IMAPMessage
+from leap.bitmask.mail.imap.search import parse_search_query
+from leap.bitmask.mail.search_indexer import FulltextDisabledError
 
 # TODO LIST
 # [ ] finish the implementation of IMailboxListener
-# [ ] implement the rest of ISearchableMailbox
 
 
 INIT_FLAGS = (MessageFlags.RECENT_FLAG, MessageFlags.LIST_FLAG)
@@ -388,9 +389,8 @@ class IMAPMailbox(object):
                  messages and number of recent messages.
         :rtype: Deferred
         """
-        # XXX this is way too expensive in cases like multiple APPENDS.
-        # We should have a way of keep a cache or do a self-increment for that
-        # kind of calls.
+        # the collection keeps the counts up to date, so this does not query
+        # the store after every APPEND.
         d_exists = defer.maybeDeferred(self.getMessageCount)
         d_recent = defer.maybeDeferred(self.getRecentCount)
         d_list = [d_exists, d_recent]
@@ -439,29 +439,22 @@ class IMAPMailbox(object):
             raise imap4.ReadOnlyMailbox
         return self.collection.delete_all_flagged()
 
-    def _get_message_fun(self, uid):
+    def _get_messages_range(self, messages_asked, uid=True):
         """
-        Return the proper method to get a message for this mailbox, depending
-        on the passed uid flag.
+        Resolve a messages sequence into the messages that do exist in this
+        mailbox.
 
-        :param uid: If true, the IDs specified in the query are UIDs;
-                    otherwise they are message sequence IDs.
+        :param messages_asked: IDs of the messages.
+        :type messages_asked: MessageSet
+        :param uid: If true, the IDs are UIDs. They are message sequence IDs
+                    otherwise.
         :type uid: bool
-        :rtype: callable
+        :return: a Deferred that will fire with a list of (msgid, uid)
+                 tuples, msgid being the UID or the message sequence number
+                 depending on the uid flag.
         """
-        get_message_fun = [
-            self.collection.get_message_by_sequence_number,
-            self.collection.get_message_by_uid][uid]
-        return get_message_fun
-
-    def _get_messages_range(self, messages_asked, uid=True):
-
-        def get_range(messages_asked):
-            return self._filter_msg_seq(messages_asked)
-
         d = self._bound_seq(messages_asked, uid)
-        if uid:
-            d.addCallback(get_range)
+        d.addCallback(self._filter_msg_seq, uid)
         d.addErrback(
             lambda f: self.log.failure('Error getting msg range'))
         return d
@@ -475,12 +468,8 @@ class IMAPMailbox(object):
         :return: a Deferred that will fire with a MessageSet
         """
 
-        def set_last_uid(last_uid):
-            messages_asked.last = last_uid
-            return messages_asked
-
-        def set_last_seq(all_uid):
-            messages_asked.last = len(all_uid)
+        def set_last(last):
+            messages_asked.last = last
             return messages_asked
 
         if not messages_asked.last:
@@ -490,31 +479,57 @@ class IMAPMailbox(object):
                 # looks like we cannot iterate
                 if uid:
                     d = self.collection.get_last_uid()
-                    d.addCallback(set_last_uid)
                 else:
-                    d = self.collection.all_uid_iter()
-                    d.addCallback(set_last_seq)
+                    d = self.collection.count()
+                d.addCallback(set_last)
                 return d
         return defer.succeed(messages_asked)
 
-    def _filter_msg_seq(self, messages_asked):
+    def _filter_msg_seq(self, messages_asked, uid=True):
         """
         Filter a message sequence returning only the ones that do exist in the
         collection.
 
+        The ranges in the sequence are passed down to the mailbox indexer, so
+        the cost of this depends on the size of the ranges asked and not on
+        the size of the mailbox.
+
         :param messages_asked: IDs of the messages.
         :type messages_asked: MessageSet
-        :rtype: set
+        :param uid: If true, the IDs are UIDs. They are message sequence IDs
+                    otherwise.
+        :type uid: bool
+        :return: a Deferred that will fire with a list of (msgid, uid)
+                 tuples.
+        :rtype: Deferred
         """
-        # TODO we could pass the asked sequence to the indexer
-        # all_uid_iter, and bound the sql query instead.
-        def filter_by_asked(all_msg_uid):
-            set_asked = set(messages_asked)
-            set_exist = set(all_msg_uid)
-            return set_asked.intersection(set_exist)
+        ranges = messages_asked.ranges
+        if not uid:
+            return self.collection.get_uids_from_msn_ranges(ranges)
+        d = self.collection.get_uids_in_ranges(ranges)
+        d.addCallback(lambda uids: [(msg_uid, msg_uid) for msg_uid in uids])
+        return d
 
-        d = self.collection.all_uid_iter()
-        d.addCallback(filter_by_asked)
+    def _get_messages_for_range(self, msg_range, get_cdocs=False):
+        """
+        Retrieve the messages for a range, in bulk.
+
+        :param msg_range: a list of (msgid, uid) tuples.
+        :type msg_range: list
+        :param get_cdocs: whether to retrieve the content documents too.
+        :type get_cdocs: bool
+        :return: a Deferred that will fire with a list of (msgid, message)
+                 tuples for the messages still in the mailbox.
+        :rtype: Deferred
+        """
+        def zip_msgid(messages):
+            return [(msgid, msg)
+                    for (msgid, _), msg in zip(msg_range, messages)
+                    if msg is not None]
+
+        d = self.collection.get_messages_by_uids(
+            [msg_uid for _, msg_uid in msg_range], get_cdocs=get_cdocs)
+        d.addCallback(zip_msgid)
         return d
 
     def fetch(self, messages_asked, uid):
@@ -534,7 +549,6 @@ class IMAPMailbox(object):
 
         :rtype: deferred with a generator that yields...
         """
-        get_msg_fun = self._get_message_fun(uid)
         getimapmsg = self.get_imap_message
 
         def get_imap_messages_for_range(msg_range):
@@ -542,29 +556,28 @@ class IMAPMailbox(object):
             def _get_imap_msg(messages):
                 d_imapmsg = []
                 # just in case we got bad data in here
-                for msg in filter(None, messages):
-                    d_imapmsg.append(getimapmsg(msg))
+                for msgid, msg in messages:
+                    if msg is None:
+                        continue
+                    d = getimapmsg(msg)
+                    d.addCallback(lambda imap_msg, msgid: (msgid, imap_msg),
+                                  msgid)
+                    d_imapmsg.append(d)
                 return defer.gatherResults(d_imapmsg, consumeErrors=True)
 
             def _zip_msgid(imap_messages):
-                zipped = zip(
-                    list(msg_range), imap_messages)
-                return (item for item in zipped)
+                return (item for item in imap_messages)
 
             # XXX not called??
             def _unset_recent(sequence):
                 reactor.callLater(0, self.unset_recent_flags, sequence)
                 return sequence
 
-            d_msg = []
-            for msgid in msg_range:
-                # XXX We want cdocs because we "probably" are asked for the
-                # body. We should be smarter at do_FETCH and pass a parameter
-                # to this method in order not to prefetch cdocs if they're not
-                # going to be used.
-                d_msg.append(get_msg_fun(msgid, get_cdocs=True))
-
-            d = defer.gatherResults(d_msg, consumeErrors=True)
+            # XXX We want cdocs because we "probably" are asked for the
+            # body. We should be smarter at do_FETCH and pass a parameter
+            # to this method in order not to prefetch cdocs if they're not
+            # going to be used.
+            d = self._get_messages_for_range(msg_range, get_cdocs=True)
             d.addCallback(_get_imap_msg)
             d.addCallback(_zip_msgid)
             d.addErrback(
@@ -602,17 +615,6 @@ class IMAPMailbox(object):
                 MessagePart.
         :rtype: tuple
         """
-        # is_sequence = True if uid == 0 else False
-        # XXX FIXME -----------------------------------------------------
-        # imap/tests, or muas like mutt, it will choke until we implement
-        # sequence numbers. This is an easy hack meanwhile.
-        is_sequence = False
-        # ---------------------------------------------------------------
-
-        if is_sequence:
-            raise NotImplementedError(
-                "FETCH FLAGS NOT IMPLEMENTED FOR MESSAGE SEQUENCE NUMBERS YET")
-
         d = defer.Deferred()
         reactor.callLater(0, self._do_fetch_flags, messages_asked, uid, d)
         return d
@@ -643,27 +645,14 @@ class IMAPMailbox(object):
             def getFlags(self):
                 return map(str, self.flags)
 
-        def pack_flags(result):
-            _uid, _flags = result
-            return _uid, flagsPart(_uid, _flags)
-
-        def get_flags_for_seq(sequence):
-            d_all_flags = []
-            for msgid in sequence:
-                # TODO implement sequence numbers here too
-                d_flags_per_uid = self.collection.get_flags_by_uid(msgid)
-                d_flags_per_uid.addCallback(pack_flags)
-                d_all_flags.append(d_flags_per_uid)
-            gotflags = defer.gatherResults(d_all_flags)
-            gotflags.addCallback(get_uid_flag_generator)
-            return gotflags
-
-        def get_uid_flag_generator(result):
-            generator = (item for item in result)
+        def get_uid_flag_generator(messages):
+            generator = ((msgid, flagsPart(msg.get_uid(), msg.get_flags()))
+                         for msgid, msg in messages)
             d.callback(generator)
 
         d_seq = self._get_messages_range(messages_asked, uid)
-        d_seq.addCallback(get_flags_for_seq)
+        d_seq.addCallback(self._get_messages_for_range)
+        d_seq.addCallback(get_uid_flag_generator)
         return d_seq
 
     @defer.inlineCallbacks
@@ -691,12 +680,6 @@ class IMAPMailbox(object):
                 MessagePart.
         :rtype: tuple
         """
-        # TODO implement sequences
-        is_sequence = True if uid == 0 else False
-        if is_sequence:
-            raise NotImplementedError(
-                "FETCH HEADERS NOT IMPLEMENTED FOR SEQUENCE NUMBER YET")
-
         class headersPart(object):
             def __init__(self, uid, headers):
                 self.uid = uid
@@ -711,14 +694,11 @@ class IMAPMailbox(object):
                     for key, value in
                     self.headers.items())
 
-        messages_asked = yield self._bound_seq(messages_asked, uid)
-        seq_messg = yield self._filter_msg_seq(messages_asked)
+        msg_range = yield self._get_messages_range(messages_asked, uid)
+        messages = yield self._get_messages_for_range(msg_range)
 
-        result = []
-        for msgid in seq_messg:
-            msg = yield self.collection.get_message_by_uid(msgid)
-            headers = headersPart(msgid, msg.get_headers())
-            result.append((msgid, headers))
+        result = [(msgid, headersPart(msg.get_uid(), msg.get_headers()))
+                  for msgid, msg in messages]
         defer.returnValue(iter(result))
 
     def store(self, messages_asked, flags, mode, uid):
@@ -754,17 +734,23 @@ class IMAPMailbox(object):
             self.log.info('Read only mailbox!')
             raise imap4.ReadOnlyMailbox
 
+        def signal_unread(result):
+            self.collection.cb_signal_unread_to_ui()
+            # the server needs the flags for the untagged FETCH responses
+            return result
+
         d = defer.Deferred()
         reactor.callLater(0, self._do_store, messages_asked, flags,
                           mode, uid, d)
 
-        d.addCallback(self.collection.cb_signal_unread_to_ui)
+        d.addCallback(signal_unread)
         d.addErrback(lambda f: self.log.error('Error on store'))
         return d
 
     def _do_store(self, messages_asked, flags, mode, uid, observer):
         """
-        Helper method, invoke set_flags method in the IMAPMessageCollection.
+        Helper method, update the flags of the messages in bulk through the
+        collection.
 
         See the documentation for the `store` method for the parameters.
 
@@ -774,26 +760,23 @@ class IMAPMailbox(object):
         :type observer: deferred
         """
         # TODO we should prevent client from setting Recent flag
-        get_msg_fun = self._get_message_fun(uid)
         leap_assert(not isinstance(flags, basestring),
                     "flags cannot be a string")
         flags = tuple(flags)
 
-        def set_flags_for_seq(sequence):
-            def return_result_dict(list_of_flags):
-                result = dict(zip(list(sequence), list_of_flags))
+        def set_flags_for_seq(msg_range):
+            def return_result_dict(flags_by_uid):
+                result = dict((msgid, flags_by_uid[msg_uid])
+                              for msgid, msg_uid in msg_range
+                              if msg_uid in flags_by_uid)
                 observer.callback(result)
                 return result
 
-            d_all_set = []
-            for msgid in sequence:
-                d = get_msg_fun(msgid)
-                d.addCallback(lambda msg: self.collection.update_flags(
-                    msg, flags, mode))
-                d_all_set.append(d)
-            got_flags_setted = defer.gatherResults(d_all_set)
-            got_flags_setted.addCallback(return_result_dict)
-            return got_flags_setted
+            # all the flags are updated at once, without loading the messages
+            d = self.collection.update_flags_by_uids(
+                [msg_uid for _, msg_uid in msg_range], flags, mode)
+            d.addCallback(return_result_dict)
+            return d
 
         d_seq = self._get_messages_range(messages_asked, uid)
         d_seq.addCallback(set_flags_for_seq)
@@ -805,9 +788,9 @@ class IMAPMailbox(object):
         """
         Search for messages that meet the given query criteria.
 
-        Warning: this is half-baked, and it might give problems since
-        it offers the SearchableInterface.
-        We'll be implementing it asap.
+        The query is answered from the local search index of the mailbox,
+        so no message document is loaded for it. Searching the message
+        contents needs the optional full-text index.
 
         :param query: The search criteria
         :type query: list
@@ -820,30 +803,35 @@ class IMAPMailbox(object):
                  match the search criteria or a C{Deferred} whose callback
                  will be invoked with such a list.
         :rtype: C{list} or C{Deferred}
+
+        :raise IllegalQueryError: Raised when query is not valid.
         """
-        # TODO see if we can raise w/o interrupting flow
-        # :raise IllegalQueryError: Raised when query is not valid.
         # example query:
         #  ['UNDELETED', 'HEADER', 'Message-ID',
-        # XXX fixme, does not exist
         #   '52D44F11.9060107@dev.bitmask.net']
 
-        # TODO hardcoding for now! -- we'll support generic queries later on
-        # but doing a quickfix for avoiding duplicate saves in the draft
-        # folder.  # See issue #4209
+        def parse_query((last_msn, last_uid)):
+            return parse_search_query(query, last_msn or 0, last_uid or 0)
 
-        if len(query) > 2:
-            if query[1] == 'HEADER' and query[2].lower() == "message-id":
-                msgid = str(query[3]).strip()
-                self.log.debug('Searching for %s' % (msgid,))
-
-                d = self.collection.get_uid_from_msgid(str(msgid))
-                d.addCallback(lambda result: [result])
-                return d
+        def get_msns(uids):
+            d = self.collection.get_msns_from_uids(uids)
+            d.addCallback(lambda msns: sorted(
+                msns[msg_uid] for msg_uid in uids if msg_uid in msns))
+            return d
 
-        # nothing implemented for any other query
-        self.log.warn('Cannot process query: %s' % (query,))
-        return []
+        def fulltext_disabled(failure):
+            failure.trap(FulltextDisabledError)
+            raise imap4.IllegalQueryError(
+                'Searching the message contents is not enabled')
+
+        d = defer.gatherResults([self.collection.count(),
+                                 self.collection.get_last_uid()])
+        d.addCallback(parse_query)
+        d.addCallback(self.collection.search)
+        d.addErrback(fulltext_disabled)
+        if not uid:
+            d.addCallback(get_msns)
+        return d
 
     # IMessageCopier
 
@@ -118,7 +118,7 @@ class IMAPMessage(object):
         Retrieve a file object containing only the body of this message.
 
         :return: file-like object opened for reading
-        :rtype: a deferred that will fire with a StringIO object.
+        :rtype: a deferred that will fire with a BodyFile object.
         """
         if self.__body_fd is not None:
             fd = self.__body_fd
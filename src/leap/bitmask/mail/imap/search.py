@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# search.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Translation of IMAP SEARCH queries (rfc 3501, section 6.4.4) into the
+search criteria understood by leap.bitmask.mail.search_indexer.
+"""
+from twisted.mail import imap4
+
+from leap.bitmask.mail.constants import MessageFlags
+
+
+_FLAG_KEYS = {
+    'ANSWERED': MessageFlags.ANSWERED_FLAG,
+    'DELETED': MessageFlags.DELETED_FLAG,
+    'DRAFT': MessageFlags.DRAFT_FLAG,
+    'FLAGGED': MessageFlags.FLAGGED_FLAG,
+    'RECENT': MessageFlags.RECENT_FLAG,
+    'SEEN': MessageFlags.SEEN_FLAG,
+}
+
+_HEADER_KEYS = ('BCC', 'CC', 'FROM', 'SUBJECT', 'TO')
+
+_DATE_KEYS = {
+    'BEFORE': ('date', '<'),
+    'ON': ('date', '='),
+    'SINCE': ('date', '>='),
+    'SENTBEFORE': ('sentdate', '<'),
+    'SENTON': ('sentdate', '='),
+    'SENTSINCE': ('sentdate', '>='),
+}
+
+_SIZE_KEYS = {
+    'LARGER': '>',
+    'SMALLER': '<',
+}
+
+
+def parse_search_query(query, last_msn, last_uid):
+    """
+    Translate a parsed IMAP SEARCH query into search criteria.
+
+    :param query: the search keys, as parsed by twisted. Parenthesized keys
+                  come as nested lists.
+    :type query: list
+    :param last_msn: the highest message sequence number in the mailbox.
+    :type last_msn: int
+    :param last_uid: the highest uid in the mailbox.
+    :type last_uid: int
+
+    :return: the search criteria.
+    :rtype: tuple
+    :raise IllegalQueryError: if the query is not valid or not supported.
+    """
+    query = list(query)
+    criteria = []
+    while query:
+        criteria.append(_parse_key(query, last_msn, last_uid))
+    return ('and', criteria)
+
+
+def _parse_key(query, last_msn, last_uid):
+    """
+    Pop one search key (and its arguments) from the beginning of C{query}
+    and translate it.
+    """
+    item = query.pop(0)
+    if isinstance(item, list):
+        return parse_search_query(item, last_msn, last_uid)
+
+    key = str(item).upper()
+    try:
+        if not key[:1].isalpha():
+            return ('msn', _parse_id_list(key, last_msn))
+        elif key == 'ALL':
+            return ('all',)
+        elif key in _FLAG_KEYS:
+            return ('flag', _FLAG_KEYS[key])
+        elif key[:2] == 'UN' and key[2:] in _FLAG_KEYS and key != 'UNRECENT':
+            return ('not', ('flag', _FLAG_KEYS[key[2:]]))
+        elif key == 'NEW':
+            return ('and', [('flag', MessageFlags.RECENT_FLAG),
+                            ('not', ('flag', MessageFlags.SEEN_FLAG))])
+        elif key == 'OLD':
+            return ('not', ('flag', MessageFlags.RECENT_FLAG))
+        elif key == 'KEYWORD':
+            return ('flag', query.pop(0))
+        elif key == 'UNKEYWORD':
+            return ('not', ('flag', query.pop(0)))
+        elif key in _HEADER_KEYS:
+            return ('header', key.lower(), query.pop(0))
+        elif key == 'HEADER':
+            name = query.pop(0)
+            return ('header', name, query.pop(0))
+        elif key in _DATE_KEYS:
+            field, op = _DATE_KEYS[key]
+            return (field, op, _parse_date(query.pop(0)))
+        elif key in _SIZE_KEYS:
+            return ('size', _SIZE_KEYS[key], int(query.pop(0)))
+        elif key == 'UID':
+            return ('uid', _parse_id_list(query.pop(0), last_uid))
+        elif key in ('BODY', 'TEXT'):
+            return (key.lower(), query.pop(0))
+        elif key == 'NOT':
+            return ('not', _parse_key(query, last_msn, last_uid))
+        elif key == 'OR':
+            first = _parse_key(query, last_msn, last_uid)
+            return ('or', first, _parse_key(query, last_msn, last_uid))
+    except IndexError:
+        raise imap4.IllegalQueryError('Missing argument for %s' % (key,))
+    except (ValueError, imap4.IllegalIdentifierError) as e:
+        raise imap4.IllegalQueryError('Bad argument for %s: %s' % (key, e))
+    raise imap4.IllegalQueryError('Invalid search command %s' % (key,))
+
+
+def _parse_id_list(ids, last):
+    # the message set is resolved against the last id, so '*' gets a value
+    return imap4.parseIdList(str(ids), last).ranges
+
+
+def _parse_date(date):
+    parsed = imap4.parseTime(str(date))
+    return '%04d-%02d-%02d' % tuple(parsed[:3])
@@ -132,17 +132,18 @@ class LEAPIMAPServer(imap4.IMAP4Server):
             if part.part:
                 # PATCHED #############################################
                 # implement partial FETCH
-                # TODO implement boundary checks
-                # TODO see if there's a more efficient way, without
-                # copying the original content into a new buffer.
                 fd = msg.getBodyFile()
                 begin = getattr(part, "partialBegin", None)
                 _len = getattr(part, "partialLength", None)
                 if begin is not None and _len is not None:
-                    _fd = StringIO.StringIO()
-                    fd.seek(part.partialBegin)
-                    _fd.write(fd.read(part.partialLength))
-                    _fd.seek(0)
+                    if hasattr(fd, 'window'):
+                        # stream only the window, without copying the body
+                        _fd = fd.window(begin, _len)
+                    else:
+                        _fd = StringIO.StringIO()
+                        fd.seek(begin)
+                        _fd.write(fd.read(_len))
+                        _fd.seek(0)
                 else:
                     _fd = fd
                 return imap4.FileProducer(
@@ -23,6 +23,7 @@ import shlex
 import time
 import warnings
 
+from multiprocessing import cpu_count
 from email.parser import Parser
 from email.utils import parseaddr
 from email.utils import formatdate
@@ -59,6 +60,11 @@ PGP_END = "-----END PGP MESSAGE-----"
 # queue (in seconds)
 INCOMING_CHECK_PERIOD = int(os.environ.get('INCOMING_CHECK_PERIOD', 60))
 
+# The maximum number of incoming messages that are decrypted and saved
+# concurrently
+INCOMING_MAX_CONCURRENT = int(
+    os.environ.get('INCOMING_MAX_CONCURRENT', cpu_count()))
+
 
 class MalformedMessage(Exception):
     """
@@ -104,7 +110,8 @@ class IncomingMail(Service):
     log = Logger()
 
     def __init__(self, keymanager, soledad, inbox, userid,
-                 check_period=INCOMING_CHECK_PERIOD):
+                 check_period=INCOMING_CHECK_PERIOD,
+                 max_concurrent=INCOMING_MAX_CONCURRENT):
 
         """
         Initialize IncomingMail..
@@ -121,11 +128,16 @@ class IncomingMail(Service):
 
         :param check_period: the period to fetch new mail, in seconds.
         :type check_period: int
+
+        :param max_concurrent: the maximum number of incoming messages being
+                               decrypted and saved at the same time.
+        :type max_concurrent: int
         """
         leap_assert(keymanager, "need a keymanager to initialize")
         leap_assert_type(soledad, Soledad)
         leap_assert(check_period, "need a period to check incoming mail")
         leap_assert_type(check_period, int)
+        leap_assert(max_concurrent > 0, "need at least one concurrent message")
         leap_assert(userid, "need a userid to initialize")
 
         self._keymanager = keymanager
@@ -136,6 +148,7 @@ class IncomingMail(Service):
         self._listeners = []
         self._loop = None
         self._check_period = check_period
+        self._semaphore = defer.DeferredSemaphore(max_concurrent)
 
         # initialize a mail parser only once
         self._parser = Parser()
@@ -220,6 +233,8 @@ class IncomingMail(Service):
         """
         def _log_synced(result):
             self.log.info('Sync finished')
+            # the keys might have been modified remotely
+            self._keymanager.clear_key_cache()
             return result
 
         def _handle_invalid_auth_token_error(failure):
@@ -254,27 +269,24 @@ class IncomingMail(Service):
     def _process_incoming_mail(self, doclist):
         """
         Iterates through the doclist, checks if each doc
-        looks like a message, and yields a deferred that will decrypt and
-        process the message.
+        looks like a message, and schedules its decryption and processing.
+
+        At most max_concurrent messages are processed at the same time, and
+        each one is saved to the inbox as soon as it is ready, without
+        waiting for the rest of the batch.
 
         :param doclist: iterable with msg documents.
         :type doclist: iterable.
-        :returns: a list of deferreds for individual messages.
+        :returns: a deferred that will be fired with the doclist once all
+                  messages have been processed.
         """
         self.log.info('Processing incoming mail')
         if not doclist:
             self.log.debug("no incoming messages found")
             return
-        num_mails = len(doclist)
-
-        deferreds = []
-        for index, doc in enumerate(doclist):
-            self.log.debug(
-                'Processing Incoming Message: %d of %d'
-                % (index + 1, num_mails))
-            emit_async(catalog.MAIL_MSG_PROCESSING, self._userid,
-                       str(index), str(num_mails))
 
+        msgdocs = []
+        for doc in doclist:
             keys = doc.content.keys()
 
             # TODO Compatibility check with the index in pre-0.6 mx
@@ -290,11 +302,27 @@ class IncomingMail(Service):
             if has_errors:
                 self.log.debug('Skipping message with decrypting errors...')
             elif self._is_msg(keys):
-                # TODO this pipeline is a bit obscure!
-                d = self._decrypt_doc(doc)
-                d.addCallbacks(self._add_message_locally, self._errback)
-                deferreds.append(d)
+                msgdocs.append(doc)
+
+        num_mails = len(msgdocs)
+        started = [0]
+
+        def process(doc):
+            # progress is reported when processing actually starts, so the
+            # index always grows even if messages finish out of order.
+            index = started[0]
+            started[0] += 1
+            self.log.debug(
+                'Processing Incoming Message: %d of %d'
+                % (index + 1, num_mails))
+            emit_async(catalog.MAIL_MSG_PROCESSING, self._userid,
+                       str(index), str(num_mails))
+            # TODO this pipeline is a bit obscure!
+            d = self._decrypt_doc(doc)
+            d.addCallbacks(self._add_message_locally, self._errback)
+            return d
 
+        deferreds = [self._semaphore.run(process, doc) for doc in msgdocs]
         d = defer.gatherResults(deferreds, consumeErrors=True)
         d.addCallback(lambda _: doclist)
         return d
@@ -130,6 +130,13 @@ class IMailAdaptor(Interface):
         have been previously generated by `get_msg_from_string`.
         """
 
+    def get_msgs_from_mdoc_ids(self, MessageClass, store, mdoc_ids,
+                               uids=None, get_cdocs=False):
+        """
+        Get instances of a MessageClass for many MetaMsg doc_ids at once,
+        retrieving the part documents in bulk.
+        """
+
     def get_flags_from_mdoc_id(self, store, mdoc_id):
         """
         """
@@ -154,6 +161,48 @@ class IMailAdaptor(Interface):
         :rtype: defer.Deferred
         """
 
+    def update_msgs_flags(self, store, mdoc_ids, update):
+        """
+        Update the flags of many messages at once, given the doc_ids of
+        their MetaMsg documents.
+
+        :param update: a function that gets the current flags of a message
+                       and returns the new ones.
+        :return: a Deferred that is fired with the old and new flags of each
+                 message when all the flags documents have been updated.
+        :rtype: defer.Deferred
+        """
+
+    def delete_orphaned_fdocs(self, store):
+        """
+        Delete the Flags documents left behind by the interrupted creation
+        of messages, before their MetaMsg document was written.
+
+        :return: a Deferred that is fired with the uuids of the mailboxes
+                 that had orphaned Flags documents.
+        :rtype: defer.Deferred
+        """
+
+    def queue_orphaned_parts(self, store, doc_ids):
+        """
+        Queue the header and content documents of some messages deleted in
+        this device, to be deleted by sweep_orphaned_parts after a grace
+        period.
+
+        :return: a Deferred that is fired when the documents are queued.
+        :rtype: defer.Deferred
+        """
+
+    def sweep_orphaned_parts(self, store):
+        """
+        Delete the header and content documents queued for longer than the
+        grace period that no MetaMsg document points to anymore.
+
+        :return: a Deferred that is fired with the number of documents
+                 deleted.
+        :rtype: defer.Deferred
+        """
+
     def get_count_unseen(self, store, mbox_uuid):
         """
         Get the number of unseen messages for a given mailbox.
@@ -22,9 +22,9 @@ entry point for message and account manipulation, in a protocol-agnostic way.
 
 In the future, pluggable transports will expose this generic API.
 """
+import cStringIO
 import itertools
 import uuid
-import StringIO
 import time
 import weakref
 
@@ -32,6 +32,7 @@ from collections import defaultdict
 
 from twisted.internet import defer
 from twisted.logger import Logger
+from twisted.python.failure import Failure
 
 from leap.common.check import leap_assert_type
 from leap.common.events import emit_async, catalog
@@ -40,6 +41,9 @@ from leap.bitmask.mail.constants import INBOX_NAME
 from leap.bitmask.mail.constants import MessageFlags
 from leap.bitmask.mail.mailbox_indexer import MailboxIndexer
 from leap.bitmask.mail.plugins import soledad_sync_hooks
+from leap.bitmask.mail.search_indexer import FulltextDisabledError
+from leap.bitmask.mail.search_indexer import SearchIndexer
+from leap.bitmask.mail.search_indexer import needs_fulltext
 from leap.bitmask.mail.utils import find_charset, CaseInsensitiveDict
 
 log = Logger()
@@ -57,11 +61,62 @@ def _get_mdoc_id(mbox, chash):
     return "M+{mbox}+{chash}".format(mbox=mbox, chash=chash)
 
 
-def _write_and_rewind(payload):
-    fd = StringIO.StringIO()
-    fd.write(payload)
-    fd.seek(0)
-    return fd
+class BodyFile(object):
+    """
+    A read-only, seekable file with the body of a message, or a window of it.
+
+    The payload is encoded the first time the file is read, and it is never
+    copied: windows of the body share the payload with the file they come
+    from.
+    """
+
+    def __init__(self, payload, ctype="", begin=0, length=-1):
+        """
+        :param payload: the payload of the body.
+        :type payload: basestring
+        :param ctype: optional, the content of the content-type header for
+                      the payload, used to encode unicode payloads.
+        :type ctype: str
+        :param begin: the offset of the window in the encoded payload.
+        :type begin: int
+        :param length: the length of the window, or -1 for the rest of the
+                       payload.
+        :type length: int
+        """
+        self._payload = payload
+        self._ctype = ctype
+        self._begin = begin
+        self._length = length
+        self._fd = None
+
+    def window(self, begin, length):
+        """
+        Get a file with C{length} octets of this file, starting at C{begin}.
+
+        :rtype: BodyFile
+        """
+        if self._length != -1:
+            length = max(0, min(length, self._length - begin))
+        return BodyFile(self._get_payload(), begin=self._begin + begin,
+                        length=length)
+
+    def _get_payload(self):
+        if isinstance(self._payload, unicode):
+            self._payload = _encode_payload(self._payload, ctype=self._ctype)
+        return self._payload
+
+    def _get_fd(self):
+        if self._fd is None:
+            self._fd = cStringIO.StringIO(
+                buffer(self._get_payload(), self._begin, self._length))
+        return self._fd
+
+    def __getattr__(self, name):
+        # read, readline, seek, tell, close...
+        return getattr(self._get_fd(), name)
+
+    def __iter__(self):
+        return iter(self._get_fd())
 
 
 def _encode_payload(payload, ctype=""):
@@ -121,6 +176,24 @@ def _unpack_headers(headers_dict):
     return headers_l
 
 
+def _get_phash_map(cdocs):
+    """
+    Index the content-doc wrappers of a message by their payload hash.
+
+    :param cdocs: a dict of wrappers for content-docs (1-indexed).
+    :type cdocs: dict
+    :rtype: dict
+    """
+    phash_map = {}
+    # the first cdoc wins when several parts share a payload, as in a
+    # linear scan
+    for key in sorted(cdocs, reverse=True):
+        cdocw = cdocs[key]
+        if cdocw is not None:
+            phash_map[cdocw.phash] = cdocw
+    return phash_map
+
+
 class MessagePart(object):
 
     # TODO This class should be better abstracted from the data model.
@@ -131,9 +204,12 @@ class MessagePart(object):
     Represents a part of a multipart MIME Message.
     """
 
+    __slots__ = ('_pmap', '_cdocs', '_nested', '_phash_map', '_size',
+                 '_headers', '_subparts')
+
     log = Logger()
 
-    def __init__(self, part_map, cdocs=None, nested=False):
+    def __init__(self, part_map, cdocs=None, nested=False, phash_map=None):
         """
         :param part_map: a dictionary mapping the subparts for
                          this MessagePart (1-indexed).
@@ -151,23 +227,33 @@ class MessagePart(object):
 
         :param cdocs: optional, a reference to the top-level dict of wrappers
                       for content-docs (1-indexed).
+        :param phash_map: optional, the wrappers for content-docs indexed by
+                          payload hash, shared by all the parts of a message.
+                          It is built from cdocs if not given.
+        :type phash_map: dict
         """
         if cdocs is None:
             cdocs = {}
         self._pmap = part_map
         self._cdocs = cdocs
         self._nested = nested
+        self._phash_map = phash_map
+        self._size = None
+        self._headers = None
+        self._subparts = {}
 
     def get_size(self):
         """
         Size of the body, in octets.
         """
-        total = self._pmap['size']
-        _h = self.get_headers()
-        headers = len(
-            '\n'.join(["%s: %s" % (k, v) for k, v in dict(_h).items()]))
-        # have to subtract 2 blank lines
-        return total - headers - 2
+        if self._size is None:
+            total = self._pmap['size']
+            _h = self.get_headers()
+            headers = len(
+                '\n'.join(["%s: %s" % (k, v) for k, v in dict(_h).items()]))
+            # have to subtract 2 blank lines
+            self._size = total - headers - 2
+        return self._size
 
     def get_body_file(self):
         payload = ""
@@ -176,13 +262,13 @@ class MessagePart(object):
         multi = pmap.get('multi')
         if not multi:
             payload = self._get_payload(pmap.get('phash'))
-        if payload:
-            payload = _encode_payload(payload)
 
-        return _write_and_rewind(payload)
+        return BodyFile(payload or "")
 
     def get_headers(self):
-        return CaseInsensitiveDict(self._pmap.get("headers", []))
+        if self._headers is None:
+            self._headers = CaseInsensitiveDict(self._pmap.get("headers", []))
+        return self._headers
 
     def is_multipart(self):
         return self._pmap.get("multi", False)
@@ -190,20 +276,30 @@ class MessagePart(object):
     def get_subpart(self, part):
         if not self.is_multipart():
             raise TypeError
-        sub_pmap = self._pmap.get("part_map", {})
-
-        try:
-            part_map = sub_pmap[str(part)]
-        except KeyError:
-            self.log.debug('get_subpart for %s: KeyError' % (part,))
-            raise IndexError
-        return MessagePart(part_map, cdocs=self._cdocs, nested=True)
+        subpart = self._subparts.get(part)
+        if subpart is None:
+            sub_pmap = self._pmap.get("part_map", {})
+
+            try:
+                part_map = sub_pmap[str(part)]
+            except KeyError:
+                self.log.debug('get_subpart for %s: KeyError' % (part,))
+                raise IndexError
+            subpart = self._subparts[part] = MessagePart(
+                part_map, cdocs=self._cdocs, nested=True,
+                phash_map=self._get_phash_map())
+        return subpart
+
+    def _get_phash_map(self):
+        if self._phash_map is None:
+            self._phash_map = _get_phash_map(self._cdocs)
+        return self._phash_map
 
     def _get_payload(self, phash):
-        for cdocw in self._cdocs.values():
-            if cdocw.phash == phash:
-                return cdocw.raw
-        return ""
+        cdocw = self._get_phash_map().get(phash)
+        if cdocw is None:
+            return ""
+        return cdocw.raw
 
 
 class Message(object):
@@ -212,6 +308,8 @@ class Message(object):
     Represents a single message, and gives access to all its attributes.
     """
 
+    __slots__ = ('_wrapper', '_uid', '_headers', '_phash_map', '_subparts')
+
     def __init__(self, wrapper, uid=None):
         """
         :param wrapper: an instance of an implementor of IMessageWrapper
@@ -220,6 +318,9 @@ class Message(object):
         """
         self._wrapper = wrapper
         self._uid = uid
+        self._headers = None
+        self._phash_map = None
+        self._subparts = {}
 
     def get_wrapper(self):
         """
@@ -265,21 +366,22 @@ class Message(object):
         """
         Get the raw headers document.
         """
-        return CaseInsensitiveDict(self._wrapper.hdoc.headers)
+        if self._headers is None:
+            self._headers = CaseInsensitiveDict(self._wrapper.hdoc.headers)
+        return self._headers
 
     def get_body_file(self, store):
         """
         Get a file descriptor with the body content.
         """
-        def write_and_rewind_if_found(cdoc):
-            payload = cdoc.raw if cdoc else ""
+        def get_body_file_if_found(cdoc):
+            if not cdoc or not cdoc.raw:
+                return BodyFile("")
             # XXX pass ctype from headers if not multipart?
-            if payload:
-                payload = _encode_payload(payload, ctype=cdoc.content_type)
-            return _write_and_rewind(payload)
+            return BodyFile(cdoc.raw, ctype=cdoc.content_type)
 
         d = defer.maybeDeferred(self._wrapper.get_body, store)
-        d.addCallback(write_and_rewind_if_found)
+        d.addCallback(get_body_file_if_found)
         return d
 
     def get_size(self):
@@ -303,13 +405,19 @@ class Message(object):
         """
         if not self.is_multipart():
             raise TypeError
-        try:
-            subpart_dict = self._wrapper.get_subpart_dict(part)
-        except KeyError:
-            raise IndexError
-
-        return MessagePart(
-            subpart_dict, cdocs=self._wrapper.cdocs)
+        subpart = self._subparts.get(part)
+        if subpart is None:
+            try:
+                subpart_dict = self._wrapper.get_subpart_dict(part)
+            except KeyError:
+                raise IndexError
+
+            if self._phash_map is None:
+                self._phash_map = _get_phash_map(self._wrapper.cdocs)
+            subpart = self._subparts[part] = MessagePart(
+                subpart_dict, cdocs=self._wrapper.cdocs,
+                phash_map=self._phash_map)
+        return subpart
 
     # Custom methods.
 
@@ -320,6 +428,108 @@ class Message(object):
         return tuple(self._wrapper.fdoc.tags)
 
 
+def _get_count_deltas(fdoc, sign):
+    """
+    Get the changes to the counts of a mailbox when a message is added to it
+    (C{sign} is 1) or removed from it (C{sign} is -1).
+
+    :param fdoc: the flags document of the message.
+    :type fdoc: FlagsDocWrapper
+    :type sign: int
+    :rtype: dict
+    """
+    return {MailboxCounters.EXISTS: sign,
+            MailboxCounters.RECENT: sign if fdoc.recent else 0,
+            MailboxCounters.UNSEEN: 0 if fdoc.seen else sign}
+
+
+class MailboxCounters(object):
+    """
+    The number of messages in a mailbox, and of the recent and unseen ones.
+
+    The counts are queried from the store the first time they are needed,
+    and then kept up to date by the writes to the mailbox, so that STATUS,
+    SELECT or the notifications after an APPEND do not query the store again.
+
+    A write has to L{begin} before it touches the store, and L{end} with the
+    changes to the counts once it is done. A count that was queried while a
+    write was running could include the write or not, so it is not cached.
+    Anything else that changes the mailbox (a sync, a copy from another
+    mailbox) has to L{invalidate} the counts.
+    """
+
+    EXISTS = 'exists'
+    RECENT = 'recent'
+    UNSEEN = 'unseen'
+
+    def __init__(self):
+        self._counts = {}
+        self._writes = 0
+        self.generation = 0
+
+    def get(self, name, query):
+        """
+        Get a count, querying the store if it is not cached.
+
+        :param name: the count to get.
+        :type name: str
+        :param query: a function that queries the store for the count.
+        :type query: callable
+
+        :return: a deferred that will fire with the count.
+        :rtype: Deferred
+        """
+        if name in self._counts:
+            return defer.succeed(self._counts[name])
+
+        def cache(count, generation):
+            if (count is not None and not self._writes and
+                    generation == self.generation):
+                self._counts[name] = count
+            return count
+
+        generation = self.generation if not self._writes else None
+        d = defer.maybeDeferred(query)
+        d.addCallback(cache, generation)
+        return d
+
+    def begin(self):
+        """
+        Mark the start of a write to the mailbox.
+        """
+        self._writes += 1
+
+    def end(self, deltas=None):
+        """
+        Mark the end of a write to the mailbox, adding C{deltas} to the cached
+        counts.
+
+        :param deltas: the changes to the counts, by name. A delta of None
+                       drops the count, and no deltas at all (for a write
+                       that failed halfway) drop all of them.
+        :type deltas: dict
+        """
+        self._writes -= 1
+        self.generation += 1
+        if deltas is None:
+            self._counts.clear()
+            return
+        for name, delta in deltas.items():
+            if name not in self._counts:
+                continue
+            if delta is None or self._counts[name] + delta < 0:
+                del self._counts[name]
+            else:
+                self._counts[name] += delta
+
+    def invalidate(self):
+        """
+        Drop the cached counts.
+        """
+        self.generation += 1
+        self._counts.clear()
+
+
 class Flagsmode(object):
     """
     Modes for setting the flags/tags.
@@ -368,7 +578,17 @@ class MessageCollection(object):
     store = None
     messageklass = Message
 
-    def __init__(self, adaptor, store, mbox_indexer=None, mbox_wrapper=None):
+    # number of messages to load at once when updating the search index
+    SEARCH_INDEX_BATCH_SIZE = 100
+    # same, for the full-text index, which needs the contents too
+    FULLTEXT_INDEX_BATCH_SIZE = 20
+
+    # the counters of each mailbox, by uuid, shared by all the collections
+    # for the mailbox while any of them is alive
+    _mailbox_counters = weakref.WeakValueDictionary()
+
+    def __init__(self, adaptor, store, mbox_indexer=None, mbox_wrapper=None,
+                 search_indexer=None):
         """
         Constructor for a MessageCollection.
         """
@@ -380,7 +600,9 @@ class MessageCollection(object):
         # of by doc_id. See get_message_by_content_hash
         self.mbox_indexer = mbox_indexer
         self.mbox_wrapper = mbox_wrapper
+        self.search_indexer = search_indexer
         self._listeners = set([])
+        self._counters = None
 
     def is_mailbox_collection(self):
         """
@@ -437,14 +659,13 @@ class MessageCollection(object):
         Retrieve a message by its Message Sequence Number.
         :rtype: Deferred
         """
-        def get_uid_for_msn(all_uid):
-            return all_uid[msn - 1]
-        d = self.all_uid_iter()
-        d.addCallback(get_uid_for_msn)
-        d.addCallback(
-            lambda uid: self.get_message_by_uid(
-                uid, get_cdocs=get_cdocs))
-        d.addErrback(self.log.error('Error getting msg by seq'))
+        def get_message_for_uid(uid):
+            if uid is None:
+                return None
+            return self.get_message_by_uid(uid, get_cdocs=get_cdocs)
+
+        d = self.mbox_indexer.get_uid_from_msn(self.mbox_uuid, msn)
+        d.addCallback(get_message_for_uid)
         return d
 
     def get_message_by_uid(self, uid, absolute=True, get_cdocs=False):
@@ -474,6 +695,41 @@ class MessageCollection(object):
         d.addCallback(get_msg_from_mdoc_id)
         return d
 
+    def get_messages_by_uids(self, uids, get_cdocs=False):
+        """
+        Retrieve several messages by their Unique Identifiers.
+
+        The doc_ids for all the uids are looked up with a single query to the
+        mailbox index, and the documents of all the messages are then
+        retrieved in bulk.
+
+        :param uids: the uids of the messages.
+        :type uids: iterable of int
+        :param get_cdocs: whether to retrieve the content documents too.
+        :type get_cdocs: bool
+        :return: a Deferred that will fire with a list of messages, in the
+                 same order than uids, with None in place of the uids that
+                 are not in this mailbox.
+        :rtype: Deferred
+        """
+        if not self.is_mailbox_collection():
+            raise NotImplementedError()
+        uids = list(uids)
+
+        def get_msgs_from_mdoc_ids(mdoc_ids):
+            found = [uid for uid in uids if uid in mdoc_ids]
+            d = self.adaptor.get_msgs_from_mdoc_ids(
+                self.messageklass, self.store,
+                [mdoc_ids[uid] for uid in found],
+                uids=found, get_cdocs=get_cdocs)
+            d.addCallback(lambda msgs: dict(zip(found, msgs)))
+            d.addCallback(lambda msgs: [msgs.get(uid) for uid in uids])
+            return d
+
+        d = self.mbox_indexer.get_doc_ids_from_uids(self.mbox_uuid, uids)
+        d.addCallback(get_msgs_from_mdoc_ids)
+        return d
+
     def get_flags_by_uid(self, uid, absolute=True):
         # TODO use sequence numbers
         if not absolute:
@@ -502,8 +758,9 @@ class MessageCollection(object):
         if not self.is_mailbox_collection():
             raise NotImplementedError()
 
-        d = self.mbox_indexer.count(self.mbox_uuid)
-        return d
+        return self._get_counters().get(
+            MailboxCounters.EXISTS,
+            lambda: self.mbox_indexer.count(self.mbox_uuid))
 
     def count_recent(self):
         """
@@ -513,7 +770,9 @@ class MessageCollection(object):
         """
         if not self.is_mailbox_collection():
             raise NotImplementedError()
-        return self.adaptor.get_count_recent(self.store, self.mbox_uuid)
+        return self._get_counters().get(
+            MailboxCounters.RECENT,
+            lambda: self.adaptor.get_count_recent(self.store, self.mbox_uuid))
 
     def count_unseen(self):
         """
@@ -523,7 +782,31 @@ class MessageCollection(object):
         """
         if not self.is_mailbox_collection():
             raise NotImplementedError()
-        return self.adaptor.get_count_unseen(self.store, self.mbox_uuid)
+        return self._get_counters().get(
+            MailboxCounters.UNSEEN,
+            lambda: self.adaptor.get_count_unseen(self.store, self.mbox_uuid))
+
+    def _get_counters(self):
+        if self._counters is None:
+            counters = self._mailbox_counters.get(self.mbox_uuid)
+            if counters is None:
+                counters = MailboxCounters()
+                self._mailbox_counters[self.mbox_uuid] = counters
+            self._counters = counters
+        return self._counters
+
+    @classmethod
+    def invalidate_counters(cls, mbox_uuid):
+        """
+        Drop the cached counts of a mailbox, after it was changed by other
+        means than its collections (a sync, for instance).
+
+        :param mbox_uuid: the uuid of the mailbox.
+        :type mbox_uuid: str
+        """
+        counters = cls._mailbox_counters.get(mbox_uuid)
+        if counters is not None:
+            counters.invalidate()
 
     def get_uid_next(self):
         """
@@ -546,6 +829,33 @@ class MessageCollection(object):
         """
         return self.mbox_indexer.all_uid_iter(self.mbox_uuid)
 
+    def get_uids_in_ranges(self, ranges):
+        """
+        Get the uids of the messages in this mailbox within the given ranges.
+
+        :param ranges: inclusive (first, last) uid ranges, with None as last
+                       for an open range.
+        :type ranges: iterable of tuples
+        :return: a Deferred that will fire with the sorted list of uids.
+        :rtype: Deferred
+        """
+        return self.mbox_indexer.get_uids_in_ranges(self.mbox_uuid, ranges)
+
+    def get_uids_from_msn_ranges(self, ranges):
+        """
+        Get the uids of the messages in this mailbox for the given message
+        sequence numbers.
+
+        :param ranges: inclusive (first, last) sequence number ranges, with
+                       None as last for an open range.
+        :type ranges: iterable of tuples
+        :return: a Deferred that will fire with a sorted list of (msn, uid)
+                 tuples.
+        :rtype: Deferred
+        """
+        return self.mbox_indexer.get_uids_from_msn_ranges(
+            self.mbox_uuid, ranges)
+
     def get_uid_from_msgid(self, msgid):
         """
         Return the UID(s) of the matching msg-ids for this mailbox collection.
@@ -565,6 +875,80 @@ class MessageCollection(object):
         d.addCallback(get_uid)
         return d
 
+    # Search messages
+
+    @defer.inlineCallbacks
+    def search(self, criteria):
+        """
+        Search the messages in this mailbox.
+
+        The messages that are not in the search index yet are indexed first.
+
+        :param criteria: a tree of search criteria, as described in
+                         leap.bitmask.mail.search_indexer.
+        :type criteria: tuple
+        :return: a Deferred that will fire with the sorted list of the uids
+                 of the matching messages.
+        :rtype: Deferred
+        :raise FulltextDisabledError: if the criteria search the message
+                                      contents, and the full-text index is
+                                      not enabled for this mailbox.
+        """
+        if not self.is_mailbox_collection() or self.search_indexer is None:
+            raise NotImplementedError()
+        indexer = self.search_indexer
+        if needs_fulltext(criteria):
+            enabled = yield indexer.has_fulltext_table(self.mbox_uuid)
+            if not enabled:
+                raise FulltextDisabledError(
+                    'The full-text index is not enabled for this mailbox')
+            yield self.update_fulltext_index()
+
+        yield indexer.create_table(self.mbox_uuid)
+        unindexed = yield indexer.get_unindexed_uids(self.mbox_uuid)
+        step = self.SEARCH_INDEX_BATCH_SIZE
+        for i in range(0, len(unindexed), step):
+            msgs = yield self.get_messages_by_uids(unindexed[i:i + step])
+            yield indexer.index_messages(self.mbox_uuid, msgs)
+        uids = yield indexer.search(self.mbox_uuid, criteria)
+        defer.returnValue(uids)
+
+    @defer.inlineCallbacks
+    def update_fulltext_index(self):
+        """
+        Add the messages that are not in the full-text index of this mailbox
+        yet, if the index is enabled.
+
+        :return: a Deferred that will fire with the number of messages added
+                 to the index.
+        :rtype: Deferred
+        """
+        if not self.is_mailbox_collection() or self.search_indexer is None:
+            raise NotImplementedError()
+        indexer = self.search_indexer
+        enabled = yield indexer.has_fulltext_table(self.mbox_uuid)
+        if not enabled:
+            defer.returnValue(0)
+        unindexed = yield indexer.get_unindexed_fulltext_uids(self.mbox_uuid)
+        step = self.FULLTEXT_INDEX_BATCH_SIZE
+        for i in range(0, len(unindexed), step):
+            msgs = yield self.get_messages_by_uids(
+                unindexed[i:i + step], get_cdocs=True)
+            yield indexer.index_fulltext(self.mbox_uuid, msgs)
+        defer.returnValue(len(unindexed))
+
+    def get_msns_from_uids(self, uids):
+        """
+        Get the message sequence numbers for several uids in this mailbox.
+
+        :param uids: the uids of the messages.
+        :type uids: iterable of int
+        :return: a Deferred that will fire with a dict mapping the uids that
+                 exist to their sequence numbers.
+        :rtype: Deferred
+        """
+        return self.mbox_indexer.get_msns_from_uids(self.mbox_uuid, uids)
+
     # Manipulate messages
 
     @defer.inlineCallbacks
@@ -606,6 +990,8 @@ class MessageCollection(object):
         wrapper.set_tags(tags)
         wrapper.set_date(date)
 
+        counters = self._get_counters()
+        counters.begin()
         try:
             updated_wrapper = yield wrapper.create(self.store)
             doc_id = updated_wrapper.mdoc.doc_id
@@ -614,6 +1000,7 @@ class MessageCollection(object):
             assert doc_id
 
         except Exception:
+            counters.end()
             self.log.failure('Error creating message')
             raise
 
@@ -627,11 +1014,26 @@ class MessageCollection(object):
             yield self.mbox_indexer.create_table(self.mbox_uuid)
             uid = yield self.mbox_indexer.insert_doc(self.mbox_uuid, doc_id)
         except Exception:
+            counters.end()
             self.log.failure('Error indexing message')
         else:
+            counters.end(_get_count_deltas(wrapper.fdoc, 1))
+            msg = Message(wrapper, uid)
+            if self.search_indexer is not None:
+                try:
+                    yield self.search_indexer.index_messages(
+                        self.mbox_uuid, [msg])
+                    fulltext = yield self.search_indexer.has_fulltext_table(
+                        self.mbox_uuid)
+                    if fulltext:
+                        yield self.search_indexer.index_fulltext(
+                            self.mbox_uuid, [msg])
+                except Exception:
+                    # it will be indexed again before the next search
+                    self.log.debug('Could not add message to search index')
             self.cb_signal_unread_to_ui()
             self.notify_new_to_listeners()
-            defer.returnValue(Message(wrapper, uid))
+            defer.returnValue(msg)
 
     # Listeners
 
@@ -717,10 +1119,16 @@ class MessageCollection(object):
             d.addBoth(insert_doc, new_mbox_uuid, doc_id)
             return d
 
+        def invalidate_counters(result):
+            self.invalidate_counters(new_mbox_uuid)
+            return result
+
         wrapper = msg.get_wrapper()
 
         d = wrapper.copy(self.store, new_mbox_uuid)
         d.addCallback(insert_copied_mdoc_id)
+        # the copy can replace a message that was already in the mailbox
+        d.addBoth(invalidate_counters)
         d.addCallback(lambda _: self.notify_new_to_listeners())
         return d
 
@@ -734,39 +1142,73 @@ class MessageCollection(object):
             doc_id = wrapper.mdoc.doc_id
             return self.mbox_indexer.delete_doc_by_hash(
                 self.mbox_uuid, doc_id)
+
+        def delete_search_entry(_):
+            if self.search_indexer is None or not msg.get_uid():
+                return
+            return self.search_indexer.delete_uids(
+                self.mbox_uuid, [msg.get_uid()])
+
+        def queue_parts(_):
+            d = self.adaptor.queue_orphaned_parts(
+                self.store, wrapper.get_part_doc_ids())
+            d.addErrback(lambda f: self.log.failure(
+                'Error queueing orphaned parts', failure=f))
+            return d
+
+        def count_deleted(result):
+            if isinstance(result, Failure):
+                counters.end()
+            else:
+                counters.end(_get_count_deltas(wrapper.fdoc, -1))
+            return result
+
+        counters = self._get_counters()
+        counters.begin()
         d = wrapper.delete(self.store)
         d.addCallback(delete_mdoc_id, wrapper)
+        d.addBoth(count_deleted)
+        d.addCallback(delete_search_entry)
+        d.addCallback(queue_parts)
         return d
 
     def delete_all_flagged(self):
         """
         Delete all messages flagged as \\Deleted.
         Used from IMAPMailbox.expunge()
-        """
-        def get_uid_list(hashes):
-            d = []
-            for h in hashes:
-                d.append(self.mbox_indexer.get_uid_from_doc_id(
-                         self.mbox_uuid, h))
-            return defer.gatherResults(d), hashes
 
-        def delete_uid_entries((uids, hashes)):
-            d = []
-            for h in hashes:
-                d.append(self.mbox_indexer.delete_doc_by_hash(
-                         self.mbox_uuid, h))
+        :return: a Deferred that will fire with the sorted list of the uids
+                 of the deleted messages.
+        :rtype: Deferred
+        """
+        def delete_uid_entries(hashes):
+            return self.mbox_indexer.delete_docs_by_hash(
+                self.mbox_uuid, hashes)
 
-            def return_uids_when_deleted(ignored):
+        def delete_search_entries(uids):
+            if self.search_indexer is None:
                 return uids
+            d = self.search_indexer.delete_uids(self.mbox_uuid, uids)
+            d.addCallback(lambda _: uids)
+            return d
 
-            all_deleted = defer.gatherResults(d).addCallback(
-                return_uids_when_deleted)
-            return all_deleted
-
+        def count_deleted(result):
+            if isinstance(result, Failure):
+                counters.end()
+            else:
+                # the flags of the deleted messages are not known here
+                counters.end({MailboxCounters.EXISTS: -len(result),
+                              MailboxCounters.RECENT: None,
+                              MailboxCounters.UNSEEN: None})
+            return result
+
+        counters = self._get_counters()
+        counters.begin()
         mdocs_deleted = self.adaptor.del_all_flagged_messages(
             self.store, self.mbox_uuid)
-        mdocs_deleted.addCallback(get_uid_list)
         mdocs_deleted.addCallback(delete_uid_entries)
+        mdocs_deleted.addCallback(delete_search_entries)
+        mdocs_deleted.addBoth(count_deleted)
         return mdocs_deleted
 
     # TODO should add a delete-by-uid to collection?
@@ -793,13 +1235,90 @@ class MessageCollection(object):
         newflags = map(str, self._update_flags_or_tags(current, flags, mode))
         wrapper.fdoc.flags = newflags
 
+        was_seen = wrapper.fdoc.seen
         wrapper.fdoc.seen = MessageFlags.SEEN_FLAG in newflags
         wrapper.fdoc.deleted = MessageFlags.DELETED_FLAG in newflags
 
+        def count_updated(result):
+            if isinstance(result, Failure):
+                counters.end()
+            else:
+                counters.end(
+                    {MailboxCounters.UNSEEN: was_seen - wrapper.fdoc.seen})
+            return result
+
+        counters = self._get_counters()
+        counters.begin()
         d = self.adaptor.update_msg(self.store, msg)
+        d.addBoth(count_updated)
+        if self.search_indexer is not None and msg.get_uid():
+            d.addCallback(lambda _: self.search_indexer.update_flags(
+                self.mbox_uuid, msg.get_uid(), newflags))
         d.addCallback(lambda _: newflags)
         return d
 
+    def update_flags_by_uids(self, uids, flags, mode):
+        """
+        Update the flags of several messages at once.
+
+        The flags documents of all the messages are retrieved, updated and
+        written back in bulk, instead of one message at a time.
+
+        :param uids: the uids of the messages.
+        :type uids: iterable of int
+        :param flags: the flags to set, add or remove.
+        :type flags: tuple of str
+        :param mode: one of the Flagsmode modes.
+        :type mode: int
+        :return: a Deferred that will fire with a dict mapping the uids that
+                 are in this mailbox to their new flags.
+        :rtype: Deferred
+        """
+        if not self.is_mailbox_collection():
+            raise NotImplementedError()
+        uids = list(uids)
+
+        def update_flags(mdoc_ids):
+            found = [uid for uid in uids if uid in mdoc_ids]
+            d = self.adaptor.update_msgs_flags(
+                self.store, [mdoc_ids[uid] for uid in found],
+                lambda current: self._update_flags_or_tags(
+                    current, flags, mode))
+            d.addCallback(lambda results: zip(found, results))
+            return d
+
+        def count_updated(result):
+            if isinstance(result, Failure):
+                counters.end()
+                return result
+            unseen = 0
+            for _, flags_pair in result:
+                if flags_pair is not None:
+                    old, new = flags_pair
+                    unseen += ((MessageFlags.SEEN_FLAG in old) -
+                               (MessageFlags.SEEN_FLAG in new))
+            counters.end({MailboxCounters.UNSEEN: unseen})
+            return result
+
+        def update_search_index(result):
+            newflags = dict((uid, flags_pair[1])
+                            for uid, flags_pair in result
+                            if flags_pair is not None)
+            if self.search_indexer is None or not newflags:
+                return newflags
+            d = self.search_indexer.update_many_flags(
+                self.mbox_uuid, newflags)
+            d.addCallback(lambda _: newflags)
+            return d
+
+        counters = self._get_counters()
+        counters.begin()
+        d = self.mbox_indexer.get_doc_ids_from_uids(self.mbox_uuid, uids)
+        d.addCallback(update_flags)
+        d.addBoth(count_updated)
+        d.addCallback(update_search_index)
+        return d
+
     def update_tags(self, msg, tags, mode):
         """
         Update tags for a given message.
@@ -863,6 +1382,7 @@ class Account(object):
         self.adaptor = self.adaptor_class()
 
         self.mbox_indexer = MailboxIndexer(self.store)
+        self.search_indexer = SearchIndexer(self.store)
 
         # This flag is only used from the imap service for the moment.
         # In the future, we should prevent any public method to continue if
@@ -879,6 +1399,10 @@ class Account(object):
     @defer.inlineCallbacks
     def _initialize_storage(self):
         yield self.adaptor.initialize_store(self.store)
+        # a crash while creating a message may have left its flags behind
+        mbox_uuids = yield self.adaptor.delete_orphaned_fdocs(self.store)
+        for mbox_uuid in mbox_uuids:
+            self.invalidate_counters(mbox_uuid)
         mboxes = yield self.list_all_mailbox_names()
         if INBOX_NAME not in mboxes:
             yield self.add_mailbox(INBOX_NAME)
@@ -909,6 +1433,28 @@ class Account(object):
     def _teardown_sync_hooks(self):
         soledad_sync_hooks.post_sync_uid_reindexer.set_account(None)
 
+    def invalidate_counters(self, mbox_uuid):
+        """
+        Drop the cached message counts of a mailbox that was changed by a
+        sync.
+
+        :param mbox_uuid: the uuid of the mailbox.
+        :type mbox_uuid: str
+        """
+        MessageCollection.invalidate_counters(mbox_uuid)
+
+    def sweep_orphaned_parts(self):
+        """
+        Delete the header and content documents of the messages deleted in
+        this device, after their grace period, that no message points to
+        anymore.
+
+        :return: a Deferred that will fire with the number of documents
+                 deleted.
+        :rtype: Deferred
+        """
+        return self.adaptor.sweep_orphaned_parts(self.store)
+
     #
     # Public API Starts
     #
@@ -927,8 +1473,9 @@ class Account(object):
         return d
 
     def add_mailbox(self, name, creation_ts=None):
-        return self.adaptor.atomic.run(
-            self._add_mailbox, name, creation_ts=creation_ts)
+        return self.adaptor.atomic(
+            self.store, [name], self._add_mailbox, name,
+            creation_ts=creation_ts)
 
     def _add_mailbox(self, name, creation_ts=None):
 
@@ -953,8 +1500,18 @@ class Account(object):
                 return d
             return wrapper
 
+        def create_fulltext_table(enabled, uuid):
+            # new mailboxes get a full-text index if the other ones have it
+            if enabled:
+                return self.search_indexer.create_fulltext_table(uuid)
+
         def create_uid_table_cb(wrapper):
             d = self.mbox_indexer.create_table(wrapper.uuid)
+            d.addCallback(
+                lambda _: self.search_indexer.create_table(wrapper.uuid))
+            d.addCallback(
+                lambda _: self.search_indexer.is_fulltext_enabled())
+            d.addCallback(create_fulltext_table, wrapper.uuid)
             d.addCallback(lambda _: wrapper)
             return d
 
@@ -965,13 +1522,15 @@ class Account(object):
         return d
 
     def delete_mailbox(self, name):
-        return self.adaptor.atomic.run(
-            self._delete_mailbox, name)
+        return self.adaptor.atomic(
+            self.store, [name], self._delete_mailbox, name)
 
     def _delete_mailbox(self, name):
 
         def delete_uid_table_cb(wrapper):
             d = self.mbox_indexer.delete_table(wrapper.uuid)
+            d.addCallback(
+                lambda _: self.search_indexer.delete_table(wrapper.uuid))
             d.addCallback(lambda _: wrapper)
             return d
 
@@ -982,8 +1541,9 @@ class Account(object):
         return d
 
     def rename_mailbox(self, oldname, newname):
-        return self.adaptor.atomic.run(
-            self._rename_mailbox, oldname, newname)
+        return self.adaptor.atomic(
+            self.store, [oldname, newname], self._rename_mailbox,
+            oldname, newname)
 
     def _rename_mailbox(self, oldname, newname):
 
@@ -997,6 +1557,69 @@ class Account(object):
         d.addCallback(_rename_mbox)
         return d
 
+    # Full-text search
+
+    def is_fulltext_enabled(self):
+        """
+        Tell whether the full-text index of the message contents is enabled.
+
+        :rtype: Deferred
+        :return: a deferred that will fire with a boolean.
+        """
+        return self.search_indexer.is_fulltext_enabled()
+
+    @defer.inlineCallbacks
+    def enable_fulltext(self, rebuild=False):
+        """
+        Enable the local full-text index of the message contents, for all the
+        mailboxes.
+
+        The existing messages are indexed in the background, and the new ones
+        as they are added. The searches index any message that is still
+        missing before running.
+
+        :param rebuild: if True, the index is deleted and built again.
+        :type rebuild: bool
+        :rtype: Deferred
+        :return: a deferred that will fire when the index tables are ready.
+        """
+        mboxes = yield self.get_all_mailboxes()
+        for mbox in mboxes:
+            if rebuild:
+                yield self.search_indexer.delete_fulltext_table(mbox.uuid)
+            yield self.search_indexer.create_fulltext_table(mbox.uuid)
+        self._update_fulltext_index([mbox.mbox for mbox in mboxes])
+
+    @defer.inlineCallbacks
+    def disable_fulltext(self):
+        """
+        Disable the full-text index of the message contents, deleting it for
+        all the mailboxes.
+
+        :rtype: Deferred
+        """
+        mboxes = yield self.get_all_mailboxes()
+        for mbox in mboxes:
+            yield self.search_indexer.delete_fulltext_table(mbox.uuid)
+
+    def _update_fulltext_index(self, names):
+        """
+        Index in the background the messages of some mailboxes that are not
+        in the full-text index yet, one mailbox after the other.
+        """
+        def log_error(failure, name):
+            log.failure('Error updating the full-text index of {name}',
+                        failure, name=name)
+
+        d = defer.succeed(None)
+        for name in names:
+            d.addCallback(
+                lambda _, name: self.get_collection_by_mailbox(name), name)
+            d.addCallback(
+                lambda collection: collection.update_fulltext_index())
+            d.addErrback(log_error, name)
+        return d
+
     # Get Collections
 
     def get_collection_by_mailbox(self, name):
@@ -1004,8 +1627,8 @@ class Account(object):
         :rtype: deferred
         :return: a deferred that will fire with a MessageCollection
         """
-        return self.adaptor.atomic.run(
-            self._get_collection_by_mailbox, name)
+        return self.adaptor.atomic(
+            self.store, [name], self._get_collection_by_mailbox, name)
 
     def _get_collection_by_mailbox(self, name):
         collection = self._collection_mapping[self.user_id].get(
@@ -1016,7 +1639,8 @@ class Account(object):
         # imap select will use this, passing the collection to SoledadMailbox
         def get_collection_for_mailbox(mbox_wrapper):
             collection = MessageCollection(
-                self.adaptor, self.store, self.mbox_indexer, mbox_wrapper)
+                self.adaptor, self.store, self.mbox_indexer, mbox_wrapper,
+                search_indexer=self.search_indexer)
             self._collection_mapping[self.user_id][name] = collection
             return collection
 
@@ -22,9 +22,15 @@ Local tables to store the message Unique Identifiers for a given mailbox.
 import re
 import uuid
 
+from twisted.internet import defer
+
 from leap.bitmask.mail.constants import METAMSGID_RE
 
 
+# sqlite limits the number of host parameters in a query to 999 by default
+MAX_SQL_VARIABLES = 500
+
+
 def _maybe_first_query_item(thing):
     """
     Return the first item the returned query result, or None
@@ -203,6 +209,48 @@ class MailboxIndexer(object):
         values = (doc_id,)
         return self._query(sql, values)
 
+    def delete_docs_by_hash(self, mailbox_uuid, doc_ids):
+        """
+        Delete the entries for several MetaMsgs in the UID table for a given
+        mailbox, with as few queries as possible.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox: str
+        :param doc_ids: the doc_ids for the MetaMsgs
+        :type doc_ids: iterable of str
+        :return: a deferred that will fire with the sorted list of the uids
+                 of the deleted entries.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        doc_ids = list(doc_ids)
+        table = self.table_preffix + sanitize(mailbox_uuid)
+
+        def chunks(values):
+            for i in range(0, len(values), MAX_SQL_VARIABLES):
+                chunk = tuple(values[i:i + MAX_SQL_VARIABLES])
+                yield chunk, ", ".join("?" * len(chunk))
+
+        def delete_uids(results):
+            uids = sorted(uid for rows in results for (uid,) in rows)
+            deletes = []
+            for chunk, params in chunks(uids):
+                sql = "DELETE FROM {table} WHERE uid IN ({params})".format(
+                    table=table, params=params)
+                deletes.append(self._operation(sql, chunk))
+            d = defer.gatherResults(deletes, consumeErrors=True)
+            d.addCallback(lambda _: uids)
+            return d
+
+        queries = []
+        for chunk, params in chunks(doc_ids):
+            sql = "SELECT uid FROM {table} WHERE hash IN ({params})".format(
+                table=table, params=params)
+            queries.append(self._query(sql, chunk))
+        d = defer.gatherResults(queries, consumeErrors=True)
+        d.addCallback(delete_uids)
+        return d
+
     def get_doc_id_from_uid(self, mailbox_uuid, uid):
         """
         Get the doc_id for a MetaMsg in the UID table for a given mailbox.
@@ -243,9 +291,169 @@ class MailboxIndexer(object):
         return d
 
     def get_doc_ids_from_uids(self, mailbox_uuid, uids):
-        # For IMAP relative numbering /sequences.
-        # XXX dereference the range (n,*)
-        raise NotImplementedError()
+        """
+        Get the doc_ids for several MetaMsgs in the UID table for a given
+        mailbox, with as few queries as possible.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox: str
+        :param uids: the uids for the MetaMsgs for this mailbox
+        :type uids: iterable of int
+        :return: a deferred that will fire with a dict mapping each uid found
+                 in the table to its doc_id.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        uids = list(uids)
+
+        def get_uid_hash_pairs(results):
+            return dict((uid, doc_id) for rows in results
+                        for uid, doc_id in rows)
+
+        queries = []
+        for i in range(0, len(uids), MAX_SQL_VARIABLES):
+            chunk = uids[i:i + MAX_SQL_VARIABLES]
+            sql = ("SELECT uid, hash FROM {preffix}{name} "
+                   "WHERE uid IN ({params})".format(
+                       preffix=self.table_preffix,
+                       name=sanitize(mailbox_uuid),
+                       params=", ".join("?" * len(chunk))))
+            queries.append(self._query(sql, tuple(chunk)))
+        d = defer.gatherResults(queries, consumeErrors=True)
+        d.addCallback(get_uid_hash_pairs)
+        return d
+
+    def get_uids_in_ranges(self, mailbox_uuid, ranges):
+        """
+        Get the uids that exist in the UID table for a given mailbox within
+        the given ranges.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox: str
+        :param ranges: inclusive (first, last) uid ranges. A last value of
+                       None means that the range has no upper bound.
+        :type ranges: iterable of tuples
+        :return: a deferred that will fire with the sorted list of uids.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        ranges = list(ranges)
+
+        def get_results(results):
+            return sorted(set(row[0] for rows in results for row in rows))
+
+        # each range takes up to two sql variables
+        step = MAX_SQL_VARIABLES / 2
+        queries = []
+        for i in range(0, len(ranges), step):
+            clauses = []
+            values = []
+            for first, last in ranges[i:i + step]:
+                if last is None:
+                    clauses.append("uid >= ?")
+                    values.append(first)
+                else:
+                    clauses.append("uid BETWEEN ? AND ?")
+                    values.extend((first, last))
+            sql = ("SELECT uid FROM {preffix}{name} "
+                   "WHERE {where}").format(
+                preffix=self.table_preffix, name=sanitize(mailbox_uuid),
+                where=" OR ".join(clauses))
+            queries.append(self._query(sql, tuple(values)))
+        d = defer.gatherResults(queries, consumeErrors=True)
+        d.addCallback(get_results)
+        return d
+
+    def get_uids_from_msn_ranges(self, mailbox_uuid, ranges):
+        """
+        Get the uids for the given message sequence numbers in a given
+        mailbox. The sequence number of a message is its (1-based) position
+        in the UID table, ordered by uid.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox: str
+        :param ranges: inclusive (first, last) sequence number ranges. A last
+                       value of None means that the range has no upper bound.
+        :type ranges: iterable of tuples
+        :return: a deferred that will fire with a list of (msn, uid) tuples,
+                 sorted by msn, for the sequence numbers that do exist.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        ranges = sorted(ranges)
+        sql = ("SELECT uid FROM {preffix}{name} "
+               "ORDER BY uid LIMIT ? OFFSET ?").format(
+            preffix=self.table_preffix, name=sanitize(mailbox_uuid))
+
+        def number_results(rows, first):
+            return [(first + i, row[0]) for i, row in enumerate(rows)]
+
+        def get_results(results):
+            seen = set()
+            msn_uids = []
+            for msn, uid in (item for items in results for item in items):
+                if msn not in seen:
+                    seen.add(msn)
+                    msn_uids.append((msn, uid))
+            return sorted(msn_uids)
+
+        queries = []
+        for first, last in ranges:
+            first = max(first, 1)
+            limit = -1 if last is None else last - first + 1
+            if limit == 0 or limit < -1:
+                continue
+            d = self._query(sql, (limit, first - 1))
+            d.addCallback(number_results, first)
+            queries.append(d)
+        d = defer.gatherResults(queries, consumeErrors=True)
+        d.addCallback(get_results)
+        return d
+
+    def get_msns_from_uids(self, mailbox_uuid, uids):
+        """
+        Get the message sequence numbers for the given uids in a given
+        mailbox.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param uids: the uids of the messages
+        :type uids: iterable of int
+        :return: a deferred that will fire with a dict mapping the uids that
+                 do exist to their sequence numbers.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        uids = set(uids)
+        if not uids:
+            return defer.succeed({})
+        sql = ("SELECT uid FROM {preffix}{name} "
+               "WHERE uid <= ? ORDER BY uid").format(
+            preffix=self.table_preffix, name=sanitize(mailbox_uuid))
+
+        def get_msns(rows):
+            return dict((row[0], msn) for msn, row in enumerate(rows, 1)
+                        if row[0] in uids)
+
+        d = self._query(sql, (max(uids),))
+        d.addCallback(get_msns)
+        return d
+
+    def get_uid_from_msn(self, mailbox_uuid, msn):
+        """
+        Get the uid for a given message sequence number in a given mailbox.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox: str
+        :param msn: the message sequence number, starting at 1
+        :type msn: int
+        :return: a deferred that will fire with the uid, or None if there is
+                 no message with that sequence number.
+        :rtype: Deferred
+        """
+        d = self.get_uids_from_msn_ranges(mailbox_uuid, [(msn, msn)])
+        d.addCallback(lambda msn_uids: msn_uids[0][1] if msn_uids else None)
+        return d
 
     def count(self, mailbox_uuid):
         """
@@ -15,10 +15,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+from collections import deque
+
 from OpenSSL import SSL
 from StringIO import StringIO
 from twisted.internet import reactor
 from twisted.internet import defer
+from twisted.internet import error
+from twisted.internet import protocol
 from twisted.logger import Logger
 from twisted.mail import smtp
 from twisted.protocols.amp import ssl
@@ -53,12 +57,21 @@ class SendError(Exception):
     pass
 
 
+# the connections kept open to the smtp relay of the provider
+MAX_RELAY_CONNECTIONS = 3
+RELAY_IDLE_TIMEOUT = 60  # seconds
+RELAY_TIMEOUT = 60  # seconds
+RELAY_RETRIES = 3
+
+
 class SMTPSender(object):
     implements(ISender)
 
     log = Logger()
 
-    def __init__(self, from_address, key, host, port):
+    def __init__(self, from_address, key, host, port,
+                 max_connections=MAX_RELAY_CONNECTIONS,
+                 idle_timeout=RELAY_IDLE_TIMEOUT):
         """
         :param from_address: The sender address.
         :type from_address: str
@@ -68,6 +81,11 @@ class SMTPSender(object):
         :type host: str
         :param port: The port of the remote SMTP server.
         :type port: int
+        :param max_connections: The maximum number of connections kept open
+                                to the remote SMTP server.
+        :type max_connections: int
+        :param idle_timeout: The seconds an unused connection is kept open.
+        :type idle_timeout: int
         """
         leap_assert_type(host, (str, unicode))
         leap_assert(host != '')
@@ -80,40 +98,375 @@ class SMTPSender(object):
         self._host = host
         self._key = key
         self._from_address = from_address
+        self._pool = SMTPRelayPool(
+            host, port, SSLContextFactory(key, key),
+            max_connections=max_connections, idle_timeout=idle_timeout)
 
     def can_send(self, recipient):
         return '@' in recipient
 
     def send(self, recipient, message):
-        self.log.info(
-            'Connecting to SMTP server %s:%s' % (self._host, self._port))
-
-        # we construct a defer to pass to the ESMTPSenderFactory
-        d = defer.Deferred()
-        # we don't pass an ssl context factory to the ESMTPSenderFactory
-        # because ssl will be handled by reactor.connectSSL() below.
-        factory = smtp.ESMTPSenderFactory(
-            "",  # username is blank, no client auth here
-            "",  # password is blank, no client auth here
-            self._from_address,
-            recipient.dest.addrstr,
-            StringIO(message),
-            d,
-            heloFallback=True,
-            requireAuthentication=False,
-            requireTransportSecurity=True)
-        factory.domain = bytes('leap.bitmask.mail-' + __version__)
-        reactor.connectSSL(
-            self._host, self._port, factory,
-            contextFactory=SSLContextFactory(self._key, self._key))
+        d = self._pool.send(
+            self._from_address, recipient.dest.addrstr, message)
         d.addCallback(lambda result: result[1][0][0])
         d.addErrback(self._send_errback)
         return d
 
+    def get_stats(self):
+        """
+        Get the usage statistics of the connections to the SMTP server.
+
+        :rtype: dict
+        """
+        return self._pool.get_stats()
+
+    def close(self):
+        """
+        Close the connections to the SMTP server once they are not in use.
+        """
+        self._pool.close()
+
     def _send_errback(self, failure):
         raise SendError(failure.getErrorMessage())
 
 
+class _Envelope(object):
+    """
+    A message waiting to be relayed, with the deferred that fires when the
+    remote SMTP server accepts or rejects it.
+    """
+
+    def __init__(self, from_address, to_address, message):
+        self.from_address = from_address
+        self.to_address = to_address
+        self.message = message
+        self.deferred = defer.Deferred()
+        self.attempts = 0
+
+
+class _RelayClient(smtp.ESMTPClient):
+    """
+    An ESMTP client that stays connected to the relay and sends, one after
+    the other, the envelopes queued in its pool.
+
+    Twisted resets the session with RSET after each mail transaction, and
+    calls C{smtpState_from} when the server is ready for the next one. When
+    there is nothing left to send the client waits there, idle, until it is
+    woken up by the pool or its idle timeout expires.
+    """
+
+    requireAuthentication = False
+    requireTransportSecurity = True
+
+    def __init__(self, pool, identity):
+        # no secret, the client is authenticated by its certificate
+        smtp.ESMTPClient.__init__(self, '', None, identity)
+        self._pool = pool
+        self._envelope = None
+        self._error = None
+        self._data_sent = False
+        self._closing = False
+        self.idle = False
+
+    def wake(self):
+        """
+        Start sending the next queued envelope on this idle connection.
+        """
+        self.smtpState_from(250, '')
+
+    def quit(self):
+        """
+        Disconnect from the server, once the current envelope is sent.
+        """
+        self._closing = True
+        if self.idle:
+            self.idle = False
+            self.setTimeout(self.timeout)
+            self._disconnectFromServer()
+
+    def smtpState_from(self, code, resp):
+        if not self._closing:
+            self._envelope = self._pool._next_envelope(self)
+        if self._envelope is None:
+            if self._closing or not self._pool._client_idle(self):
+                self._closing = True
+                self._disconnectFromServer()
+            else:
+                self._wait()
+            return
+        self.idle = False
+        self._data_sent = False
+        self.setTimeout(self.timeout)
+        smtp.ESMTPClient.smtpState_from(self, code, resp)
+
+    def _wait(self):
+        self.idle = True
+        self.setTimeout(self._pool.idle_timeout)
+        # the server is not supposed to say anything until we send a new
+        # command, but it might close the session
+        self._expected = []
+        self._failresponse = self.smtpState_disconnect
+
+    def timeoutConnection(self):
+        if self.idle:
+            self._pool._client_closing(self)
+            self.quit()
+        elif self._closing:
+            self.transport.loseConnection()
+        else:
+            smtp.ESMTPClient.timeoutConnection(self)
+
+    def getMailFrom(self):
+        return self._envelope.from_address
+
+    def getMailTo(self):
+        return [self._envelope.to_address]
+
+    def getMailData(self):
+        return StringIO(self._envelope.message)
+
+    def finishedFileTransfer(self, lastsent):
+        # from now on the server may have accepted the message, so it can
+        # not be safely sent again
+        self._data_sent = True
+        smtp.ESMTPClient.finishedFileTransfer(self, lastsent)
+
+    def sentMail(self, code, resp, numOk, addresses, log):
+        envelope, self._envelope = self._envelope, None
+        if code in smtp.SUCCESS:
+            self._pool._envelope_sent(envelope, (numOk, addresses))
+            return
+        errlog = ['%s: %03d %s' % (addr, acode, aresp)
+                  for addr, acode, aresp in addresses
+                  if acode not in smtp.SUCCESS]
+        errlog.append(log.str())
+        self._pool._envelope_failed(envelope, smtp.SMTPDeliveryError(
+            code, resp, '\n'.join(errlog), addresses))
+
+    def sendError(self, exc):
+        # the connection is closed after an error, the envelope is handed
+        # back to the pool once it is lost
+        self._error = exc
+        smtp.ESMTPClient.sendError(self, exc)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        smtp.ESMTPClient.connectionLost(self, reason)
+        envelope, self._envelope = self._envelope, None
+        self._pool._client_lost(
+            self, envelope, self._data_sent, self._error or reason.value)
+
+
+class _RelayClientFactory(protocol.ClientFactory):
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def buildProtocol(self, addr):
+        client = _RelayClient(self._pool, self._pool.identity)
+        client.timeout = self._pool.timeout
+        return client
+
+    def clientConnectionFailed(self, connector, reason):
+        self._pool._connection_failed(reason.value)
+
+
+class SMTPRelayPool(object):
+    """
+    A pool of persistent TLS connections to an SMTP relay.
+
+    Messages are queued and sent over the connections already open to the
+    relay, so the TLS handshake with the client certificate is only done
+    when a new connection is needed. Up to C{max_connections} are opened
+    while there are messages waiting, and they are closed after being idle
+    for C{idle_timeout} seconds.
+
+    A message that fails because its connection was lost before the relay
+    got it, for example when the relay had closed an idle connection, is
+    sent again over a new one.
+    """
+
+    log = Logger()
+
+    def __init__(self, host, port, context_factory,
+                 max_connections=MAX_RELAY_CONNECTIONS,
+                 idle_timeout=RELAY_IDLE_TIMEOUT, timeout=RELAY_TIMEOUT,
+                 retries=RELAY_RETRIES, reactor=reactor):
+        """
+        :param host: The hostname of the remote SMTP server.
+        :type host: str
+        :param port: The port of the remote SMTP server.
+        :type port: int
+        :param context_factory: The factory of the TLS contexts for the
+                                connections.
+        :type context_factory: twisted.internet.ssl.ClientContextFactory
+        :param max_connections: The maximum number of open connections.
+        :type max_connections: int
+        :param idle_timeout: The seconds an unused connection is kept open.
+        :type idle_timeout: int
+        :param timeout: The seconds to wait for the server responses.
+        :type timeout: int
+        :param retries: How many times a message is retried, or the relay
+                        is reconnected to, before giving up.
+        :type retries: int
+        """
+        self.identity = bytes('leap.bitmask.mail-' + __version__)
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._host = host
+        self._port = port
+        self._context_factory = context_factory
+        self._retries = retries
+        self._reactor = reactor
+
+        self._pending = deque()
+        self._clients = set()
+        self._idle = []
+        self._starting = 0
+        self._failures = 0
+        self._closed = False
+        self._stats = {
+            'opened': 0,
+            'sent': 0,
+            'failed': 0,
+            'retried': 0,
+        }
+
+    def send(self, from_address, to_address, message):
+        """
+        Relay a message.
+
+        :param from_address: The envelope sender.
+        :type from_address: str
+        :param to_address: The envelope recipient.
+        :type to_address: str
+        :param message: The message.
+        :type message: str
+
+        :return: A deferred that fires with a tuple with the number of
+                 accepted recipients and a list of the responses to each of
+                 them, as twisted.mail.smtp.ESMTPSenderFactory does.
+        :rtype: Deferred
+        """
+        self._closed = False
+        envelope = _Envelope(from_address, to_address, message)
+        self._pending.append(envelope)
+        self._dispatch()
+        return envelope.deferred
+
+    def get_stats(self):
+        """
+        Get the usage statistics of the pool.
+
+        :return: the number of open, idle and opening connections, the
+                 number of queued messages, and the number of connections
+                 opened, and of messages sent, failed and retried so far.
+        :rtype: dict
+        """
+        stats = {
+            'connections': len(self._clients),
+            'idle': len(self._idle),
+            'connecting': self._starting,
+            'queued': len(self._pending),
+        }
+        stats.update(self._stats)
+        return stats
+
+    def close(self):
+        """
+        Close the idle connections, and the busy ones once the queued
+        messages have been sent.
+        """
+        self._closed = True
+        idle, self._idle = self._idle, []
+        for client in idle:
+            client.quit()
+
+    def _dispatch(self):
+        while self._pending and self._idle:
+            self._idle.pop().wake()
+        waiting = len(self._pending) - self._starting
+        while (waiting > 0 and len(self._clients) + self._starting <
+               self.max_connections):
+            self._connect()
+            waiting -= 1
+
+    def _connect(self):
+        self.log.info('Connecting to SMTP server %s:%s'
+                      % (self._host, self._port))
+        self._starting += 1
+        self._reactor.connectSSL(
+            self._host, self._port, _RelayClientFactory(self),
+            self._context_factory, timeout=self.timeout)
+
+    def _next_envelope(self, client):
+        if client not in self._clients:
+            # the session has just been set up
+            self._starting -= 1
+            self._failures = 0
+            self._clients.add(client)
+            self._stats['opened'] += 1
+        if self._pending:
+            return self._pending.popleft()
+
+    def _client_idle(self, client):
+        if self._closed:
+            return False
+        self._idle.append(client)
+        return True
+
+    def _client_closing(self, client):
+        if client in self._idle:
+            self._idle.remove(client)
+
+    def _envelope_sent(self, envelope, result):
+        self._stats['sent'] += 1
+        envelope.deferred.callback(result)
+
+    def _envelope_failed(self, envelope, reason):
+        self._stats['failed'] += 1
+        envelope.deferred.errback(reason)
+
+    def _client_lost(self, client, envelope, data_sent, reason):
+        self._client_closing(client)
+        if client in self._clients:
+            self._clients.remove(client)
+        else:
+            # lost before the session was ready
+            self._connection_failed(reason, envelope)
+            return
+        if envelope is not None:
+            if data_sent or envelope.attempts >= self._retries:
+                self._envelope_failed(envelope, reason)
+            else:
+                self.log.debug('Connection to SMTP server lost, retrying')
+                envelope.attempts += 1
+                self._stats['retried'] += 1
+                self._pending.appendleft(envelope)
+        self._dispatch()
+
+    def _connection_failed(self, reason, envelope=None):
+        self._starting -= 1
+        if envelope is not None:
+            self._pending.appendleft(envelope)
+        self._failures += 1
+        self.log.warn('Could not connect to SMTP server %s:%s: %s'
+                      % (self._host, self._port, reason))
+        if self._failures <= self._retries:
+            self._dispatch()
+            return
+        if self._clients or self._starting:
+            # the queued messages will be sent by the open connections
+            return
+        self._failures = 0
+        if isinstance(reason, error.ConnectionDone):
+            reason = smtp.SMTPConnectError(
+                -1, 'Unable to connect to server.')
+        pending, self._pending = self._pending, deque()
+        for envelope in pending:
+            self._envelope_failed(envelope, reason)
+
+
 class SSLContextFactory(ssl.ClientContextFactory):
     def __init__(self, cert, key):
         self.cert = cert
@@ -29,6 +29,7 @@ from email.encoders import encode_7or8bit
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.utils import getaddresses
 
 from twisted.mail import smtp
 from twisted.internet import defer
@@ -51,6 +52,71 @@ from leap.bitmask.mail.rfc3156 import PGPEncrypted
 #     of IService
 
 
+def _read_message(raw):
+    """
+    Get the raw message, that might have been spooled to a file.
+    """
+    if hasattr(raw, 'read'):
+        raw.seek(0)
+        return raw.read()
+    return raw
+
+
+class _SharedResult(object):
+    """
+    Give the result of a deferred to many consumers.
+    """
+
+    def __init__(self, d):
+        self._waiting = []
+        self._result = None
+        self._done = False
+        d.addBoth(self._fire)
+
+    def _fire(self, result):
+        self._done = True
+        self._result = result
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            self._pass(d)
+
+    def _pass(self, d):
+        if isinstance(self._result, Failure):
+            d.errback(self._result)
+        else:
+            d.callback(self._result)
+
+    def get(self):
+        """
+        :return: a new deferred that fires with the shared result.
+        :rtype: Deferred
+        """
+        d = defer.Deferred()
+        if self._done:
+            self._pass(d)
+        else:
+            self._waiting.append(d)
+        return d
+
+
+class _MessageParts(object):
+    """
+    The parts of an outgoing message that are the same for all its
+    recipients, so they are only built once.
+    """
+
+    def __init__(self, origmsg):
+        self.origmsg = origmsg
+        # fires with the message prepared for encryption
+        self.prepared = None
+        # fires with the signed message, for recipients without a key
+        self.signed = None
+        # the recipients that share a single encryption of the message, and
+        # the deferred that fires with it
+        self.shared_to = []
+        self.encrypted = None
+
+
 class OutgoingMail(object):
     """
     Sends Outgoing Mail, encrypting and signing if needed.
@@ -58,7 +124,8 @@ class OutgoingMail(object):
 
     log = Logger()
 
-    def __init__(self, from_address, keymanager, bouncer=None):
+    def __init__(self, from_address, keymanager, bouncer=None,
+                 encrypt_once=False):
         """
         Initialize the outgoing mail service.
 
@@ -66,6 +133,10 @@ class OutgoingMail(object):
         :type from_address: str
         :param keymanager: A KeyManager for retrieving recipient's keys.
         :type keymanager: leap.common.keymanager.KeyManager
+        :param encrypt_once: Whether to encrypt a message once to the keys
+                             of all its recipients, instead of once for
+                             each of them.
+        :type encrypt_once: bool
         """
 
         # assert params
@@ -78,6 +149,7 @@ class OutgoingMail(object):
         self._from_address = from_address
         self._keymanager = keymanager
         self._bouncer = bouncer
+        self._encrypt_once = encrypt_once
         self._senders = []
 
     def add_sender(self, sender):
@@ -96,10 +168,57 @@ class OutgoingMail(object):
         :type recipient: smtp.User
         :return: a deferred which delivers the message when fired
         """
-        d = self._maybe_encrypt_and_sign(raw, recipient)
-        d.addCallback(self._route_msg, recipient, raw)
-        d.addErrback(self.sendError, raw)
-        return d
+        return self.send_message_to_recipients(StringIO(raw), [recipient])[0]
+
+    def send_message_to_recipients(self, msg_file, recipients):
+        """
+        Sends a message to several recipients. Maybe encrypts and signs.
+
+        The message is parsed, and prepared for encryption or signed, only
+        once. Just the encryption is done for each of the recipients.
+
+        :param msg_file: A file with the raw message
+        :type msg_file: file
+        :param recipients: The recipients for the message
+        :type recipients: list of smtp.User
+        :return: a list with a deferred for each recipient, which delivers
+                 the message to the recipient when fired
+        :rtype: list of Deferred
+        """
+        parts = _MessageParts(Parser().parse(msg_file))
+        if self._encrypt_once:
+            parts.shared_to = self._get_shared_recipients(
+                parts.origmsg, recipients)
+        deferreds = []
+        for recipient in recipients:
+            d = self._maybe_encrypt_and_sign_parts(parts, recipient)
+            d.addCallback(self._route_msg, recipient, msg_file)
+            d.addErrback(self.sendError, msg_file)
+            deferreds.append(d)
+        return deferreds
+
+    def _get_shared_recipients(self, origmsg, recipients):
+        """
+        Get the addresses of the recipients that can share a single
+        encryption of C{origmsg}.
+
+        The encrypted message discloses the keys it was encrypted to, so only
+        the recipients that are already disclosed in the To and Cc headers
+        share it.
+
+        :rtype: list of str
+        """
+        headers = origmsg.get_all('to', []) + origmsg.get_all('cc', [])
+        disclosed = set(address.lower()
+                        for _, address in getaddresses(headers))
+        shared = []
+        for recipient in recipients:
+            address = validate_address(recipient.dest.addrstr)
+            if address.lower() in disclosed and address not in shared:
+                shared.append(address)
+        if len(shared) < 2:
+            return []
+        return shared
 
     def can_encrypt_for(self, recipient):
         def cb(_):
@@ -130,7 +249,7 @@ class OutgoingMail(object):
         :type failure: anything
         :param origmsg: the original, unencrypted, raw message, to be passed to
                         the bouncer.
-        :type origmsg: str
+        :type origmsg: str or file
         """
         # XXX: need to get the address from the original message to send signal
         # emit_async(catalog.SMTP_SEND_MESSAGE_ERROR, self._from_address,
@@ -146,7 +265,7 @@ class OutgoingMail(object):
         if self._bouncer:
             self._bouncer.bounce_message(
                 failure.getErrorMessage(), to=self._from_address,
-                orig=origmsg)
+                orig=_read_message(origmsg))
         else:
             failure.raiseException()
 
@@ -217,23 +336,59 @@ class OutgoingMail(object):
                  and the original recipient Message
         :rtype: Deferred
         """
-        # pass if the original message's content-type is "multipart/encrypted"
-        origmsg = Parser().parsestr(raw)
+        return self._maybe_encrypt_and_sign_parts(
+            _MessageParts(Parser().parsestr(raw)), recipient,
+            fetch_remote=fetch_remote)
+
+    def _maybe_encrypt_and_sign_parts(self, parts, recipient,
+                                      fetch_remote=True):
+        """
+        Attempt to encrypt and sign an outgoing message for a recipient,
+        reusing the work already done for its other recipients.
 
+        See L{_maybe_encrypt_and_sign}.
+
+        :param parts: The parts of the message shared by the recipients.
+        :type parts: _MessageParts
+        :param recipient: The recipient for the message
+        :type: recipient: smtp.User
+
+        :return: A Deferred that will be fired with a MIMEMultipart message
+                 and the original recipient Message
+        :rtype: Deferred
+        """
+        # pass if the original message's content-type is "multipart/encrypted"
+        origmsg = parts.origmsg
         if origmsg.get_content_type() == 'multipart/encrypted':
             return defer.succeed((origmsg, recipient))
 
         from_address = validate_address(self._from_address)
-        username, domain = from_address.split('@')
         to_address = validate_address(recipient.dest.addrstr)
 
-        def maybe_encrypt_and_sign(message):
-            d = self._encrypt_and_sign(
-                message, to_address, from_address,
+        def encrypt(prepared):
+            return self._encrypt_and_sign(
+                prepared, to_address, from_address,
                 fetch_remote=fetch_remote)
+
+        def if_key_not_found_encrypt_alone(failure, prepared):
+            # some of the recipients have no key
+            failure.trap(KeyNotFound, KeyAddressMismatch)
+            return encrypt(prepared)
+
+        def maybe_encrypt_and_sign(prepared):
+            if to_address in parts.shared_to:
+                if parts.encrypted is None:
+                    parts.encrypted = _SharedResult(
+                        self._encrypt_and_sign_to_all(
+                            prepared, parts.shared_to, from_address,
+                            fetch_remote=fetch_remote))
+                d = parts.encrypted.get()
+                d.addErrback(if_key_not_found_encrypt_alone, prepared)
+            else:
+                d = encrypt(prepared)
             d.addCallbacks(signal_encrypt_sign,
                            if_key_not_found_send_unencrypted,
-                           errbackArgs=(message,))
+                           errbackArgs=(prepared[0],))
             return d
 
         def signal_encrypt_sign(newmsg):
@@ -247,7 +402,10 @@ class OutgoingMail(object):
 
             self.log.info('Will send unencrypted message to %s.' % to_address)
             emit_async(catalog.SMTP_START_SIGN, self._from_address, to_address)
-            d = self._sign(message, from_address)
+            if parts.signed is None:
+                parts.signed = _SharedResult(
+                    self._sign(message, from_address))
+            d = parts.signed.get()
             d.addCallback(signal_sign)
             return d
 
@@ -260,7 +418,11 @@ class OutgoingMail(object):
         emit_async(catalog.SMTP_START_ENCRYPT_AND_SIGN,
                    self._from_address,
                    "%s,%s" % (self._from_address, to_address))
-        d = self._attach_key(origmsg, from_address)
+        if parts.prepared is None:
+            d = self._attach_key(origmsg, from_address)
+            d.addCallback(self._prepare_encryption, from_address)
+            parts.prepared = _SharedResult(d)
+        d = parts.prepared.get()
         d.addCallback(maybe_encrypt_and_sign)
         return d
 
@@ -294,14 +456,41 @@ class OutgoingMail(object):
         d.addErrback(lambda _: origmsg)
         return d
 
-    def _encrypt_and_sign(self, origmsg, encrypt_address, sign_address,
+    def _prepare_encryption(self, origmsg, sign_address):
+        """
+        Do the part of the encryption of C{origmsg} that is the same for all
+        the recipients: build the headers of the new multipart/encrypted
+        message, and the text to encrypt.
+
+        :param origmsg: The original message
+        :type origmsg: email.message.Message
+        :param sign_address: The address used to sign the message.
+        :type sign_address: str
+
+        :return: A Deferred with a tuple: (original Message, new Message
+                 with the unencrypted headers, text to encrypt)
+        :rtype: Deferred
+        """
+        def serialize(res):
+            newmsg, msg = res
+            return origmsg, newmsg, msg.as_string(unixfrom=False)
+
+        d = self._fix_headers(
+            origmsg,
+            MultipartEncrypted('application/pgp-encrypted'),
+            sign_address)
+        d.addCallback(serialize)
+        return d
+
+    def _encrypt_and_sign(self, prepared, encrypt_address, sign_address,
                           fetch_remote=True):
         """
         Create an RFC 3156 compliang PGP encrypted and signed message using
         C{encrypt_address} to encrypt and C{sign_address} to sign.
 
-        :param origmsg: The original message
-        :type origmsg: email.message.Message
+        :param prepared: The message prepared for encryption, as returned by
+                         L{_prepare_encryption}
+        :type prepared: tuple
         :param encrypt_address: The address used to encrypt the message.
         :type encrypt_address: str
         :param sign_address: The address used to sign the message.
@@ -310,39 +499,54 @@ class OutgoingMail(object):
         :return: A Deferred with the MultipartEncrypted message
         :rtype: Deferred
         """
-        # create new multipart/encrypted message with 'pgp-encrypted' protocol
-
-        def encrypt(res):
-            newmsg, origmsg = res
-            d = self._keymanager.encrypt(
-                origmsg.as_string(unixfrom=False),
-                encrypt_address, sign=sign_address,
-                fetch_remote=fetch_remote)
-            d.addCallback(lambda encstr: (newmsg, encstr))
-            return d
+        _, headermsg, plaintext = prepared
+        d = self._keymanager.encrypt(
+            plaintext, encrypt_address, sign=sign_address,
+            fetch_remote=fetch_remote)
+        d.addCallback(self._create_encrypted_message, headermsg)
+        return d
 
-        def create_encrypted_message(res):
-            newmsg, encstr = res
-            encmsg = MIMEApplication(
-                encstr, _subtype='octet-stream', _encoder=encode_7or8bit)
-            encmsg.add_header('content-disposition', 'attachment',
-                              filename='msg.asc')
-            # create meta message
-            metamsg = PGPEncrypted()
-            metamsg.add_header('Content-Disposition', 'attachment')
-            # attach pgp message parts to new message
-            newmsg.attach(metamsg)
-            newmsg.attach(encmsg)
-            return newmsg
+    def _encrypt_and_sign_to_all(self, prepared, encrypt_addresses,
+                                 sign_address, fetch_remote=True):
+        """
+        Create an RFC 3156 compliant PGP encrypted and signed message, that
+        is encrypted only once to the keys of all the C{encrypt_addresses}
+        and signed using C{sign_address}.
+
+        :param prepared: The message prepared for encryption, as returned by
+                         L{_prepare_encryption}
+        :type prepared: tuple
+        :param encrypt_addresses: The addresses used to encrypt the message.
+        :type encrypt_addresses: list of str
+        :param sign_address: The address used to sign the message.
+        :type sign_address: str
 
-        d = self._fix_headers(
-            origmsg,
-            MultipartEncrypted('application/pgp-encrypted'),
-            sign_address)
-        d.addCallback(encrypt)
-        d.addCallback(create_encrypted_message)
+        :return: A Deferred with the MultipartEncrypted message
+        :rtype: Deferred
+        """
+        _, headermsg, plaintext = prepared
+        d = self._keymanager.encrypt_to_addresses(
+            plaintext, encrypt_addresses, sign=sign_address,
+            fetch_remote=fetch_remote)
+        d.addCallback(self._create_encrypted_message, headermsg)
         return d
 
+    def _create_encrypted_message(self, encstr, headermsg):
+        # create new multipart/encrypted message with 'pgp-encrypted'
+        # protocol, the headers are shared by all the recipients
+        newmsg = deepcopy(headermsg)
+        encmsg = MIMEApplication(
+            encstr, _subtype='octet-stream', _encoder=encode_7or8bit)
+        encmsg.add_header('content-disposition', 'attachment',
+                          filename='msg.asc')
+        # create meta message
+        metamsg = PGPEncrypted()
+        metamsg.add_header('Content-Disposition', 'attachment')
+        # attach pgp message parts to new message
+        newmsg.attach(metamsg)
+        newmsg.attach(encmsg)
+        return newmsg
+
     def _sign(self, origmsg, sign_address):
         """
         Create an RFC 3156 compliant PGP signed MIME message using
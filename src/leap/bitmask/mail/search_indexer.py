@@ -0,0 +1,669 @@
+# -*- coding: utf-8 -*-
+# search_indexer.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+.. :py:module::search_indexer
+
+Local tables to search the messages of a given mailbox by their headers,
+flags, dates and sizes, without deserializing any document.
+
+Searches are expressed as trees of criteria, made of tuples:
+
+    * ``('all',)``
+    * ``('and', [criterion, ...])``
+    * ``('or', criterion, criterion)``
+    * ``('not', criterion)``
+    * ``('flag', flag)``
+    * ``('header', name, substring)``
+    * ``('date', op, 'YYYY-MM-DD')``, for the internal date.
+    * ``('sentdate', op, 'YYYY-MM-DD')``, for the Date header.
+    * ``('size', op, size)``
+    * ``('uid', ranges)``
+    * ``('msn', ranges)``
+    * ``('body', text)``
+    * ``('text', text)``, for the headers and the body.
+
+where ``op`` is one of ``<``, ``=``, ``>``, ``>=`` and the ranges are
+inclusive ``(first, last)`` tuples, a last value of None meaning that the
+range has no upper bound. Text comparisons are case-insensitive.
+
+The ``body`` and ``text`` criteria are answered from an optional full-text
+index, which has to be enabled for the mailbox with
+L{SearchIndexer.create_fulltext_table}. They match the messages that contain
+all the words of the text, in order, the last one being matched as a prefix.
+"""
+import base64
+import binascii
+import quopri
+import re
+
+from collections import defaultdict
+from email.header import decode_header, make_header
+from email.utils import parsedate_tz
+from HTMLParser import HTMLParser
+
+from twisted.internet import defer
+
+from leap.bitmask.mail.mailbox_indexer import MailboxIndexer
+from leap.bitmask.mail.mailbox_indexer import MAX_SQL_VARIABLES
+from leap.bitmask.mail.mailbox_indexer import check_good_uuid, sanitize
+
+
+_OPERATORS = ('<', '=', '>', '>=')
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+_HTML_TAG_RE = re.compile(r'<[^>]*>')
+
+
+class FulltextDisabledError(Exception):
+    """
+    Raised when searching the contents of the messages of a mailbox that has
+    no full-text index.
+    """
+    pass
+
+
+def needs_fulltext(criterion):
+    """
+    Tell whether some search criteria need the full-text index.
+
+    :param criterion: a tree of criteria, as described in this module.
+    :type criterion: tuple
+    :rtype: bool
+    """
+    key = criterion[0]
+    if key in ('body', 'text'):
+        return True
+    elif key == 'and':
+        return any(needs_fulltext(c) for c in criterion[1])
+    elif key in ('or', 'not'):
+        return any(needs_fulltext(c) for c in criterion[1:])
+    return False
+
+
+def _get_day(date):
+    """
+    Get the day of an RFC 2822 date, disregarding time and timezone, as
+    the IMAP searches do.
+
+    :return: the day in YYYY-MM-DD format, or None if it cannot be parsed.
+    :rtype: str
+    """
+    parsed = parsedate_tz(date or '')
+    if not parsed:
+        return None
+    return '%04d-%02d-%02d' % parsed[:3]
+
+
+def _to_unicode(value):
+    if isinstance(value, unicode):
+        return value
+    return str(value).decode('utf-8', 'replace')
+
+
+def _decode_header_value(value):
+    """
+    Decode the RFC 2047 encoded words in a header value, if any.
+
+    :rtype: unicode
+    """
+    try:
+        return unicode(make_header(decode_header(value)))
+    except Exception:
+        return _to_unicode(value)
+
+
+def _get_part_text(cdoc):
+    """
+    Get the text of a content document, if it is a text part that is not an
+    attachment.
+
+    :rtype: unicode
+    """
+    ctype = (cdoc.content_type or 'text/plain').lower()
+    disposition = (cdoc.content_disposition or '').lower()
+    if not ctype.startswith('text/') or disposition == 'attachment':
+        return u''
+
+    raw = cdoc.raw or ''
+    encoding = (cdoc.content_transfer_encoding or '').strip().lower()
+    if encoding in ('base64', 'quoted-printable'):
+        if isinstance(raw, unicode):
+            raw = raw.encode('utf-8')
+        try:
+            if encoding == 'base64':
+                raw = base64.b64decode(raw)
+            else:
+                raw = quopri.decodestring(raw)
+        except (binascii.Error, TypeError):
+            return u''
+    if not isinstance(raw, unicode):
+        try:
+            raw = raw.decode(cdoc.charset or 'utf-8', 'replace')
+        except LookupError:
+            raw = raw.decode('utf-8', 'replace')
+
+    if ctype == 'text/html':
+        raw = HTMLParser().unescape(_HTML_TAG_RE.sub(u' ', raw))
+    return raw
+
+
+def _fulltext_query(text):
+    """
+    Build a full-text query matching the words of C{text} as a phrase.
+
+    :return: the query, or None if the text has no words.
+    :rtype: unicode
+    """
+    words = _WORD_RE.findall(_to_unicode(text).lower())
+    if not words:
+        return None
+    # the last word can be cut, as it is a substring search
+    return u'"%s*"' % u' '.join(words)
+
+
+def _join_flags(flags):
+    # the flags are stored surrounded by spaces, so a single flag can be
+    # looked up as a substring
+    return u' %s ' % u' '.join(_to_unicode(flag).lower() for flag in flags)
+
+
+def _any_of(clauses):
+    """
+    Join some sql clauses with OR, as a balanced tree, since sqlite limits
+    the depth of the expressions.
+
+    :rtype: str
+    """
+    if not clauses:
+        return "0"
+    if len(clauses) == 1:
+        return clauses[0]
+    half = len(clauses) / 2
+    return "(%s OR %s)" % (_any_of(clauses[:half]), _any_of(clauses[half:]))
+
+
+class SearchIndexer(object):
+    """
+    This class contains the commands needed to create, modify and query the
+    local-only search tables for a given mailbox.
+
+    For every message of a mailbox there is a row with its flags, sizes and
+    dates, and a row per header. The tables are kept up to date as messages
+    are added, flagged and removed, and the messages that reach a mailbox
+    through other ways (copies, syncs) are indexed right before searching.
+
+    The full-text index of the message contents is opt-in: it only exists for
+    the mailboxes for which its table has been created.
+    """
+
+    store = None
+    table_preffix = "leapmail_search_"
+    headers_table_preffix = "leapmail_search_headers_"
+    fulltext_table_preffix = "leapmail_fulltext_"
+
+    def __init__(self, store):
+        self.store = store
+
+    def _query(self, *args, **kw):
+        assert self.store is not None
+        return self.store.raw_sqlcipher_query(*args, **kw)
+
+    def _operation(self, *args, **kw):
+        assert self.store is not None
+        return self.store.raw_sqlcipher_operation(*args, **kw)
+
+    def _names(self, mailbox_uuid):
+        name = sanitize(mailbox_uuid)
+        return {'table': self.table_preffix + name,
+                'headers': self.headers_table_preffix + name,
+                'fulltext': self.fulltext_table_preffix + name,
+                'uids': MailboxIndexer.table_preffix + name}
+
+    def create_table(self, mailbox_uuid):
+        """
+        Create the search tables for a given mailbox.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        names = self._names(mailbox_uuid)
+        sql_table = ("CREATE TABLE if not exists {table}( "
+                     "uid INTEGER PRIMARY KEY, "
+                     "flags TEXT NOT NULL DEFAULT '', "
+                     "internal_date TEXT, "
+                     "sent_date TEXT, "
+                     "size INTEGER)".format(**names))
+        sql_headers = ("CREATE TABLE if not exists {headers}( "
+                       "uid INTEGER NOT NULL, "
+                       "name TEXT NOT NULL, "
+                       "value TEXT NOT NULL)".format(**names))
+        sql_name_index = ("CREATE INDEX if not exists {headers}_name "
+                          "ON {headers}(name)".format(**names))
+        sql_uid_index = ("CREATE INDEX if not exists {headers}_uid "
+                         "ON {headers}(uid)".format(**names))
+        d = self._operation(sql_table)
+        d.addCallback(lambda _: self._operation(sql_headers))
+        d.addCallback(lambda _: self._operation(sql_name_index))
+        d.addCallback(lambda _: self._operation(sql_uid_index))
+        return d
+
+    def delete_table(self, mailbox_uuid):
+        """
+        Delete the search tables for a given mailbox.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        names = self._names(mailbox_uuid)
+        d = self._operation("DROP TABLE if exists {table}".format(**names))
+        d.addCallback(lambda _: self._operation(
+            "DROP TABLE if exists {headers}".format(**names)))
+        d.addCallback(lambda _: self.delete_fulltext_table(mailbox_uuid))
+        return d
+
+    def create_fulltext_table(self, mailbox_uuid):
+        """
+        Create the full-text index table for a given mailbox, which enables
+        searching the contents of its messages.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        sql = ("CREATE VIRTUAL TABLE if not exists {fulltext} "
+               "USING fts4(headers, body, tokenize=unicode61)".format(
+                   **self._names(mailbox_uuid)))
+        return self._operation(sql)
+
+    def delete_fulltext_table(self, mailbox_uuid):
+        """
+        Delete the full-text index table for a given mailbox.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        return self._operation("DROP TABLE if exists {fulltext}".format(
+            **self._names(mailbox_uuid)))
+
+    def has_fulltext_table(self, mailbox_uuid):
+        """
+        Tell whether a given mailbox has a full-text index.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :return: a deferred that will fire with a boolean.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        sql = "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?"
+        d = self._query(sql, (self._names(mailbox_uuid)['fulltext'],))
+        d.addCallback(lambda rows: bool(rows))
+        return d
+
+    def is_fulltext_enabled(self):
+        """
+        Tell whether any mailbox has a full-text index.
+
+        :return: a deferred that will fire with a boolean.
+        :rtype: Deferred
+        """
+        sql = ("SELECT 1 FROM sqlite_master WHERE type='table' "
+               "AND name GLOB ? LIMIT 1")
+        d = self._query(sql, (self.fulltext_table_preffix + '*',))
+        d.addCallback(lambda rows: bool(rows))
+        return d
+
+    def index_messages(self, mailbox_uuid, msgs):
+        """
+        Add (or replace) the search entries for some messages of a given
+        mailbox.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param msgs: the messages, which must have their uid set.
+        :type msgs: list of leap.bitmask.mail.mail.Message
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        names = self._names(mailbox_uuid)
+        msgs = [msg for msg in msgs if msg is not None and msg.get_uid()]
+        if not msgs:
+            return defer.succeed(None)
+
+        rows = []
+        header_rows = []
+        for msg in msgs:
+            uid = msg.get_uid()
+            headers = msg.get_headers()
+            rows.append((
+                uid, _join_flags(msg.get_flags()),
+                _get_day(msg.get_internal_date()),
+                _get_day(headers.get('date')),
+                msg.get_size()))
+            for name, value in headers.items():
+                header_rows.append((
+                    uid, _to_unicode(name).lower(),
+                    _decode_header_value(value).lower()))
+
+        def insert(sql, rows, width):
+            # a multi-row insert per chunk of rows
+            step = MAX_SQL_VARIABLES / width
+            row_params = "(%s)" % ", ".join("?" * width)
+            d = defer.succeed(None)
+            for i in range(0, len(rows), step):
+                chunk = rows[i:i + step]
+                values = tuple(value for row in chunk for value in row)
+                chunk_sql = sql + ", ".join([row_params] * len(chunk))
+                d.addCallback(
+                    lambda _, s, v: self._operation(s, v), chunk_sql, values)
+            return d
+
+        d = self.delete_uids(mailbox_uuid, [row[0] for row in rows],
+                             headers_only=True)
+        d.addCallback(lambda _: insert(
+            "INSERT OR REPLACE INTO {table} VALUES ".format(**names),
+            rows, 5))
+        d.addCallback(lambda _: insert(
+            "INSERT INTO {headers} VALUES ".format(**names),
+            header_rows, 3))
+        return d
+
+    def index_fulltext(self, mailbox_uuid, msgs):
+        """
+        Add (or replace) the full-text index entries for some messages of a
+        given mailbox, whose full-text index table must exist.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param msgs: the messages, which must have their uid set and their
+                     content documents loaded.
+        :type msgs: list of leap.bitmask.mail.mail.Message
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        sql = ("INSERT OR REPLACE INTO {fulltext}(docid, headers, body) "
+               "VALUES (?, ?, ?)".format(**self._names(mailbox_uuid)))
+
+        d = defer.succeed(None)
+        for msg in msgs:
+            if msg is None or not msg.get_uid():
+                continue
+            headers = u'\n'.join(
+                u'%s: %s' % (_to_unicode(name), _decode_header_value(value))
+                for name, value in msg.get_headers().items())
+            cdocs = msg.get_wrapper().cdocs
+            body = u'\n'.join(
+                _get_part_text(cdocs[i]) for i in sorted(cdocs))
+            # one statement per message, since the bodies can be large
+            d.addCallback(
+                lambda _, v: self._operation(sql, v),
+                (msg.get_uid(), headers, body))
+        return d
+
+    def update_flags(self, mailbox_uuid, uid, flags):
+        """
+        Update the flags of a message in the search table of a given mailbox.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param uid: the uid of the message
+        :type uid: int
+        :param flags: the new flags of the message
+        :type flags: iterable of str
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        sql = "UPDATE {table} SET flags=? WHERE uid=?".format(
+            **self._names(mailbox_uuid))
+        return self._operation(sql, (_join_flags(flags), uid))
+
+    def update_many_flags(self, mailbox_uuid, flags_by_uid):
+        """
+        Update the flags of several messages in the search table of a given
+        mailbox, with one statement for all the messages that end up with
+        the same flags.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param flags_by_uid: the new flags of each message, by uid
+        :type flags_by_uid: dict
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        names = self._names(mailbox_uuid)
+        uids_by_flags = defaultdict(list)
+        for uid, flags in flags_by_uid.items():
+            if uid:
+                uids_by_flags[_join_flags(flags)].append(uid)
+
+        deferreds = []
+        for flags, uids in uids_by_flags.items():
+            step = MAX_SQL_VARIABLES - 1
+            for i in range(0, len(uids), step):
+                chunk = tuple(uids[i:i + step])
+                sql = "UPDATE {table} SET flags=? WHERE uid IN ({params})"
+                sql = sql.format(params=", ".join("?" * len(chunk)), **names)
+                deferreds.append(self._operation(sql, (flags,) + chunk))
+        return defer.gatherResults(deferreds, consumeErrors=True)
+
+    def invalidate_doc(self, mailbox_uuid, doc_id):
+        """
+        Drop the search entry of a message of a given mailbox that changed
+        elsewhere, by the doc_id of its MetaMsg, so it is indexed again
+        before the next search.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param doc_id: the doc_id of the MetaMsg of the message
+        :type doc_id: str
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        sql = ("DELETE FROM {table} WHERE uid IN "
+               "(SELECT uid FROM {uids} WHERE hash = ?)").format(
+            **self._names(mailbox_uuid))
+        return self._operation(sql, (doc_id,))
+
+    def delete_uids(self, mailbox_uuid, uids, headers_only=False):
+        """
+        Delete the search entries for some messages of a given mailbox.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param uids: the uids of the messages
+        :type uids: iterable of int
+        :param headers_only: if True, only the header entries are deleted.
+        :type headers_only: bool
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        names = self._names(mailbox_uuid)
+        uids = [uid for uid in uids if uid]
+        if not uids:
+            return defer.succeed(None)
+
+        def delete(has_fulltext):
+            tables = [(names['headers'], 'uid')]
+            if not headers_only:
+                tables.append((names['table'], 'uid'))
+            if has_fulltext:
+                tables.append((names['fulltext'], 'docid'))
+
+            deferreds = []
+            for i in range(0, len(uids), MAX_SQL_VARIABLES):
+                chunk = tuple(uids[i:i + MAX_SQL_VARIABLES])
+                for table, column in tables:
+                    sql = ("DELETE FROM {table} "
+                           "WHERE {column} IN ({params})").format(
+                        table=table, column=column,
+                        params=", ".join("?" * len(chunk)))
+                    deferreds.append(self._operation(sql, chunk))
+            return defer.gatherResults(deferreds, consumeErrors=True)
+
+        if headers_only:
+            return delete(False)
+        d = self.has_fulltext_table(mailbox_uuid)
+        d.addCallback(delete)
+        return d
+
+    def get_unindexed_uids(self, mailbox_uuid):
+        """
+        Get the uids of the messages in a given mailbox that are not in its
+        search table yet.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :return: a deferred that will fire with a sorted list of uids.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        sql = ("SELECT u.uid FROM {uids} AS u "
+               "LEFT JOIN {table} AS s ON s.uid = u.uid "
+               "WHERE s.uid IS NULL ORDER BY u.uid").format(
+            **self._names(mailbox_uuid))
+        d = self._query(sql)
+        d.addCallback(lambda rows: [row[0] for row in rows])
+        return d
+
+    def get_unindexed_fulltext_uids(self, mailbox_uuid):
+        """
+        Get the uids of the messages in a given mailbox that are not in its
+        full-text index yet. The full-text index table must exist.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :return: a deferred that will fire with a sorted list of uids.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        sql = ("SELECT u.uid FROM {uids} AS u "
+               "LEFT JOIN {fulltext} AS f ON f.docid = u.uid "
+               "WHERE f.docid IS NULL ORDER BY u.uid").format(
+            **self._names(mailbox_uuid))
+        d = self._query(sql)
+        d.addCallback(lambda rows: [row[0] for row in rows])
+        return d
+
+    def search(self, mailbox_uuid, criteria):
+        """
+        Get the uids of the messages in a given mailbox that match some
+        search criteria. The full-text index table must exist if the criteria
+        search the message contents.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param criteria: a tree of criteria, as described in this module.
+        :type criteria: tuple
+        :return: a deferred that will fire with a sorted list of uids.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        names = self._names(mailbox_uuid)
+        values = []
+        where = self._compile(criteria, names, values)
+        if len(values) > MAX_SQL_VARIABLES:
+            raise ValueError('Too many search criteria')
+        sql = ("SELECT u.uid FROM {uids} AS u "
+               "JOIN {table} AS s ON s.uid = u.uid "
+               "WHERE {where} ORDER BY u.uid").format(where=where, **names)
+        d = self._query(sql, tuple(values))
+        d.addCallback(lambda rows: [row[0] for row in rows])
+        return d
+
+    def _compile(self, criterion, names, values):
+        """
+        Translate a criterion into a sql expression, appending the values for
+        its parameters to C{values}.
+
+        The uid and sequence number ranges, which can be as many as the
+        messages in the mailbox, are written in the expression as integer
+        literals so they do not run into the sqlite host parameter limit,
+        and joined as a balanced tree so they do not run into its
+        expression depth limit.
+        """
+        key = criterion[0]
+        if key == 'all':
+            return "1"
+        elif key == 'and':
+            if not criterion[1]:
+                return "1"
+            return "(%s)" % " AND ".join(
+                self._compile(c, names, values) for c in criterion[1])
+        elif key == 'or':
+            return "(%s OR %s)" % (
+                self._compile(criterion[1], names, values),
+                self._compile(criterion[2], names, values))
+        elif key == 'not':
+            return "NOT %s" % (self._compile(criterion[1], names, values),)
+        elif key == 'flag':
+            values.append(_join_flags([criterion[1]]))
+            return "(instr(s.flags, ?) > 0)"
+        elif key == 'header':
+            values.extend((_to_unicode(criterion[1]).lower(),
+                           _to_unicode(criterion[2]).lower()))
+            return ("(u.uid IN (SELECT uid FROM {headers} "
+                    "WHERE name = ? AND instr(value, ?) > 0))".format(
+                        **names))
+        elif key in ('date', 'sentdate', 'size'):
+            column = {'date': 's.internal_date', 'sentdate': 's.sent_date',
+                      'size': 's.size'}[key]
+            op = criterion[1]
+            if op not in _OPERATORS:
+                raise ValueError('Unknown operator: %r' % (op,))
+            values.append(criterion[2])
+            return "(%s IS NOT NULL AND %s %s ?)" % (column, column, op)
+        elif key == 'uid':
+            clauses = []
+            for first, last in criterion[1]:
+                if last is None:
+                    clauses.append("u.uid >= %d" % int(first))
+                else:
+                    clauses.append("u.uid BETWEEN %d AND %d" % (
+                        int(first), int(last)))
+            return "(%s)" % (_any_of(clauses),)
+        elif key == 'msn':
+            # the sequence number of a message is its position in the uid
+            # table, ordered by uid
+            clauses = []
+            for first, last in criterion[1]:
+                first = max(first, 1)
+                limit = -1 if last is None else last - first + 1
+                if limit == 0 or limit < -1:
+                    continue
+                clauses.append(
+                    "u.uid IN (SELECT uid FROM {uids} "
+                    "ORDER BY uid LIMIT {limit} OFFSET {offset})".format(
+                        limit=int(limit), offset=int(first - 1), **names))
+            return "(%s)" % (_any_of(clauses),)
+        elif key in ('body', 'text'):
+            query = _fulltext_query(criterion[1])
+            if query is None:
+                # every message contains the empty string
+                return "1"
+            values.append(query)
+            # matching against the table name searches all the columns
+            column = 'body' if key == 'body' else names['fulltext']
+            return ("(u.uid IN (SELECT docid FROM {fulltext} "
+                    "WHERE {column} MATCH ?))".format(column=column, **names))
+        raise ValueError('Unknown search criterion: %r' % (key,))
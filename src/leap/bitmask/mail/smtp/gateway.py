@@ -28,7 +28,12 @@ The following classes comprise the SMTP gateway service:
 
     * EncryptedMessage - An implementation of twisted.mail.smtp.IMessage that
       knows how to encrypt/sign itself before sending.
+
+    * MessageSpool - The data of a message, shared by the EncryptedMessages
+      of all its recipients.
 """
+import tempfile
+
 from email import generator
 from email.Header import Header
 
@@ -38,6 +43,7 @@ from zope.interface import implementer
 from twisted.cred.portal import Portal, IRealm
 from twisted.mail import smtp
 from twisted.mail.imap4 import LOGINCredentials, PLAINCredentials
+from twisted.internet import defer
 from twisted.internet import protocol
 from twisted.logger import Logger
 
@@ -53,6 +59,9 @@ generator.Generator = RFC3156CompliantGenerator
 
 LOCAL_FQDN = "bitmask.local"
 
+# bigger messages are spooled to disk while they are received
+SPOOL_MAX_MEMORY = 1024 * 1024
+
 
 @implementer(IRealm)
 class LocalSMTPRealm(object):
@@ -180,6 +189,7 @@ class SMTPDelivery(object):
         self._outgoing = outgoing_mail
         self._encrypted_only = encrypted_only
         self._origin = None
+        self._spool = None
 
     def receivedHeader(self, helo, origin, recipients):
         """
@@ -217,7 +227,8 @@ class SMTPDelivery(object):
         then that recipient is rejected.
 
         The method returns an encrypted message object that is able to send
-        itself to the user's address.
+        itself to the user's address. The encrypted messages for all the
+        recipients of a message share the spool with its data.
 
         :param user: The user whose address we wish to validate.
         :type: twisted.mail.smtp.User
@@ -249,8 +260,13 @@ class SMTPDelivery(object):
                     catalog.SMTP_RECIPIENT_ACCEPTED_UNENCRYPTED,
                     self._userid, user.dest.addrstr)
 
+        spool = self._spool
+        if spool is None or spool.started:
+            # the recipient is for a new message
+            spool = self._spool = MessageSpool(self._outgoing)
+
         def encrypt_func(_):
-            return lambda: EncryptedMessage(user, self._outgoing)
+            return lambda: EncryptedMessage(user, self._outgoing, spool)
 
         d = self._outgoing.can_encrypt_for(address)
         d.addCallback(verify_if_can_encrypt_for_recipient)
@@ -296,7 +312,7 @@ class EncryptedMessage(object):
     implements(smtp.IMessage)
     log = Logger()
 
-    def __init__(self, user, outgoing_mail):
+    def __init__(self, user, outgoing_mail, spool=None):
         """
         Initialize the encrypted message.
 
@@ -304,13 +320,19 @@ class EncryptedMessage(object):
         :type user: twisted.mail.smtp.User
         :param outgoing_mail: The outgoing mail to send the message
         :type outgoing_mail: leap.bitmask.mail.outgoing.service.OutgoingMail
+        :param spool: The spool for the message data, shared with the
+                      messages for the other recipients.
+        :type spool: MessageSpool
         """
         # assert params
         leap_assert_type(user, smtp.User)
 
         self._user = user
-        self._lines = []
         self._outgoing = outgoing_mail
+        if spool is None:
+            spool = MessageSpool(outgoing_mail)
+        self._spool = spool
+        spool.add_recipient(self, user)
 
     def lineReceived(self, line):
         """
@@ -319,7 +341,7 @@ class EncryptedMessage(object):
         :param line: The received line.
         :type line: str
         """
-        self._lines.append(line)
+        self._spool.lineReceived(self, line)
 
     def eomReceived(self):
         """
@@ -330,18 +352,91 @@ class EncryptedMessage(object):
         :returns: a deferred
         """
         self.log.debug('Message data complete.')
-        self._lines.append('')  # add a trailing newline
-        raw_mail = '\r\n'.join(self._lines)
-
-        return self._outgoing.send_message(raw_mail, self._user)
+        return self._spool.eomReceived(self)
 
     def connectionLost(self):
         """
         Log an error when the connection is lost.
         """
         self.log.error('Connection lost unexpectedly!')
+        # unexpected loss of connection; don't save
+        self._spool.close()
         emit_async(catalog.SMTP_CONNECTION_LOST, self._userid,
                    self._user.dest.addrstr)
-        # unexpected loss of connection; don't save
 
-        self._lines = []
+
+class MessageSpool(object):
+    """
+    Keep the data of a message that is being received for one or more
+    recipients, and send it to all of them once it is complete.
+
+    Twisted hands every line to the message of each recipient, but the data
+    is only kept once: in memory, or in a temporary file once it grows
+    bigger than SPOOL_MAX_MEMORY. The message is then parsed, and signed if
+    needed, only once for all the recipients.
+    """
+
+    def __init__(self, outgoing_mail):
+        """
+        :param outgoing_mail: The outgoing mail to send the message
+        :type outgoing_mail: leap.bitmask.mail.outgoing.service.OutgoingMail
+        """
+        self._outgoing = outgoing_mail
+        self._file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+        self._messages = []
+        self._users = []
+        self._results = None
+
+    def add_recipient(self, message, user):
+        """
+        Add a recipient of the message.
+
+        :param message: The message for the recipient.
+        :type message: EncryptedMessage
+        :param user: The recipient.
+        :type user: twisted.mail.smtp.User
+        """
+        self._messages.append(message)
+        self._users.append(user)
+
+    @property
+    def started(self):
+        """
+        Whether the data of the message has started to be received.
+        """
+        return bool(self._messages)
+
+    def lineReceived(self, message, line):
+        """
+        Handle another line of the message for a recipient.
+
+        All the recipients receive the same lines, so only the ones for the
+        first recipient are kept.
+        """
+        if message is self._messages[0]:
+            self._file.write(line + '\r\n')
+
+    def eomReceived(self, message):
+        """
+        Handle the end of the message for a recipient.
+
+        The message is sent to all the recipients on the first call.
+
+        :return: a deferred that fires when the message has been sent to the
+                 recipient of C{message}.
+        :rtype: Deferred
+        """
+        if self._results is None:
+            self._file.seek(0)
+            deferreds = self._outgoing.send_message_to_recipients(
+                self._file, self._users)
+            self._results = dict(zip(self._messages, deferreds))
+            d = defer.DeferredList(deferreds, consumeErrors=False)
+            d.addBoth(lambda _: self.close())
+        return self._results[message]
+
+    def close(self):
+        """
+        Discard the message data.
+        """
+        self._file.close()
@@ -44,15 +44,24 @@ class MailProcessingPostSyncHook(object):
     implements(IPlugin, ISoledadPostSyncPlugin)
 
     META_DOC_PREFFIX = _get_doc_type_preffix(constants.METAMSGID)
-    watched_doc_types = (META_DOC_PREFFIX, )
+    FLAGS_DOC_PREFFIX = _get_doc_type_preffix(constants.FDOCID)
+    watched_doc_types = (META_DOC_PREFFIX, FLAGS_DOC_PREFFIX)
 
     _account = None
     _pending_docs = []
+    _pending_sweep = False
     _processing_deferreds = []
 
     def process_received_docs(self, doc_id_list):
+        # the parts of the messages deleted in this device are swept after a
+        # sync, so the copies of them that it brought are counted as
+        # references too
+        self._pending_sweep = True
+        return self._process_docs(doc_id_list)
+
+    def _process_docs(self, doc_id_list):
         if self._has_configured_account():
-            process_fun = self._make_uid_index
+            process_fun = self._process_doc
         else:
             self._processing_deferreds = []
             process_fun = self._queue_doc_id
@@ -62,6 +71,10 @@ class MailProcessingPostSyncHook(object):
                 log.info("Mail post-sync hook: processing %s" % doc_id)
                 process_fun(doc_id)
 
+        if self._has_configured_account() and self._pending_sweep:
+            self._pending_sweep = False
+            self._sweep_orphaned_parts()
+
         return defer.gatherResults(self._processing_deferreds)
 
     def set_account(self, account):
@@ -75,6 +88,16 @@ class MailProcessingPostSyncHook(object):
     def _queue_doc_id(self, doc_id):
         self._pending_docs.append(doc_id)
 
+    def _process_doc(self, doc_id):
+        if _get_doc_type_preffix(doc_id) == self.META_DOC_PREFFIX:
+            self._make_uid_index(doc_id)
+        else:
+            # the flags of a message were changed in another device
+            mbox_uuid = _get_mbox_uuid_from_fdoc(doc_id)
+            if mbox_uuid:
+                self._account.invalidate_counters(mbox_uuid)
+                self._invalidate_search_entry(mbox_uuid, doc_id)
+
     def _make_uid_index(self, mdoc_id):
         indexer = self._account.mbox_indexer
         mbox_uuid = _get_mbox_uuid(mdoc_id)
@@ -89,8 +112,33 @@ class MailProcessingPostSyncHook(object):
             # inserting the index entry!.
             d = indexer.create_table(mbox_uuid)
             d.addBoth(lambda _: indexer.insert_doc(mbox_uuid, index_docid))
+            d.addBoth(self._invalidate_counters, mbox_uuid)
             self._processing_deferreds.append(d)
 
+    def _invalidate_search_entry(self, mbox_uuid, fdoc_id):
+        # the message is indexed again, with its new flags, right before the
+        # next search in its mailbox
+        mdoc_id = self.META_DOC_PREFFIX + fdoc_id[len(self.FLAGS_DOC_PREFFIX):]
+        mbox_indexer = self._account.mbox_indexer
+        search_indexer = self._account.search_indexer
+        d = mbox_indexer.create_table(mbox_uuid)
+        d.addCallback(lambda _: search_indexer.create_table(mbox_uuid))
+        d.addCallback(
+            lambda _: search_indexer.invalidate_doc(mbox_uuid, mdoc_id))
+        d.addErrback(lambda f: log.failure(
+            'Error invalidating search entry for %s' % fdoc_id, failure=f))
+        self._processing_deferreds.append(d)
+
+    def _sweep_orphaned_parts(self):
+        d = self._account.sweep_orphaned_parts()
+        d.addErrback(lambda f: log.failure(
+            'Error sweeping orphaned parts', failure=f))
+        self._processing_deferreds.append(d)
+
+    def _invalidate_counters(self, result, mbox_uuid):
+        self._account.invalidate_counters(mbox_uuid)
+        return result
+
     def _process_queued_docs(self):
         assert(self._has_configured_account())
         pending = self._pending_docs
@@ -100,13 +148,14 @@ class MailProcessingPostSyncHook(object):
             self._pending_docs = []
             return res
 
-        d = self.process_received_docs(pending)
+        d = self._process_docs(pending)
         d.addCallback(remove_pending_docs)
         return d
 
 
 _mbox_uuid_regex = regex_compile(constants.METAMSGID_MBOX_RE)
 _mdoc_chash_regex = regex_compile(constants.METAMSGID_CHASH_RE)
+_fdoc_mbox_uuid_regex = regex_compile(constants.FDOCID_MBOX_RE)
 
 
 def _get_mbox_uuid(doc_id):
@@ -115,6 +164,12 @@ def _get_mbox_uuid(doc_id):
         return matches[0].replace('_', '-')
 
 
+def _get_mbox_uuid_from_fdoc(doc_id):
+    matches = _fdoc_mbox_uuid_regex.findall(doc_id)
+    if matches:
+        return matches[0].replace('_', '-')
+
+
 def _get_chash_from_mdoc(doc_id):
     matches = _mdoc_chash_regex.findall(doc_id)
     if matches:
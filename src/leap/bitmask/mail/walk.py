@@ -29,6 +29,60 @@ crypto_backend = default_backend()
 
 _parser = Parser()
 
+# XXX what other ctypes should be considered body?
+BODY_CTYPES = ("text/plain", "text/html")
+
+
+def walk_message(msg):
+    """
+    Walk the message tree once, hashing each payload only once.
+
+    :return: a tuple with the part map of the message (as in get_tree), the
+             content docs of its non-multipart parts (as in get_raw_docs)
+             and the body payload-hash (as in get_body_phash).
+    :rtype: tuple
+    """
+    cdocs = []
+    body_phash = []
+    tree = _walk_part(msg, cdocs, body_phash)
+    return tree, cdocs, first(body_phash)
+
+
+def _walk_part(part, cdocs, body_phash):
+    ctype = part.get_content_type()
+    p = {'ctype': ctype, 'headers': part.items()}
+
+    payload = part.get_payload()
+    is_multi = part.is_multipart()
+    if is_multi:
+        # the parts are walked in order, so the content docs are sorted
+        # as in msg.walk()
+        p['part_map'] = part_map = {}
+        for idx, subpart in enumerate(payload, 1):
+            part_map[idx] = _walk_part(subpart, cdocs, body_phash)
+        p['parts'] = len(payload)
+        p['phash'] = None
+    else:
+        phash = get_hash(payload)
+        p['parts'] = 0
+        p['size'] = len(payload)
+        p['phash'] = phash
+        p['part_map'] = {}
+        cdocs.append(
+            {'type': 'cnt',
+             'raw': payload,
+             'phash': phash,
+             'content-type': ctype,
+             'charset': part.get_content_charset(),
+             'content-disposition': first(part.get(
+                 'content-disposition', '').split(';')),
+             'content-transfer-encoding': part.get(
+                 'content-transfer-encoding', '')})
+        if not body_phash and ctype in BODY_CTYPES:
+            body_phash.append(phash)
+    p['multi'] = is_multi
+    return p
+
 
 def get_tree(msg):
     p = {}
@@ -60,9 +114,7 @@ def get_body_phash(msg):
     Find the body payload-hash for this message.
     """
     for part in msg.walk():
-        # XXX what other ctypes should be considered body?
-        if part.get_content_type() in ("text/plain", "text/html"):
-            # XXX avoid hashing again
+        if part.get_content_type() in BODY_CTYPES:
             return get_hash(part.get_payload())
 
 
@@ -17,12 +17,15 @@
 
 """
 Firewall Manager
+
+The firewall is managed through privileged helpers, which can take a while to
+answer (the polkit authentication alone can take hundreds of milliseconds),
+so every operation runs outside of the reactor thread and returns a Deferred.
 """
 
-import commands
 import os
-import subprocess
 
+from twisted.internet import defer, threads, utils
 from twisted.logger import Logger
 
 from leap.bitmask.util import STANDALONE
@@ -64,26 +67,35 @@ class _OSXFirewallManager(object):
     def start(self, restart=False):
         gateways = [gateway for gateway, port in self._remotes]
         cmd = 'firewall_start %s' % (' '.join(gateways),)
-        self._helper.send(cmd)
-        self._started = True
-        # TODO parse OK from result
-        return True
+
+        def started(_):
+            self._started = True
+            # TODO parse OK from result
+            return True
+
+        d = threads.deferToThread(self._helper.send, cmd)
+        d.addCallback(started)
+        return d
 
     def stop(self):
         cmd = 'firewall_stop'
-        self._helper.send(cmd)
-        self._started = False
-        return True
+
+        def stopped(_):
+            self._started = False
+            return True
+
+        d = threads.deferToThread(self._helper.send, cmd)
+        d.addCallback(stopped)
+        return d
 
     def is_up(self):
         # TODO implement!!!
-        return self._started
+        return defer.succeed(self._started)
 
-    @property
-    def status(self):
+    def get_status(self):
         # TODO implement!!! -- factor out, too
         status = 'on' if self._started else 'off'
-        return {'status': status, 'error': None}
+        return defer.succeed({'status': status, 'error': None})
 
 
 class _LinuxFirewallManager(object):
@@ -92,6 +104,9 @@ class _LinuxFirewallManager(object):
     Firewall manager that blocks/unblocks all the internet traffic with some
     exceptions.
     This allows us to achieve fail close on a vpn connection.
+
+    The state of the firewall is cached after asking the privileged wrapper
+    for it, and forgotten every time that the firewall is started or stopped.
     """
     # TODO factor out choosing a version of bitmask-root.
     # together with linux vpnlauncher.
@@ -126,74 +141,117 @@ class _LinuxFirewallManager(object):
         :type remotes: list
         """
         self._remotes = remotes
+        # None means that the state is unknown
+        self._up = None
+        # bumped every time that the cached state is forgotten, so that the
+        # answers to older queries are not cached
+        self._generation = 0
+
+    def _forget_state(self):
+        self._up = None
+        self._generation += 1
+
+    def _run(self, *args):
+        """
+        Run the privileged wrapper with some arguments.
 
+        :return: a deferred that will fire with a (out, err, exit code) tuple.
+        :rtype: Deferred
+        """
+        cmd = check_root([self.BITMASK_ROOT] + list(args))
+        return utils.getProcessOutputAndValue(
+            cmd[0], cmd[1:], env=os.environ)
+
+    @defer.inlineCallbacks
     def start(self, restart=False):
         """
         Launch the firewall using the privileged wrapper.
 
-        :returns: True if the exitcode of calling the root helper in a
-                  subprocess is 0.
-        :rtype: bool
+        :returns: a deferred that will fire with True once the root helper
+                  has been called.
+        :rtype: Deferred
         """
         gateways = [gateway for gateway, port in self._remotes]
 
         # XXX check for wrapper existence, check it's root owned etc.
         # XXX check that the iptables rules are in place.
 
-        cmd = [self.BITMASK_ROOT, "firewall", "start"]
-        cmd = check_root(cmd)
-
+        args = ["firewall", "start"]
         if restart:
-            cmd.append("restart")
-        result = '<did not run>'
+            args.append("restart")
         if not os.path.isfile(self.BITMASK_ROOT):
             raise FirewallError('Could not find bitmask-root!')
+
+        self._forget_state()
         try:
-            retcode, result = commands.getstatusoutput(
-                ' '.join(cmd + gateways))
+            out, err, code = yield self._run(*(args + gateways))
         except Exception:
             msg = 'Error launching the firewall'
             log.failure(msg)
             if NOT_ROOT:
                 raise FirewallError(msg)
-        finally:
-            log.debug(result)
+        else:
+            log.debug('{out}{err}', out=out, err=err)
         emit_async(catalog.VPN_STATUS_CHANGED, "FW_ON")
-        return True
+        defer.returnValue(True)
 
+    @defer.inlineCallbacks
     def stop(self):
         """
         Tear the firewall down using the privileged wrapper.
+
+        :returns: a deferred that will fire with True if the exitcode of
+                  calling the root helper is 0.
+        :rtype: Deferred
         """
-        cmd = [self.BITMASK_ROOT, "firewall", "stop"]
-        cmd = check_root(cmd)
-        exitCode = subprocess.call(cmd)
+        self._forget_state()
+        try:
+            out, err, code = yield self._run("firewall", "stop")
+        except Exception:
+            log.failure('Error stopping the firewall')
+            code = None
         emit_async(catalog.VPN_STATUS_CHANGED, "FW_OFF")
-        if exitCode == 0:
-            return True
-        else:
-            return False
+        defer.returnValue(code == 0)
 
     def is_up(self):
         """
         Return whether the firewall is up or not.
 
-        :rtype: bool
+        :returns: a deferred that will fire with a boolean.
+        :rtype: Deferred
         """
-        cmd = [self.BITMASK_ROOT, "firewall", "isup"]
-        cmd = check_root(cmd)
-        cmd = ' '.join(cmd)
-        output = commands.getstatusoutput(cmd)[0]
+        if self._up is not None:
+            return defer.succeed(self._up)
+
+        generation = self._generation
 
-        return output != 256
+        def got_result((out, err, code)):
+            up = code != 1
+            if generation == self._generation:
+                self._up = up
+            return up
+
+        def got_error(failure):
+            # killed by a signal: we don't know, so we don't cache it
+            log.error('Error checking the firewall: {err!r}',
+                      err=failure.value)
+            return False
 
-    @property
-    def status(self):
-        status = 'off'
-        if self.is_up():
-            status = 'on'
+        d = self._run("firewall", "isup")
+        d.addCallbacks(got_result, got_error)
+        return d
 
-        return {'status': status, 'error': None}
+    def get_status(self):
+        """
+        Return the status of the firewall.
+
+        :returns: a deferred that will fire with a status dict.
+        :rtype: Deferred
+        """
+        d = self.is_up()
+        d.addCallback(lambda up: {'status': 'on' if up else 'off',
+                                  'error': None})
+        return d
 
 
 if IS_LINUX:
@@ -93,8 +93,10 @@ class VPNService(HookableService):
         _anonymous = self._cfg.get('anonymous', True, boolean=True)
         self._anonymous_enabled = _anonymous
 
-        if helpers.check() and self._firewall.is_up():
-            self._firewall.stop()
+        # a firewall left up by a previous run is torn down before starting
+        self._fw_cleanup = defer.succeed(None)
+        if helpers.check():
+            self._fw_cleanup = self._stop_firewall_if_up()
 
         self.watchdog = LoopingCall(self.push_status)
 
@@ -107,18 +109,20 @@ class VPNService(HookableService):
             self.start_vpn()
 
     def stopService(self):
-        try:
-            self.stop_vpn(shutdown=True)
-        except Exception as e:
-            self.log.error('Error stopping vpn service... {0!r}'.format(e))
+        d = defer.maybeDeferred(self.stop_vpn, shutdown=True)
+        d.addErrback(lambda failure: self.log.error(
+            'Error stopping vpn service... {err!r}', err=failure.value))
         super(VPNService, self).stopService()
+        return d
 
     @defer.inlineCallbacks
     def start_vpn(self, domain=None):
         self.log.debug('Starting VPN')
         self._cfg.set('autostart', True)
 
-        if self.do_status()['status'] == 'on':
+        yield self._fw_cleanup
+        status = yield self.do_status()
+        if status['status'] == 'on':
             exc = Exception('VPN already started')
             exc.expected = True
             raise exc
@@ -135,14 +139,14 @@ class VPNService(HookableService):
             exc.expected = True
             raise exc
 
-        fw_ok = self._firewall.start()
+        fw_ok = yield self._firewall.start()
         if not fw_ok:
             raise Exception('Could not start firewall')
 
         try:
             result = yield self._tunnel.start()
         except Exception as exc:
-            self._firewall.stop()
+            yield self._firewall.stop()
             # TODO get message from exception
             raise Exception('Could not start VPN (reason: %r)' % exc)
 
@@ -157,6 +161,7 @@ class VPNService(HookableService):
             self.watchdog.start(WATCHDOG_PERIOD)
         defer.returnValue(data)
 
+    @defer.inlineCallbacks
     def stop_vpn(self, shutdown=False):
         if shutdown:
             if self._tunnel and self._tunnel.status.get('status') == 'on':
@@ -166,13 +171,10 @@ class VPNService(HookableService):
         else:
             self._cfg.set('autostart', False)
 
-        if self._firewall.is_up():
-            fw_ok = self._firewall.stop()
-            if not fw_ok:
-                self.log.error('Firewall: error stopping')
+        yield self._stop_firewall_if_up()
 
         if not self._tunnel:
-            return {'result': 'VPN was not running'}
+            defer.returnValue({'result': 'VPN was not running'})
 
         vpn_ok = self._tunnel.stop()
         if not vpn_ok:
@@ -180,31 +182,39 @@ class VPNService(HookableService):
 
         if self.watchdog.running:
             self.watchdog.stop()
-        return {'result': 'vpn stopped'}
+        defer.returnValue({'result': 'vpn stopped'})
 
+    @defer.inlineCallbacks
     def fw_reload(self):
         if not self._tunnel:
-            return {'result': 'VPN was not running'}
+            defer.returnValue({'result': 'VPN was not running'})
 
-        if self._firewall.is_up():
-            fw_ok = self._firewall.stop()
-            if not fw_ok:
-                self.log.error('Firewall: error stopping')
+        yield self._stop_firewall_if_up()
 
-        fw_ok = self._firewall.start()
+        fw_ok = yield self._firewall.start()
         if not fw_ok:
             raise Exception('Could not start firewall')
 
-        return {'result': 'fw reloaded'}
+        defer.returnValue({'result': 'fw reloaded'})
 
+    @defer.inlineCallbacks
+    def _stop_firewall_if_up(self):
+        fw_up = yield self._firewall.is_up()
+        if fw_up:
+            fw_ok = yield self._firewall.stop()
+            if not fw_ok:
+                self.log.error('Firewall: error stopping')
+
+    @defer.inlineCallbacks
     def push_status(self):
         try:
-            statusdict = self.do_status()
+            statusdict = yield self.do_status()
             status = statusdict.get('status').upper()
             emit_async(catalog.VPN_STATUS_CHANGED, status)
         except ValueError:
             pass
 
+    @defer.inlineCallbacks
     def do_status(self):
         # TODO - add the current gateway and CC to the status
         childrenStatus = {
@@ -214,14 +224,14 @@ class VPNService(HookableService):
 
         if self._tunnel:
             childrenStatus['vpn'] = self._tunnel.status
-        childrenStatus['firewall'] = self._firewall.status
+        childrenStatus['firewall'] = yield self._firewall.get_status()
         status = merge_status(childrenStatus)
 
         if self._domain:
             status['domain'] = self._domain
         else:
             status['domain'] = self._read_last()
-        return status
+        defer.returnValue(status)
 
     def do_check(self, domain=None, timeout=1):
         """Check whether the VPN Service is properly configured,
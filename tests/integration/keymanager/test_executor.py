@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# test_executor.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the crypto executors.
+"""
+import os
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from leap.bitmask.keymanager import errors
+from leap.bitmask.keymanager.executor import (
+    get_crypto_executor,
+    ProcessCryptoExecutor,
+    ThreadCryptoExecutor,
+)
+from leap.bitmask.keymanager.keys import build_key_from_dict
+
+from common import ADDRESS, KEY_FINGERPRINT, PUBLIC_KEY
+
+
+def _pid():
+    return os.getpid()
+
+
+def _fail():
+    raise errors.GPGError('failed')
+
+
+def _unpicklable():
+    return lambda: None
+
+
+def _exit():
+    os._exit(1)
+
+
+def _list_fingerprints(keyring):
+    with keyring as gpg:
+        return [key['fingerprint'] for key in gpg.list_keys()]
+
+
+class _ExecutorTestMixin(object):
+
+    executor_class = None
+
+    def setUp(self):
+        self.executor = self.executor_class(size=2)
+
+    def tearDown(self):
+        return self.executor.stop()
+
+    @defer.inlineCallbacks
+    def test_run(self):
+        pid = yield self.executor.run(_pid)
+        self.assertTrue(pid > 0)
+        stats = self.executor.stats()
+        self.assertEqual(self.executor_class.mode, stats['mode'])
+        self.assertEqual(2, stats['workers'])
+        self.assertEqual(0, stats['pending'])
+        self.assertEqual(1, stats['completed'])
+
+    @defer.inlineCallbacks
+    def test_failure_is_propagated(self):
+        yield self.assertFailure(self.executor.run(_fail), errors.GPGError)
+        self.assertEqual(1, self.executor.stats()['failed'])
+
+    @defer.inlineCallbacks
+    def test_queue_depth(self):
+        yield defer.gatherResults([self.executor.run(_pid) for _ in range(6)])
+        stats = self.executor.stats()
+        self.assertEqual(6, stats['max_pending'])
+        self.assertEqual(0, stats['pending'])
+        self.assertEqual(6, stats['completed'])
+
+    @defer.inlineCallbacks
+    def test_keyring(self):
+        key = build_key_from_dict({
+            'uids': [ADDRESS],
+            'fingerprint': KEY_FINGERPRINT,
+            'key_data': PUBLIC_KEY,
+            'private': False,
+            'length': 4096,
+            'expiry_date': 0,
+            'refreshed_at': 1311239602,
+        })
+        fingerprints = yield self.executor.run(
+            _list_fingerprints, self.executor.keyring(key))
+        self.assertEqual(1, len(fingerprints))
+
+
+class ThreadCryptoExecutorTestCase(_ExecutorTestMixin, unittest.TestCase):
+
+    executor_class = ThreadCryptoExecutor
+
+
+class ProcessCryptoExecutorTestCase(_ExecutorTestMixin, unittest.TestCase):
+
+    executor_class = ProcessCryptoExecutor
+
+    @defer.inlineCallbacks
+    def test_run_in_other_process(self):
+        pid = yield self.executor.run(_pid)
+        self.assertNotEqual(os.getpid(), pid)
+
+    def test_unpicklable_result_fails(self):
+        d = self.executor.run(_unpicklable)
+        return self.assertFailure(d, errors.GPGError)
+
+    def test_unpicklable_job_fails(self):
+        d = self.executor.run(_pid, lambda: None)
+        return self.assertFailure(d, errors.GPGError)
+
+    def test_lost_job_times_out(self):
+        self.executor._timeout = 1
+        d = self.executor.run(_exit)
+        return self.assertFailure(d, errors.GPGError)
+
+
+class GetCryptoExecutorTestCase(unittest.TestCase):
+
+    def test_unknown_mode_falls_back_to_threads(self):
+        executor = get_crypto_executor(mode='foo', size=1)
+        self.assertIsInstance(executor, ThreadCryptoExecutor)
+        return executor.stop()
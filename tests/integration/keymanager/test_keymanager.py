@@ -158,6 +158,29 @@ class KeyManagerKeyManagementTestCase(KeyManagerWithSoledadTestCase):
         self.assertTrue(ADDRESS in keys[0].uids)
         self.assertTrue(keys[0].private)
 
+    @defer.inlineCallbacks
+    def test_get_all_keys_repairs_docs(self):
+        km = self._key_manager()
+        yield km._openpgp.deferred_init
+        key = OpenPGPKey(ADDRESS, uids=[ADDRESS], fingerprint=KEY_FINGERPRINT,
+                         key_data=PUBLIC_KEY)
+        inactive_key = OpenPGPKey(ADDRESS_2, uids=[ADDRESS_2],
+                                  fingerprint=DIFFERENT_KEY_FPR,
+                                  key_data=DIFFERENT_PUBLIC_KEY)
+        orphan = OpenPGPKey(OLD_AND_NEW_KEY_ADDRESS, fingerprint='F00')
+        # a duplicated key doc, and an active doc without key doc
+        for json_doc in [key.get_json(), key.get_json(),
+                         key.get_active_json(), inactive_key.get_json(),
+                         orphan.get_active_json()]:
+            yield self._soledad.create_doc_from_json(json_doc)
+
+        keys = yield km.iter_all_keys()
+        self.assertEqual(
+            [(KEY_FINGERPRINT, ADDRESS), (DIFFERENT_KEY_FPR, None)],
+            [(k.fingerprint, k.address) for k in keys])
+        docs = yield self._soledad.get_all_docs()
+        self.assertEqual(3, len(docs[1]))
+
     @defer.inlineCallbacks
     def test_get_public_key(self):
         km = self._key_manager()
@@ -208,7 +231,8 @@ class KeyManagerKeyManagementTestCase(KeyManagerWithSoledadTestCase):
         assert_expiration_date(key)
         self.assertTrue(km._nicknym.put_key.called)
         key_sent_data = km._nicknym.put_key.call_args[0][1]
-        key_sent_pub, key_sent_priv = km._openpgp.parse_key(key_sent_data)
+        key_sent_pub, key_sent_priv = yield km._openpgp.parse_key(
+            key_sent_data)
         self.assertTrue(key_sent_priv is None)
         assert_expiration_date(key_sent_pub)
 
@@ -644,6 +668,21 @@ class KeyManagerCryptoTestCase(KeyManagerWithSoledadTestCase):
         key = yield km.get_key(ADDRESS_2, private=False, fetch_remote=False)
         self.assertEqual(signingkey.fingerprint, key.fingerprint)
 
+    @defer.inlineCallbacks
+    def test_keymanager_openpgp_encrypt_to_addresses(self):
+        km = self._key_manager()
+        yield km._openpgp.put_raw_key(PRIVATE_KEY, ADDRESS)
+        yield km._openpgp.put_raw_key(PRIVATE_KEY_2, ADDRESS_2)
+        encdata = yield km.encrypt_to_addresses(
+            self.RAW_DATA, [ADDRESS, ADDRESS_2], sign=ADDRESS_2,
+            fetch_remote=False)
+        self.assertNotEqual(self.RAW_DATA, encdata)
+        # every recipient decrypts the same message
+        for address in (ADDRESS, ADDRESS_2):
+            rawdata, signingkey = yield km.decrypt(
+                encdata, address, verify=ADDRESS_2, fetch_remote=False)
+            self.assertEqual(self.RAW_DATA, rawdata)
+
     @defer.inlineCallbacks
     def test_keymanager_decryption_tries_inactive_valid_key(self):
         km = self._key_manager()
@@ -729,7 +768,7 @@ class KeyManagerCryptoTestCase(KeyManagerWithSoledadTestCase):
     @defer.inlineCallbacks
     def test_fetch_key_fingerprint_keep_usage(self):
         km = self._key_manager(user=ADDRESS_2)
-        key, _ = km._openpgp.parse_key(PUBLIC_KEY, ADDRESS)
+        key, _ = yield km._openpgp.parse_key(PUBLIC_KEY, ADDRESS)
         key.sign_used = True
         yield km.put_key(key)
 
@@ -135,7 +135,7 @@ class OpenPGPCryptoTestCase(KeyManagerWithSoledadTestCase):
             self._soledad, gpgbinary=self.gpg_binary_path)
         yield pgp.put_raw_key(PRIVATE_KEY, ADDRESS)
         privkey = yield pgp.get_key(ADDRESS, private=True)
-        signed = pgp.sign(data, privkey)
+        signed = yield pgp.sign(data, privkey)
         self.assertRaises(
             AssertionError,
             pgp.verify, signed, privkey)
@@ -146,9 +146,9 @@ class OpenPGPCryptoTestCase(KeyManagerWithSoledadTestCase):
         pgp = openpgp.OpenPGPScheme(
             self._soledad, gpgbinary=self.gpg_binary_path)
         yield pgp.put_raw_key(PUBLIC_KEY, ADDRESS)
-        self.assertRaises(
-            AssertionError,
-            pgp.sign, data, ADDRESS, OpenPGPKey)
+        self.failureResultOf(
+            pgp.sign(data, ADDRESS, OpenPGPKey),
+            AssertionError)
 
     @inlineCallbacks
     def test_verify_with_wrong_key_raises(self):
@@ -157,10 +157,11 @@ class OpenPGPCryptoTestCase(KeyManagerWithSoledadTestCase):
             self._soledad, gpgbinary=self.gpg_binary_path)
         yield pgp.put_raw_key(PRIVATE_KEY, ADDRESS)
         privkey = yield pgp.get_key(ADDRESS, private=True)
-        signed = pgp.sign(data, privkey)
+        signed = yield pgp.sign(data, privkey)
         yield pgp.put_raw_key(PUBLIC_KEY_2, ADDRESS_2)
         wrongkey = yield pgp.get_key(ADDRESS_2)
-        self.assertFalse(pgp.verify(signed, wrongkey))
+        validsign = yield pgp.verify(signed, wrongkey)
+        self.assertFalse(validsign)
 
     @inlineCallbacks
     def test_encrypt_sign_with_public_raises(self):
@@ -212,9 +213,9 @@ class OpenPGPCryptoTestCase(KeyManagerWithSoledadTestCase):
             self._soledad, gpgbinary=self.gpg_binary_path)
         yield pgp.put_raw_key(PRIVATE_KEY, ADDRESS)
         privkey = yield pgp.get_key(ADDRESS, private=True)
-        signed = pgp.sign(data, privkey, detach=False)
+        signed = yield pgp.sign(data, privkey, detach=False)
         pubkey = yield pgp.get_key(ADDRESS, private=False)
-        validsign = pgp.verify(signed, pubkey)
+        validsign = yield pgp.verify(signed, pubkey)
         self.assertTrue(validsign)
 
     @inlineCallbacks
@@ -247,7 +248,7 @@ class OpenPGPCryptoTestCase(KeyManagerWithSoledadTestCase):
         privkey = yield pgp.get_key(ADDRESS, private=True)
         signature = yield pgp.sign(data, privkey, detach=True)
         pubkey = yield pgp.get_key(ADDRESS, private=False)
-        validsign = pgp.verify(data, pubkey, detached_sig=signature)
+        validsign = yield pgp.verify(data, pubkey, detached_sig=signature)
         self.assertTrue(validsign)
 
     @inlineCallbacks
@@ -342,12 +343,13 @@ class OpenPGPCryptoTestCase(KeyManagerWithSoledadTestCase):
         d = pgp.get_key(address, private=private)
         return self.assertFailure(d, KeyNotFound)
 
+    @inlineCallbacks
     def test_key_is_signed_by(self):
         pgp = openpgp.OpenPGPScheme(
             self._soledad, gpgbinary=self.gpg_binary_path)
-        old_pubkey, old_privkey = pgp.parse_key(
+        old_pubkey, old_privkey = yield pgp.parse_key(
             OLD_PUB_KEY, OLD_AND_NEW_KEY_ADDRESS)
-        new_pubkey, new_privkey = pgp.parse_key(
+        new_pubkey, new_privkey = yield pgp.parse_key(
             NEW_PUB_KEY, OLD_AND_NEW_KEY_ADDRESS)
         self.assertTrue(new_pubkey.is_signed_by(old_pubkey))
 
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# test_packets.py
+# Copyright (C) 2018 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the parsing of OpenPGP packets.
+"""
+import binascii
+
+from twisted.trial import unittest
+
+from leap.bitmask.keymanager.packets import get_key_ids
+from leap.bitmask.keymanager.packets import get_recipient_key_ids
+from leap.bitmask.keymanager.packets import WILDCARD_KEY_ID
+
+from common import (
+    DIFFERENT_PRIVATE_KEY,
+    KEY_FINGERPRINT,
+    PRIVATE_KEY,
+    PUBLIC_KEY,
+)
+
+
+def _message(*key_ids):
+    """
+    Build an armored message with a session key packet for each of
+    C{key_ids}, followed by an encrypted data packet of partial length.
+    """
+    packets = []
+    for key_id in key_ids:
+        # version, key id, RSA and a 8 bits MPI
+        body = '\x03' + binascii.unhexlify(key_id) + '\x01\x00\x08\xff'
+        packets.append(chr(0xc0 | 1) + chr(len(body)) + body)
+    packets.append(chr(0xc0 | 18) + chr(0xe0 | 4) + '\x01' * 16)
+    return ('-----BEGIN PGP MESSAGE-----\n\n%s=abcd\n'
+            '-----END PGP MESSAGE-----\n'
+            % binascii.b2a_base64(''.join(packets)))
+
+
+class PacketsTestCase(unittest.TestCase):
+
+    def test_key_ids(self):
+        # primary key and encryption subkey
+        key_ids = set([KEY_FINGERPRINT[-16:], '28FD686FF1B593B0'])
+        self.assertEqual(key_ids, get_key_ids(PUBLIC_KEY))
+        self.assertEqual(key_ids, get_key_ids(PRIVATE_KEY))
+
+    def test_recipient_key_ids(self):
+        message = _message('22064494958E6D7B', WILDCARD_KEY_ID)
+        self.assertEqual(['22064494958E6D7B', WILDCARD_KEY_ID],
+                         get_recipient_key_ids(message))
+        # the encryption subkey
+        self.assertIn('22064494958E6D7B', get_key_ids(DIFFERENT_PRIVATE_KEY))
+
+    def test_not_a_message(self):
+        self.assertIsNone(get_recipient_key_ids('not a message'))
+        self.assertEqual(set(), get_key_ids('not a key'))
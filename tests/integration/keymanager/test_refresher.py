@@ -18,50 +18,123 @@
 """
 Tests for refreshing the key directory.
 """
-from datetime import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
 
 from mock import Mock, patch
 from twisted.internet import defer
+from twisted.internet.task import Clock
 from twisted.logger import Logger
 
 
+from leap.bitmask.keymanager import KeyManager
 from leap.bitmask.keymanager import openpgp
 from leap.bitmask.keymanager.keys import OpenPGPKey
 from leap.bitmask.keymanager.refresher import RandomRefreshPublicKey, \
-    MIN_RANDOM_INTERVAL_RANGE, DEBUG_START_REFRESH, DEBUG_STOP_REFRESH,\
-    ERROR_UNEQUAL_FINGERPRINTS
+    MIN_RANDOM_INTERVAL_RANGE, MAX_RANDOM_INTERVAL_RANGE, REFRESH_PERIOD, \
+    DEBUG_START_REFRESH, DEBUG_STOP_REFRESH, ERROR_UNEQUAL_FINGERPRINTS
 from leap.bitmask.keymanager.testing import KeyManagerWithSoledadTestCase
 
-from common import KEY_FINGERPRINT, PUBLIC_KEY_2, KEY_FINGERPRINT_2
+from common import ADDRESS, KEY_FINGERPRINT, PUBLIC_KEY_2, KEY_FINGERPRINT_2
 
 ANOTHER_FP = 'ANOTHERFINGERPRINT'
 
 
 class RandomRefreshPublicKeyTestCase(KeyManagerWithSoledadTestCase):
 
-    @defer.inlineCallbacks
-    def test_get_random_address(self):
+    def _refresher(self, keys, **kwargs):
         pgp = openpgp.OpenPGPScheme(
             self._soledad, gpgbinary=self.gpg_binary_path)
-        rf = RandomRefreshPublicKey(pgp, self._key_manager())
-        key = OpenPGPKey(address='user@leap.se')
-        key_another = OpenPGPKey(address='zara@leap.se')
+        pgp.get_all_keys = Mock(return_value=defer.succeed(keys))
+        rf = RandomRefreshPublicKey(pgp, self._key_manager(), **kwargs)
+        rf._loop.clock = Clock()
+        rf._loop.clock.advance(time.time())
+        return rf
 
-        pgp.get_all_keys = Mock(return_value=defer.succeed([key, key_another]))
+    @defer.inlineCallbacks
+    def test_stalest_keys_are_refreshed_first(self):
+        now = datetime.now()
+        recent = OpenPGPKey(fingerprint='RECENT', refreshed_at=now)
+        old = OpenPGPKey(fingerprint='OLD', refreshed_at=now - timedelta(3))
+        never = OpenPGPKey(fingerprint='NEVER')
+        rf = self._refresher([recent, old, never], batch_size=2)
 
-        random_key = yield rf._get_random_key()
-        self.assertTrue(random_key.address == key.address or
-                        random_key.address == key_another.address)
+        keys = yield rf._get_keys_to_refresh()
+        self.assertEqual(['NEVER', 'OLD'], [k.fingerprint for k in keys])
+
+    @defer.inlineCallbacks
+    def test_expiring_keys_are_refreshed_more_often(self):
+        rf = self._refresher([])
+        now = rf._now()
+        rf._refreshed = {'EXPIRING': now - REFRESH_PERIOD // 2,
+                         'LASTING': now - REFRESH_PERIOD // 2}
+        expiring = OpenPGPKey(
+            fingerprint='EXPIRING',
+            expiry_date=datetime.fromtimestamp(now) + timedelta(1))
+        lasting = OpenPGPKey(
+            fingerprint='LASTING',
+            expiry_date=datetime.fromtimestamp(now) + timedelta(365))
+        rf._keys = [lasting, expiring]
+        rf._scanned_at = now
+
+        keys = yield rf._get_keys_to_refresh()
+        self.assertEqual([expiring], keys)
 
     @defer.inlineCallbacks
     def test_do_not_throw_error_for_empty_key_dict(self):
-        pgp = openpgp.OpenPGPScheme(
-            self._soledad, gpgbinary=self.gpg_binary_path)
-        rf = RandomRefreshPublicKey(pgp, self._key_manager())
+        rf = self._refresher([])
+        keys = yield rf._get_keys_to_refresh()
+        self.assertEqual([], keys)
+        yield rf._refresh_continuous()
 
-        pgp.get_all_keys = Mock(return_value=defer.succeed([]))
-        random_address = yield rf._get_random_key()
-        self.assertTrue(random_address is None)
+    @defer.inlineCallbacks
+    def test_batch_is_refreshed_and_scheduled(self):
+        keys = [OpenPGPKey(fingerprint='FP%d' % i) for i in range(3)]
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        # the folder of the schedule is created on the first save
+        path = os.path.join(tmpdir, 'keymanager', 'schedule.json')
+        rf = self._refresher(keys, batch_size=2, schedule_path=path)
+        rf.maybe_refresh_key = Mock(side_effect=[
+            defer.succeed(None), defer.fail(Exception('unreachable')),
+            defer.succeed(None)])
+
+        yield rf._refresh_continuous()
+        self.assertEqual(2, rf.maybe_refresh_key.call_count)
+        with open(path) as f:
+            schedule = json.load(f)
+        self.assertEqual(2, len(schedule))
+        stats = rf.get_stats()
+        self.assertEqual(3, stats['keys'])
+        self.assertEqual(2, stats['fresh'])
+        self.assertEqual(2, stats['requests'])
+        self.assertEqual(1, stats['failures'])
+
+        # the last key is refreshed next, even after a restart
+        rf = self._refresher(keys, schedule_path=path)
+        rf.maybe_refresh_key = Mock(return_value=defer.succeed(None))
+        yield rf._refresh_continuous()
+        rf.maybe_refresh_key.assert_called_once_with(keys[2])
+        self.assertEqual(1.0, rf.get_stats()['coverage'])
+
+    def test_schedule_is_kept_under_the_basedir(self):
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        km = KeyManager(ADDRESS, '', self._soledad,
+                        gpgbinary=self.gpg_binary_path, basedir=basedir)
+
+        with patch.object(RandomRefreshPublicKey, 'start'):
+            km.start_refresher()
+            self.assertEqual(
+                os.path.join(basedir, 'keymanager',
+                             '%s.refresh_schedule.json' % ADDRESS),
+                km.refresher._schedule_path)
+            km.start_refresher(schedule_path=None)
+            self.assertIsNone(km.refresher._schedule_path)
 
     @defer.inlineCallbacks
     def test_log_error_if_fetch_by_fingerprint_returns_wrong_key(self):
@@ -71,14 +144,11 @@ class RandomRefreshPublicKeyTestCase(KeyManagerWithSoledadTestCase):
 
         with patch.object(Logger, 'error') as mock_logger_error:
             rf = RandomRefreshPublicKey(pgp, km)
-            rf._get_random_key = \
-                Mock(return_value=defer.succeed(OpenPGPKey(
-                    fingerprint=KEY_FINGERPRINT)))
-
             km._nicknym.fetch_key_with_fingerprint = \
                 Mock(return_value=defer.succeed(PUBLIC_KEY_2))
 
-            yield rf.maybe_refresh_key()
+            yield rf.maybe_refresh_key(
+                OpenPGPKey(fingerprint=KEY_FINGERPRINT))
 
             mock_logger_error.assert_called_with(
                 ERROR_UNEQUAL_FINGERPRINTS %
@@ -91,13 +161,10 @@ class RandomRefreshPublicKeyTestCase(KeyManagerWithSoledadTestCase):
         km = self._key_manager()
 
         rf = RandomRefreshPublicKey(pgp, km)
-        rf._get_random_key = Mock(return_value=defer.succeed(
-            OpenPGPKey(fingerprint=KEY_FINGERPRINT)))
-
         km._nicknym.fetch_key_with_fingerprint = Mock(
             return_value=defer.succeed(PUBLIC_KEY_2))
 
-        yield rf.maybe_refresh_key()
+        yield rf.maybe_refresh_key(OpenPGPKey(fingerprint=KEY_FINGERPRINT))
 
     @defer.inlineCallbacks
     def test_key_expired_will_be_deactivatet(self):
@@ -130,3 +197,12 @@ class RandomRefreshPublicKeyTestCase(KeyManagerWithSoledadTestCase):
             self._soledad, gpgbinary=self.gpg_binary_path)
         rf = RandomRefreshPublicKey(pgp, self._key_manager())
         self.assertTrue(rf._loop.interval >= MIN_RANDOM_INTERVAL_RANGE)
+        self.assertTrue(rf._loop.interval <= MAX_RANDOM_INTERVAL_RANGE)
+
+    def test_interval_keeps_to_the_request_budget(self):
+        pgp = openpgp.OpenPGPScheme(
+            self._soledad, gpgbinary=self.gpg_binary_path)
+        rf = RandomRefreshPublicKey(pgp, self._key_manager(), batch_size=10,
+                                    max_requests_per_hour=20)
+        # ten keys every half an hour at least
+        self.assertTrue(30 * 60 <= rf._get_random_interval_to_refresh())
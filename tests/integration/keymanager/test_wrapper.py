@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# test_wrapper.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the pool of warm GPG keyrings.
+"""
+import os
+import tempfile
+import shutil
+
+from mock import patch
+from twisted.trial import unittest
+
+from leap.bitmask.keymanager import wrapper
+from leap.bitmask.keymanager.keys import build_key_from_dict
+from leap.bitmask.keymanager.wrapper import GPGKeyringPool
+
+from common import (
+    ADDRESS,
+    ADDRESS_2,
+    KEY_FINGERPRINT,
+    KEY_FINGERPRINT_2,
+    PUBLIC_KEY,
+    PUBLIC_KEY_2,
+)
+
+
+def _get_key(address, fingerprint, key_data):
+    return build_key_from_dict({
+        'uids': [address],
+        'fingerprint': fingerprint,
+        'key_data': key_data,
+        'private': False,
+        'length': 4096,
+        'expiry_date': 0,
+        'refreshed_at': 1311239602,
+    })
+
+
+def _homedir(gpg):
+    try:
+        return gpg.homedir
+    except AttributeError:
+        return gpg.gnupghome
+
+
+class GPGKeyringPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.key = _get_key(ADDRESS, KEY_FINGERPRINT, PUBLIC_KEY)
+        self.key_2 = _get_key(ADDRESS_2, KEY_FINGERPRINT_2, PUBLIC_KEY_2)
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_reuse_keyring_for_same_keys(self):
+        pool = GPGKeyringPool(size=2, basedir=self.basedir)
+        with pool.keyring(self.key) as gpg:
+            self.assertEqual(1, len(gpg.list_keys()))
+            homedir = _homedir(gpg)
+        with pool.keyring([self.key]) as gpg:
+            self.assertEqual(homedir, _homedir(gpg))
+        self.assertEqual(1, pool.hits)
+        self.assertEqual(1, pool.misses)
+        pool.clear()
+
+    def test_different_keys_get_different_keyrings(self):
+        pool = GPGKeyringPool(size=2, basedir=self.basedir)
+        with pool.keyring(self.key) as gpg:
+            homedir = _homedir(gpg)
+        with pool.keyring(self.key_2) as gpg:
+            self.assertNotEqual(homedir, _homedir(gpg))
+            keys = gpg.list_keys()
+            self.assertEqual(1, len(keys))
+            self.assertNotEqual(KEY_FINGERPRINT, keys[0]['fingerprint'])
+        self.assertEqual(2, len(pool))
+        pool.clear()
+
+    def test_evict_least_recently_used(self):
+        pool = GPGKeyringPool(size=1, basedir=self.basedir)
+        with pool.keyring(self.key) as gpg:
+            homedir = _homedir(gpg)
+        with pool.keyring(self.key_2):
+            pass
+        self.assertEqual(1, len(pool))
+        self.assertEqual(1, pool.evictions)
+        self.assertFalse(os.path.exists(homedir))
+        pool.clear()
+
+    def test_keyring_in_use_is_not_evicted(self):
+        pool = GPGKeyringPool(size=1, basedir=self.basedir)
+        with pool.keyring(self.key) as gpg:
+            homedir = _homedir(gpg)
+            with pool.keyring(self.key_2):
+                self.assertEqual(2, len(pool))
+                self.assertTrue(os.path.exists(homedir))
+            self.assertEqual(1, len(pool))
+        self.assertEqual(1, len(pool))
+
+    def test_clear_wipes_keyrings(self):
+        pool = GPGKeyringPool(size=2, basedir=self.basedir)
+        with pool.keyring(self.key) as gpg:
+            homedir = _homedir(gpg)
+        pool.clear()
+        self.assertEqual(0, len(pool))
+        self.assertFalse(os.path.exists(homedir))
+
+    def test_keyring_is_built_without_holding_the_lock(self):
+        pool = GPGKeyringPool(size=2, basedir=self.basedir)
+        import_keys = wrapper._import_keys
+        locked = []
+
+        def _import_keys(gpg, keys):
+            locked.append(pool._lock.locked())
+            return import_keys(gpg, keys)
+
+        with patch.object(wrapper, '_import_keys', _import_keys):
+            with pool.keyring(self.key) as gpg:
+                self.assertEqual(1, len(gpg.list_keys()))
+        self.assertEqual([False], locked)
+        self.assertEqual(1, len(pool))
+        pool.clear()
@@ -20,9 +20,11 @@ Tests for the Soledad Adaptor module - leap.bitmask.mail.adaptors.soledad
 import os
 from functools import partial
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task
 
+from leap.bitmask.mail import constants
 from leap.bitmask.mail.adaptors import models
+from leap.bitmask.mail.adaptors import soledad
 from leap.bitmask.mail.adaptors.soledad import SoledadDocumentWrapper
 from leap.bitmask.mail.adaptors.soledad import SoledadIndexMixin
 from leap.bitmask.mail.adaptors.soledad import SoledadMailAdaptor
@@ -326,7 +328,7 @@ class SoledadMailAdaptorTestCase(SoledadTestMixin):
         self.assertTrue(msg.wrapper.cdocs is not None)
         self.assertEquals(len(msg.wrapper.cdocs), 1)
         self.assertEquals(msg.wrapper.fdoc.chash, chash)
-        self.assertEquals(msg.wrapper.fdoc.size, 3837)
+        self.assertEquals(msg.wrapper.fdoc.size, len(raw))
         self.assertEquals(msg.wrapper.hdoc.chash, chash)
         self.assertEqual(dict(msg.wrapper.hdoc.headers)['Subject'],
                          subject)
@@ -388,6 +390,35 @@ class SoledadMailAdaptorTestCase(SoledadTestMixin):
 
     test_get_msg_from_metamsg_doc_id.skip = "Not yet implemented"
 
+    @defer.inlineCallbacks
+    def test_get_msgs_from_mdoc_ids_skips_missing_docs(self):
+        adaptor = self.get_adaptor()
+        store = adaptor.store
+        yield adaptor.initialize_store(store)
+        with open(os.path.join(HERE, '..', 'rfc822.multi.message')) as f:
+            raw = f.read()
+        msg = adaptor.get_msg_from_string(MessageClass, raw)
+        wrapper = msg.get_wrapper()
+        wrapper.set_mbox_uuid('inbox')
+        yield wrapper.create(store)
+        hdoc = yield store.get_doc(wrapper.hdoc.doc_id)
+        yield store.delete_doc(hdoc)
+
+        mdoc_id = wrapper.mdoc.doc_id
+        missing_id = constants.METAMSGID.format(
+            mbox_uuid='inbox', chash='0' * 64)
+        msgs = yield adaptor.get_msgs_from_mdoc_ids(
+            MessageClass, store, [missing_id, mdoc_id], uids=[1, 2],
+            get_cdocs=True)
+
+        missing, found = msgs
+        self.assertIsNone(missing)
+        self.assertEqual(2, found.uid)
+        self.assertEqual(mdoc_id, found.get_wrapper().mdoc.doc_id)
+        self.assertEqual(wrapper.fdoc.doc_id, found.get_wrapper().fdoc.doc_id)
+        self.assertEqual(len(wrapper.mdoc.cdocs),
+                         len(found.get_wrapper().cdocs))
+
     def test_create_msg(self):
         adaptor = self.get_adaptor()
 
@@ -403,10 +434,181 @@ class SoledadMailAdaptorTestCase(SoledadTestMixin):
                     doc.__class__.__name__,
                     "SoledadDocument")
 
-        d = adaptor.create_msg(adaptor.store, msg)
+        d = adaptor.initialize_store(adaptor.store)
+        d.addCallback(lambda _: adaptor.create_msg(adaptor.store, msg))
         d.addCallback(check_create_result)
         return d
 
+    @defer.inlineCallbacks
+    def test_create_msg_is_all_or_nothing(self):
+        adaptor = self.get_adaptor()
+        store = adaptor.store
+        yield adaptor.initialize_store(store)
+        with open(os.path.join(HERE, '..', 'rfc822.multi.message')) as f:
+            raw = f.read()
+        msg = adaptor.get_msg_from_string(MessageClass, raw)
+
+        create_doc = store.create_doc
+
+        def fail_to_create_content(content, doc_id=None):
+            if content['type'] == 'cnt':
+                return defer.fail(IOError('No space left on device'))
+            return create_doc(content, doc_id=doc_id)
+
+        self.patch(store, 'create_doc', fail_to_create_content)
+        yield self.assertFailure(adaptor.create_msg(store, msg), IOError)
+
+        # only the headers, that could be shared with other messages, are
+        # left
+        _, docs = yield store.get_all_docs()
+        self.assertEqual(['head'], [doc.content['type'] for doc in docs])
+
+    @defer.inlineCallbacks
+    def test_delete_orphaned_fdocs(self):
+        adaptor = self.get_adaptor()
+        store = adaptor.store
+        yield adaptor.initialize_store(store)
+
+        def get_wrapper(name, mbox_uuid):
+            with open(os.path.join(HERE, '..', name)) as f:
+                raw = f.read()
+            msg = adaptor.get_msg_from_string(MessageClass, raw)
+            wrapper = msg.get_wrapper()
+            wrapper.set_mbox_uuid(mbox_uuid)
+            return wrapper
+
+        created = get_wrapper('rfc822.message', 'inbox')
+        yield created.create(store)
+        # the creation of this one was interrupted after writing the flags
+        interrupted = get_wrapper('rfc822.multi.message', 'inbox')
+        yield soledad._add_pending_fdoc(store, interrupted.fdoc.future_doc_id)
+        yield interrupted.fdoc.create(store)
+        # and the meta doc of this one is still to be synced
+        synced = get_wrapper('rfc822.plain.message', 'trash')
+        yield synced.fdoc.create(store)
+
+        mbox_uuids = yield adaptor.delete_orphaned_fdocs(store)
+        self.assertEqual(['inbox'], mbox_uuids)
+        self.assertIsNone((yield store.get_doc(interrupted.fdoc.doc_id)))
+        self.assertIsNotNone((yield store.get_doc(created.fdoc.doc_id)))
+        self.assertIsNotNone((yield store.get_doc(synced.fdoc.doc_id)))
+        self.assertEqual([], (yield adaptor.delete_orphaned_fdocs(store)))
+
+    @defer.inlineCallbacks
+    def test_sweep_orphaned_parts_after_del_all_flagged(self):
+        adaptor = self.get_adaptor()
+        store = adaptor.store
+        yield adaptor.initialize_store(store)
+        with open(os.path.join(HERE, '..', 'rfc822.multi.message')) as f:
+            raw = f.read()
+        msg = adaptor.get_msg_from_string(MessageClass, raw)
+        wrapper = msg.get_wrapper()
+        wrapper.set_mbox_uuid('inbox')
+        yield wrapper.create(store)
+        # the copy shares the headers and contents with the original
+        copy = yield wrapper.copy(store, 'trash')
+
+        @defer.inlineCallbacks
+        def get_doc_types():
+            _, docs = yield store.get_all_docs()
+            defer.returnValue(sorted(doc.content['type'] for doc in docs))
+
+        def expunge(wrapper, mbox_uuid):
+            wrapper.set_flags(('\\Deleted',))
+            d = wrapper.update(store)
+            d.addCallback(lambda _: adaptor.del_all_flagged_messages(
+                store, mbox_uuid))
+            return d
+
+        parts = ['cnt'] * len(wrapper.mdoc.cdocs) + ['head']
+        self.assertEqual(
+            sorted(['flags', 'flags', 'meta', 'meta'] + parts),
+            (yield get_doc_types()))
+
+        deleted = yield expunge(wrapper, 'inbox')
+        self.assertEqual([wrapper.mdoc.doc_id], deleted)
+        self.assertEqual(
+            sorted(['flags', 'meta'] + parts), (yield get_doc_types()))
+
+        self.assertEqual(0, (yield adaptor.sweep_orphaned_parts(store)))
+
+        # the parts are kept for the grace period
+        deleted = yield expunge(copy, 'trash')
+        self.assertEqual([copy.mdoc.doc_id], deleted)
+        self.assertEqual(sorted(parts), (yield get_doc_types()))
+        self.assertEqual(0, (yield adaptor.sweep_orphaned_parts(store)))
+        self.assertEqual(sorted(parts), (yield get_doc_types()))
+
+        # and a copy made in another device that arrives meanwhile keeps them
+        self.patch(soledad, 'PARTS_SWEEP_GRACE_PERIOD', 0)
+        synced = yield copy.copy(store, 'sent')
+        self.assertEqual(0, (yield adaptor.sweep_orphaned_parts(store)))
+        self.assertEqual(
+            sorted(['flags', 'meta'] + parts), (yield get_doc_types()))
+
+        yield expunge(synced, 'sent')
+        self.assertEqual(
+            len(parts), (yield adaptor.sweep_orphaned_parts(store)))
+        self.assertEqual([], (yield get_doc_types()))
+        self.assertEqual(0, (yield adaptor.sweep_orphaned_parts(store)))
+
+    @defer.inlineCallbacks
+    def test_queue_many_orphaned_parts(self):
+        adaptor = self.get_adaptor()
+        store = adaptor.store
+        yield adaptor.initialize_store(store)
+        # more parts than host parameters are allowed in a sqlite query
+        doc_ids = ['C-%d' % n for n in range(1000)]
+
+        def get_queued():
+            return store.raw_sqlcipher_query(
+                "SELECT COUNT(*) FROM leapmail_pending_parts")
+
+        yield adaptor.queue_orphaned_parts(store, doc_ids)
+        yield adaptor.queue_orphaned_parts(store, doc_ids[:10])
+        self.assertEqual([(1000,)], (yield get_queued()))
+        self.patch(soledad, 'PARTS_SWEEP_GRACE_PERIOD', 0)
+        self.assertEqual(0, (yield adaptor.sweep_orphaned_parts(store)))
+        self.assertEqual([(0,)], (yield get_queued()))
+
+    @defer.inlineCallbacks
+    def test_update_msgs_flags(self):
+        adaptor = self.get_adaptor()
+        store = adaptor.store
+        yield adaptor.initialize_store(store)
+        with open(os.path.join(HERE, '..', 'rfc822.message')) as f:
+            raw = f.read()
+        msg = adaptor.get_msg_from_string(MessageClass, raw)
+        wrapper = msg.get_wrapper()
+        wrapper.set_mbox_uuid('inbox')
+        yield wrapper.create(store)
+        missing_id = constants.METAMSGID.format(
+            mbox_uuid='inbox', chash='0' * 64)
+
+        # a single update of the same flags doc waits for the bulk one
+        release = defer.Deferred()
+        key = soledad.FlagsDocWrapper._get_klass_lock_key(
+            store, wrapper.fdoc.doc_id)
+        locked = soledad.FlagsDocWrapper._k_locks.run([key], lambda: release)
+        wrapper.fdoc.flags = ['\\Seen']
+        updated = []
+        d = wrapper.update(store)
+        d.addCallback(updated.append)
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual([], updated)
+        release.callback(None)
+        yield locked
+        yield d
+        self.assertEqual(1, len(updated))
+
+        results = yield adaptor.update_msgs_flags(
+            store, [missing_id, wrapper.mdoc.doc_id],
+            lambda flags: flags + ['\\Deleted'])
+        self.assertEqual(
+            [None, (['\\Seen'], ['\\Seen', '\\Deleted'])], results)
+        fdoc = yield store.get_doc(wrapper.fdoc.doc_id)
+        self.assertTrue(fdoc.content['deleted'])
+
     def test_update_msg(self):
         adaptor = self.get_adaptor()
         with open(os.path.join(HERE, '..', 'rfc822.message')) as f:
@@ -439,7 +641,8 @@ class SoledadMailAdaptorTestCase(SoledadTestMixin):
             return d
 
         msg = adaptor.get_msg_from_string(MessageClass, raw)
-        d = adaptor.create_msg(adaptor.store, msg)
+        d = adaptor.initialize_store(adaptor.store)
+        d.addCallback(lambda _: adaptor.create_msg(adaptor.store, msg))
         d.addCallback(lambda _: adaptor.store.get_all_docs())
         d.addCallback(partial(self.assert_num_docs, 4))
         d.addCallback(assert_msg_has_doc_id, msg)
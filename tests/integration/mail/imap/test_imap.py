@@ -1040,6 +1040,62 @@ class LEAPIMAP4ServerTestCase(IMAP4HelperMixin):
         # the uids of the deleted messages
         self.assertItemsEqual(self.results, [1, 3])
 
+    def testStore(self):
+        """
+        Test store command
+        """
+        acc = self.server.theAccount
+        mailbox_name = 'mailboxstore'
+
+        def add_mailbox():
+            return acc.addMailbox(mailbox_name)
+
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        def select():
+            return self.client.select(mailbox_name)
+
+        def save_mailbox(mailbox):
+            self.mailbox = mailbox
+
+        def get_mailbox():
+            d = acc.getMailbox(mailbox_name)
+            d.addCallback(save_mailbox)
+            return d
+
+        def add_messages():
+            d = self.mailbox.addMessage('test 1', flags=('AnotherFlag',))
+            d.addCallback(lambda _: self.mailbox.addMessage('test 2', ()))
+            return d
+
+        def store():
+            return self.client.addFlags('1:*', ['\\Seen'], silent=False)
+
+        def stored(results):
+            self.results = results
+
+        self.results = None
+        d1 = self.connected.addCallback(strip(add_mailbox))
+        d1.addCallback(strip(login))
+        d1.addCallback(strip(get_mailbox))
+        d1.addCallbacks(strip(add_messages), self._ebGeneral)
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        d1.addCallbacks(strip(store), self._ebGeneral)
+        d1.addCallbacks(stored, self._ebGeneral)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(lambda _: self.mailbox.getUnseenCount())
+        return d.addCallback(self._cbTestStore)
+
+    def _cbTestStore(self, unseen):
+        self.assertEqual(unseen, 0)
+        self.assertEqual(sorted(self.results), [1, 2])
+        self.assertItemsEqual(
+            self.results[1]['FLAGS'], ['AnotherFlag', '\\Seen'])
+        self.assertItemsEqual(self.results[2]['FLAGS'], ['\\Seen'])
+
 
 class AccountTestCase(IMAP4HelperMixin):
     """
@@ -1057,7 +1113,140 @@ class AccountTestCase(IMAP4HelperMixin):
 
 class IMAP4ServerSearchTestCase(IMAP4HelperMixin):
     """
-    Tests for the behavior of the search_* functions in L{imap5.IMAP4Server}.
+    Tests for the SEARCH command, answered from the search index.
     """
-    # XXX coming soon to your screens!
-    pass
+    mailbox_name = 'searchbox'
+
+    messages = [
+        ("From: Alice <alice@example.org>\r\n"
+         "To: bob@example.org\r\n"
+         "Subject: Lunch plans\r\n"
+         "Date: Mon, 05 Jan 2015 10:00:00 +0000\r\n"
+         "\r\n"
+         "Pizza?\r\n",
+         ('\\Seen',), 'Mon, 05 Jan 2015 10:00:00 +0000'),
+        ("From: carol@example.org\r\n"
+         "To: bob@example.org\r\n"
+         "Cc: Alice <alice@example.org>\r\n"
+         "Subject: =?utf-8?q?Caf=C3=A9?= meeting\r\n"
+         "Date: Wed, 10 Feb 2016 10:00:00 +0000\r\n"
+         "\r\n" + "x" * 2000 + "\r\n",
+         ('\\Flagged',), 'Wed, 10 Feb 2016 10:00:00 +0000'),
+        ("From: bob@example.org\r\n"
+         "To: alice@example.org\r\n"
+         "Subject: Re: Lunch plans\r\n"
+         "Message-ID: <lunch-reply@example.org>\r\n"
+         "Date: Wed, 01 Mar 2017 10:00:00 +0000\r\n"
+         "\r\n"
+         "Sure!\r\n",
+         ('\\Seen', '\\Deleted', 'work'), 'Wed, 01 Mar 2017 10:00:00 +0000'),
+    ]
+
+    queries = [
+        (('FROM alice',), False, [1]),
+        (('CC alice',), False, [2]),
+        (('SUBJECT lunch',), False, [1, 3]),
+        (('SUBJECT "caf\xc3\xa9 meeting"',), False, [2]),
+        (('HEADER Message-ID lunch-reply@example.org',), False, [3]),
+        (('SEEN',), False, [1, 3]),
+        (('UNSEEN',), False, [2]),
+        (('FLAGGED',), False, [2]),
+        (('DELETED',), False, [3]),
+        (('KEYWORD work',), False, [3]),
+        (('SINCE 1-Jan-2016',), False, [2, 3]),
+        (('BEFORE 1-Jan-2016',), False, [1]),
+        (('ON 10-Feb-2016',), False, [2]),
+        (('SENTBEFORE 1-Mar-2017',), False, [1, 2]),
+        (('LARGER 1000',), False, [2]),
+        (('SMALLER 1000',), False, [1, 3]),
+        (('OR FROM carol FROM bob',), False, [2, 3]),
+        (('NOT SEEN',), False, [2]),
+        (('2:* SEEN',), False, [3]),
+        (('(OR FLAGGED DELETED) NOT KEYWORD work',), False, [2]),
+        (('UID 2:*',), True, [2, 3]),
+        (('SEEN',), True, [1, 3]),
+    ]
+
+    fulltext_queries = [
+        (('BODY pizza',), False, [1]),
+        (('BODY piz',), False, [1]),
+        (('BODY carol',), False, []),
+        (('TEXT carol',), False, [2]),
+        (('TEXT "lunch plans"',), False, [1, 3]),
+        (('OR BODY sure BODY pizza',), False, [1, 3]),
+        (('BODY sure SEEN',), True, [3]),
+    ]
+
+    def test_search(self):
+        return self._test_search(self.mailbox_name, self.queries)
+
+    def test_search_fulltext(self):
+        acc = self.server.theAccount
+        d = acc.account.enable_fulltext()
+        d.addCallback(lambda _: self._test_search(
+            'searchfulltext', self.fulltext_queries))
+        return d
+
+    def _test_search(self, mailbox_name, queries):
+        acc = self.server.theAccount
+        self.results = []
+
+        def add_messages(mailbox):
+            d = defer.succeed(None)
+            for raw, flags, date in self.messages:
+                d.addCallback(
+                    lambda _, raw=raw, flags=flags, date=date:
+                    mailbox.addMessage(raw, flags=flags, date=date))
+            return d
+
+        def search():
+            d = defer.succeed(None)
+            for query, uid, _ in queries:
+                d.addCallback(
+                    lambda _, query=query, uid=uid:
+                    self.client.search(*query, uid=uid))
+                d.addCallback(self.results.append)
+            return d
+
+        d1 = self.connected.addCallback(
+            strip(lambda: acc.addMailbox(mailbox_name)))
+        d1.addCallback(strip(lambda: acc.getMailbox(mailbox_name)))
+        d1.addCallback(add_messages)
+        d1.addCallback(strip(
+            lambda: self.client.login(TEST_USER, TEST_PASSWD)))
+        d1.addCallback(strip(lambda: self.client.select(mailbox_name)))
+        d1.addCallbacks(strip(search), self._ebGeneral)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        return d.addCallback(self._cbTestSearch, queries)
+
+    def _cbTestSearch(self, ignored, queries):
+        expected = [result for _, _, result in queries]
+        self.assertEqual(expected, self.results)
+
+    def test_search_body_unsupported(self):
+        acc = self.server.theAccount
+        self.failures = []
+
+        def search():
+            d = self.client.search('BODY pizza')
+            d.addErrback(self.failures.append)
+            return d
+
+        d1 = self.connected.addCallback(
+            strip(lambda: acc.addMailbox('searchbody')))
+        d1.addCallback(strip(
+            lambda: self.client.login(TEST_USER, TEST_PASSWD)))
+        d1.addCallback(strip(lambda: self.client.select('searchbody')))
+        d1.addCallbacks(strip(search), self._ebGeneral)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        return d.addCallback(self._cbTestSearchBodyUnsupported)
+
+    def _cbTestSearchBodyUnsupported(self, ignored):
+        self.assertEqual(1, len(self.failures))
+        self.failures[0].trap(imap4.IMAP4Exception)
+        # logged by the server when answering BAD
+        self.flushLoggedErrors(imap4.IllegalQueryError)
@@ -443,6 +443,45 @@ subject: independence of cyberspace
         d.addCallback(add_verified_signature_header_called)
         return d
 
+    def testProcessIncomingMailWithBoundedConcurrency(self):
+        pending = []
+
+        def decrypt_doc(doc):
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+
+        docs = []
+        for i in range(5):
+            doc = SoledadDocument(doc_id="doc%d" % i)
+            doc.content = {ENC_SCHEME_KEY: EncryptionSchemes.PUBKEY,
+                           ENC_JSON_KEY: "",
+                           fields.ERROR_DECRYPTING_KEY: False}
+            docs.append(doc)
+
+        fetcher = IncomingMail(self.km, self._soledad,
+                               self.fetcher._inbox_collection, ADDRESS,
+                               max_concurrent=2)
+        fetcher._decrypt_doc = Mock(side_effect=decrypt_doc)
+        fetcher._add_message_locally = Mock(return_value=None)
+
+        d = fetcher._process_incoming_mail(docs)
+        self.assertEqual(2, len(pending))
+
+        # each finished message lets the next one in, and is saved
+        # right away
+        pending.pop(0).callback((docs[0], "msg"))
+        fetcher._add_message_locally.assert_called_once_with(
+            (docs[0], "msg"))
+        self.assertEqual(2, len(pending))
+        self.assertEqual(3, fetcher._decrypt_doc.call_count)
+
+        while pending:
+            pending.pop(0).callback((None, ""))
+        self.assertEqual(5, fetcher._decrypt_doc.call_count)
+        d.addCallback(lambda result: self.assertEqual(docs, result))
+        return d
+
     def _do_fetch(self, message):
         d = self._create_incoming_email(message)
         d.addCallback(
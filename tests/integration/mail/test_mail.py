@@ -25,9 +25,19 @@ from functools import partial
 from email.parser import Parser
 from email.Utils import formatdate
 
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from leap.bitmask.mail.adaptors import soledad
 from leap.bitmask.mail.adaptors.soledad import SoledadMailAdaptor
 from leap.bitmask.mail.mail import MessageCollection, Account, _unpack_headers
+from leap.bitmask.mail.mail import BodyFile
+from leap.bitmask.mail.mail import Flagsmode
+from leap.bitmask.mail.mail import MailboxCounters
 from leap.bitmask.mail.mailbox_indexer import MailboxIndexer
+from leap.bitmask.mail.plugins import soledad_sync_hooks
+from leap.bitmask.mail.search_indexer import FulltextDisabledError
+from leap.bitmask.mail.search_indexer import SearchIndexer
 from leap.bitmask.mail.testing.common import SoledadTestMixin
 
 HERE = os.path.split(os.path.abspath(__file__))[0]
@@ -54,10 +64,90 @@ def _get_msg_time():
     return formatdate(timestamp)
 
 
+class BodyFileTestCase(unittest.TestCase):
+
+    def test_read_and_seek(self):
+        fd = BodyFile(u'caf\xe9\nline two\n')
+        self.assertEqual('caf\xc3\xa9\n', fd.readline())
+        self.assertEqual(6, fd.tell())
+        fd.seek(0)
+        self.assertEqual(['caf\xc3\xa9\n', 'line two\n'], list(fd))
+
+    def test_window(self):
+        payload = 'The quick brown fox'
+        fd = BodyFile(payload)
+        fd.read()
+        window = fd.window(4, 11)
+        self.assertEqual('quick brown', window.read())
+        self.assertEqual('uick', fd.window(4, 11).window(1, 4).read())
+        self.assertEqual('fox', fd.window(16, 100).read())
+        self.assertEqual('', fd.window(100, 5).read())
+        self.assertEqual('', fd.window(4, 11).window(20, 5).read())
+
+        # the window does not move the position of the file
+        self.assertEqual('', fd.read())
+
+
+class MailboxCountersTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.counters = MailboxCounters()
+        self.queries = 0
+
+    def query(self, count):
+        self.queries += 1
+        return defer.succeed(count)
+
+    def get(self, count=None):
+        d = self.counters.get(MailboxCounters.EXISTS,
+                              lambda: self.query(count))
+        return self.successResultOf(d)
+
+    def test_count_is_cached(self):
+        self.assertEqual(3, self.get(3))
+        self.assertEqual(3, self.get(5))
+        self.assertEqual(1, self.queries)
+
+        self.counters.begin()
+        self.counters.end({MailboxCounters.EXISTS: 2,
+                           MailboxCounters.UNSEEN: 1})
+        self.assertEqual(5, self.get())
+        self.counters.invalidate()
+        self.assertEqual(7, self.get(7))
+        self.assertEqual(2, self.queries)
+
+    def test_count_is_not_cached_while_writing(self):
+        self.counters.begin()
+        self.assertEqual(3, self.get(3))
+        self.counters.end({MailboxCounters.EXISTS: 1})
+        self.assertEqual(4, self.get(4))
+        self.assertEqual(2, self.queries)
+
+        # a query that races with a write
+        d = defer.Deferred()
+        self.counters.invalidate()
+        self.counters.get(MailboxCounters.EXISTS, lambda: d)
+        self.counters.begin()
+        self.counters.end({MailboxCounters.EXISTS: 1})
+        d.callback(4)
+        self.assertEqual(5, self.get(5))
+
+    def test_failed_write_drops_the_counts(self):
+        self.get(3)
+        self.counters.begin()
+        self.counters.end()
+        self.assertEqual(2, self.get(2))
+
+        self.counters.begin()
+        self.counters.end({MailboxCounters.EXISTS: -3})
+        self.assertEqual(0, self.get(0))
+        self.assertEqual(3, self.queries)
+
+
 class CollectionMixin(object):
 
     def get_collection(self, mbox_collection=True, mbox_name=None,
-                       mbox_uuid=None):
+                       mbox_uuid=None, search_indexer=None):
         """
         Get a collection for tests.
         """
@@ -76,7 +166,8 @@ class CollectionMixin(object):
             wrapper.uuid = mbox_uuid
             return MessageCollection(
                 adaptor, store,
-                mbox_indexer=mbox_indexer, mbox_wrapper=wrapper)
+                mbox_indexer=mbox_indexer, mbox_wrapper=wrapper,
+                search_indexer=search_indexer)
 
         d = adaptor.initialize_store(store)
         if mbox_collection:
@@ -173,7 +264,7 @@ class MessageTestCase(SoledadTestMixin, CollectionMixin):
 
     def _test_get_size_cb(self, msg):
         self.assertTrue(msg is not None)
-        expected = len(_get_parsed_msg().as_string())
+        expected = len(_get_raw_msg())
         self.assertEqual(msg.get_size(), expected)
 
     def test_is_multipart_no(self):
@@ -197,12 +288,23 @@ class MessageTestCase(SoledadTestMixin, CollectionMixin):
         self.assertEqual(msg.is_multipart(), expected)
 
     def test_get_subpart(self):
-        d = self.get_inserted_msg(multi=True)
+        d = self._do_insert_msg(multi=True)
+        d.addCallback(lambda _: self.get_collection(mbox_uuid=self._mbox_uuid))
+        d.addCallback(lambda col: col.get_message_by_uid(1, get_cdocs=True))
         d.addCallback(self._test_get_subpart_cb)
         return d
 
     def _test_get_subpart_cb(self, msg):
         self.assertTrue(msg is not None)
+        subpart = msg.get_subpart(1)
+        self.assertIs(subpart, msg.get_subpart(1))
+        self.assertIs(subpart.get_headers(), subpart.get_headers())
+        self.assertEqual(subpart.get_size(), subpart.get_size())
+
+        orig = _get_parsed_msg(multi=True)
+        expected = orig.get_payload()[0].get_payload()
+        self.assertEqual(subpart.get_body_file().read(), expected)
+        self.assertRaises(IndexError, msg.get_subpart, 100)
 
     def test_get_tags(self):
         d = self.get_inserted_msg()
@@ -296,6 +398,229 @@ class MessageCollectionTestCase(SoledadTestMixin, CollectionMixin):
     def _test_delete_msg_cb(self, _):
         return partial(self.assert_collection_count, expected=0)
 
+    def test_get_messages_by_uids(self):
+        def add_msgs(collection):
+            self._collection = collection
+            d = collection.add_msg(_get_raw_msg(), flags=('\\Seen',),
+                                   date=_get_msg_time())
+            d.addCallback(lambda _: collection.add_msg(
+                _get_raw_msg(multi=True), date=_get_msg_time()))
+            return d
+
+        def get_msgs(_):
+            return self._collection.get_messages_by_uids(
+                [2, 3, 1], get_cdocs=True)
+
+        d = self.get_collection()
+        d.addCallback(add_msgs)
+        d.addCallback(get_msgs)
+        d.addCallback(self._test_get_messages_by_uids_cb)
+        return d
+
+    def _test_get_messages_by_uids_cb(self, msgs):
+        self.assertEqual(3, len(msgs))
+        multi, missing, single = msgs
+        self.assertIsNone(missing)
+        self.assertEqual(2, multi.get_uid())
+        self.assertTrue(multi.is_multipart())
+        self.assertEqual(1, single.get_uid())
+        self.assertFalse(single.is_multipart())
+        self.assertEqual(('\\Seen',), tuple(single.get_flags()))
+        expected = [
+            (str(key.lower()), str(value))
+            for (key, value) in _get_parsed_msg().items()]
+        self.assertItemsEqual(_unpack_headers(single.get_headers()), expected)
+        self.assertEqual(_get_parsed_msg().get_payload(),
+                         single.get_wrapper().cdocs[1].raw)
+
+    def test_search(self):
+        search_indexer = SearchIndexer(self._soledad)
+        seen = ('flag', '\\Seen')
+
+        @defer.inlineCallbacks
+        def search_after_changes(collection):
+            # the first message is added before there is a search table, as
+            # it happens with copies and synced messages
+            yield collection.add_msg(_get_raw_msg(), date=_get_msg_time())
+            yield search_indexer.create_table(collection.mbox_uuid)
+            yield collection.add_msg(
+                _get_raw_msg(multi=True), date=_get_msg_time())
+
+            uids = yield collection.search(('all',))
+            self.assertEqual([1, 2], uids)
+            uids = yield collection.search(seen)
+            self.assertEqual([], uids)
+
+            first = yield collection.get_message_by_uid(1)
+            yield collection.update_flags(
+                first, ('\\Seen',), Flagsmode.APPEND)
+            uids = yield collection.search(seen)
+            self.assertEqual([1], uids)
+
+            yield collection.delete_msg(first)
+            uids = yield collection.search(('all',))
+            self.assertEqual([2], uids)
+
+        d = self.get_collection(search_indexer=search_indexer)
+        d.addCallback(search_after_changes)
+        return d
+
+    def test_search_after_flags_change_elsewhere(self):
+        search_indexer = SearchIndexer(self._soledad)
+        seen = ('flag', '\\Seen')
+
+        @defer.inlineCallbacks
+        def search_after_sync(collection):
+            yield search_indexer.create_table(collection.mbox_uuid)
+            yield collection.add_msg(_get_raw_msg(), date=_get_msg_time())
+            uids = yield collection.search(seen)
+            self.assertEqual([], uids)
+
+            # the flags doc is changed as a sync from another device would
+            msg = yield collection.get_message_by_uid(1)
+            wrapper = msg.get_wrapper()
+            fdoc = yield self._soledad.get_doc(wrapper.fdoc.doc_id)
+            fdoc.content['flags'] = ['\\Seen']
+            fdoc.content['seen'] = True
+            yield self._soledad.put_doc(fdoc)
+            yield search_indexer.invalidate_doc(
+                collection.mbox_uuid, wrapper.mdoc.doc_id)
+
+            uids = yield collection.search(seen)
+            self.assertEqual([1], uids)
+
+        d = self.get_collection(search_indexer=search_indexer)
+        d.addCallback(search_after_sync)
+        return d
+
+    def test_search_many_ranges(self):
+        search_indexer = SearchIndexer(self._soledad)
+        # more ranges than host parameters are allowed in a sqlite query
+        ranges = [(n, n) for n in range(1, 2000, 2)]
+
+        @defer.inlineCallbacks
+        def search_ranges(collection):
+            yield search_indexer.create_table(collection.mbox_uuid)
+            yield collection.add_msg(_get_raw_msg(), date=_get_msg_time())
+            yield collection.add_msg(
+                _get_raw_msg(multi=True), date=_get_msg_time())
+            uids = yield collection.search(('uid', ranges))
+            self.assertEqual([1], uids)
+            uids = yield collection.search(('msn', ranges))
+            self.assertEqual([1], uids)
+
+        d = self.get_collection(search_indexer=search_indexer)
+        d.addCallback(search_ranges)
+        return d
+
+    def test_search_fulltext(self):
+        search_indexer = SearchIndexer(self._soledad)
+
+        @defer.inlineCallbacks
+        def search_contents(collection):
+            yield self.assertFailure(
+                collection.search(('body', 'rebuild')), FulltextDisabledError)
+
+            # the first message is added before there is a full-text index
+            yield collection.add_msg(_get_raw_msg(), date=_get_msg_time())
+            yield search_indexer.create_fulltext_table(collection.mbox_uuid)
+            yield collection.add_msg(
+                _get_raw_msg(multi=True), date=_get_msg_time())
+
+            uids = yield collection.search(('body', 'rebuild now works'))
+            self.assertEqual([1], uids)
+            uids = yield collection.search(('body', 'from PINE mu'))
+            self.assertEqual([2], uids)
+            uids = yield collection.search(('body', 'Doug Sauder'))
+            self.assertEqual([], uids)
+            uids = yield collection.search(('text', 'Doug Sauder'))
+            self.assertEqual([2], uids)
+            # the attachments are not indexed
+            uids = yield collection.search(('body', 'iVBORw0KGgo'))
+            self.assertEqual([], uids)
+
+            first = yield collection.get_message_by_uid(1)
+            yield collection.delete_msg(first)
+            uids = yield collection.search(('body', 'rebuild'))
+            self.assertEqual([], uids)
+
+        d = self.get_collection(search_indexer=search_indexer)
+        d.addCallback(search_contents)
+        return d
+
+    @defer.inlineCallbacks
+    def test_counts_are_kept_up_to_date(self):
+        collection = yield self.get_collection()
+        adaptor = collection.adaptor
+        store = collection.store
+
+        @defer.inlineCallbacks
+        def assert_counts(exists, recent, unseen):
+            counts = yield defer.gatherResults([
+                collection.count(), collection.count_recent(),
+                collection.count_unseen()])
+            self.assertEqual([exists, recent, unseen], counts)
+            counts = yield defer.gatherResults([
+                collection.mbox_indexer.count(collection.mbox_uuid),
+                adaptor.get_count_recent(store, collection.mbox_uuid),
+                adaptor.get_count_unseen(store, collection.mbox_uuid)])
+            self.assertEqual([exists, recent, unseen], counts)
+
+        yield assert_counts(0, 0, 0)
+        msg = yield collection.add_msg(
+            _get_raw_msg(), flags=('\\Recent',), date=_get_msg_time())
+        yield collection.add_msg(
+            _get_raw_msg(multi=True), flags=('\\Seen',),
+            date=_get_msg_time())
+        yield assert_counts(2, 1, 1)
+
+        yield collection.update_flags(msg, ('\\Seen',), Flagsmode.APPEND)
+        yield assert_counts(2, 1, 0)
+        yield collection.update_flags(msg, ('\\Seen',), Flagsmode.REMOVE)
+        yield assert_counts(2, 1, 1)
+
+        yield collection.delete_msg(msg)
+        yield assert_counts(1, 0, 0)
+
+        other = yield self.get_collection(mbox_uuid=collection.mbox_uuid)
+        self.assertEqual(1, (yield other.count()))
+
+    def test_update_flags_by_uids(self):
+        search_indexer = SearchIndexer(self._soledad)
+        seen = ('flag', '\\Seen')
+
+        @defer.inlineCallbacks
+        def update_flags(collection):
+            yield search_indexer.create_table(collection.mbox_uuid)
+            for sample in ('rfc822.message', 'rfc822.multi.message',
+                           'rfc822.plain.message'):
+                with open(os.path.join(HERE, sample)) as f:
+                    yield collection.add_msg(
+                        f.read(), flags=('\\Answered',),
+                        date=_get_msg_time())
+
+            result = yield collection.update_flags_by_uids(
+                [1, 2, 3, 42], ('\\Seen',), Flagsmode.APPEND)
+            self.assertEqual([1, 2, 3], sorted(result))
+            self.assertEqual(['\\Answered', '\\Seen'], sorted(result[1]))
+            self.assertEqual(0, (yield collection.count_unseen()))
+            self.assertEqual([1, 2, 3], (yield collection.search(seen)))
+
+            yield collection.update_flags_by_uids(
+                [2], ('\\Seen',), Flagsmode.REMOVE)
+            yield collection.update_flags_by_uids(
+                [3], ('\\Flagged',), Flagsmode.SET)
+            self.assertEqual(2, (yield collection.count_unseen()))
+            self.assertEqual([1], (yield collection.search(seen)))
+            self.assertEqual(
+                (2, ['\\Answered']), (yield collection.get_flags_by_uid(2)))
+            self.assertEqual(
+                (3, ['\\Flagged']), (yield collection.get_flags_by_uid(3)))
+
+        d = self.get_collection(search_indexer=search_indexer)
+        d.addCallback(update_flags)
+        return d
+
     def test_update_flags(self):
         d = self.add_msg_to_collection()
         d.addCallback(self._test_update_flags_cb)
@@ -393,6 +718,56 @@ class AccountTestCase(SoledadTestMixin):
         d.addCallback(assert_uid_next_empty_collection)
         return d
 
+    def test_enable_fulltext(self):
+        acc = self.get_account('some_user_id')
+
+        @defer.inlineCallbacks
+        def enable_and_disable(_):
+            enabled = yield acc.is_fulltext_enabled()
+            self.assertFalse(enabled)
+            yield acc.enable_fulltext()
+            enabled = yield acc.is_fulltext_enabled()
+            self.assertTrue(enabled)
+
+            # new mailboxes get their full-text index too
+            wrapper = yield acc.add_mailbox('FulltextMailbox')
+            has_table = yield acc.search_indexer.has_fulltext_table(
+                wrapper.uuid)
+            self.assertTrue(has_table)
+
+            yield acc.disable_fulltext()
+            enabled = yield acc.is_fulltext_enabled()
+            self.assertFalse(enabled)
+
+        d = acc.callWhenReady(enable_and_disable)
+        return d
+
+    def test_sweep_orphaned_parts_after_sync(self):
+        acc = self.get_account('some_user_id')
+        hook = soledad_sync_hooks.post_sync_uid_reindexer
+        self.patch(soledad, 'PARTS_SWEEP_GRACE_PERIOD', 0)
+
+        @defer.inlineCallbacks
+        def get_doc_types():
+            _, docs = yield self._soledad.get_all_docs()
+            defer.returnValue(sorted(
+                doc.content['type'] for doc in docs
+                if doc.content['type'] in ('head', 'cnt')))
+
+        @defer.inlineCallbacks
+        def delete_and_sync(_):
+            collection = yield acc.get_collection_by_mailbox('INBOX')
+            yield collection.add_msg(_get_raw_msg(), date=_get_msg_time())
+            msg = yield collection.get_message_by_uid(1)
+            yield collection.delete_msg(msg)
+            self.assertEqual(['cnt', 'head'], (yield get_doc_types()))
+
+            yield hook.process_received_docs([])
+            self.assertEqual([], (yield get_doc_types()))
+
+        d = acc.callWhenReady(delete_and_sync)
+        return d
+
     def test_get_collection_by_docs(self):
         pass
 
@@ -248,3 +248,91 @@ class MailboxIndexerTestCase(SoledadTestMixin):
         d.addCallback(lambda _: m_uid.all_uid_iter(mbox_id))
         d.addCallback(partial(assert_all_uid))
         return d
+
+    def _insert_five_and_delete(self, m_uid, *uids):
+        hashes = (hash_test0, hash_test1, hash_test2, hash_test3, hash_test4)
+        d = m_uid.create_table(mbox_id)
+        for h in hashes:
+            d.addCallback(
+                lambda _, h=h: m_uid.insert_doc(mbox_id, fmt_hash(mbox_id, h)))
+        for uid in uids:
+            d.addCallback(
+                lambda _, uid=uid: m_uid.delete_doc_by_uid(mbox_id, uid))
+        return d
+
+    def test_get_doc_ids_from_uids(self):
+        m_uid = self.get_mbox_uid()
+
+        def assert_doc_ids(result):
+            self.assertEquals(result, {
+                2: fmt_hash(mbox_id, hash_test1),
+                5: fmt_hash(mbox_id, hash_test4)})
+
+        d = self._insert_five_and_delete(m_uid, 1, 4)
+        d.addCallback(
+            lambda _: m_uid.get_doc_ids_from_uids(mbox_id, [1, 2, 4, 5, 9]))
+        d.addCallback(assert_doc_ids)
+        return d
+
+    def test_delete_docs_by_hash(self):
+        m_uid = self.get_mbox_uid()
+
+        def assert_deleted(result):
+            self.assertEquals(result, [3, 5])
+
+        d = self._insert_five_and_delete(m_uid, 1)
+        d.addCallback(lambda _: m_uid.delete_docs_by_hash(mbox_id, [
+            fmt_hash(mbox_id, hash_test0), fmt_hash(mbox_id, hash_test2),
+            fmt_hash(mbox_id, hash_test4)]))
+        d.addCallback(assert_deleted)
+        d.addCallback(lambda _: m_uid.all_uid_iter(mbox_id))
+        d.addCallback(self.assertEquals, [2, 4])
+        return d
+
+    def test_get_uids_in_ranges(self):
+        m_uid = self.get_mbox_uid()
+
+        def assert_uids(result, expected):
+            self.assertEquals(result, expected)
+
+        d = self._insert_five_and_delete(m_uid, 1, 4)
+        d.addCallback(
+            lambda _: m_uid.get_uids_in_ranges(mbox_id, [(1, 3)]))
+        d.addCallback(assert_uids, [2, 3])
+        d.addCallback(
+            lambda _: m_uid.get_uids_in_ranges(mbox_id, [(1, 1), (4, None)]))
+        d.addCallback(assert_uids, [5])
+        d.addCallback(
+            lambda _: m_uid.get_uids_in_ranges(mbox_id, [(6, 10)]))
+        d.addCallback(assert_uids, [])
+        return d
+
+    def test_get_uids_from_msn_ranges(self):
+        m_uid = self.get_mbox_uid()
+
+        def assert_msn_uids(result, expected):
+            self.assertEquals(result, expected)
+
+        d = self._insert_five_and_delete(m_uid, 1, 4)
+        d.addCallback(
+            lambda _: m_uid.get_uids_from_msn_ranges(mbox_id, [(2, 3)]))
+        d.addCallback(assert_msn_uids, [(2, 3), (3, 5)])
+        d.addCallback(
+            lambda _: m_uid.get_uids_from_msn_ranges(
+                mbox_id, [(1, 1), (3, None)]))
+        d.addCallback(assert_msn_uids, [(1, 2), (3, 5)])
+        d.addCallback(lambda _: m_uid.get_uid_from_msn(mbox_id, 4))
+        d.addCallback(assert_msn_uids, None)
+        return d
+
+    def test_get_msns_from_uids(self):
+        m_uid = self.get_mbox_uid()
+
+        def assert_msns(result):
+            self.assertEquals(result, {2: 1, 5: 3})
+
+        d = self._insert_five_and_delete(m_uid, 1, 4)
+        d.addCallback(
+            lambda _: m_uid.get_msns_from_uids(mbox_id, [1, 2, 5, 7]))
+        d.addCallback(assert_msns)
+        return d
@@ -11,6 +11,8 @@ CORPUS = {
     'multimin': 'rfc822.multi-minimal.message',
     'multisigned': 'rfc822.multi-signed.message',
     'bounced': 'rfc822.bounce.message',
+    'multi': 'rfc822.multi.message',
+    'nested': 'rfc822.multi-nested.message',
 }
 
 _here = os.path.dirname(__file__)
@@ -67,6 +69,15 @@ def test_bounce_mime():
         'message/rfc822']
 
 
+def test_walk_message_in_one_pass():
+    for name in CORPUS:
+        msg = _parse(name)
+        tree, cdocs, body_phash = walk.walk_message(msg)
+        assert tree == walk.get_tree(msg)
+        assert cdocs == list(walk.get_raw_docs(msg))
+        assert body_phash == walk.get_body_phash(msg)
+
+
 # utils
 
 def _parse(name):
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer
+from twisted.internet.error import ConnectionLost
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from twisted.web.client import ResponseDone
+
+from leap.bitmask.bonafide import _http
+
+
+class BodyReceiverTest(unittest.TestCase):
+
+    def test_body_is_joined(self):
+        d = defer.Deferred()
+        receiver = _http._BodyReceiver(d)
+        for chunk in ('{"a": ', '1', '}'):
+            receiver.dataReceived(chunk)
+        receiver.connectionLost(Failure(ResponseDone()))
+        d.addCallback(self.assertEqual, '{"a": 1}')
+        return d
+
+    def test_incomplete_body_fails(self):
+        d = defer.Deferred()
+        receiver = _http._BodyReceiver(d)
+        receiver.dataReceived('{"a": ')
+        receiver.connectionLost(Failure(ConnectionLost()))
+        return self.assertFailure(d, ConnectionLost)
+
+
+class FileReceiverTest(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        # the receiver creates the folder of the file
+        self.path = os.path.join(tmpdir, 'provider', 'provider.json')
+
+    @defer.inlineCallbacks
+    def test_body_is_written(self):
+        d = defer.Deferred()
+        receiver = _http._FileReceiver(d, self.path)
+        receiver.dataReceived('first ')
+        receiver.dataReceived('second')
+        self.assertFalse(os.path.isfile(self.path))
+        receiver.connectionLost(Failure(ResponseDone()))
+        yield d
+        with open(self.path) as f:
+            self.assertEqual('first second', f.read())
+        self.assertFalse(os.path.isfile(self.path + '.part'))
+
+    @defer.inlineCallbacks
+    def test_incomplete_body_keeps_old_file(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('old')
+        d = defer.Deferred()
+        receiver = _http._FileReceiver(d, self.path)
+        receiver.dataReceived('trunc')
+        receiver.connectionLost(Failure(ConnectionLost()))
+        yield self.assertFailure(d, ConnectionLost)
+        with open(self.path) as f:
+            self.assertEqual('old', f.read())
+        self.assertFalse(os.path.isfile(self.path + '.part'))
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(_http, '_pools', {})
+
+    @defer.inlineCallbacks
+    def test_pool_is_shared_per_provider(self):
+        pool = _http.getConnectionPool('/provider/cacert.pem')
+        self.assertTrue(pool.persistent)
+        self.assertEqual(_http.MAX_PERSISTENT_PER_HOST,
+                         pool.maxPersistentPerHost)
+        self.assertEqual(_http.IDLE_TIMEOUT, pool.cachedConnectionTimeout)
+        self.assertIs(pool, _http.getConnectionPool('/provider/cacert.pem'))
+        self.assertIsNot(pool, _http.getConnectionPool('/other/cacert.pem'))
+
+        yield _http.closeConnectionPools()
+        self.assertIsNot(pool, _http.getConnectionPool('/provider/cacert.pem'))
@@ -10,7 +10,15 @@ class KeymanagerServiceTestCase(unittest.TestCase):
     def test_keymanager_service_list_call(self):
         kms = keymanagerServiceFactory()
         yield kms.do_list_keys('user')
-        assert kms._keymanager.loopback == ['get_all_keys']
+        assert kms._keymanager.loopback == ['iter_all_keys']
+
+    @defer.inlineCallbacks
+    def test_keymanager_service_list_page(self):
+        kms = keymanagerServiceFactory()
+        keys = yield kms.do_list_keys('user', offset=1, limit=2)
+        assert [key['fingerprint'] for key in keys] == ['F1', 'F2']
+        # the keys after the page are never built
+        assert kms._keymanager.built == 3
 
     @defer.inlineCallbacks
     def test_keymanager_service_export_call(self):
@@ -40,10 +48,16 @@ class _container(object):
         """
         def __init__(self):
             self.loopback = []
+            self.built = 0
+
+        def iter_all_keys(self, private=False):
+            self.loopback.append('iter_all_keys')
 
-        def get_all_keys(self, private=False):
-            self.loopback.append('get_all_keys')
-            return defer.succeed([])
+            def build_keys():
+                for i in range(5):
+                    self.built += 1
+                    yield {'fingerprint': 'F%d' % i}
+            return defer.succeed(build_keys())
 
         def get_key(self, address, private=False, fetch_remote=False):
             self.loopback.append('get_key')
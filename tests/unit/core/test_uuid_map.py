@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+
+from leap.bitmask.core import uuid_map
+from leap.bitmask.core.uuid_map import UserMap
+
+
+class UserMapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'uuids')
+
+    def get_records(self):
+        with open(self.path) as f:
+            return f.read().splitlines()[1:]
+
+    def test_lookup_uuid(self):
+        usermap = UserMap(self.path)
+        usermap.add('alice@example.org', 'uuid-alice', 'alice-pass')
+        usermap.add('bob@example.org', 'uuid-bob', 'bob-pass')
+
+        usermap = UserMap(self.path)
+        self.assertEqual(
+            'uuid-alice',
+            usermap.lookup_uuid('alice@example.org', 'alice-pass'))
+        self.assertEqual(
+            'uuid-bob', usermap.lookup_uuid('bob@example.org', 'bob-pass'))
+        self.assertEqual(
+            None, usermap.lookup_uuid('bob@example.org', 'alice-pass'))
+        self.assertEqual(
+            None, usermap.lookup_uuid('carol@example.org', 'bob-pass'))
+        self.assertEqual('uuid-bob', usermap.lookup_uuid('bob@example.org'))
+        self.assertEqual('bob@example.org', usermap.lookup_userid('uuid-bob'))
+
+    def test_only_the_matching_record_is_decrypted(self):
+        usermap = UserMap(self.path)
+        usermap.add('alice@example.org', 'uuid-alice', 'pass')
+        usermap.add('bob@example.org', 'uuid-bob', 'pass')
+
+        decrypted = []
+        decode = uuid_map._decode_uuid_line
+
+        def counting_decode(line, passwd):
+            decrypted.append(line)
+            return decode(line, passwd)
+
+        self.patch(uuid_map, '_decode_uuid_line', counting_decode)
+        usermap = UserMap(self.path)
+        self.assertEqual(
+            'uuid-bob', usermap.lookup_uuid('bob@example.org', 'pass'))
+        self.assertEqual(1, len(decrypted))
+
+    def test_add_appends(self):
+        usermap = UserMap(self.path)
+        usermap.add('alice@example.org', 'uuid-alice', 'pass')
+        first = self.get_records()
+        usermap.add('bob@example.org', 'uuid-bob', 'pass')
+        self.assertEqual(first, self.get_records()[:1])
+        self.assertEqual(2, len(self.get_records()))
+
+    def test_superseded_records_are_dropped(self):
+        usermap = UserMap(self.path)
+        for passwd in ('old', 'older', 'new'):
+            usermap.add('alice@example.org', 'uuid-alice', passwd)
+        self.assertTrue(len(self.get_records()) <= 2)
+
+        usermap = UserMap(self.path)
+        self.assertEqual(
+            'uuid-alice', usermap.lookup_uuid('alice@example.org', 'new'))
+        self.assertEqual(
+            None, usermap.lookup_uuid('alice@example.org', 'old'))
+
+    def test_migrate_old_file(self):
+        old_records = [
+            uuid_map._encode_uuid_map('alice@example.org', 'uuid-alice', 'a'),
+            uuid_map._encode_uuid_map('bob@example.org', 'uuid-bob', 'b')]
+        with open(self.path, 'w') as f:
+            f.write('\n'.join(old_records))
+
+        usermap = UserMap(self.path)
+        with open(self.path) as f:
+            self.assertTrue(f.readline().startswith('#uuids:2:'))
+        self.assertEqual(
+            'uuid-bob', usermap.lookup_uuid('bob@example.org', 'b'))
+
+        # the record is tagged once it has been decrypted
+        tags = [line.split(' ')[0] for line in self.get_records()]
+        self.assertEqual(1, tags.count('-'))
+        usermap = UserMap(self.path)
+        self.assertEqual(
+            'uuid-bob', usermap.lookup_uuid('bob@example.org', 'b'))
+        self.assertEqual(
+            'uuid-alice', usermap.lookup_uuid('alice@example.org', 'a'))
+        self.assertFalse(os.path.isfile(self.path + '.tmp'))
+
+    def test_stale_tagged_record_is_replaced(self):
+        old_record = uuid_map._encode_uuid_map(
+            'alice@example.org', 'uuid-alice', 'new')
+        with open(self.path, 'w') as f:
+            f.write(old_record + '\n')
+        usermap = UserMap(self.path)
+        # a tagged record that does not decrypt with the current password
+        usermap.add('alice@example.org', 'uuid-old', 'old')
+
+        usermap = UserMap(self.path)
+        self.assertEqual(
+            'uuid-alice', usermap.lookup_uuid('alice@example.org', 'new'))
+        self.assertEqual(1, len(self.get_records()))
+
+        decrypted = []
+        decode = uuid_map._decode_uuid_line
+
+        def counting_decode(line, passwd):
+            decrypted.append(line)
+            return decode(line, passwd)
+
+        self.patch(uuid_map, '_decode_uuid_line', counting_decode)
+        usermap = UserMap(self.path)
+        self.assertEqual(
+            'uuid-alice', usermap.lookup_uuid('alice@example.org', 'new'))
+        self.assertEqual(1, len(decrypted))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# test_cache.py
+# Copyright (C) 2018 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from mock import MagicMock
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from leap.bitmask.keymanager.cache import KeyCache
+
+
+def _key(address, fingerprint, private=False):
+    return MagicMock(address=address, fingerprint=fingerprint,
+                     private=private)
+
+
+class KeyCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = KeyCache(size=2, ttl=60, reactor=self.clock)
+
+    def put(self, address, key):
+        self.cache.put(address, key, self.cache.generation)
+
+    def test_get(self):
+        key = _key('one@test', 'F1')
+        privkey = _key('one@test', 'F1', private=True)
+        self.assertIsNone(self.cache.get('one@test'))
+        self.put('one@test', key)
+        self.put('one@test', privkey)
+        self.assertIs(key, self.cache.get('one@test'))
+        self.assertIs(privkey, self.cache.get('one@test', private=True))
+        stats = self.cache.stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+    def test_key_expires(self):
+        self.put('one@test', _key('one@test', 'F1'))
+        self.clock.advance(59)
+        self.assertIsNotNone(self.cache.get('one@test'))
+        self.clock.advance(1)
+        self.assertIsNone(self.cache.get('one@test'))
+        self.assertEqual(0, len(self.cache))
+
+    def test_least_recently_used_is_evicted(self):
+        self.put('one@test', _key('one@test', 'F1'))
+        self.put('two@test', _key('two@test', 'F2'))
+        self.cache.get('one@test')
+        self.put('three@test', _key('three@test', 'F3'))
+        self.assertIsNone(self.cache.get('two@test'))
+        self.assertIsNotNone(self.cache.get('one@test'))
+        self.assertIsNotNone(self.cache.get('three@test'))
+        self.assertEqual(1, self.cache.stats()['evictions'])
+
+    def test_invalidate(self):
+        key = _key('one@test', 'F1')
+        self.put('one@test', key)
+        self.put('alias@test', key)
+        self.put('two@test', _key('two@test', 'F2'))
+        self.cache.invalidate(key=_key('one@test', 'F1'))
+        self.assertIsNone(self.cache.get('one@test'))
+        self.assertIsNone(self.cache.get('alias@test'))
+        self.assertIsNotNone(self.cache.get('two@test'))
+
+        self.cache.invalidate(address='two@test')
+        self.assertEqual(0, len(self.cache))
+
+    def test_stale_lookup_is_not_cached(self):
+        generation = self.cache.generation
+        # the key is modified while it is being looked up
+        self.cache.invalidate(address='one@test')
+        self.cache.put('one@test', _key('one@test', 'F1'), generation)
+        self.assertIsNone(self.cache.get('one@test'))
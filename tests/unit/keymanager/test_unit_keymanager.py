@@ -1,6 +1,12 @@
+import binascii
+
+from mock import MagicMock, patch
+from twisted.internet import defer
 from twisted.trial import unittest
 
 from leap.bitmask.keymanager import KeyManager
+from leap.bitmask.keymanager.errors import DecryptError
+from leap.bitmask.keymanager.packets import get_key_ids
 
 
 class KeymanagerTestCase(unittest.TestCase):
@@ -15,6 +21,133 @@ class KeymanagerTestCase(unittest.TestCase):
         assert km.token == 'othertoken'
         assert km._nicknym.token == 'othertoken'
 
+    @patch('leap.bitmask.keymanager.emit_async')
+    @defer.inlineCallbacks
+    def test_get_key_is_cached(self, emit_async):
+        km = keymanagerFactory()
+        key = _key()
+        km._openpgp = MagicMock()
+        km._openpgp.get_key.side_effect = \
+            lambda *args, **kw: defer.succeed(key)
+
+        for address in ('bar@localhost', 'Bar <bar@localhost>'):
+            cached = yield km.get_key(address, fetch_remote=False)
+            self.assertIs(key, cached)
+        self.assertEqual(1, km._openpgp.get_key.call_count)
+        self.assertEqual(1, km.get_key_cache_stats()['hits'])
+
+        # the key storage has been modified
+        km._key_cache.invalidate(key=key)
+        yield km.get_key('bar@localhost', fetch_remote=False)
+        self.assertEqual(2, km._openpgp.get_key.call_count)
+
+    @defer.inlineCallbacks
+    def test_used_flag_writes_are_coalesced(self):
+        km = keymanagerFactory()
+        stored = defer.Deferred()
+        km._openpgp = MagicMock()
+        km._openpgp.put_key.return_value = stored
+
+        # two copies of the same key, used at the same time
+        first = km._put_used_flag(_key(), 'encr_used')
+        second = km._put_used_flag(_key(), 'encr_used')
+        self.assertEqual(1, km._openpgp.put_key.call_count)
+        stored.callback(None)
+        yield defer.gatherResults([first, second])
+
+        key = _key()
+        key.encr_used = True
+        yield km._put_used_flag(key, 'encr_used')
+        self.assertEqual(1, km._openpgp.put_key.call_count)
+
+
+class DecryptKeySelectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.get_inactive_keys = MagicMock(
+            side_effect=lambda: defer.succeed(self.inactive_keys))
+        self.patch(KeyManager, '_get_inactive_private_keys',
+                   self.get_inactive_keys)
+        emit_async = patch('leap.bitmask.keymanager.emit_async')
+        emit_async.start()
+        self.addCleanup(emit_async.stop)
+
+        self.active_key = _key('ACTIVE', private=True, modulus='\xfe')
+        self.inactive_keys = [
+            _key('OLD', private=True, modulus='\xfd'),
+            _key('OLDER', private=True, modulus='\xfc')]
+        for key in self.inactive_keys:
+            key.is_active.return_value = False
+
+        self.km = keymanagerFactory()
+        self.km._openpgp = MagicMock()
+        self.km._openpgp.get_key.side_effect = \
+            lambda *args, **kw: defer.succeed(self.active_key)
+        self.km._openpgp.decrypt.side_effect = \
+            lambda *args, **kw: defer.succeed(('data', False))
+
+    def decrypted_with(self):
+        return [args[1].fingerprint
+                for args, _ in self.km._openpgp.decrypt.call_args_list]
+
+    @defer.inlineCallbacks
+    def test_decrypt_with_active_key(self):
+        data = _encrypted_to(self.active_key)
+        decrypted, _ = yield self.km.decrypt(data, 'bar@localhost')
+        self.assertEqual('data', decrypted)
+        self.assertEqual(['ACTIVE'], self.decrypted_with())
+
+    @defer.inlineCallbacks
+    def test_decrypt_with_inactive_key(self):
+        data = _encrypted_to(self.inactive_keys[1])
+        yield self.km.decrypt(data, 'bar@localhost')
+        yield self.km.decrypt(data, 'bar@localhost')
+        self.assertEqual(['OLDER', 'OLDER'], self.decrypted_with())
+        # the index of inactive keys is reused
+        self.assertEqual(1, self.get_inactive_keys.call_count)
+
+    @defer.inlineCallbacks
+    def test_decrypt_fails_fast_without_matching_key(self):
+        data = _encrypted_to(_key('OTHER', modulus='\xfb'))
+        with self.assertRaises(DecryptError):
+            yield self.km.decrypt(data, 'bar@localhost')
+        self.assertEqual([], self.decrypted_with())
+
+    @defer.inlineCallbacks
+    def test_decrypt_without_recipients_tries_all_keys(self):
+        # only an encrypted data packet, with no session key packets
+        data = chr(0xc0 | 18) + chr(0xe0 | 4) + '\x01' * 16
+
+        def decrypt(data, key, **kw):
+            if key.fingerprint != 'OLD':
+                return defer.fail(DecryptError())
+            return defer.succeed(('data', False))
+
+        self.km._openpgp.decrypt.side_effect = decrypt
+        decrypted, _ = yield self.km.decrypt(data, 'bar@localhost')
+        self.assertEqual('data', decrypted)
+        self.assertEqual(['ACTIVE', 'OLDER', 'OLD'], self.decrypted_with())
+
+
+def _key(fingerprint='F00', private=False, modulus='\xff'):
+    # a version 4 RSA key packet, with a 8 bits modulus and exponent
+    body = '\x04\x00\x00\x00\x00\x01\x00\x08' + modulus + '\x00\x08\x03'
+    key = MagicMock(address='bar@localhost', fingerprint=fingerprint,
+                    private=private, encr_used=False, sign_used=False,
+                    key_data=chr(0xc0 | 6) + chr(len(body)) + body)
+    key.is_expired.return_value = False
+    key.needs_renewal.return_value = False
+    key.is_active.return_value = True
+    return key
+
+
+def _encrypted_to(key):
+    key_id, = get_key_ids(key.key_data)
+    # a session key packet followed by an encrypted data packet
+    body = '\x03' + binascii.unhexlify(key_id) + '\x01\x00\x08\xff'
+    return (chr(0xc0 | 1) + chr(len(body)) + body +
+            chr(0xc0 | 18) + chr(0xe0 | 4) + '\x01' * 16)
+
 
 def keymanagerFactory():
 
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# test_locks.py
+# Copyright (C) 2018 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from leap.bitmask.mail.adaptors.locks import KeyedLocks
+
+
+class KeyedLocksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.locks = KeyedLocks()
+        self.running = []
+        self.pending = {}
+
+    def run_blocked(self, keys, name):
+        def block():
+            self.running.append(name)
+            d = self.pending[name] = defer.Deferred()
+            return d
+        return self.locks.run(keys, block)
+
+    def test_independent_keys_do_not_wait(self):
+        self.run_blocked([('store1', 'INBOX')], 'first')
+        self.run_blocked([('store2', 'INBOX')], 'second')
+        self.run_blocked([('store1', 'Sent')], 'third')
+        self.assertEqual(['first', 'second', 'third'], self.running)
+        self.assertEqual(0, self.locks.get_stats()['contended'])
+
+    def test_same_key_waits(self):
+        first = self.run_blocked([('store', 'INBOX')], 'first')
+        self.run_blocked([('store', 'INBOX')], 'second')
+        self.assertEqual(['first'], self.running)
+        stats = self.locks.get_stats()
+        self.assertEqual(1, stats['held'])
+        self.assertEqual(1, stats['waiting'])
+        self.assertEqual(1, stats['contended'])
+        self.assertEqual(1, stats['max_queue'])
+
+        self.pending['first'].callback('result')
+        self.assertEqual('result', self.successResultOf(first))
+        self.assertEqual(['first', 'second'], self.running)
+
+        self.pending['second'].callback(None)
+        stats = self.locks.get_stats()
+        self.assertEqual(0, stats['held'])
+        self.assertEqual(2, stats['acquired'])
+
+    def test_several_keys(self):
+        self.run_blocked([('store', 'INBOX')], 'first')
+        self.run_blocked([('store', 'Trash'), ('store', 'INBOX')], 'rename')
+        # the locks are taken in order, so rename holds none while it
+        # waits for the first one
+        self.run_blocked([('store', 'Trash')], 'third')
+        self.assertEqual(['first', 'third'], self.running)
+
+        self.pending['first'].callback(None)
+        self.assertEqual(['first', 'third'], self.running)
+        self.pending['third'].callback(None)
+        self.assertEqual(['first', 'third', 'rename'], self.running)
+        self.run_blocked([('store', 'Trash')], 'fourth')
+        self.assertEqual(['first', 'third', 'rename'], self.running)
+
+    def test_failure_releases_the_locks(self):
+        d = self.locks.run(['key'], lambda: 1 / 0)
+        self.failureResultOf(d, ZeroDivisionError)
+        self.assertEqual(0, self.locks.get_stats()['held'])
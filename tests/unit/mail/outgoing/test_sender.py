@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# test_sender.py
+# Copyright (C) 2018 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import error
+from twisted.internet.interfaces import ISSLTransport
+from twisted.mail import smtp
+from twisted.python.failure import Failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from zope.interface import directlyProvides
+
+from leap.bitmask.mail.outgoing.sender import SMTPRelayPool
+
+
+class FakeRelay(object):
+    """
+    Play the server side of an SMTP session over a string transport.
+    """
+
+    def __init__(self, reactor):
+        host, port, factory = reactor.sslClients.pop(0)[:3]
+        self.client = factory.buildProtocol((host, port))
+        self.client.callLater = reactor.callLater
+        self.transport = proto_helpers.StringTransport()
+        directlyProvides(self.transport, ISSLTransport)
+        self.client.makeConnection(self.transport)
+
+    def reply(self, line):
+        self.transport.clear()
+        self.client.dataReceived(line + '\r\n')
+        # the message data is written by a non-streaming producer
+        while self.transport.producer is not None:
+            self.transport.producer.resumeProducing()
+        return self.transport.value()
+
+    def greet(self):
+        self.reply('220 relay ESMTP')
+        return self.reply('250 relay')
+
+    def accept(self):
+        """
+        Accept the message that the client has started to send.
+        """
+        self.reply('250 sender ok')
+        self.reply('250 recipient ok')
+        data = self.reply('354 go ahead')
+        return data, self.reply('250 queued')
+
+    def lose(self):
+        self.client.connectionLost(Failure(error.ConnectionDone()))
+
+
+class SMTPRelayPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = proto_helpers.MemoryReactorClock()
+        self.pool = SMTPRelayPool('relay.test', 465, None,
+                                  max_connections=1, reactor=self.reactor)
+
+    def send(self, to_address, message):
+        results = []
+        d = self.pool.send('me@test', to_address, message)
+        d.addBoth(results.append)
+        return results
+
+    def test_messages_share_connection(self):
+        first = self.send('one@test', 'first message')
+        second = self.send('two@test', 'second message')
+        self.assertEqual(1, len(self.reactor.sslClients))
+
+        relay = FakeRelay(self.reactor)
+        self.assertEqual('MAIL FROM:<me@test>\r\n', relay.greet())
+        data, reset = relay.accept()
+        self.assertIn('first message', data)
+        self.assertEqual('RSET\r\n', reset)
+        self.assertEqual(1, first[0][0])
+        self.assertEqual(
+            'MAIL FROM:<me@test>\r\n', relay.reply('250 reset'))
+        data, reset = relay.accept()
+        self.assertIn('second message', data)
+        self.assertEqual(1, second[0][0])
+
+        # the connection waits for more messages
+        self.assertEqual('', relay.reply('250 reset'))
+        third = self.send('three@test', 'third message')
+        self.assertEqual('MAIL FROM:<me@test>\r\n', relay.transport.value())
+        relay.accept()
+        self.assertEqual(1, third[0][0])
+        self.assertEqual(0, len(self.reactor.sslClients))
+
+        stats = self.pool.get_stats()
+        self.assertEqual(1, stats['opened'])
+        self.assertEqual(3, stats['sent'])
+        self.assertEqual(1, stats['connections'])
+
+    def test_idle_connection_is_closed(self):
+        self.send('one@test', 'first message')
+        relay = FakeRelay(self.reactor)
+        relay.greet()
+        relay.accept()
+        relay.reply('250 reset')
+        self.assertEqual(1, self.pool.get_stats()['idle'])
+
+        relay.transport.clear()
+        self.reactor.advance(self.pool.idle_timeout)
+        self.assertEqual('QUIT\r\n', relay.transport.value())
+        self.assertEqual(0, self.pool.get_stats()['idle'])
+        relay.reply('221 bye')
+        self.assertTrue(relay.transport.disconnecting)
+
+    def test_lost_message_is_retried(self):
+        self.send('one@test', 'first message')
+        relay = FakeRelay(self.reactor)
+        relay.greet()
+        relay.accept()
+        relay.reply('250 reset')
+
+        # the relay has dropped the idle connection without telling
+        second = self.send('two@test', 'second message')
+        relay.lose()
+        self.assertEqual([], second)
+        self.assertEqual(1, len(self.reactor.sslClients))
+
+        relay = FakeRelay(self.reactor)
+        relay.greet()
+        data, _ = relay.accept()
+        self.assertIn('second message', data)
+        self.assertEqual(1, second[0][0])
+        self.assertEqual(1, self.pool.get_stats()['retried'])
+
+    def test_accepted_message_is_not_retried(self):
+        first = self.send('one@test', 'first message')
+        relay = FakeRelay(self.reactor)
+        relay.greet()
+        relay.reply('250 sender ok')
+        relay.reply('250 recipient ok')
+        relay.reply('354 go ahead')
+        # lost while waiting for the reply to the message data
+        relay.lose()
+        self.assertIsInstance(first[0], Failure)
+        self.assertEqual(0, len(self.reactor.sslClients))
+
+    def test_rejected_recipient(self):
+        first = self.send('one@test', 'first message')
+        relay = FakeRelay(self.reactor)
+        relay.greet()
+        relay.reply('250 sender ok')
+        self.assertEqual('RSET\r\n', relay.reply('550 no such user'))
+        first[0].trap(smtp.SMTPDeliveryError)
+        self.assertEqual(1, self.pool.get_stats()['failed'])
+
+    def test_unreachable_relay(self):
+        first = self.send('one@test', 'first message')
+        for _ in range(self.pool._retries + 1):
+            factory = self.reactor.sslClients.pop(0)[2]
+            factory.clientConnectionFailed(
+                None, Failure(error.ConnectionRefusedError()))
+        self.assertEqual(0, len(self.reactor.sslClients))
+        first[0].trap(error.ConnectionRefusedError)
+        self.assertEqual(0, self.pool.get_stats()['connecting'])
+
+    def test_close(self):
+        self.send('one@test', 'first message')
+        relay = FakeRelay(self.reactor)
+        relay.greet()
+        relay.accept()
+        relay.reply('250 reset')
+
+        relay.transport.clear()
+        self.pool.close()
+        self.assertEqual('QUIT\r\n', relay.transport.value())
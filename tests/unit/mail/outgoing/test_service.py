@@ -16,10 +16,14 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
+from StringIO import StringIO
 
-from mock import MagicMock
+from mock import MagicMock, patch
+from twisted.internet.defer import fail, succeed
+from twisted.mail import smtp
 from twisted.python.failure import Failure
 
+from leap.bitmask.keymanager.errors import KeyNotFound
 from leap.bitmask.mail.outgoing.service import OutgoingMail
 
 
@@ -53,3 +57,105 @@ class TestService(unittest.TestCase):
         origmsg = 'message'
         with self.assertRaises(Exception):
             outgoing_mail.sendError(failure, origmsg)
+
+    @patch('leap.bitmask.mail.outgoing.service.emit_async')
+    def test_message_is_signed_once_for_all_recipients(self, emit_async):
+        key = MagicMock(key_data='KEY DATA', fingerprint='F00')
+        self.keymanager.get_key.side_effect = \
+            lambda *args, **kw: succeed(key)
+        self.keymanager.encrypt.side_effect = \
+            lambda *args, **kw: fail(KeyNotFound())
+        self.keymanager.sign.side_effect = \
+            lambda *args, **kw: succeed('SIGNATURE')
+        sent = []
+        sender = MagicMock()
+        sender.can_send.return_value = True
+        sender.send.side_effect = lambda recipient, msg: succeed(
+            sent.append((recipient.dest.addrstr, msg)))
+        outgoing_mail = OutgoingMail(self.from_address, self.keymanager)
+        outgoing_mail.add_sender(sender)
+
+        raw = ('From: %s\r\nSubject: hello\r\n\r\nsome text\r\n'
+               % self.from_address)
+        recipients = [smtp.User(address, None, None, self.from_address)
+                      for address in ('one@test', 'two@test', 'three@test')]
+        outgoing_mail.send_message_to_recipients(StringIO(raw), recipients)
+
+        self.assertEqual(3, self.keymanager.encrypt.call_count)
+        plaintexts = set(args[0] for args, _
+                         in self.keymanager.encrypt.call_args_list)
+        self.assertEqual(1, len(plaintexts))
+        self.assertEqual(1, self.keymanager.sign.call_count)
+        self.assertEqual(['one@test', 'two@test', 'three@test'],
+                         [address for address, _ in sent])
+        messages = set(msg for _, msg in sent)
+        self.assertEqual(1, len(messages))
+        self.assertIn('SIGNATURE', messages.pop())
+
+    @patch('leap.bitmask.mail.outgoing.service.emit_async')
+    def test_message_is_encrypted_once_for_disclosed_recipients(
+            self, emit_async):
+        key = MagicMock(key_data='KEY DATA', fingerprint='F00')
+        self.keymanager.get_key.side_effect = \
+            lambda *args, **kw: succeed(key)
+        self.keymanager.encrypt_to_addresses.side_effect = \
+            lambda *args, **kw: succeed('SHARED CIPHERTEXT')
+        self.keymanager.encrypt.side_effect = \
+            lambda *args, **kw: succeed('CIPHERTEXT')
+        sent = []
+        sender = MagicMock()
+        sender.can_send.return_value = True
+        sender.send.side_effect = lambda recipient, msg: succeed(
+            sent.append((recipient.dest.addrstr, msg)))
+        outgoing_mail = OutgoingMail(self.from_address, self.keymanager,
+                                     encrypt_once=True)
+        outgoing_mail.add_sender(sender)
+
+        raw = ('From: %s\r\nTo: one@test\r\nCc: Two <two@test>\r\n'
+               'Subject: hello\r\n\r\nsome text\r\n' % self.from_address)
+        recipients = [smtp.User(address, None, None, self.from_address)
+                      for address in ('one@test', 'two@test', 'bcc@test')]
+        outgoing_mail.send_message_to_recipients(StringIO(raw), recipients)
+
+        self.assertEqual(1, self.keymanager.encrypt_to_addresses.call_count)
+        args, _ = self.keymanager.encrypt_to_addresses.call_args
+        self.assertEqual(['one@test', 'two@test'], args[1])
+        # the blind copy is not disclosed to the other recipients
+        self.assertEqual(1, self.keymanager.encrypt.call_count)
+        args, _ = self.keymanager.encrypt.call_args
+        self.assertEqual('bcc@test', args[1])
+        sent = dict(sent)
+        self.assertIn('SHARED CIPHERTEXT', sent['one@test'])
+        self.assertEqual(sent['one@test'], sent['two@test'])
+        self.assertIn('CIPHERTEXT', sent['bcc@test'])
+        self.assertNotIn('SHARED', sent['bcc@test'])
+
+    @patch('leap.bitmask.mail.outgoing.service.emit_async')
+    def test_encrypt_once_falls_back_to_each_recipient(self, emit_async):
+        key = MagicMock(key_data='KEY DATA', fingerprint='F00')
+        self.keymanager.get_key.side_effect = \
+            lambda *args, **kw: succeed(key)
+        self.keymanager.encrypt_to_addresses.side_effect = \
+            lambda *args, **kw: fail(KeyNotFound())
+        self.keymanager.encrypt.side_effect = \
+            lambda data, address, **kw: succeed('CIPHERTEXT ' + address)
+        sent = []
+        sender = MagicMock()
+        sender.can_send.return_value = True
+        sender.send.side_effect = lambda recipient, msg: succeed(
+            sent.append((recipient.dest.addrstr, msg)))
+        outgoing_mail = OutgoingMail(self.from_address, self.keymanager,
+                                     encrypt_once=True)
+        outgoing_mail.add_sender(sender)
+
+        raw = ('From: %s\r\nTo: one@test, two@test\r\n'
+               'Subject: hello\r\n\r\nsome text\r\n' % self.from_address)
+        recipients = [smtp.User(address, None, None, self.from_address)
+                      for address in ('one@test', 'two@test')]
+        outgoing_mail.send_message_to_recipients(StringIO(raw), recipients)
+
+        self.assertEqual(1, self.keymanager.encrypt_to_addresses.call_count)
+        self.assertEqual(2, self.keymanager.encrypt.call_count)
+        sent = dict(sent)
+        self.assertIn('CIPHERTEXT one@test', sent['one@test'])
+        self.assertIn('CIPHERTEXT two@test', sent['two@test'])
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# test_spool.py
+# Copyright (C) 2018 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from mock import MagicMock, patch
+from twisted.internet.defer import succeed
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from leap.bitmask.mail.smtp import gateway
+from leap.bitmask.mail.testing.smtp import getSMTPFactory, TEST_USER
+
+
+class MessageSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.outgoing = MagicMock()
+        self.outgoing.can_encrypt_for.return_value = succeed(True)
+        self.outgoing.send_message_to_recipients.side_effect = self._send
+        self.patch(gateway, 'emit_async', MagicMock())
+
+        self.proto = getSMTPFactory({TEST_USER: self.outgoing},
+                                    {TEST_USER: None})
+        self.transport = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.transport)
+        self.addCleanup(self.proto.setTimeout, None)
+        self.proto.lineReceived('HELO gateway.leap.se')
+
+    def _send(self, msg_file, recipients):
+        self.sent.append((msg_file.read(),
+                          [str(user.dest) for user in recipients]))
+        return [succeed(None) for _ in recipients]
+
+    def send(self, recipients, body):
+        self.proto.lineReceived('MAIL FROM: <%s>' % TEST_USER)
+        for recipient in recipients:
+            self.proto.lineReceived('RCPT TO: <%s>' % recipient)
+        self.transport.clear()
+        for line in ['DATA', 'Subject: test', '', body, '.']:
+            self.proto.lineReceived(line)
+        return self.transport.value()
+
+    def test_data_is_spooled_once(self):
+        recipients = ['one@test', 'two@test', 'three@test']
+        reply = self.send(recipients, 'the body')
+        self.assertTrue(reply.endswith('250 Delivery in progress\r\n'))
+
+        self.assertEqual(1, len(self.sent))
+        data, sent_to = self.sent[0]
+        self.assertEqual(recipients, sent_to)
+        self.assertEqual(1, data.count('the body'))
+        self.assertEqual(1, data.count('Received: '))
+        self.assertTrue(data.endswith('Subject: test\r\n\r\nthe body\r\n'))
+
+    def test_new_spool_for_each_message(self):
+        self.send(['one@test'], 'first body')
+        self.send(['two@test'], 'second body')
+        self.assertEqual(2, len(self.sent))
+        self.assertNotIn('first body', self.sent[1][0])
+        self.assertEqual(['two@test'], self.sent[1][1])
+
+    @patch('leap.bitmask.mail.smtp.gateway.SPOOL_MAX_MEMORY', 10)
+    def test_big_message_is_spooled_to_disk(self):
+        spool = gateway.MessageSpool(self.outgoing)
+        message = object()
+        spool.add_recipient(message, None)
+        spool.lineReceived(message, 'more than ten bytes')
+        self.assertTrue(spool._file._rolled)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# test_firewall.py
+# Copyright (C) 2018 LEAP Encryption Access Project
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the Linux firewall manager.
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from leap.bitmask.vpn.fw import firewall
+
+
+# a bitmask-root that logs its calls, and keeps the firewall state in a file
+FAKE_BITMASK_ROOT = """#!/bin/sh
+echo "$@" >> "%(log)s"
+case "$2" in
+    start) touch "%(state)s" ;;
+    stop) rm -f "%(state)s" ;;
+    isup) test -f "%(state)s" || exit 1 ;;
+esac
+"""
+
+
+class LinuxFirewallManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.log = os.path.join(tmpdir, 'calls')
+        state = os.path.join(tmpdir, 'up')
+        script = os.path.join(tmpdir, 'bitmask-root')
+        with open(script, 'w') as f:
+            f.write(FAKE_BITMASK_ROOT % {'log': self.log, 'state': state})
+        os.chmod(script, stat.S_IRWXU)
+
+        self.patch(firewall, 'NOT_ROOT', False)
+        self.events = []
+        self.patch(firewall, 'emit_async',
+                   lambda *args: self.events.append(args[1]))
+        self.manager = firewall._LinuxFirewallManager(
+            [('1.2.3.4', '443'), ('5.6.7.8', '443')])
+        self.manager.BITMASK_ROOT = script
+
+    def get_calls(self):
+        if not os.path.isfile(self.log):
+            return []
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    @defer.inlineCallbacks
+    def test_start_and_stop(self):
+        status = yield self.manager.get_status()
+        self.assertEqual({'status': 'off', 'error': None}, status)
+
+        started = yield self.manager.start()
+        self.assertTrue(started)
+        up = yield self.manager.is_up()
+        self.assertTrue(up)
+
+        stopped = yield self.manager.stop()
+        self.assertTrue(stopped)
+        up = yield self.manager.is_up()
+        self.assertFalse(up)
+
+        self.assertEqual(
+            ['firewall isup',
+             'firewall start 1.2.3.4 5.6.7.8',
+             'firewall isup',
+             'firewall stop',
+             'firewall isup'],
+            self.get_calls())
+        self.assertEqual(['FW_ON', 'FW_OFF'], self.events)
+
+    @defer.inlineCallbacks
+    def test_state_is_cached(self):
+        yield self.manager.start()
+        for _ in range(3):
+            up = yield self.manager.is_up()
+            self.assertTrue(up)
+            status = yield self.manager.get_status()
+            self.assertEqual('on', status['status'])
+        self.assertEqual(1, self.get_calls().count('firewall isup'))
+
+    @defer.inlineCallbacks
+    def test_stale_state_is_not_cached(self):
+        yield self.manager.start()
+        # the firewall is stopped while its state is being checked
+        checking = self.manager.is_up()
+        yield self.manager.stop()
+        yield checking
+        up = yield self.manager.is_up()
+        self.assertFalse(up)
+
+    def test_start_without_bitmask_root(self):
+        self.manager.BITMASK_ROOT = '/nonexistent/bitmask-root'
+        d = self.manager.start()
+        return self.assertFailure(d, firewall.FirewallError)
@@ -443,11 +443,21 @@ var bitmask = function(){
              * @param {string} uid The uid of the keyring.
              * @param {boolean} priv Should list private keys?
              *                       If it's not provided the public ones will be listed.
+             * @param {number} offset Number of keys to skip, for paging.
+             * @param {number} limit Maximum number of keys to list.
+             *                       If it's not provided all the keys will be listed.
              *
              * @return {Promise<[KeyObject]>} List of keys in the keyring
              */
-            list: function(uid, priv) {
-                return call(['keys', 'list', uid, private_str(priv)]);
+            list: function(uid, priv, offset, limit) {
+                var args = ['keys', 'list', uid, private_str(priv)];
+                if (typeof offset !== 'undefined' || typeof limit !== 'undefined') {
+                    args.push(String(offset || 0));
+                }
+                if (typeof limit !== 'undefined') {
+                    args.push(String(limit));
+                }
+                return call(args);
             },
 
             /**